@@ -3,8 +3,13 @@
 Provides :class:`CachedDataset2`.
 """
 
+from __future__ import print_function
+
 from Dataset import Dataset, DatasetSeq
-from threading import Condition
+from threading import Condition, Thread
+from collections import deque
+import sys
+import time
 import typing
 try:
   # noinspection PyCompatibility
@@ -26,9 +31,21 @@ class CachedDataset2(Dataset):
   - handle seq ordering by overriding `init_seq_order`
   - you can set `_estimated_num_seqs`
   - you can set `_num_seqs` or `_num_timesteps` if you know them in advance
+
+  With the `read_ahead` option, `_collect_single_seq` is called in a background thread (see :class:`SeqReadAhead`),
+  which collects the next seqs of the current seq order while the seqs before are being used.
+  `_collect_single_seq` is then only called from that thread (and always with increasing seq_idx),
+  but other methods (e.g. `get_tag`) can be called concurrently from the main thread.
+  The thread is stopped in `finish_epoch` and at the beginning of our `init_seq_order`,
+  i.e. subclasses should call our `init_seq_order` before they change the state used by `_collect_single_seq`.
   """
 
-  def __init__(self, **kwargs):
+  def __init__(self, read_ahead=None, **kwargs):
+    """
+    :param int|dict[str,int]|None read_ahead: if set, collect seqs in a background thread.
+      int: max number of seqs to read ahead. or dict with the kwargs of :class:`SeqReadAhead`,
+      e.g. {"num_seqs": 100, "max_bytes": 2 ** 30}
+    """
     super(CachedDataset2, self).__init__(**kwargs)
     self._num_timesteps = None
     self.epoch = None
@@ -36,6 +53,52 @@ class CachedDataset2(Dataset):
     self.added_data = []  # type: typing.List[DatasetSeq]
     self.expected_load_seq_start = 0
     self._num_timesteps_accumulated = 0
+    self._read_ahead = None  # type: typing.Optional[SeqReadAhead]
+    if read_ahead:
+      if isinstance(read_ahead, int):
+        read_ahead = {"num_seqs": read_ahead}
+      assert isinstance(read_ahead, dict)
+      self._read_ahead = SeqReadAhead(
+        collect_func=self._read_ahead_collect_single_seq, name="%s read ahead" % self.name, **read_ahead)
+
+  def _stop_read_ahead(self):
+    """
+    Stops the background thread (if running), and prints the stats.
+    """
+    if not self._read_ahead:
+      return
+    from Log import log
+    if self._read_ahead.num_gets:
+      print("%s: %s" % (self._read_ahead.name, self._read_ahead.get_stats_str()), file=log.v4)
+    self._read_ahead.stop()
+
+  def _read_ahead_collect_single_seq(self, seq_idx):
+    """
+    Called from the read-ahead thread.
+
+    :param int seq_idx:
+    :rtype: DatasetSeq|None
+    """
+    if self._num_seqs is not None and seq_idx >= self._num_seqs:
+      return None
+    return self._collect_single_seq(seq_idx)
+
+  def get_read_ahead_stats(self):
+    """
+    :return: stats of the read-ahead of the current epoch (reset by init_seq_order/finish_epoch), or None if not used.
+      See :func:`SeqReadAhead.get_stats`.
+    :rtype: dict[str,int|float]|None
+    """
+    if not self._read_ahead:
+      return None
+    return self._read_ahead.get_stats()
+
+  def finish_epoch(self):
+    """
+    This would get called at the end of the epoch.
+    """
+    self._stop_read_ahead()
+    super(CachedDataset2, self).finish_epoch()
 
   def init_seq_order(self, epoch=None, seq_list=None):
     """
@@ -47,6 +110,9 @@ class CachedDataset2(Dataset):
     This is called when we start a new epoch, or at initialization.
     Call this when you reset the seq list.
     """
+    # Subclasses call this before they change their state for the new epoch.
+    # Usually, the thread was already stopped in finish_epoch().
+    self._stop_read_ahead()
     super(CachedDataset2, self).init_seq_order(epoch=epoch, seq_list=seq_list)
     if not epoch:
       epoch = 1
@@ -114,7 +180,10 @@ class CachedDataset2(Dataset):
       self.expected_load_seq_start = start
     if self.added_data:
       start = max(self.added_data[-1].seq_idx + 1, start)
-    seqs = [self._collect_single_seq(seq_idx=seq_idx) for seq_idx in range(start, end)]
+    if self._read_ahead:
+      seqs = [self._read_ahead.get(seq_idx=seq_idx) for seq_idx in range(start, end)]
+    else:
+      seqs = [self._collect_single_seq(seq_idx=seq_idx) for seq_idx in range(start, end)]
     seqs = list(filter(None, seqs))  # We might not know the num seqs in advance.
     self._num_timesteps_accumulated += sum([seq.num_frames for seq in seqs])
     self.added_data += seqs
@@ -268,6 +337,188 @@ class CachedDataset2(Dataset):
     return str(self.added_data[0].get_data(key).dtype)
 
 
+class SeqReadAhead(object):
+  """
+  Collects seqs in a background thread, in increasing seq_idx order,
+  such that :func:`get` usually does not need to wait.
+  Used by :class:`CachedDataset2` with the `read_ahead` option.
+  """
+
+  def __init__(self, collect_func, num_seqs=10, max_bytes=None, name="read ahead"):
+    """
+    :param (int)->(DatasetSeq|None) collect_func: returns None if seq_idx >= num_seqs
+    :param int num_seqs: max number of collected seqs we keep in the buffer
+    :param int|None max_bytes: max size of the data of the seqs in the buffer.
+      we always allow at least one seq in the buffer
+    :param str name:
+    """
+    assert num_seqs >= 1
+    self.collect_func = collect_func
+    self.num_seqs = num_seqs
+    self.max_bytes = max_bytes
+    self.name = name
+    self._cond = Condition()
+    self._thread = None  # type: typing.Optional[Thread]
+    self._stop = False
+    self._buffer = deque()  # type: typing.Deque[typing.Tuple[int,typing.Optional[DatasetSeq]]]
+    self._buffer_bytes = 0
+    self._next_collect_seq_idx = 0  # next seq which the thread will collect
+    self._next_get_seq_idx = None  # type: typing.Optional[int]  # next seq we expect to be requested
+    self._end_seq_idx = None  # type: typing.Optional[int]  # first seq_idx where collect_func returned None
+    self._exc_info = None
+    self.num_gets = 0
+    self.num_hits = 0
+    self.stall_time = 0.0
+    self.max_buffer_bytes = 0
+
+  def __repr__(self):
+    return "<%s %r num_seqs=%i max_bytes=%r>" % (self.__class__.__name__, self.name, self.num_seqs, self.max_bytes)
+
+  @staticmethod
+  def _get_seq_num_bytes(seq):
+    """
+    :param DatasetSeq|None seq:
+    :rtype: int
+    """
+    if seq is None:
+      return 0
+    return sum([v.nbytes for v in seq.features.values()])
+
+  def _is_buffer_full(self):
+    """
+    :rtype: bool
+    """
+    if not self._buffer:
+      return False
+    if len(self._buffer) >= self.num_seqs:
+      return True
+    if self.max_bytes is not None and self._buffer_bytes >= self.max_bytes:
+      return True
+    return False
+
+  def _thread_main(self):
+    while True:
+      with self._cond:
+        while not self._stop and (self._end_seq_idx is not None or self._is_buffer_full()):
+          self._cond.wait()
+        if self._stop:
+          return
+        seq_idx = self._next_collect_seq_idx
+      # noinspection PyBroadException
+      try:
+        seq = self.collect_func(seq_idx)
+      except Exception:
+        with self._cond:
+          self._exc_info = sys.exc_info()
+          self._cond.notify_all()
+        return
+      with self._cond:
+        if self._stop:
+          return
+        self._buffer.append((seq_idx, seq))
+        self._buffer_bytes += self._get_seq_num_bytes(seq)
+        self.max_buffer_bytes = max(self.max_buffer_bytes, self._buffer_bytes)
+        self._next_collect_seq_idx = seq_idx + 1
+        if seq is None:
+          self._end_seq_idx = seq_idx
+        self._cond.notify_all()
+
+  def start(self, seq_idx):
+    """
+    (Re)starts the background thread, to collect seqs starting at seq_idx.
+
+    :param int seq_idx:
+    """
+    self.stop(reset_stats=False)
+    self._stop = False
+    self._next_collect_seq_idx = seq_idx
+    self._next_get_seq_idx = seq_idx
+    self._thread = Thread(target=self._thread_main, name=self.name)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self, reset_stats=True):
+    """
+    Stops the background thread (waits until the current collect_func call returns), and clears the buffer.
+
+    :param bool reset_stats:
+    """
+    with self._cond:
+      self._stop = True
+      self._cond.notify_all()
+    if self._thread:
+      self._thread.join()
+      self._thread = None
+    self._buffer.clear()
+    self._buffer_bytes = 0
+    self._next_get_seq_idx = None
+    self._end_seq_idx = None
+    self._exc_info = None
+    if reset_stats:
+      self.num_gets = 0
+      self.num_hits = 0
+      self.stall_time = 0.0
+      self.max_buffer_bytes = 0
+
+  def get(self, seq_idx):
+    """
+    Usually, seq_idx is the seq following the one from the last call.
+    Otherwise, we restart the background thread at seq_idx.
+
+    :param int seq_idx:
+    :return: the seq, or None if seq_idx >= num_seqs
+    :rtype: DatasetSeq|None
+    """
+    with self._cond:
+      if self._end_seq_idx is not None and seq_idx >= self._end_seq_idx:
+        return None
+      need_restart = self._next_get_seq_idx != seq_idx
+    if need_restart:  # not within the lock, as this waits for the thread
+      self.start(seq_idx)
+    self.num_gets += 1
+    with self._cond:
+      if self._buffer:
+        self.num_hits += 1
+      else:
+        start_time = time.time()
+        while not self._buffer and not self._exc_info:
+          self._cond.wait()
+        self.stall_time += time.time() - start_time
+      if not self._buffer:
+        exc_info = self._exc_info
+        self._exc_info = None
+        self._next_get_seq_idx = None  # restart next time
+        if sys.version_info[0] >= 3:
+          raise exc_info[1].with_traceback(exc_info[2])
+        raise exc_info[1]
+      buffer_seq_idx, seq = self._buffer.popleft()
+      assert buffer_seq_idx == seq_idx
+      self._buffer_bytes -= self._get_seq_num_bytes(seq)
+      self._next_get_seq_idx = seq_idx + 1
+      self._cond.notify_all()
+    return seq
+
+  def get_stats(self):
+    """
+    :return: num_gets, num_hits (seq was already collected), hit_rate, stall_time (secs), max_buffer_bytes
+    :rtype: dict[str,int|float]
+    """
+    return {
+      "num_gets": self.num_gets, "num_hits": self.num_hits,
+      "hit_rate": float(self.num_hits) / self.num_gets if self.num_gets else 0.0,
+      "stall_time": self.stall_time, "max_buffer_bytes": self.max_buffer_bytes}
+
+  def get_stats_str(self):
+    """
+    :rtype: str
+    """
+    from Util import hms_fraction, human_bytes_size
+    stats = self.get_stats()
+    return "%i seqs, hit rate %.1f%%, stall time %s, max buffered %s" % (
+      stats["num_gets"], stats["hit_rate"] * 100., hms_fraction(stats["stall_time"]),
+      human_bytes_size(stats["max_buffer_bytes"]))
+
+
 class SingleStreamPipeDataset(CachedDataset2):
   """
   Producer: Gets data from somewhere / an external source, running in some thread.
@@ -23,7 +23,7 @@ import functools
 import typing
 
 from Log import log
-from EngineBatch import Batch, BatchSetGenerator
+from EngineBatch import Batch, BatchSetGenerator, numbers_dict_from_lanes
 from Util import PY3, try_run, NumbersDict, unicode, OptionalNotImplementedError
 
 
@@ -544,6 +544,17 @@ class Dataset(object):
     """
     raise OptionalNotImplementedError
 
+  def get_all_seq_lengths(self):
+    """
+    :return: data-key -> seq lengths (int array of shape (num_seqs,)) for all seqs of the current epoch,
+      in the current seq order (sorted seq idx), after self.init_seq_order was called.
+      The keys are the same as in :func:`get_seq_length`.
+      This allows to work on the seq lengths in bulk, e.g. in :func:`_generate_batches`.
+      Not all datasets implement this.
+    :rtype: dict[str,numpy.ndarray]
+    """
+    raise OptionalNotImplementedError
+
   def _base_init(self):
     self.nbytes = 0
     self.zpad = None
@@ -1017,7 +1028,7 @@ class Dataset(object):
                         max_pad_size=None,
                         min_seq_length=0, pruning=0.0,
                         seq_drop=0.0, max_total_num_seqs=-1,
-                        used_data_keys=None):
+                        used_data_keys=None, sort_window=None, seq_packing=None):
     """
     :param bool recurrent_net: If True, the batch might have a batch seq dimension > 1.
       Otherwise, the batch seq dimension is always 1 and multiple seqs will be concatenated.
@@ -1027,6 +1038,16 @@ class Dataset(object):
     :param int max_total_num_seqs:
     :param int|dict[str,int]|NumbersDict max_seq_length:
     :param set(str)|None used_data_keys:
+    :param int|None sort_window: if set, within consecutive windows of this number of seqs,
+      the seqs are grouped into batches by their length (longest first), to reduce the padding.
+      The seq order of the dataset itself (and thus the seq idx) is not changed.
+      Only for the recurrent case without chunking and without weights.
+      See :func:`_generate_batches_sorted_windows`.
+    :param int|dict[str,int]|NumbersDict|None seq_packing: if set, max number of frames per slice.
+      Multiple seqs are then packed (concatenated) into one slice, to reduce the padding.
+      This is for non-recurrent models, which need to mask across the seq boundaries,
+      see :func:`TFNetwork.ExternData.register_packed_segments`.
+      Ignored if `recurrent_net`. See :func:`_generate_batches_packed`.
     """
     if not batch_size:
       batch_size = sys.maxsize
@@ -1051,6 +1072,41 @@ class Dataset(object):
       if chunk_size != 0:
         print("Non-recurrent network, chunk size %s:%s ignored" % (chunk_size, chunk_step), file=log.v4)
         chunk_size = 0
+    if seq_packing and recurrent_net:
+      print("Seq packing %r only supported for non-recurrent net, ignored" % (seq_packing,), file=log.v4)
+      seq_packing = None
+    if seq_packing:
+      if sort_window:
+        print("Sort window %i not supported with seq packing, ignored" % sort_window, file=log.v4)
+      for batch in self._generate_batches_packed(
+            max_slice_len=NumbersDict(seq_packing), chunk_size=chunk_size, chunk_step=chunk_step,
+            batch_size=batch_size, max_seqs=max_seqs, max_seq_length=max_seq_length,
+            min_seq_length=min_seq_length, seq_drop=seq_drop, max_total_num_seqs=max_total_num_seqs,
+            used_data_keys=used_data_keys):
+        yield batch
+      return
+    if sort_window and not (recurrent_net and chunk_size == 0 and not self.weights):
+      print("Sort window %i only supported for recurrent net without chunking, ignored" % sort_window, file=log.v4)
+      sort_window = None
+    if sort_window:
+      for batch in self._generate_batches_sorted_windows(
+            sort_window=sort_window,
+            batch_size=batch_size, max_seqs=max_seqs, max_seq_length=max_seq_length, max_pad_size=max_pad_size,
+            min_seq_length=min_seq_length, seq_drop=seq_drop, max_total_num_seqs=max_total_num_seqs):
+        yield batch
+      return
+    if recurrent_net and chunk_size == 0 and not self.weights:
+      try:
+        seq_lengths = self.get_all_seq_lengths()
+      except OptionalNotImplementedError:
+        seq_lengths = None
+      if seq_lengths is not None:
+        for batch in self._generate_batches_from_seq_lengths(
+              seq_lengths=seq_lengths,
+              batch_size=batch_size, max_seqs=max_seqs, max_seq_length=max_seq_length, max_pad_size=max_pad_size,
+              min_seq_length=min_seq_length, seq_drop=seq_drop, max_total_num_seqs=max_total_num_seqs):
+          yield batch
+        return
     batch = Batch()
     total_num_seqs = 0
     last_seq_idx = -1
@@ -1107,6 +1163,218 @@ class Dataset(object):
     if batch.get_all_slices_num_frames().max_value() > 0:
       yield batch
 
+  def _generate_batches_packed(self, max_slice_len, chunk_size, chunk_step,
+                               batch_size, max_seqs, max_seq_length,
+                               min_seq_length, seq_drop, max_total_num_seqs, used_data_keys):
+    """
+    Packing variant of :func:`_generate_batches`.
+    Each seq (or chunk) is appended to the first slice of the current batch which still has space for it
+    (up to max_slice_len frames), or otherwise gets a new slice (see :func:`EngineBatch.Batch.add_sequence_packed`).
+    Thus a slice usually contains multiple seqs, and there is much less padding than with one seq per slice.
+    The limit batch_size refers to the padded batch as usual, and max_seqs to the number of seqs.
+
+    :param NumbersDict max_slice_len:
+    :param int chunk_size:
+    :param int chunk_step:
+    :param NumbersDict batch_size:
+    :param int|float max_seqs:
+    :param NumbersDict max_seq_length:
+    :param NumbersDict min_seq_length:
+    :param float seq_drop:
+    :param int|float max_total_num_seqs:
+    :param set(str)|None used_data_keys:
+    :rtype: typing.Generator[Batch]
+    """
+    batch = Batch()
+    total_num_seqs = 0
+    last_seq_idx = -1
+    for seq_idx, t_start, t_end in self.iterate_seqs(
+          chunk_size=chunk_size, chunk_step=chunk_step, used_data_keys=used_data_keys):
+      if not self.sample(seq_idx):
+        continue
+      if total_num_seqs > max_total_num_seqs:
+        break
+      t_start -= self.ctx_left
+      t_end += self.ctx_right
+      length = t_end - t_start
+      if length.any_compare(max_seq_length, (lambda a, b: a > b)):
+        continue
+      if length.any_compare(min_seq_length, (lambda a, b: a < b)):
+        continue
+      if length.any_compare(max_slice_len, (lambda a, b: a > b)):
+        print("warning: sequence length (%r) larger than seq packing limit (%r)" % (length, max_slice_len),
+              file=log.v4)
+      if self.rnd_seq_drop.random() < seq_drop:
+        continue
+      _, dt, ds = batch.try_sequence_packed(length=length, max_slice_len=max_slice_len)
+      if batch.num_slices >= 1:
+        if (dt * ds).any_compare(batch_size, (lambda a, b: a > b)) or len(batch.seqs) + 1 > max_seqs:
+          yield batch
+          batch = Batch()
+      batch.add_sequence_packed(
+        seq_idx=seq_idx, seq_start_frame=t_start, length=length, max_slice_len=max_slice_len)
+      if seq_idx != last_seq_idx:
+        last_seq_idx = seq_idx
+        total_num_seqs += 1
+    if batch.seqs:
+      yield batch
+
+  def _generate_batches_sorted_windows(self, sort_window,
+                                      batch_size, max_seqs, max_seq_length, max_pad_size,
+                                      min_seq_length, seq_drop, max_total_num_seqs):
+    """
+    Length-bucketed variant of :func:`_generate_batches_from_seq_lengths`.
+    We go through the seqs in consecutive windows of sort_window seqs,
+    sort the seqs of each window by length, and cut the batches from that sorted order,
+    such that each batch contains seqs of similar length and there is much less padding
+    than with the seqs in dataset order.
+    The seq idx stay the same, i.e. the user can map the outputs back to the dataset order via the seq idx.
+    The batches of one window are yielded ordered by their first seq idx,
+    such that the calls to :func:`load_seqs` stay monotonic, as e.g. :class:`CachedDataset2` expects it.
+
+    :param int sort_window: number of seqs
+    :param NumbersDict batch_size:
+    :param int|float max_seqs:
+    :param NumbersDict max_seq_length:
+    :param NumbersDict max_pad_size:
+    :param NumbersDict min_seq_length:
+    :param float seq_drop:
+    :param int|float max_total_num_seqs:
+    :rtype: typing.Iterator[Batch]
+    """
+    assert sort_window > 0
+    try:
+      all_seq_lengths = self.get_all_seq_lengths()
+    except OptionalNotImplementedError:
+      all_seq_lengths = None
+    start = 0
+    while self.is_less_than_num_seqs(start) and max_total_num_seqs >= 0:
+      end = start + 1
+      while end < start + sort_window and self.is_less_than_num_seqs(end):
+        end += 1
+      if all_seq_lengths is not None:
+        seq_lengths = {key: value[start:end] for (key, value) in all_seq_lengths.items()}
+      else:
+        self.load_seqs(start, end)
+        lengths = [self.get_seq_length(seq_idx) for seq_idx in range(start, end)]
+        seq_lengths = {key: numpy.array([length[key] for length in lengths]) for key in lengths[0].keys()}
+      batches = list(self._generate_batches_from_seq_lengths(
+        seq_lengths=seq_lengths, seq_idx_offset=start, sort_by_length=True,
+        batch_size=batch_size, max_seqs=max_seqs, max_seq_length=max_seq_length, max_pad_size=max_pad_size,
+        min_seq_length=min_seq_length, seq_drop=seq_drop, max_total_num_seqs=max_total_num_seqs))
+      batches.sort(key=lambda batch_: batch_.start_seq)
+      for batch in batches:
+        max_total_num_seqs -= batch.num_slices
+        yield batch
+      start = end
+
+  def _generate_batches_from_seq_lengths(self, seq_lengths,
+                                        batch_size, max_seqs, max_seq_length, max_pad_size,
+                                        min_seq_length, seq_drop, max_total_num_seqs,
+                                        seq_idx_offset=0, sort_by_length=False):
+    """
+    Array-based variant of :func:`_generate_batches` for the recurrent case without chunking and without weights.
+    It produces exactly the same batches, but it computes the seq filtering and the batch boundaries
+    on the whole seq length arrays via numpy, instead of going through every seq in Python.
+
+    :param dict[str,numpy.ndarray] seq_lengths: see :func:`get_all_seq_lengths`
+    :param NumbersDict batch_size:
+    :param int|float max_seqs:
+    :param NumbersDict max_seq_length:
+    :param NumbersDict max_pad_size:
+    :param NumbersDict min_seq_length:
+    :param float seq_drop:
+    :param int|float max_total_num_seqs:
+    :param int seq_idx_offset: seq_lengths starts at this seq idx
+    :param bool sort_by_length: go through the seqs sorted by length (longest first) instead of by seq idx.
+      See :func:`_generate_batches_sorted_windows`.
+    :rtype: typing.Iterator[Batch]
+    """
+    seq_lengths = {key: numpy.asarray(value, dtype="int64") for (key, value) in seq_lengths.items()}
+    assert seq_lengths
+    num_seqs = len(next(iter(seq_lengths.values())))
+    assert all([value.shape == (num_seqs,) for value in seq_lengths.values()])
+    # Same as t_start/t_end/length as in iterate_seqs() and _generate_batches(), just with arrays as values.
+    length = NumbersDict(seq_lengths)
+    t_start = NumbersDict.constant_like(0, numbers_dict=length) - self.ctx_left
+    length = length + self.ctx_right - t_start
+    # Columns ("lanes") of lengths_mat correspond to the keys of length, and the broadcast value (if set).
+    lane_keys = sorted(length.keys())
+    lanes = [length[key] for key in lane_keys]
+    if length.value is not None:
+      lane_keys.append(None)
+      lanes.append(length.value)
+    lengths_mat = numpy.stack(
+      [numpy.broadcast_to(numpy.asarray(lane, dtype="int64"), (num_seqs,)) for lane in lanes], axis=1)
+
+    def get_lane_limits(limit, default):
+      """
+      :param NumbersDict limit:
+      :param float default: if there is no limit for some lane
+      :return: limit per lane, such that comparisons behave like :func:`NumbersDict.any_compare`
+      :rtype: numpy.ndarray
+      """
+      res = []
+      for key in lane_keys:
+        if key is not None and key in limit.keys():
+          value = limit[key]
+        else:
+          value = limit.value
+        res.append(default if value is None else value)
+      return numpy.array(res, dtype="float64")
+
+    batch_size_limits = get_lane_limits(batch_size, default=float("inf"))
+    max_pad_size_limits = get_lane_limits(max_pad_size, default=float("inf"))
+    mask = numpy.logical_not(numpy.any(lengths_mat > get_lane_limits(max_seq_length, default=float("inf")), axis=1))
+    mask &= numpy.logical_not(numpy.any(lengths_mat < get_lane_limits(min_seq_length, default=-float("inf")), axis=1))
+    for seq_idx in numpy.nonzero(mask & numpy.any(lengths_mat > batch_size_limits, axis=1))[0]:
+      print("warning: sequence length (%r) larger than limit (%r)" % (
+        numbers_dict_from_lanes(lane_keys, lengths_mat[seq_idx].tolist()), batch_size), file=log.v4)
+    seq_idxs = numpy.nonzero(mask)[0]
+    if seq_drop > 0:
+      keep = numpy.array([self.rnd_seq_drop.random() >= seq_drop for _ in range(len(seq_idxs))], dtype="bool")
+      seq_idxs = seq_idxs[keep]
+    if max_total_num_seqs < float("inf"):
+      seq_idxs = seq_idxs[:int(max_total_num_seqs) + 1]
+    lengths_mat = lengths_mat[seq_idxs]
+    if sort_by_length:
+      # Relative to the batch size limit, such that different lanes (e.g. data and classes) are comparable.
+      sort_key = numpy.max(lengths_mat / numpy.where(numpy.isinf(batch_size_limits), 1., batch_size_limits), axis=1)
+      order = numpy.argsort(-sort_key, kind="stable")
+      seq_idxs = seq_idxs[order]
+      lengths_mat = lengths_mat[order]
+    seq_idxs = seq_idxs + seq_idx_offset
+
+    start = 0
+    window = 16
+    while start < len(seq_idxs):
+      while True:
+        if max_seqs < float("inf"):
+          window = min(window, int(max_seqs) + 1)  # enough to always find the end of the batch
+        end = min(start + window, len(seq_idxs))
+        block = lengths_mat[start:end]
+        # Like Batch.try_sequence_as_slice(), for all possible batch ends at once.
+        dt = numpy.maximum.accumulate(numpy.maximum(block, 0), axis=0)
+        ds = numpy.arange(1, end - start + 1)
+        frames = dt * ds[:, None]
+        exceeds = numpy.any(frames > batch_size_limits, axis=1)
+        exceeds |= ds > max_seqs
+        exceeds |= numpy.any(frames - numpy.cumsum(block, axis=0) > max_pad_size_limits, axis=1)
+        exceeds[0] = False  # we always add at least one seq to a batch
+        if numpy.any(exceeds):
+          end = start + int(numpy.argmax(exceeds))
+          break
+        if end == len(seq_idxs):
+          break
+        window *= 2
+      batch = Batch()
+      batch.add_sequences_as_slices(
+        seq_idxs=seq_idxs[start:end].tolist(), seq_start_frame=t_start,
+        lengths=lengths_mat[start:end], lane_keys=lane_keys)
+      yield batch
+      window = max(16, (end - start) * 2)
+      start = end
+
   def batch_set_generator_cache_whole_epoch(self):
     """
     The BatchSetGenerator can cache the list of batches which we generated across epochs.
@@ -6,9 +6,25 @@ This is shared across different backends.
 
 import random
 import typing
+import numpy
 from Util import NumbersDict
 
 
+def numbers_dict_from_lanes(lane_keys, lane_values):
+  """
+  :param list[str|None] lane_keys: None for the broadcast value
+  :param list[int]|numpy.ndarray lane_values: value for each key
+  :rtype: NumbersDict
+  """
+  res = NumbersDict()
+  for key, value in zip(lane_keys, lane_values):
+    if key is None:
+      res.value = value
+    else:
+      res[key] = value
+  return res
+
+
 class BatchSeqCopyPart:
   """
   A batch used for training in CRNN can consist of several parts from sequences,
@@ -32,13 +48,56 @@ class BatchSeqCopyPart:
     """
     self.seq_idx = seq_idx
     self.seq_start_frame = NumbersDict(seq_start_frame)
-    self.seq_end_frame = NumbersDict(seq_end_frame)
+    self._seq_end_frame = NumbersDict(seq_end_frame)
+    self._seq_end_frame_lanes = None  # type: typing.Optional[typing.Tuple[typing.List[typing.Optional[str]],list]]
     self.batch_slice = batch_slice
     self.batch_frame_offset = NumbersDict(batch_frame_offset)
     assert self.seq_start_frame.has_values()
     assert self.seq_end_frame.has_values()
     assert self.batch_frame_offset.has_values()
 
+  @classmethod
+  def from_lanes(cls, seq_idx, seq_start_frame, lane_keys, seq_end_frame_lanes, batch_slice, batch_frame_offset):
+    """
+    Like the constructor, but seq_start_frame and batch_frame_offset are used as-is (not copied, no checks),
+    and seq_end_frame is only created on first access.
+    This is for :func:`Batch.add_sequences_as_slices`, which creates many of these at once.
+
+    :param int seq_idx:
+    :param NumbersDict seq_start_frame: not copied, can be shared across parts
+    :param list[str|None] lane_keys: see :func:`numbers_dict_from_lanes`
+    :param list[int] seq_end_frame_lanes: see :func:`numbers_dict_from_lanes`
+    :param int batch_slice:
+    :param NumbersDict batch_frame_offset: not copied, can be shared across parts
+    :rtype: BatchSeqCopyPart
+    """
+    part = cls.__new__(cls)
+    part.seq_idx = seq_idx
+    part.seq_start_frame = seq_start_frame
+    part._seq_end_frame = None
+    part._seq_end_frame_lanes = (lane_keys, seq_end_frame_lanes)
+    part.batch_slice = batch_slice
+    part.batch_frame_offset = batch_frame_offset
+    return part
+
+  @property
+  def seq_end_frame(self):
+    """
+    :rtype: NumbersDict
+    """
+    if self._seq_end_frame is None:
+      self._seq_end_frame = numbers_dict_from_lanes(*self._seq_end_frame_lanes)
+      self._seq_end_frame_lanes = None
+    return self._seq_end_frame
+
+  @seq_end_frame.setter
+  def seq_end_frame(self, value):
+    """
+    :param NumbersDict value:
+    """
+    self._seq_end_frame = value
+    self._seq_end_frame_lanes = None
+
   @property
   def frame_length(self):
     """
@@ -63,6 +122,8 @@ class Batch:
     # original data_shape = [0, 0], format (time,batch/slice)
     #          data_shape = [max_num_frames_per_slice, num_slices]
     self.seqs = []  # type: typing.List[BatchSeqCopyPart]
+    # Only used by add_sequence_packed(). Number of frames per slice.
+    self.slice_num_frames = []  # type: typing.List[NumbersDict]
 
   def __repr__(self):
     return "<Batch start_seq:%r, len(seqs):%i>" % (self.start_seq, len(self.seqs))
@@ -90,6 +151,70 @@ class Batch:
                                    batch_slice=self.num_slices - 1,
                                    batch_frame_offset=0)]
 
+  def add_sequences_as_slices(self, seq_idxs, seq_start_frame, lengths, lane_keys):
+    """
+    Like :func:`add_sequence_as_slice`, for multiple seqs at once.
+    The lengths are given as one matrix, so that we do not need a :class:`NumbersDict` per seq here.
+
+    :param list[int] seq_idxs:
+    :param NumbersDict|int seq_start_frame: same for all seqs
+    :param numpy.ndarray lengths: (len(seq_idxs), len(lane_keys)), number of (time) frames, for each seq
+    :param list[str|None] lane_keys: the keys of the columns of lengths, see :func:`numbers_dict_from_lanes`
+    """
+    lengths = numpy.asarray(lengths)
+    assert lengths.shape == (len(seq_idxs), len(lane_keys))
+    if not seq_idxs:
+      return
+    seq_start_frame = NumbersDict(seq_start_frame)
+    start_lanes = numpy.array(
+      [seq_start_frame.value if key is None else seq_start_frame[key] for key in lane_keys], dtype=lengths.dtype)
+    self.max_num_frames_per_slice = NumbersDict.max([
+      self.max_num_frames_per_slice, numbers_dict_from_lanes(lane_keys, numpy.max(lengths, axis=0).tolist())])
+    batch_frame_offset = NumbersDict(0)
+    for seq_idx, end_lanes in zip(seq_idxs, (lengths + start_lanes[None, :]).tolist()):
+      self.seqs.append(BatchSeqCopyPart.from_lanes(
+        seq_idx=seq_idx, seq_start_frame=seq_start_frame,
+        lane_keys=lane_keys, seq_end_frame_lanes=end_lanes,
+        batch_slice=self.num_slices, batch_frame_offset=batch_frame_offset))
+      self.num_slices += 1
+
+  def try_sequence_packed(self, length, max_slice_len):
+    """
+    :param NumbersDict length: number of (time) frames
+    :param NumbersDict max_slice_len: max number of frames per slice
+    :return: the slice where the seq would be appended (first fit, or a new slice),
+      and the new shape which covers the old shape, format (time,batch)
+    :rtype: (int,NumbersDict,int)
+    """
+    for batch_slice, num_frames in enumerate(self.slice_num_frames):
+      if not (num_frames + length).any_compare(max_slice_len, (lambda a, b: a > b)):
+        return batch_slice, NumbersDict.max([self.max_num_frames_per_slice, num_frames + length]), self.num_slices
+    return self.num_slices, NumbersDict.max([self.max_num_frames_per_slice, length]), self.num_slices + 1
+
+  def add_sequence_packed(self, seq_idx, seq_start_frame, length, max_slice_len):
+    """
+    Appends the seq to the first slice which has enough space left (see :func:`try_sequence_packed`),
+    i.e. multiple seqs will be concatenated in one slice.
+    Each data-key is packed on its own, i.e. the batch frame offset can differ between the keys.
+
+    :param int seq_idx:
+    :param NumbersDict|int seq_start_frame:
+    :param NumbersDict length: number of (time) frames
+    :param NumbersDict max_slice_len: max number of frames per slice
+    """
+    assert len(self.slice_num_frames) == self.num_slices, "cannot mix with other add_* functions"
+    batch_slice, self.max_num_frames_per_slice, self.num_slices = self.try_sequence_packed(
+      length=length, max_slice_len=max_slice_len)
+    if batch_slice == len(self.slice_num_frames):
+      self.slice_num_frames.append(NumbersDict(0))
+    batch_frame_offset = self.slice_num_frames[batch_slice]
+    self.seqs.append(BatchSeqCopyPart(seq_idx=seq_idx,
+                                      seq_start_frame=seq_start_frame,
+                                      seq_end_frame=seq_start_frame + length,
+                                      batch_slice=batch_slice,
+                                      batch_frame_offset=batch_frame_offset))
+    self.slice_num_frames[batch_slice] = batch_frame_offset + length
+
   def add_frames(self, seq_idx, seq_start_frame, length, frame_dim_corresponds=True):
     """
     Adds frames to all data-batches.
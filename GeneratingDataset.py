@@ -9,8 +9,11 @@ from Dataset import Dataset, DatasetSeq, convert_data_dims
 from CachedDataset2 import CachedDataset2
 from Util import class_idx_seq_to_1_of_k, CollectionReadCheckCovered, PY3
 from Log import log
+import contextlib
+import mmap
 import numpy
 import re
+import struct
 import sys
 import typing
 
@@ -836,6 +839,15 @@ class StaticDataset(GeneratingDataset):
     data = self.data[seq_idx]
     return DatasetSeq(seq_idx=seq_idx, features={key: data[key] for key in self.data_keys})
 
+  def get_all_seq_lengths(self):
+    """
+    :return: data-key -> seq lengths, for all seqs
+    :rtype: dict[str,numpy.ndarray]
+    """
+    return {
+      key: numpy.array([(data[key].shape[0] if data[key].ndim >= 1 else 1) for data in self.data], dtype="int64")
+      for key in self.data_keys}
+
   def get_data_keys(self):
     """
     :rtype: list[str]
@@ -910,6 +922,258 @@ class CopyTaskDataset(GeneratingDataset):
 # * nltk.corpus
 
 
+class FeatureCacheFile:
+  """
+  Persistent on-disk cache for extracted features (e.g. by :class:`ExtractAudioFeatures`),
+  addressed by some content key (see :func:`make_key`).
+  All entries are stored in a single append-only file, which is memory-mapped for reading.
+  Multiple processes can use the same file (e.g. via :class:`MetaDataset.MultiProcDataset`),
+  writes are synchronized via a lock file.
+
+  File format: file header, followed by records.
+  A record is the record header (magic, key, shape, dtype), followed by the raw data, padded to 16 bytes.
+  A record which is not complete (e.g. because the writer was killed) is ignored and overwritten by the next write.
+
+  If ``max_size`` is given and it would be exceeded,
+  the file is rewritten with only the most recently used entries (up to ``evict_to_frac * max_size``).
+  """
+
+  _file_header = b"RETURNN-FEATURE-CACHE-V1\n\0\0\0\0\0\0\0"  # 32 bytes
+  _record_header = struct.Struct("<4s20sQQ8s")  # magic, key, dim0, dim1, dtype. 48 bytes
+  _record_magic = b"FEAT"
+  _alignment = 16
+
+  def __init__(self, filename, max_size=None, evict_to_frac=0.75):
+    """
+    :param str filename:
+    :param int|None max_size: in bytes. None means unlimited
+    :param float evict_to_frac: when max_size is reached, we keep only up to this fraction of max_size
+    """
+    import os
+    self.filename = filename
+    self.max_size = max_size
+    self.evict_to_frac = evict_to_frac
+    self.num_hits = 0
+    self.num_misses = 0
+    # key -> offset,shape,dtype
+    self._index = {}  # type: typing.Dict[bytes,typing.Tuple[int,typing.Tuple[int,int],str]]
+    self._last_used = {}  # type: typing.Dict[bytes,int]  # key -> use counter
+    self._use_counter = 0
+    self._scanned_size = 0
+    self._file_id = None  # type: typing.Optional[typing.Tuple[int,int]]
+    self._file = None  # type: typing.Optional[typing.BinaryIO]
+    self._mmap = None  # type: typing.Optional[mmap.mmap]
+    with self._lock():
+      if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        with open(filename, "wb") as f:
+          f.write(self._file_header)
+      self._update_index()
+    print("%s: %i entries, %i bytes" % (self, len(self._index), self._scanned_size), file=log.v4)
+
+  def __repr__(self):
+    return "<%s %r>" % (self.__class__.__name__, self.filename)
+
+  def __del__(self):
+    self._close()
+
+  @staticmethod
+  def make_key(*parts):
+    """
+    :param parts: anything where the repr identifies the content, e.g. filename, checksum, options hash
+    :return: key (20 bytes)
+    :rtype: bytes
+    """
+    import hashlib
+    return hashlib.sha1(repr(parts).encode("utf8")).digest()
+
+  @contextlib.contextmanager
+  def _lock(self):
+    """
+    Exclusive lock over processes, for writing.
+    """
+    try:
+      import fcntl
+    except ImportError:  # e.g. Windows. just don't lock then
+      yield
+      return
+    with open(self.filename + ".lock", "a") as lock_file:
+      fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+  def _close(self):
+    if self._mmap is not None:
+      self._mmap.close()
+      self._mmap = None
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  def _update_index(self):
+    """
+    Reads all new records which were appended since the last call (by us or by other processes).
+    If the file was replaced (eviction by another process), rereads everything.
+    """
+    import os
+    st = os.stat(self.filename)
+    if self._file_id != (st.st_dev, st.st_ino):
+      self._close()
+      self._file = open(self.filename, "rb")
+      self._file_id = (st.st_dev, st.st_ino)
+      self._index.clear()
+      self._scanned_size = 0
+    if st.st_size <= self._scanned_size:
+      return
+    f = self._file
+    if self._scanned_size == 0:
+      f.seek(0)
+      assert f.read(len(self._file_header)) == self._file_header, "%s: invalid file header" % self
+      self._scanned_size = len(self._file_header)
+    pos = self._scanned_size
+    while True:
+      f.seek(pos)
+      header = f.read(self._record_header.size)
+      if len(header) < self._record_header.size:
+        break
+      magic, key, dim0, dim1, dtype = self._record_header.unpack(header)
+      if magic != self._record_magic:
+        break
+      dtype = dtype.rstrip(b"\0").decode("ascii")
+      data_offset = pos + self._record_header.size
+      end = self._align(data_offset + dim0 * dim1 * numpy.dtype(dtype).itemsize)
+      if end > st.st_size:
+        break
+      self._index[key] = (data_offset, (dim0, dim1), dtype)
+      pos = end
+    self._scanned_size = pos
+
+  @classmethod
+  def _align(cls, pos):
+    """
+    :param int pos:
+    :rtype: int
+    """
+    return (pos + cls._alignment - 1) // cls._alignment * cls._alignment
+
+  def _get_mmap(self, end):
+    """
+    :param int end: we need the mmap to cover up to here
+    :rtype: mmap.mmap
+    """
+    if self._mmap is None or len(self._mmap) < end:
+      if self._mmap is not None:
+        self._mmap.close()
+      self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    assert len(self._mmap) >= end
+    return self._mmap
+
+  def get(self, key):
+    """
+    :param bytes key: via :func:`make_key`
+    :return: copy of the cached value, or None if not cached
+    :rtype: numpy.ndarray|None
+    """
+    if key not in self._index:
+      self._update_index()  # maybe some other process has added it
+      if key not in self._index:
+        self.num_misses += 1
+        return None
+    offset, shape, dtype = self._index[key]
+    count = shape[0] * shape[1]
+    mm = self._get_mmap(offset + count * numpy.dtype(dtype).itemsize)
+    self.num_hits += 1
+    self._use_counter += 1
+    self._last_used[key] = self._use_counter
+    return numpy.frombuffer(mm, dtype=dtype, count=count, offset=offset).reshape(shape).copy()
+
+  def _make_record(self, key, value):
+    """
+    :param bytes key:
+    :param numpy.ndarray value:
+    :rtype: bytes
+    """
+    assert isinstance(key, bytes) and len(key) == 20
+    assert isinstance(value, numpy.ndarray) and value.ndim == 2
+    header = self._record_header.pack(
+      self._record_magic, key, value.shape[0], value.shape[1], value.dtype.str.encode("ascii"))
+    data = numpy.ascontiguousarray(value).tobytes()
+    size = len(header) + len(data)
+    return header + data + b"\0" * (self._align(size) - size)
+
+  def add(self, key, value):
+    """
+    :param bytes key: via :func:`make_key`
+    :param numpy.ndarray value: shape (time,dim)
+    """
+    record = self._make_record(key, value)
+    if self.max_size and len(self._file_header) + len(record) > self.max_size * self.evict_to_frac:
+      return  # would never fit
+    with self._lock():
+      self._update_index()
+      if key in self._index:
+        return
+      if self.max_size and self._scanned_size + len(record) > self.max_size:
+        self._evict(keep_size=int(self.max_size * self.evict_to_frac) - len(record))
+      with open(self.filename, "r+b") as f:
+        f.truncate(self._scanned_size)  # remove any incomplete record
+        f.seek(self._scanned_size)
+        f.write(record)
+      self._update_index()
+    assert key in self._index
+    self._use_counter += 1
+    self._last_used[key] = self._use_counter
+
+  def _evict(self, keep_size):
+    """
+    Rewrites the file with only the most recently used entries, such that the file size is at most keep_size.
+    Must be called with the lock.
+
+    :param int keep_size:
+    """
+    import os
+    keys = sorted(
+      self._index.keys(), key=lambda k: (self._last_used.get(k, 0), self._index[k][0]), reverse=True)
+    size = len(self._file_header)
+    kept = []
+    for key in keys:
+      start, end = self._get_record_range(key)
+      if size + end - start > keep_size:
+        break
+      size += end - start
+      kept.append(key)
+    kept.sort(key=lambda k: self._index[k][0])  # keep the file order
+    mm = self._get_mmap(self._scanned_size)
+    tmp_filename = "%s.tmp.%i" % (self.filename, os.getpid())
+    with open(tmp_filename, "wb") as f:
+      f.write(self._file_header)
+      for key in kept:
+        start, end = self._get_record_range(key)
+        f.write(mm[start:end])
+    # Like LearningRateControl.save, first write the temp file. rename is atomic (on POSIX) and exists in Python 2.
+    os.rename(tmp_filename, self.filename)
+    print("%s: evicted %i entries, kept %i entries" % (self, len(self._index) - len(kept), len(kept)), file=log.v4)
+    self._update_index()
+    self._last_used = {k: v for (k, v) in self._last_used.items() if k in self._index}
+
+  def _get_record_range(self, key):
+    """
+    :param bytes key:
+    :return: (start, end) of the record in the file, including header and padding
+    :rtype: (int, int)
+    """
+    offset, shape, dtype = self._index[key]
+    return offset - self._record_header.size, self._align(offset + shape[0] * shape[1] * numpy.dtype(dtype).itemsize)
+
+  def get_stats_str(self):
+    """
+    :rtype: str
+    """
+    return "%i entries, %i bytes, %i hits, %i misses" % (
+      len(self._index), self._scanned_size, self.num_hits, self.num_misses)
+
+
 class ExtractAudioFeatures:
   """
   Currently uses librosa to extract MFCC/log-mel features.
@@ -1024,6 +1288,35 @@ class ExtractAudioFeatures:
     audio, sample_rate = soundfile.read(raw_bytes)
     return self.get_audio_features(audio=audio, sample_rate=sample_rate, seq_name=seq_name)
 
+  def get_audio_features_from_raw_bytes_batch(self, raw_bytes_list, seq_names=None):
+    """
+    Like :func:`get_audio_features_from_raw_bytes` for multiple audio files,
+    but the feature extraction is done via :func:`get_audio_features_batch`.
+
+    :param list[io.BytesIO] raw_bytes_list:
+    :param list[str]|None seq_names:
+    :return: list of shape (time,feature_dim)
+    :rtype: list[numpy.ndarray]
+    """
+    if seq_names is None:
+      seq_names = [None] * len(raw_bytes_list)
+    assert len(seq_names) == len(raw_bytes_list)
+    if self.features == "raw_ogg":
+      return [
+        self.get_audio_features_from_raw_bytes(raw_bytes, seq_name=seq_name)
+        for (raw_bytes, seq_name) in zip(raw_bytes_list, seq_names)]
+    # noinspection PyPackageRequirements
+    import soundfile  # pip install pysoundfile
+    audios_and_sample_rates = [soundfile.read(raw_bytes) for raw_bytes in raw_bytes_list]
+    sample_rates = set(sample_rate for (_, sample_rate) in audios_and_sample_rates)
+    if len(sample_rates) == 1:
+      return self.get_audio_features_batch(
+        audios=[audio for (audio, _) in audios_and_sample_rates], sample_rate=sample_rates.pop(),
+        seq_names=seq_names)
+    return [
+      self.get_audio_features(audio=audio, sample_rate=sample_rate, seq_name=seq_name)
+      for ((audio, sample_rate), seq_name) in zip(audios_and_sample_rates, seq_names)]
+
   def get_audio_features(self, audio, sample_rate, seq_name=None):
     """
     :param numpy.ndarray audio: raw audio samples, shape (audio_len,)
@@ -1032,6 +1325,48 @@ class ExtractAudioFeatures:
     :return: array (time,dim), dim == self.get_feature_dimension()
     :rtype: numpy.ndarray
     """
+    audio = self._preprocess_audio(audio=audio, sample_rate=sample_rate)
+    feature_data = self._extract_features(audio=audio, sample_rate=sample_rate)
+    return self._postprocess_features(feature_data, seq_name=seq_name)
+
+  def get_audio_features_batch(self, audios, sample_rate, seq_names=None):
+    """
+    Same result as :func:`get_audio_features` for each audio,
+    but the framing, STFT and filterbank are computed by single numpy operations over all the audios,
+    which is much faster than one librosa call per audio.
+    Falls back to :func:`get_audio_features` for feature types which do not support this.
+
+    :param list[numpy.ndarray] audios: raw audio samples, each shape (audio_len,)
+    :param int sample_rate: e.g. 22050, same for all audios
+    :param list[str]|None seq_names:
+    :return: list of arrays (time,dim), dim == self.get_feature_dimension()
+    :rtype: list[numpy.ndarray]
+    """
+    if seq_names is None:
+      seq_names = [None] * len(audios)
+    assert len(seq_names) == len(audios)
+    if not audios:
+      return []
+    batch_func = self._get_batch_feature_func(sample_rate=sample_rate)
+    if batch_func:
+      audios = [self._preprocess_audio(audio=audio, sample_rate=sample_rate) for audio in audios]
+      features = batch_func(audios=audios, **self._get_feature_func_kwargs(sample_rate=sample_rate))
+    else:
+      features = []
+      for audio in audios:
+        audio = self._preprocess_audio(audio=audio, sample_rate=sample_rate)
+        features.append(self._extract_features(audio=audio, sample_rate=sample_rate))
+    return [
+      self._postprocess_features(feature_data, seq_name=seq_name)
+      for (feature_data, seq_name) in zip(features, seq_names)]
+
+  def _preprocess_audio(self, audio, sample_rate):
+    """
+    :param numpy.ndarray audio: raw audio samples, shape (audio_len,)
+    :param int sample_rate: e.g. 22050
+    :return: audio, after preemphasis, peak normalization, random permutation
+    :rtype: numpy.ndarray
+    """
     if self.sample_rate is not None:
       assert sample_rate == self.sample_rate, "currently no conversion implemented..."
 
@@ -1049,36 +1384,76 @@ class ExtractAudioFeatures:
         sample_rate=sample_rate,
         opts=self.random_permute_opts,
         random_state=self.random_state)
+    return audio
 
+  def _get_feature_func_kwargs(self, sample_rate):
+    """
+    :param int sample_rate:
+    :return: kwargs for the feature function, e.g. :func:`_get_audio_features_mfcc`, except audio
+    :rtype: dict[str]
+    """
+    kwargs = {
+      "sample_rate": sample_rate,
+      "window_len": self.window_len,
+      "step_len": self.step_len,
+      "num_feature_filters": self.num_feature_filters}
+    if self.feature_options is not None:
+      assert isinstance(self.feature_options, dict)
+      kwargs.update(self.feature_options)
+    return kwargs
+
+  def _extract_features(self, audio, sample_rate):
+    """
+    :param numpy.ndarray audio: preprocessed audio samples, shape (audio_len,)
+    :param int sample_rate: e.g. 22050
+    :return: array (time,num_feature_filters)
+    :rtype: numpy.ndarray
+    """
     if self.features == "raw":
       assert self.num_feature_filters == 1
-      feature_data = audio[:, None].astype("float32")  # add dummy dimension
-
+      return audio[:, None].astype("float32")  # add dummy dimension
+    kwargs = self._get_feature_func_kwargs(sample_rate=sample_rate)
+    if self.features == "mfcc":
+      return _get_audio_features_mfcc(audio=audio, **kwargs)
+    elif self.features == "log_mel_filterbank":
+      return _get_audio_log_mel_filterbank(audio=audio, **kwargs)
+    elif self.features == "log_log_mel_filterbank":
+      return _get_audio_log_log_mel_filterbank(audio=audio, **kwargs)
+    elif self.features == "db_mel_filterbank":
+      return _get_audio_db_mel_filterbank(audio=audio, **kwargs)
+    elif self.features == "linear_spectrogram":
+      return _get_audio_linear_spectrogram(audio=audio, **kwargs)
     else:
-      kwargs = {
-        "sample_rate": sample_rate,
-        "window_len": self.window_len,
-        "step_len": self.step_len,
-        "num_feature_filters": self.num_feature_filters,
-        "audio": audio}
-
-      if self.feature_options is not None:
-        assert isinstance(self.feature_options, dict)
-        kwargs.update(self.feature_options)
-
-      if self.features == "mfcc":
-        feature_data = _get_audio_features_mfcc(**kwargs)
-      elif self.features == "log_mel_filterbank":
-        feature_data = _get_audio_log_mel_filterbank(**kwargs)
-      elif self.features == "log_log_mel_filterbank":
-        feature_data = _get_audio_log_log_mel_filterbank(**kwargs)
-      elif self.features == "db_mel_filterbank":
-        feature_data = _get_audio_db_mel_filterbank(**kwargs)
-      elif self.features == "linear_spectrogram":
-        feature_data = _get_audio_linear_spectrogram(**kwargs)
-      else:
-        raise Exception("non-supported feature type %r" % (self.features,))
+      raise Exception("non-supported feature type %r" % (self.features,))
 
+  def _get_batch_feature_func(self, sample_rate):
+    """
+    :param int sample_rate:
+    :return: batched feature function, e.g. :func:`_get_audio_features_mfcc_batch`, if it supports the options
+    :rtype: ((list[numpy.ndarray],**dict[str])->list[numpy.ndarray])|None
+    """
+    from Util import getargspec
+    func = {
+      "mfcc": _get_audio_features_mfcc_batch,
+      "log_mel_filterbank": _get_audio_log_mel_filterbank_batch,
+      "log_log_mel_filterbank": _get_audio_log_log_mel_filterbank_batch,
+      "db_mel_filterbank": _get_audio_db_mel_filterbank_batch,
+      "linear_spectrogram": _get_audio_linear_spectrogram_batch,
+    }.get(self.features)
+    if not func:
+      return None
+    kwargs = self._get_feature_func_kwargs(sample_rate=sample_rate)
+    if not set(kwargs.keys()).issubset(getargspec(func).args):
+      return None  # some feature_options which are not supported by the batched variant
+    return func
+
+  def _postprocess_features(self, feature_data, seq_name=None):
+    """
+    :param numpy.ndarray feature_data: (time,num_feature_filters)
+    :param str|None seq_name:
+    :return: array (time,dim), dim == self.get_feature_dimension()
+    :rtype: numpy.ndarray
+    """
     assert feature_data.ndim == 2
     assert feature_data.shape[1] == self.num_feature_filters
 
@@ -1124,6 +1499,41 @@ class ExtractAudioFeatures:
     """
     return (self.with_delta + 1) * self.num_feature_filters * (self.join_frames or 1)
 
+  def get_cache_hash(self):
+    """
+    :return: hash of all the options which influence the features, for :class:`FeatureCacheFile`,
+      or None if the features are not deterministic (random_permute) or we cannot hash the options (post_process)
+    :rtype: str|None
+    """
+    import hashlib
+    if self.random_permute_opts and self.random_permute_opts.truth_value:
+      return None
+    if self.post_process:
+      return None
+    features = self.features
+    if callable(features):
+      # The repr would contain the memory address, which changes in every run. Use the name and the source code.
+      import inspect
+      try:
+        source = inspect.getsource(features)
+      except (IOError, TypeError):  # e.g. defined interactively
+        return None
+      features = "%s.%s:%s" % (features.__module__, getattr(features, "__qualname__", features.__name__), source)
+
+    def _norm_value(v):
+      if isinstance(v, numpy.ndarray):
+        return v.tolist()
+      return v
+
+    opts = {
+      "window_len": self.window_len, "step_len": self.step_len, "num_feature_filters": self.num_feature_filters,
+      "with_delta": self.with_delta, "norm_mean": _norm_value(self.norm_mean),
+      "norm_std_dev": _norm_value(self.norm_std_dev), "features": features,
+      "feature_options": self.feature_options, "raw_ogg_opts": self.raw_ogg_opts, "sample_rate": self.sample_rate,
+      "peak_normalization": self.peak_normalization, "preemphasis": self.preemphasis,
+      "join_frames": self.join_frames}
+    return hashlib.sha1(repr(sorted(opts.items())).encode("utf8")).hexdigest()
+
 
 def _get_audio_linear_spectrogram(audio, sample_rate, window_len=0.025, step_len=0.010, num_feature_filters=512):
   """
@@ -1168,11 +1578,12 @@ def _get_audio_features_mfcc(audio, sample_rate, window_len=0.025, step_len=0.01
   # noinspection PyPackageRequirements
   import librosa
   mfccs = librosa.feature.mfcc(
-    audio, sr=sample_rate,
+    y=audio, sr=sample_rate,
     n_mfcc=num_feature_filters,
     hop_length=int(step_len * sample_rate), n_fft=int(window_len * sample_rate))
-  energy = librosa.feature.rmse(
-    audio,
+  rms_func = getattr(librosa.feature, "rmse", None) or librosa.feature.rms  # renamed in newer librosa
+  energy = rms_func(
+    y=audio,
     hop_length=int(step_len * sample_rate), frame_length=int(window_len * sample_rate))
   mfccs[0] = energy  # replace first MFCC with energy, per convention
   assert mfccs.shape[0] == num_feature_filters  # (dim, time)
@@ -1274,6 +1685,265 @@ def _get_audio_log_log_mel_filterbank(audio, sample_rate, window_len=0.025, step
   return log_log_mel_filterbank
 
 
+def _get_librosa_default_pad_mode(func):
+  """
+  The padding mode for ``center=True`` changed over librosa versions ("reflect" -> "constant"),
+  and the batched feature extraction should give the same result as the librosa functions.
+
+  :param function func: e.g. librosa.core.stft
+  :rtype: str
+  """
+  import inspect
+  # noinspection PyBroadException
+  try:
+    return inspect.signature(func).parameters["pad_mode"].default
+  except Exception:  # e.g. old librosa, Python 2, or no such arg
+    return "reflect"
+
+
+def _get_stacked_audio_frames(audios, frame_length, hop_length, pad_mode, window=None):
+  """
+  Frames several audio signals like librosa with ``center=True``, and stacks all frames into one array.
+
+  :param list[numpy.ndarray] audios: each shape (audio_len,)
+  :param int frame_length:
+  :param int hop_length:
+  :param str pad_mode: for numpy.pad
+  :param numpy.ndarray|None window: (frame_length,), multiplied to each frame
+  :return: frames of all audios (total_num_frames, frame_length), float32, and the num frames of each audio
+  :rtype: (numpy.ndarray, list[int])
+  """
+  num_frames = [1 + (len(audio) + 2 * (frame_length // 2) - frame_length) // hop_length for audio in audios]
+  frames = numpy.empty((sum(num_frames), frame_length), dtype="float32")
+  pos = 0
+  for audio, n in zip(audios, num_frames):
+    audio = numpy.pad(audio, frame_length // 2, mode=pad_mode)
+    audio_frames = numpy.lib.stride_tricks.as_strided(
+      audio, shape=(n, frame_length), strides=(audio.strides[0] * hop_length, audio.strides[0]), writeable=False)
+    if window is not None:
+      numpy.multiply(audio_frames, window[None, :], out=frames[pos:pos + n], casting="unsafe")
+    else:
+      frames[pos:pos + n] = audio_frames
+    pos += n
+  return frames, num_frames
+
+
+def _get_stacked_power_spectrum(audios, n_fft, hop_length, win_length=None, power=2.0):
+  """
+  Like ``abs(librosa.core.stft(audio, ...)) ** power`` for each audio (with Hann window),
+  but with a single FFT over the stacked frames of all audios.
+  This is in float32, which differs from librosa in the order of 1e-6 (relative).
+
+  :param list[numpy.ndarray] audios: each shape (audio_len,)
+  :param int n_fft:
+  :param int hop_length:
+  :param int|None win_length:
+  :param float power: 1 or 2
+  :return: spectrum of all frames (total_num_frames, n_fft // 2 + 1), float32, and the num frames of each audio
+  :rtype: (numpy.ndarray, list[int])
+  """
+  # noinspection PyPackageRequirements
+  import librosa
+  from scipy.signal import get_window
+  if win_length is None:
+    win_length = n_fft
+  window = get_window("hann", win_length, fftbins=True)
+  left_pad = (n_fft - win_length) // 2
+  window = numpy.pad(window, (left_pad, n_fft - win_length - left_pad), mode="constant")
+  frames, num_frames = _get_stacked_audio_frames(
+    audios, frame_length=n_fft, hop_length=hop_length, pad_mode=_get_librosa_default_pad_mode(librosa.core.stft),
+    window=window)
+  try:
+    import scipy.fft
+    stft = scipy.fft.rfft(frames, axis=1, workers=-1)  # complex64, uses all cores
+  except ImportError:  # scipy < 1.4
+    stft = numpy.fft.rfft(frames, axis=1).astype("complex64")
+  spectrum = numpy.square(stft.real)
+  spectrum += numpy.square(stft.imag)
+  assert power in (1, 2)
+  if power == 1:
+    numpy.sqrt(spectrum, out=spectrum)
+  return spectrum, num_frames
+
+
+_mel_basis_cache = {}  # type: typing.Dict[typing.Tuple[int,int,int,float],numpy.ndarray]
+
+
+def _get_mel_basis(sample_rate, n_fft, n_mels, fmin=0.0):
+  """
+  :param int sample_rate:
+  :param int n_fft:
+  :param int n_mels:
+  :param float fmin:
+  :return: librosa mel filterbank, shape (n_mels, n_fft // 2 + 1)
+  :rtype: numpy.ndarray
+  """
+  key = (sample_rate, n_fft, n_mels, fmin)
+  if key not in _mel_basis_cache:
+    # noinspection PyPackageRequirements
+    import librosa
+    _mel_basis_cache[key] = librosa.filters.mel(
+      sr=sample_rate, n_fft=n_fft, n_mels=n_mels, fmin=fmin).astype("float32")
+  return _mel_basis_cache[key]
+
+
+def _get_stacked_mel_spectrogram(audios, sample_rate, window_len, step_len, num_feature_filters, fmin=0.0):
+  """
+  Like ``librosa.feature.melspectrogram`` for each audio, but with stacked numpy operations.
+
+  :param list[numpy.ndarray] audios: each shape (audio_len,)
+  :param int sample_rate:
+  :param float window_len: in seconds
+  :param float step_len: in seconds
+  :param int num_feature_filters: number of mel filters
+  :param float fmin:
+  :return: mel spectrogram of all frames (total_num_frames, num_feature_filters), and the num frames of each audio
+  :rtype: (numpy.ndarray, list[int])
+  """
+  n_fft = int(window_len * sample_rate)
+  spectrum, num_frames = _get_stacked_power_spectrum(audios, n_fft=n_fft, hop_length=int(step_len * sample_rate))
+  mel_basis = _get_mel_basis(sample_rate=sample_rate, n_fft=n_fft, n_mels=num_feature_filters, fmin=fmin)
+  return spectrum.dot(mel_basis.T), num_frames
+
+
+def _stacked_power_to_db(values, num_frames, amin=1e-10, top_db=80.0):
+  """
+  Like ``librosa.core.power_to_db`` (with ref=1.0) for each audio, where ``top_db`` is relative to the max per audio.
+
+  :param numpy.ndarray values: (total_num_frames, dim)
+  :param list[int] num_frames:
+  :param float amin:
+  :param float top_db:
+  :rtype: numpy.ndarray
+  """
+  log_spec = 10.0 * numpy.log10(numpy.maximum(amin, values))
+  seq_starts = numpy.cumsum([0] + num_frames[:-1])
+  seq_max = numpy.maximum.reduceat(log_spec.max(axis=1), seq_starts)  # (num_seqs,)
+  return numpy.maximum(log_spec, numpy.repeat(seq_max - top_db, num_frames)[:, None])
+
+
+def _split_stacked_features(features, num_frames):
+  """
+  :param numpy.ndarray features: (total_num_frames, dim)
+  :param list[int] num_frames:
+  :return: features for each audio, (time, dim), float32
+  :rtype: list[numpy.ndarray]
+  """
+  features = features.astype("float32", copy=False)
+  return numpy.split(features, numpy.cumsum(num_frames)[:-1], axis=0)
+
+
+def _get_audio_linear_spectrogram_batch(
+      audios, sample_rate, window_len=0.025, step_len=0.010, num_feature_filters=512):
+  """
+  Batched variant of :func:`_get_audio_linear_spectrogram`.
+
+  :param list[numpy.ndarray] audios: each shape (audio_len,)
+  :param int sample_rate:
+  :param float window_len: in seconds
+  :param float step_len: in seconds
+  :param int num_feature_filters:
+  :rtype: list[numpy.ndarray]
+  """
+  assert num_feature_filters * 2 >= int(window_len * sample_rate)
+  assert num_feature_filters % 2 == 0
+  spectrum, num_frames = _get_stacked_power_spectrum(
+    audios, n_fft=num_feature_filters * 2, hop_length=int(step_len * sample_rate),
+    win_length=int(window_len * sample_rate), power=1.0)
+  return _split_stacked_features(spectrum[:, 1:], num_frames)  # remove the DC part
+
+
+def _get_audio_features_mfcc_batch(audios, sample_rate, window_len=0.025, step_len=0.010, num_feature_filters=40):
+  """
+  Batched variant of :func:`_get_audio_features_mfcc`.
+
+  :param list[numpy.ndarray] audios: each shape (audio_len,)
+  :param int sample_rate:
+  :param float window_len: in seconds
+  :param float step_len: in seconds
+  :param int num_feature_filters:
+  :rtype: list[numpy.ndarray]
+  """
+  # noinspection PyPackageRequirements
+  import librosa
+  from scipy.fftpack import dct
+  mel, num_frames = _get_stacked_mel_spectrogram(
+    audios, sample_rate=sample_rate, window_len=window_len, step_len=step_len,
+    num_feature_filters=128)  # librosa default n_mels
+  mfccs = dct(_stacked_power_to_db(mel, num_frames), axis=1, type=2, norm="ortho")[:, :num_feature_filters]
+  # Energy, like librosa.feature.rmse.
+  frame_length = int(window_len * sample_rate)
+  rms_func = getattr(librosa.feature, "rmse", None) or librosa.feature.rms
+  frames, num_frames_ = _get_stacked_audio_frames(
+    audios, frame_length=frame_length, hop_length=int(step_len * sample_rate),
+    pad_mode=_get_librosa_default_pad_mode(rms_func))
+  assert num_frames_ == num_frames
+  mfccs[:, 0] = numpy.sqrt(numpy.mean(numpy.square(frames), axis=1))  # replace first MFCC with energy
+  return _split_stacked_features(mfccs, num_frames)
+
+
+def _get_audio_log_mel_filterbank_batch(
+      audios, sample_rate, window_len=0.025, step_len=0.010, num_feature_filters=80):
+  """
+  Batched variant of :func:`_get_audio_log_mel_filterbank`.
+
+  :param list[numpy.ndarray] audios: each shape (audio_len,)
+  :param int sample_rate:
+  :param float window_len: in seconds
+  :param float step_len: in seconds
+  :param int num_feature_filters:
+  :rtype: list[numpy.ndarray]
+  """
+  mel, num_frames = _get_stacked_mel_spectrogram(
+    audios, sample_rate=sample_rate, window_len=window_len, step_len=step_len,
+    num_feature_filters=num_feature_filters)
+  log_noise_floor = 1e-3  # prevent numeric overflow in log
+  return _split_stacked_features(numpy.log(numpy.maximum(log_noise_floor, mel)), num_frames)
+
+
+def _get_audio_db_mel_filterbank_batch(
+      audios, sample_rate, window_len=0.025, step_len=0.010, num_feature_filters=80, fmin=0, min_amp=1e-10):
+  """
+  Batched variant of :func:`_get_audio_db_mel_filterbank`.
+
+  :param list[numpy.ndarray] audios: each shape (audio_len,)
+  :param int sample_rate:
+  :param float window_len: in seconds
+  :param float step_len: in seconds
+  :param int num_feature_filters:
+  :param int fmin:
+  :param float min_amp:
+  :rtype: list[numpy.ndarray]
+  """
+  assert fmin >= 0
+  assert min_amp > 0
+  mel, num_frames = _get_stacked_mel_spectrogram(
+    audios, sample_rate=sample_rate, window_len=window_len, step_len=step_len,
+    num_feature_filters=num_feature_filters, fmin=fmin)
+  return _split_stacked_features(20 * numpy.log10(numpy.maximum(min_amp, mel)), num_frames)
+
+
+def _get_audio_log_log_mel_filterbank_batch(
+      audios, sample_rate, window_len=0.025, step_len=0.010, num_feature_filters=80):
+  """
+  Batched variant of :func:`_get_audio_log_log_mel_filterbank`.
+
+  :param list[numpy.ndarray] audios: each shape (audio_len,)
+  :param int sample_rate:
+  :param float window_len: in seconds
+  :param float step_len: in seconds
+  :param int num_feature_filters:
+  :rtype: list[numpy.ndarray]
+  """
+  mel, num_frames = _get_stacked_mel_spectrogram(
+    audios, sample_rate=sample_rate, window_len=window_len, step_len=step_len,
+    num_feature_filters=num_feature_filters)
+  log_noise_floor = 1e-3  # prevent numeric overflow in log
+  log_mel = numpy.log(numpy.maximum(log_noise_floor, mel))
+  # Like librosa.core.amplitude_to_db, with its default amin=1e-5.
+  return _split_stacked_features(_stacked_power_to_db(log_mel ** 2, num_frames, amin=1e-10), num_frames)
+
+
 def _get_random_permuted_audio(audio, sample_rate, opts, random_state):
   """
   :param numpy.ndarray audio: raw time signal
@@ -1865,6 +2535,36 @@ class Vocabulary(object):
       return [self.vocab.get(k, self.unknown_label_id) for k in seq]
     return [self.vocab[k] for k in seq]
 
+  def _get_seq_parts(self, sentence):
+    """
+    :param str sentence:
+    :return: label id chunks which concatenated give :func:`get_seq`
+    :rtype: list[typing.Sequence[int]]
+    """
+    return [self.get_seq(sentence)]
+
+  def get_seqs(self, sentences):
+    """
+    Batched variant of :func:`get_seq`.
+    All label ids are written into a single preallocated array, i.e. there are no per-sentence lists to concatenate.
+
+    :param list[str] sentences:
+    :return: (labels, offsets). labels is the flat concatenation of all seqs, int32, shape (total_len,),
+      offsets is int64, shape (len(sentences) + 1,), i.e. seq i is labels[offsets[i]:offsets[i + 1]]
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    seqs_parts = [self._get_seq_parts(sentence) for sentence in sentences]
+    offsets = numpy.zeros((len(sentences) + 1,), dtype="int64")
+    numpy.cumsum([sum([len(part) for part in parts]) for parts in seqs_parts], out=offsets[1:])
+    labels = numpy.empty((int(offsets[-1]),), dtype="int32")
+    pos = 0
+    for parts in seqs_parts:
+      for part in parts:
+        labels[pos:pos + len(part)] = part
+        pos += len(part)
+    assert pos == offsets[-1]
+    return labels, offsets
+
   def get_seq_labels(self, seq):
     """
     :param list[int] seq:
@@ -1887,12 +2587,13 @@ class BytePairEncoding(Vocabulary):
   Proceedings of the 54th Annual Meeting of the Association for Computational Linguistics (ACL 2016). Berlin, Germany.
   """
 
-  def __init__(self, vocab_file, bpe_file, seq_postfix=None, unknown_label="UNK"):
+  def __init__(self, vocab_file, bpe_file, seq_postfix=None, unknown_label="UNK", cache_size=100000):
     """
     :param str vocab_file:
     :param str bpe_file:
     :param list[int]|None seq_postfix: labels will be added to the seq in self.get_seq
     :param str|None unknown_label:
+    :param int cache_size: max number of words in the LRU cache of word -> label ids
     """
     super(BytePairEncoding, self).__init__(vocab_file=vocab_file, seq_postfix=seq_postfix, unknown_label=unknown_label)
     # check version information
@@ -1906,72 +2607,50 @@ class BytePairEncoding(Vocabulary):
     # some hacking to deal with duplicates (only consider first instance)
     self._bpe_codes = dict([(code, i) for (i, code) in reversed(list(enumerate(self._bpe_codes)))])
     self._bpe_codes_reverse = dict([(pair[0] + pair[1], pair) for pair, i in self._bpe_codes.items()])
-    self._bpe_encode_cache = {}
     self._bpe_separator = '@@'
-
-  @staticmethod
-  def _get_pairs(word):
-    """
-    :param tuple[str] word: represented as tuple of symbols (symbols being variable-length strings)
-    :return: set of symbol pairs in a word
-    :rtype: set[(str,str)]
-    """
-    pairs = set()
-    prev_char = word[0]
-    for char in word[1:]:
-      pairs.add((prev_char, char))
-      prev_char = char
-    return pairs
+    from collections import OrderedDict
+    self._cache_size = cache_size
+    self._bpe_encode_cache = OrderedDict()  # word -> tuple of label ids, LRU order (most recently used last)
 
   def _encode_word(self, orig):
     """
     Encode word based on list of BPE merge operations, which are applied consecutively.
+    In every step, the adjacent pair with the lowest merge rank (see self._bpe_codes) is merged.
+
     :param str orig:
-    :rtype: tuple[str]
+    :rtype: tuple[str]|list[str]|str
     """
-
-    if orig in self._bpe_encode_cache:
-      return self._bpe_encode_cache[orig]
-
     if self._bpe_file_version == (0, 1):
-      word = tuple(orig) + ('</w>',)
+      word = list(orig) + ['</w>']
     elif self._bpe_file_version == (0, 2):  # more consistent handling of word-final segments
-      word = tuple(orig[:-1]) + (orig[-1] + '</w>',)
+      word = list(orig[:-1]) + [orig[-1] + '</w>']
     else:
       raise NotImplementedError
 
-    pairs = self._get_pairs(word)
-    if not pairs:
+    if len(word) < 2:
       return orig
 
-    while True:
-      bigram = min(pairs, key=lambda pair: self._bpe_codes.get(pair, float('inf')))
-      if bigram not in self._bpe_codes:
+    bpe_codes = self._bpe_codes
+    while len(word) > 1:
+      best_rank, best_pair = None, None
+      for pair in zip(word[:-1], word[1:]):
+        rank = bpe_codes.get(pair)
+        if rank is not None and (best_rank is None or rank < best_rank):
+          best_rank, best_pair = rank, pair
+      if best_pair is None:
         break
-      first, second = bigram
+      first, second = best_pair
       new_word = []
       i = 0
       while i < len(word):
-        try:
-          j = word.index(first, i)
-          new_word.extend(word[i:j])
-          i = j
-        except ValueError:
-          new_word.extend(word[i:])
-          break
-
         if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
           new_word.append(first + second)
           i += 2
         else:
           new_word.append(word[i])
           i += 1
-      new_word = tuple(new_word)
       word = new_word
-      if len(word) == 1:
-        break
-      else:
-        pairs = self._get_pairs(word)
+    word = tuple(word)
 
     # don't print end-of-word symbols
     if word[-1] == '</w>':
@@ -1982,9 +2661,28 @@ class BytePairEncoding(Vocabulary):
     if self.labels:
       word = self.check_vocab_and_split(word, self._bpe_codes_reverse, self.labels, self._bpe_separator)
 
-    self._bpe_encode_cache[orig] = word
     return word
 
+  def _get_word_label_ids(self, word):
+    """
+    :param str word: single word, which will be BPE encoded
+    :return: label ids of the BPE segments. cached in a LRU cache
+    :rtype: tuple[int]
+    """
+    cache = self._bpe_encode_cache
+    if word in cache:
+      label_ids = cache.pop(word)
+      cache[word] = label_ids  # mark as most recently used
+      return label_ids
+    segments = self._encode_word(word)
+    label_ids = tuple(self.get_seq_indices(
+      [segment + self._bpe_separator for segment in segments[:-1]] + [segments[-1]]))
+    if self._cache_size > 0:
+      cache[word] = label_ids
+      if len(cache) > self._cache_size:
+        cache.popitem(last=False)  # least recently used
+    return label_ids
+
   def check_vocab_and_split(self, orig, bpe_codes, vocab, separator):
     """Check for each segment in word if it is in-vocabulary,
     and segment OOV segments into smaller units by reversing the BPE merge operations"""
@@ -2037,46 +2735,54 @@ class BytePairEncoding(Vocabulary):
       for item in self.recursive_split(right, bpe_codes, vocab, separator, final):
         yield item
 
-  def _segment_sentence(self, sentence):
+  @staticmethod
+  def _iter_sentence_words(sentence):
     """
-    Segment single sentence (whitespace-tokenized string) with BPE encoding.
-    :param str sentence:
-    :rtype: list[str]
+    :param str sentence: whitespace-tokenized string
+    :return: yields (word, whether to BPE encode it). category words ($...{...}) are kept as-is
+    :rtype: typing.Iterator[(str,bool)]
     """
-
-    output = []
-
     found_category = False
     skip_category = False
 
     for word in sentence.split():
       if word[0] == '$' and len(word) > 1:
         found_category = True
-        output.append(word)
+        yield word, False
       elif found_category is True and word[0] == '{':
         skip_category = True
-        output.append(word)
+        yield word, False
       elif skip_category is True and word[0] != '}':
-        output.append(word)
+        yield word, False
       else:
         found_category = False
         skip_category = False
-        new_word = self._encode_word(word)
+        yield word, True
 
-        for item in new_word[:-1]:
-          output.append(item + self._bpe_separator)
-        output.append(new_word[-1])
-
-    return output
+  def _get_seq_parts(self, sentence):
+    """
+    :param str sentence:
+    :return: label id chunks, mostly the tuples from the word cache, and the seq postfix
+    :rtype: list[typing.Sequence[int]]
+    """
+    parts = []
+    for word, encode in self._iter_sentence_words(sentence):
+      if encode:
+        parts.append(self._get_word_label_ids(word))
+      else:
+        parts.append(self.get_seq_indices([word]))
+    parts.append(self.seq_postfix)
+    return parts
 
   def get_seq(self, sentence):
     """
     :param str sentence:
     :rtype: list[int]
     """
-    segments = self._segment_sentence(sentence)
-    seq = self.get_seq_indices(segments)
-    return seq + self.seq_postfix
+    seq = []
+    for part in self._get_seq_parts(sentence):
+      seq.extend(part)
+    return seq
 
 
 class CharacterTargets(Vocabulary):
@@ -2591,6 +3297,8 @@ class OggZipDataset(CachedDataset2):
                use_cache_manager=False,
                fixed_random_seed=None, fixed_random_subset=None,
                epoch_wise_filter=None,
+               feature_cache=None,
+               batch_feature_extraction=False,
                **kwargs):
     """
     :param str path: filename to zip
@@ -2604,6 +3312,12 @@ class OggZipDataset(CachedDataset2):
       If given, will use this random subset. This will be applied initially at loading time,
       i.e. not dependent on the epoch. It will use an internally hardcoded fixed random seed, i.e. it's deterministic.
     :param dict|None epoch_wise_filter: see init_seq_order
+    :param str|dict[str]|None feature_cache: filename, or kwargs for :class:`FeatureCacheFile`.
+      If given, the extracted features are cached there, so that only the first epoch needs to extract them.
+      The cache can also be prebuilt via ``tools/build-feature-cache.py``.
+    :param bool batch_feature_extraction: extracts the features of all seqs of a :func:`load_seqs` call at once,
+      via :func:`ExtractAudioFeatures.get_audio_features_batch`. Much faster, but computed in float32.
+      Not used together with the ``read_ahead`` option (see :class:`CachedDataset2`).
     """
     import os
     import zipfile
@@ -2640,6 +3354,18 @@ class OggZipDataset(CachedDataset2):
     self.feature_extractor = (
       ExtractAudioFeatures(random_state=self._audio_random, **audio) if audio is not None else None)
     self.num_inputs = self.feature_extractor.get_feature_dimension() if self.feature_extractor else 0
+    self.feature_cache = None  # type: typing.Optional[FeatureCacheFile]
+    self._feature_cache_opts_hash = None  # type: typing.Optional[str]
+    self._batch_feature_extraction = batch_feature_extraction
+    self._prefetched_features = {}  # type: typing.Dict[int,numpy.ndarray]  # seq_idx -> features
+    if feature_cache and self.feature_extractor:
+      self._feature_cache_opts_hash = self.feature_extractor.get_cache_hash()
+      if self._feature_cache_opts_hash is None:
+        print("%s: feature extraction is not deterministic, feature cache is disabled" % self, file=log.v2)
+      else:
+        if isinstance(feature_cache, str):
+          feature_cache = {"filename": feature_cache}
+        self.feature_cache = FeatureCacheFile(**feature_cache)
     self.num_outputs = {"raw": {"dtype": "string", "shape": ()}}
     if self.targets:
       self.num_outputs["classes"] = [self.targets.num_labels, 1]
@@ -2839,6 +3565,54 @@ class OggZipDataset(CachedDataset2):
     raw_bytes = self._read(audio_fn, seq['_zip_file_index'])
     return io.BytesIO(raw_bytes)
 
+  def _get_feature_cache_key(self, seq_idx):
+    """
+    :param int seq_idx:
+    :return: key for :class:`FeatureCacheFile`, from the audio file (name and checksum) and the feature options
+    :rtype: bytes
+    """
+    import os
+    seq = self._data[self._get_ref_seq_idx(seq_idx)]
+    zip_index = seq['_zip_file_index']
+    audio_fn = "%s/%s" % (self._names[zip_index], seq["file"])
+    if self._zip_files is not None:
+      info = self._zip_files[zip_index].getinfo(audio_fn)
+      file_id = (info.CRC, info.file_size)
+    else:
+      st = os.stat("%s/%s" % (self.paths[0], audio_fn))
+      file_id = (st.st_mtime, st.st_size)
+    return FeatureCacheFile.make_key(self._feature_cache_opts_hash, audio_fn, file_id)
+
+  def _load_seqs(self, start, end):
+    """
+    :param int start: inclusive seq idx start
+    :param int end: exclusive seq idx end
+    """
+    # With read-ahead, _collect_single_seq runs in the read-ahead thread,
+    # and we must not access the audio files concurrently here.
+    if self._batch_feature_extraction and self.feature_extractor and not self._read_ahead:
+      new_start = max(self.added_data[-1].seq_idx + 1, start) if self.added_data else start
+      seq_idxs = []
+      for seq_idx in range(new_start, min(end, self.num_seqs)):
+        if self.feature_cache:
+          features = self.feature_cache.get(self._get_feature_cache_key(seq_idx))
+          if features is not None:
+            self._prefetched_features[seq_idx] = features
+            continue
+        seq_idxs.append(seq_idx)
+      if seq_idxs:
+        raw_bytes_list = [self._open_audio_file(seq_idx) for seq_idx in seq_idxs]
+        features_list = self.feature_extractor.get_audio_features_from_raw_bytes_batch(
+          raw_bytes_list, seq_names=[self.get_tag(seq_idx) for seq_idx in seq_idxs])
+        for seq_idx, features in zip(seq_idxs, features_list):
+          self._prefetched_features[seq_idx] = features
+          if self.feature_cache:
+            self.feature_cache.add(self._get_feature_cache_key(seq_idx), features)
+    try:
+      super(OggZipDataset, self)._load_seqs(start=start, end=end)
+    finally:
+      self._prefetched_features.clear()
+
   def _collect_single_seq(self, seq_idx):
     """
     :param int seq_idx:
@@ -2846,8 +3620,16 @@ class OggZipDataset(CachedDataset2):
     """
     seq_tag = self.get_tag(seq_idx)
     if self.feature_extractor:
-      with self._open_audio_file(seq_idx) as audio_file:
-        features = self.feature_extractor.get_audio_features_from_raw_bytes(audio_file, seq_name=seq_tag)
+      features = self._prefetched_features.pop(seq_idx, None)
+      cache_key = None
+      if features is None and self.feature_cache:
+        cache_key = self._get_feature_cache_key(seq_idx)
+        features = self.feature_cache.get(cache_key)
+      if features is None:
+        with self._open_audio_file(seq_idx) as audio_file:
+          features = self.feature_extractor.get_audio_features_from_raw_bytes(audio_file, seq_name=seq_tag)
+        if self.feature_cache:
+          self.feature_cache.add(cache_key, features)
     else:
       features = numpy.zeros(())  # currently the API requires some dummy values...
     targets, txt = self._get_transcription(seq_idx)
@@ -4,6 +4,7 @@ Provides :class:`HDFDataset`.
 """
 
 from __future__ import print_function
+import sys
 import typing
 import collections
 import gc
@@ -30,17 +31,25 @@ class HDFDataset(CachedDataset):
   This was the main original dataset format of RETURNN.
   """
 
-  def __init__(self, files=None, use_cache_manager=False, **kwargs):
+  def __init__(self, files=None, use_cache_manager=False, use_mmap=False, **kwargs):
     """
     :param None|list[str] files:
     :param bool use_cache_manager: uses :func:`Util.cf` for files
+    :param bool use_mmap: memory-map the contiguous uncompressed datasets ("inputs", "targets/data/*")
+      read-only via their HDF5 offsets, such that :func:`get_data` returns views without copying.
+      Datasets which are chunked or compressed are still read via h5py.
+      Requires cache_byte_size=0.
     """
     super(HDFDataset, self).__init__(**kwargs)
     assert self.partition_epoch == 1 or self.cache_byte_size_total_limit == 0, \
       "To use partition_epoch in HDFDatasets, disable caching by setting cache_byte_size=0"
+    assert not use_mmap or self.cache_byte_size_total_limit == 0, \
+      "To use use_mmap in HDFDatasets, disable caching by setting cache_byte_size=0"
     self._use_cache_manager = use_cache_manager
+    self._use_mmap = use_mmap
     self.files = []  # type: typing.List[str]  # file names
     self.h5_files = []  # type: typing.List[h5py.File]
+    self.mmap_data = []  # type: typing.List[typing.Dict[str,numpy.ndarray]]  # per file, key -> mmap, if use_mmap
     self.file_start = [0]
     self.file_seq_start = []  # type: typing.List[numpy.ndarray]
     self.data_dtype = {}  # type: typing.Dict[str,str]
@@ -57,6 +66,7 @@ class HDFDataset(CachedDataset):
       except Exception:  # e.g. at shutdown. but does not matter
         pass
     del self.h5_files[:]
+    del self.mmap_data[:]
     del self.file_seq_start[:]
 
   @staticmethod
@@ -74,6 +84,23 @@ class HDFDataset(CachedDataset):
     s = s.split('\0')[0]
     return s
 
+  @staticmethod
+  def _mmap_h5_dataset(filename, h5_dataset):
+    """
+    :param str filename:
+    :param h5py.Dataset h5_dataset:
+    :return: read-only memory map of the raw data, or None if it is not stored contiguously and uncompressed
+    :rtype: numpy.memmap|None
+    """
+    if h5_dataset.chunks is not None or h5_dataset.compression is not None:
+      return None
+    if h5_dataset.dtype.hasobject or h5_dataset.size == 0:
+      return None
+    offset = h5_dataset.id.get_offset()
+    if offset is None:  # e.g. storage not allocated
+      return None
+    return numpy.memmap(filename, mode="r", dtype=h5_dataset.dtype, offset=offset, shape=h5_dataset.shape)
+
   def add_file(self, filename):
     """
     Setups data:
@@ -97,6 +124,14 @@ class HDFDataset(CachedDataset):
     self.files.append(filename)
     self.h5_files.append(fin)
     print("parsing file", filename, file=log.v5)
+    if self._use_mmap:
+      mmap_data = {"data": self._mmap_h5_dataset(filename, fin["inputs"])}
+      if 'targets' in fin:
+        for k in fin['targets/data']:
+          mmap_data[k] = self._mmap_h5_dataset(filename, fin['targets/data'][k])
+      mmap_data = {k: v for (k, v) in mmap_data.items() if v is not None}
+      print("mmap file %s, keys %r" % (filename, sorted(mmap_data.keys())), file=log.v5)
+      self.mmap_data.append(mmap_data)
     if 'times' in fin:
       if self.timestamps is None:
         self.timestamps = fin[attr_times][...]
@@ -270,13 +305,19 @@ class HDFDataset(CachedDataset):
     end_pos = self.file_seq_start[file_idx][real_file_seq_idx + 1]
 
     if key == "data":
-      inputs = fin['inputs']
+      if self._use_mmap and key in self.mmap_data[file_idx]:
+        inputs = self.mmap_data[file_idx][key]
+      else:
+        inputs = fin['inputs']
       data = inputs[start_pos[0]:end_pos[0]]
       if self.window > 1:
         data = self.sliding_window(data)
     else:
-      assert 'targets' in fin
-      targets = fin['targets/data/' + key]
+      if self._use_mmap and key in self.mmap_data[file_idx]:
+        targets = self.mmap_data[file_idx][key]
+      else:
+        assert 'targets' in fin
+        targets = fin['targets/data/' + key]
       ldx = self.target_keys.index(key) + 1
       data = targets[start_pos[ldx]:end_pos[ldx]]
     return data
@@ -314,6 +355,20 @@ class HDFDataset(CachedDataset):
 
     return end_pos - start_pos
 
+  def get_all_seq_lengths(self):
+    """
+    :return: data-key -> seq lengths, for all seqs of the current epoch, in the current seq order
+    :rtype: dict[str,numpy.ndarray]
+    """
+    seq_lengths = numpy.concatenate(
+      [seq_start[1:] - seq_start[:-1] for seq_start in self.file_seq_start], axis=0)  # (total num seqs, num keys)
+    real_seq_idxs = numpy.array(self._seq_index, dtype="int64")[numpy.array(self._index_map, dtype="int64")]
+    seq_lengths = seq_lengths[real_seq_idxs]
+    res = {"data": seq_lengths[:, 0]}
+    for i, key in enumerate(self.target_keys):
+      res[key] = seq_lengths[:, i + 1]
+    return res
+
   def _get_tag_by_real_idx(self, real_seq_idx):
     file_idx = self._get_file_index(real_seq_idx)
     real_file_seq_idx = real_seq_idx - self.file_start[file_idx]
@@ -879,9 +934,17 @@ class SimpleHDFWriter:
   which can be read later by :class:`HDFDataset`.
 
   Note that we dump to a temp file first, and only at :func:`close` we move it over to the real destination.
+  With ``resume_partial``, the temp file is ``<filename>.partial``,
+  and it is flushed after every :func:`insert_batch`,
+  such that a later writer for the same filename can continue where this one stopped (e.g. after a crash).
   """
 
-  def __init__(self, filename, dim, labels=None, ndim=None, extra_type=None, swmr=False):
+  # When the data needs to grow, we allocate at least that factor of the current size (or this number of frames),
+  # to avoid a HDF resize for every single seq. The unused space is cut off in close().
+  _preallocate_factor = 2.0
+  _preallocate_min_steps = 1000
+
+  def __init__(self, filename, dim, labels=None, ndim=None, extra_type=None, swmr=False, resume_partial=False):
     """
     :param str filename: Create file, truncate if exists
     :param int|None dim:
@@ -889,6 +952,7 @@ class SimpleHDFWriter:
     :param list[str]|None labels:
     :param dict[str,(int,int,str)]|None extra_type: key -> (dim,ndim,dtype)
     :param bool swmr: see http://docs.h5py.org/en/stable/swmr.html
+    :param bool resume_partial: write to <filename>.partial, and continue it if it exists. see :func:`get_seq_tags`
     """
     from Util import hdf5_strings, unicode
     import tempfile
@@ -907,8 +971,22 @@ class SimpleHDFWriter:
     # By default, we should not override existing data.
     # If we want that at some later point, we can introduce an option for it.
     assert not os.path.exists(self.filename)
-    tmp_fd, self.tmp_filename = tempfile.mkstemp(suffix=".hdf")
-    os.close(tmp_fd)
+    self.resume_partial = resume_partial
+    self._datasets = {}  # type: typing.Dict[str, h5py.Dataset]  # key -> data
+    self._extra_num_time_steps = {}  # type: typing.Dict[str,int]  # key -> num-steps
+    self._prepared_extra = set()
+    # Like the attribs numSeqs and numTimesteps, but those are only updated at the end of insert_batch.
+    self._num_seqs = 0
+    self._num_timesteps = 0
+    if resume_partial:
+      self.tmp_filename = "%s.partial" % filename
+      if os.path.exists(self.tmp_filename):
+        self._file = h5py.File(self.tmp_filename, "a")
+        self._load_partial()
+        return
+    else:
+      tmp_fd, self.tmp_filename = tempfile.mkstemp(suffix=".hdf")
+      os.close(tmp_fd)
     self._file = h5py.File(self.tmp_filename, "w", libver='latest' if swmr else None)
 
     self._file.attrs['numTimesteps'] = 0  # we will increment this on-the-fly
@@ -921,7 +999,6 @@ class SimpleHDFWriter:
     else:
       self._file.create_dataset('labels', (0,), dtype="S5")  # dtype string length does not matter
 
-    self._datasets = {}  # type: typing.Dict[str, h5py.Dataset]  # key -> data
     # seq_length idx represents (seq_idx,data_key_idx),
     # where data_key_idx == 0 is for the main input data,
     # and otherwise data_key_idx == 1 + sorted(self._prepared_extra).index(data_key).
@@ -933,8 +1010,6 @@ class SimpleHDFWriter:
     dt = h5py.special_dtype(vlen=unicode)
     self._seq_tags = self._file.create_dataset('seqTags', (0,), dtype=dt, maxshape=(None,))
 
-    self._extra_num_time_steps = {}  # type: typing.Dict[str,int]  # key -> num-steps
-    self._prepared_extra = set()
     if extra_type:
       self._prepare_extra(extra_type)
 
@@ -949,6 +1024,44 @@ class SimpleHDFWriter:
       self._file.close()
       self._file = None
 
+  def _load_partial(self):
+    """
+    Continue the existing partial file.
+    Everything after the last complete :func:`insert_batch` (numSeqs, numTimesteps) is discarded.
+    """
+    assert self._file.attrs['inputPattSize'] == (self.dim or 1), "%s: dim mismatch in partial file" % self
+    self._num_seqs = int(self._file.attrs['numSeqs'])
+    self._num_timesteps = int(self._file.attrs['numTimesteps'])
+    self._seq_lengths = self._file["seqLengths"]
+    self._seq_tags = self._file["seqTags"]
+    self._seq_lengths.resize(self._num_seqs, axis=0)
+    self._seq_tags.resize(self._num_seqs, axis=0)
+    if "inputs" in self._file:
+      self._datasets["inputs"] = self._file["inputs"]
+    if "targets/data" in self._file:
+      for data_key_idx_0, data_key in enumerate(sorted(self._file["targets/data"].keys())):
+        self._datasets[data_key] = self._file["targets/data"][data_key]
+        self._prepared_extra.add(data_key)
+        self._extra_num_time_steps[data_key] = int(numpy.sum(self._seq_lengths[:, data_key_idx_0 + 1]))
+    print("%s: continue partial file %r with %i seqs." % (self, self.tmp_filename, self._num_seqs), file=log.v3)
+
+  def get_seq_tags(self):
+    """
+    :return: seq tags which were already written, e.g. when we continue a partial file (see resume_partial)
+    :rtype: list[str]
+    """
+    return [tag.decode("utf8") if isinstance(tag, bytes) else tag for tag in self._seq_tags[:self._num_seqs]]
+
+  def _reserve(self, hdf_data, size):
+    """
+    :param h5py.Dataset hdf_data:
+    :param int size: needed size of the first axis
+    """
+    if hdf_data.shape[0] >= size:
+      return
+    hdf_data.resize(
+      max(size, int(hdf_data.shape[0] * self._preallocate_factor), self._preallocate_min_steps), axis=0)
+
   def _prepare_extra(self, extra_type):
     """
     :param dict[str,(int,int,str)] extra_type: key -> (dim,ndim,dtype)
@@ -998,12 +1111,11 @@ class SimpleHDFWriter:
       self._datasets[name] = self._file.create_dataset(
         name, raw_data.shape, raw_data.dtype, maxshape=tuple(None for _ in raw_data.shape))
     else:
-      old_shape = self._datasets[name].shape
-      self._datasets[name].resize(old_shape[0] + raw_data.shape[0], axis=0)
+      self._reserve(self._datasets[name], self._num_timesteps + raw_data.shape[0])
     # append raw data to dataset
-    self._datasets[name][self._file.attrs['numTimesteps']:] = raw_data
-    self._file.attrs['numTimesteps'] += raw_data.shape[0]
-    self._file.attrs['numSeqs'] += 1
+    self._datasets[name][self._num_timesteps:self._num_timesteps + raw_data.shape[0]] = raw_data
+    self._num_timesteps += raw_data.shape[0]
+    self._num_seqs += 1
 
   def _insert_h5_other(self, data_key, raw_data, dtype=None, add_time_dim=False, dim=None):
     """
@@ -1028,10 +1140,10 @@ class SimpleHDFWriter:
         dim = 1  # dummy
 
     # We assume that _insert_h5_inputs was called before.
-    assert self._file.attrs['numSeqs'] > 0 and self._seq_lengths.shape[0] > 0
-    seq_idx = self._file.attrs['numSeqs'] - 1
+    assert self._num_seqs > 0 and self._seq_lengths.shape[0] > 0
+    seq_idx = self._num_seqs - 1
 
-    if raw_data.dtype == numpy.object:
+    if raw_data.dtype == object:
       # Is this a string?
       assert isinstance(raw_data.flat[0], (str, bytes))
       dtype = "string"
@@ -1045,14 +1157,14 @@ class SimpleHDFWriter:
         self._seq_lengths[seq_idx, data_key_idx_0 + 1] = self._extra_num_time_steps[data_key_]
 
     self._extra_num_time_steps[data_key] += raw_data.shape[0]
-    self._datasets[data_key].resize(self._extra_num_time_steps[data_key], axis=0)
+    self._reserve(self._datasets[data_key], self._extra_num_time_steps[data_key])
 
     data_key_idx = sorted(self._prepared_extra).index(data_key) + 1
     self._seq_lengths[seq_idx, data_key_idx] = raw_data.shape[0]
 
     offset = self._extra_num_time_steps[data_key] - raw_data.shape[0]
     hdf_data = self._datasets[data_key]
-    hdf_data[offset:] = raw_data
+    hdf_data[offset:offset + raw_data.shape[0]] = raw_data
 
   def insert_batch(self, inputs, seq_len, seq_tag, extra=None):
     """
@@ -1125,6 +1237,17 @@ class SimpleHDFWriter:
             file=log.v3)
           raise
 
+    self._commit()
+
+  def _commit(self):
+    """
+    Marks all inserted seqs as complete.
+    """
+    self._file.attrs['numTimesteps'] = self._num_timesteps
+    self._file.attrs['numSeqs'] = self._num_seqs
+    if self.resume_partial:
+      self._file.flush()
+
   def close(self):
     """
     Closes the file.
@@ -1132,15 +1255,94 @@ class SimpleHDFWriter:
     import os
     import shutil
     if self._file:
+      # Cut off the preallocated space.
+      if "inputs" in self._datasets:
+        self._datasets["inputs"].resize(self._num_timesteps, axis=0)
+      for data_key, num_time_steps in self._extra_num_time_steps.items():
+        self._datasets[data_key].resize(num_time_steps, axis=0)
+      self._commit()
       self._file.close()
       self._file = None
     if self.tmp_filename:
       assert not os.path.exists(self.filename)
-      shutil.copyfile(self.tmp_filename, self.filename)
-      os.remove(self.tmp_filename)
+      if self.resume_partial:
+        os.rename(self.tmp_filename, self.filename)
+      else:
+        shutil.copyfile(self.tmp_filename, self.filename)
+        os.remove(self.tmp_filename)
       self.tmp_filename = None
 
 
+class BackgroundHDFWriter:
+  """
+  Wraps a :class:`SimpleHDFWriter`, and does the writing in a background thread,
+  such that :func:`insert_batch` usually returns immediately.
+  The queue is bounded, such that the writer cannot lag behind arbitrarily.
+  """
+
+  def __init__(self, writer, max_queue_size=10):
+    """
+    :param SimpleHDFWriter writer:
+    :param int max_queue_size: number of batches
+    """
+    from threading import Thread
+    try:
+      # noinspection PyCompatibility
+      from queue import Queue
+    except ImportError:  # Python 2
+      # noinspection PyUnresolvedReferences,PyCompatibility
+      from Queue import Queue
+    self.writer = writer
+    self._queue = Queue(maxsize=max_queue_size)
+    self._exc_info = None
+    self._thread = Thread(target=self._thread_main, name="%r writer" % writer.filename)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _thread_main(self):
+    while True:
+      kwargs = self._queue.get()
+      if kwargs is None:
+        return
+      if self._exc_info:
+        continue  # skip, but continue to consume the queue, such that insert_batch does not block
+      # noinspection PyBroadException
+      try:
+        self.writer.insert_batch(**kwargs)
+      except Exception:
+        self._exc_info = sys.exc_info()
+
+  def _check_exception(self):
+    if self._exc_info:
+      exc_info = self._exc_info
+      if sys.version_info[0] >= 3:
+        raise exc_info[1].with_traceback(exc_info[2])
+      raise exc_info[1]
+
+  def insert_batch(self, inputs, seq_len, seq_tag, extra=None):
+    """
+    See :func:`SimpleHDFWriter.insert_batch`. The arrays must not be modified afterwards.
+
+    :param numpy.ndarray inputs:
+    :param list[int]|dict[int,list[int]|numpy.ndarray] seq_len:
+    :param list[str|bytes] seq_tag:
+    :param dict[str,numpy.ndarray]|None extra:
+    """
+    self._check_exception()
+    self._queue.put(dict(inputs=inputs, seq_len=seq_len, seq_tag=seq_tag, extra=extra))
+
+  def close(self):
+    """
+    Waits until everything is written, and closes the writer.
+    """
+    if self._thread:
+      self._queue.put(None)
+      self._thread.join()
+      self._thread = None
+    self._check_exception()
+    self.writer.close()
+
+
 class HDFDatasetWriter:
   """
   Similar as :class:`SimpleHDFWriter`, but is mostly intended to copy an existing dataset,
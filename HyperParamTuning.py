@@ -14,15 +14,21 @@ The current logic probably can be improved.
 Currently, each search is a training started from the scratch, and the accumulated train score
 is used as an evaluation measure.
 This probably also can be improved.
-Also, instead of always starting from scratch, we could keep intermediate results and resume from them,
-or use real training intermediate results and resume from them.
 We could even do some simple search in the beginning of each epoch when we keep it cheap enough.
 
-Also, we could store the population of hyper params on disk to allow resuming of a search.
+With ``"use_processes": True`` in the ``hyper_param_tuning`` options, each individual is trained
+in its own RETURNN subprocess (so a crash only loses that individual),
+and multiple individuals are packed on one GPU according to ``"memory_per_individual"`` (in MB).
+The individuals are then trained for multiple (sub) epochs with successive halving:
+all are trained for ``"min_num_epochs"``, then only the best ``1 / "halving_factor"`` of them
+(by the :class:`LearningRateControl` score) are continued, up to ``"max_num_epochs"``.
+The models and logs are kept in ``"work_dir"``,
+and the population is stored in ``"population_file"``, such that a search can be resumed.
 """
 
 from __future__ import print_function
 
+import os
 import sys
 import time
 import numpy
@@ -32,7 +38,7 @@ from Log import log
 from Dataset import Dataset
 from GeneratingDataset import StaticDataset
 from TFEngine import Engine, Runner, CancelTrainingException
-from Util import CollectionReadCheckCovered, hms_fraction, guess_requested_max_num_threads
+from Util import CollectionReadCheckCovered, hms, hms_fraction, guess_requested_max_num_threads
 
 
 Eps = 1e-16
@@ -239,6 +245,25 @@ class HyperParam:
       x = 1.0
     return self.get_value(x, eps=eps)
 
+  def encode_value(self, value):
+    """
+    :param float|int|bool|object value: valid value for this `HyperParam`
+    :return: JSON-serializable value, see :func:`decode_value`
+    :rtype: float|int|bool
+    """
+    if self.classes is not None:
+      return self.classes.index(value)
+    return self.dtype(value)
+
+  def decode_value(self, value):
+    """
+    :param float|int|bool value: from :func:`encode_value`
+    :rtype: float|int|bool|object
+    """
+    if self.classes is not None:
+      return self.classes[value]
+    return self.dtype(value)
+
   def get_random_value_by_idx(self, iteration_idx, individual_idx):
     """
     :param int iteration_idx:
@@ -264,6 +289,7 @@ class Individual:
     """
     self.hyper_param_mapping = hyper_param_mapping
     self.cost = None
+    self.num_epochs = 0  # for which the cost was calculated
     self.name = name
 
   def cross_over(self, hyper_params, population, random_seed):
@@ -320,7 +346,21 @@ class Optimization:
       "num_kill_individuals", self.num_individuals // 2)
     self.num_best = self.opts.get("num_best", 10)
     self.num_threads = self.opts.get("num_threads", guess_requested_max_num_threads())
+    self.use_processes = self.opts.get("use_processes", False)
+    self.work_dir = self.opts.get("work_dir", "hyper-param-tuning")
+    self.population_file = self.opts.get(
+      "population_file", os.path.join(self.work_dir, "population.json") if self.use_processes else None)
+    self.memory_per_individual = self.opts.get("memory_per_individual", None)  # in MB. by default one per GPU
+    self.min_num_epochs = self.opts.get("min_num_epochs", 1)
+    self.max_num_epochs = self.opts.get("max_num_epochs", self.min_num_epochs)
+    self.halving_factor = self.opts.get("halving_factor", 2)
     self.opts.assert_all_read()
+    assert 1 <= self.min_num_epochs <= self.max_num_epochs and self.halving_factor >= 2
+    if not self.use_processes:
+      assert self.max_num_epochs == 1, "hyper_param_tuning: multiple epochs need use_processes"
+    # The command line of a worker (see _IndividualProcess). We assume that we were started via rnn.py.
+    self.worker_args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "rnn.py")]
+    self.worker_args += sys.argv[1:]
 
   def _find_hyper_params(self, base=None, visited=None):
     """
@@ -388,10 +428,11 @@ class Optimization:
         population=population[:i] + population[i + 1:],
         random_seed=iteration_idx * 1013 + i * 17)
 
-  def create_config_instance(self, hyper_param_mapping, gpu_ids):
+  def create_config_instance(self, hyper_param_mapping, gpu_ids, gpu_memory_fraction=None):
     """
     :param dict[HyperParam] hyper_param_mapping: maps each hyper param to some value
     :param set[int] gpu_ids:
+    :param float|None gpu_memory_fraction: if given, limits the GPU memory of the TF session
     :rtype: Config
     """
     assert set(self.hyper_params) == set(hyper_param_mapping.keys())
@@ -407,15 +448,98 @@ class Optimization:
     gpu_opts = tf_session_opts.setdefault("gpu_options", tf.GPUOptions())
     if isinstance(gpu_opts, dict):
       gpu_opts = tf.GPUOptions(**gpu_opts)
+      tf_session_opts["gpu_options"] = gpu_opts
     gpu_opts.visible_device_list = ",".join(map(str, sorted(gpu_ids)))
+    if gpu_memory_fraction:
+      gpu_opts.per_process_gpu_memory_fraction = gpu_memory_fraction
     return config
 
   def work(self):
-    print("Starting hyper param search. Using %i threads." % self.num_threads, file=log.v1)
+    if self.use_processes:
+      print("Starting hyper param search. Using up to %i processes, work dir %r." % (
+        self.num_threads, self.work_dir), file=log.v1)
+    else:
+      print("Starting hyper param search. Using %i threads." % self.num_threads, file=log.v1)
+    best_individuals = []
+    population = []
+    start_iteration_idx = 1
+    if self.population_file and os.path.exists(self.population_file):
+      start_iteration_idx, population, best_individuals = self.load_population(self.population_file)
+      print("Resume search from %r in iteration %i." % (self.population_file, start_iteration_idx), file=log.v2)
+    canceled = False
+    try:
+      print("Population of %i individuals (hyper param setting instances), running for %i evaluation iterations." % (
+        self.num_individuals, self.num_iterations), file=log.v2)
+      for cur_iteration_idx in range(start_iteration_idx, self.num_iterations + 1):
+        print("Starting iteration %i." % cur_iteration_idx, file=log.v2)
+        if cur_iteration_idx > start_iteration_idx or not population:  # otherwise resumed
+          if cur_iteration_idx == 1:
+            population.append(Individual(
+              {p: p.get_default_value() for p in self.hyper_params}, name="default"))
+            population.append(Individual(
+              {p: p.get_initial_value() for p in self.hyper_params}, name="canonical"))
+          population.extend(self.get_population(
+            iteration_idx=cur_iteration_idx, num_individuals=self.num_individuals - len(population)))
+          if cur_iteration_idx > 1:
+            self.cross_over(population=population, iteration_idx=cur_iteration_idx)
+
+        def save_population():
+          """
+          Stores the current state, such that we can resume in this iteration.
+          """
+          if self.population_file:
+            self.save_population(
+              self.population_file, iteration_idx=cur_iteration_idx,
+              population=population, best_individuals=best_individuals)
+
+        save_population()
+        iteration_start_time = time.time()
+        if self.use_processes:
+          self._train_population_processes(population, on_rung_finished=save_population)
+        else:
+          if cur_iteration_idx == 1 and self.dry_run_first_individual:
+            # Train first directly for testing and to see log output.
+            # Later we will strip away all log output.
+            print("Very first try with log output:", file=log.v2)
+            _IndividualTrainer(optim=self, individual=population[0], gpu_ids={0}).run()
+          self._train_population_threads(population)
+        print("Training iteration elapsed time:", hms(time.time() - iteration_start_time))
+        print("Training iteration finished.")
+        # With successive halving, the ones which were trained for more epochs are the better ones.
+        population.sort(key=lambda p: (-p.num_epochs, p.cost))
+        del population[-self.num_kill_individuals:]
+        best_individuals.extend([p for p in population if not any([p is q for q in best_individuals])])
+        best_individuals.sort(key=lambda p: (-p.num_epochs, p.cost))
+        del best_individuals[self.num_best:]
+        population = best_individuals[:self.num_kill_individuals // 4] + population
+        print("Current best setting, individual %s" % best_individuals[0].name, "cost:", best_individuals[0].cost)
+        for p in self.hyper_params:
+          print(" %s -> %s" % (p.description(), best_individuals[0].hyper_param_mapping[p]))
+      if self.population_file:
+        self.save_population(
+          self.population_file, iteration_idx=self.num_iterations + 1,
+          population=population, best_individuals=best_individuals)
+    except KeyboardInterrupt:
+      print("KeyboardInterrupt, canceled search.")
+      canceled = True
+
+    print("Best %i settings:" % len(best_individuals))
+    for individual in best_individuals:
+      print("Individual %s" % individual.name, "cost:", individual.cost)
+      for p in self.hyper_params:
+        print(" %s -> %s" % (p.description(), individual.hyper_param_mapping[p]))
+
+  def _train_population_threads(self, population):
+    """
+    Trains all individuals (which do not have a cost yet) of the population for one epoch,
+    in a thread pool of :class:`_IndividualTrainer`.
+
+    :param list[Individual] population:
+    """
     from TFUtil import get_available_gpu_devices
     from Log import wrap_log_streams, StreamDummy
     from threading import Thread, Condition
-    from Util import progress_bar, hms, is_tty
+    from Util import progress_bar, is_tty
 
     class Outstanding:
       cond = Condition()
@@ -477,90 +601,355 @@ class Optimization:
               # This would normally dump it on sys.stderr so it's fine.
               sys.excepthook(*sys.exc_info())
 
-    best_individuals = []
-    population = []
-    canceled = False
     num_gpus = len(get_available_gpu_devices())
     print("Num available GPUs:", num_gpus)
     num_gpus = num_gpus or 1  # Would be ignored anyway.
     interactive = is_tty()
+    print("Starting training with thread pool of %i threads." % self.num_threads)
+    iteration_start_time = time.time()
+    with wrap_log_streams(StreamDummy(), also_sys_stdout=True, tf_log_verbosity="WARN"):
+      Outstanding.exit = False
+      Outstanding.population = list(population)
+      Outstanding.threads = [WorkerThread(gpu_ids={i % num_gpus}) for i in range(self.num_threads)]
+      try:
+        while True:
+          with Outstanding.cond:
+            if all([thread.finished for thread in Outstanding.threads]) or Outstanding.exception:
+              break
+            complete_frac = max(len(population) - len(Outstanding.population) - len(Outstanding.threads), 0)
+            complete_frac += sum([thread.get_complete_frac() for thread in Outstanding.threads])
+            complete_frac /= float(len(population))
+            remaining_str = ""
+            if complete_frac > 0:
+              start_elapsed = time.time() - iteration_start_time
+              total_time_estimated = start_elapsed / complete_frac
+              remaining_estimated = total_time_estimated - start_elapsed
+              remaining_str = hms(remaining_estimated)
+            if interactive:
+              progress_bar(complete_frac, prefix=remaining_str, file=sys.__stdout__)
+            else:
+              print(
+                "Progress: %.02f%%" % (complete_frac * 100),
+                "remaining:", remaining_str or "unknown", file=sys.__stdout__)
+              sys.__stdout__.flush()
+            Outstanding.cond.wait(1 if interactive else 10)
+        for thread in Outstanding.threads:
+          thread.join()
+      finally:
+        Outstanding.exit = True
+        for thread in Outstanding.threads:
+          thread.cancel(join=True)
+    Outstanding.threads = []
+    if Outstanding.exception:
+      raise Outstanding.exception
+    assert not Outstanding.population
+
+  def _train_population_processes(self, population, on_rung_finished=None):
+    """
+    Trains the individuals of the population with successive halving,
+    each in its own subprocess (:class:`_IndividualProcess`).
+    Afterwards, :class:`Individual.num_epochs` tells how far an individual came.
+
+    :param list[Individual] population:
+    :param (()->None)|None on_rung_finished: e.g. to save the population
+    """
+    candidates = []
+    for individual in population:
+      if not any([individual is other for other in candidates]):
+        candidates.append(individual)
+    num_epochs = self.min_num_epochs
+    while True:
+      print("Successive halving: train %i individuals up to epoch %i." % (len(candidates), num_epochs), file=log.v2)
+      self._train_individuals_processes(candidates, num_epochs=num_epochs)
+      if on_rung_finished:
+        on_rung_finished()
+      if num_epochs >= self.max_num_epochs or len(candidates) <= 1:
+        break
+      candidates.sort(key=lambda p: p.cost)
+      del candidates[max(len(candidates) // self.halving_factor, 1):]
+      num_epochs = min(num_epochs * self.halving_factor, self.max_num_epochs)
+
+  def _get_devices(self):
+    """
+    :return: devices for the individual processes. the CPU (gpu_id None) if there is no GPU
+    :rtype: list[_Device]
+    """
+    from TFUtil import get_available_gpu_devices
+    gpus = get_available_gpu_devices()
+    print("Num available GPUs:", len(gpus))
+    if not gpus:
+      return [_Device(gpu_id=None, memory=None)]
+    return [_Device(gpu_id=i, memory=dev.memory_limit) for (i, dev) in enumerate(gpus)]
+
+  def _train_individuals_processes(self, individuals, num_epochs):
+    """
+    Trains the individuals up to the given epoch. Sets the cost of each individual to the score of that epoch.
+    The individuals which already came so far (e.g. the best ones from the last iteration,
+    or when we resume a search) are not trained again.
+
+    :param list[Individual] individuals:
+    :param int num_epochs:
+    """
+    outstanding = []
+    for individual in individuals:
+      cost = self.get_individual_score(individual, epoch=num_epochs)
+      if cost is None:
+        outstanding.append(individual)
+      else:
+        individual.cost = cost
+        individual.num_epochs = num_epochs
+    devices = self._get_devices()
+    running = []  # type: list[_IndividualProcess]
+    start_time = time.time()
     try:
-      print("Population of %i individuals (hyper param setting instances), running for %i evaluation iterations." % (
-        self.num_individuals, self.num_iterations), file=log.v2)
-      for cur_iteration_idx in range(1, self.num_iterations + 1):
-        print("Starting iteration %i." % cur_iteration_idx, file=log.v2)
-        if cur_iteration_idx == 1:
-          population.append(Individual(
-            {p: p.get_default_value() for p in self.hyper_params}, name="default"))
-          population.append(Individual(
-            {p: p.get_initial_value() for p in self.hyper_params}, name="canonical"))
-        population.extend(self.get_population(
-          iteration_idx=cur_iteration_idx, num_individuals=self.num_individuals - len(population)))
-        if cur_iteration_idx > 1:
-          self.cross_over(population=population, iteration_idx=cur_iteration_idx)
-        if cur_iteration_idx == 1 and self.dry_run_first_individual:
-          # Train first directly for testing and to see log output.
-          # Later we will strip away all log output.
-          print("Very first try with log output:", file=log.v2)
-          _IndividualTrainer(optim=self, individual=population[0], gpu_ids={0}).run()
-        print("Starting training with thread pool of %i threads." % self.num_threads)
-        iteration_start_time = time.time()
-        with wrap_log_streams(StreamDummy(), also_sys_stdout=True, tf_log_verbosity="WARN"):
-          Outstanding.exit = False
-          Outstanding.population = list(population)
-          Outstanding.threads = [WorkerThread(gpu_ids={i % num_gpus}) for i in range(self.num_threads)]
-          try:
-            while True:
-              with Outstanding.cond:
-                if all([thread.finished for thread in Outstanding.threads]) or Outstanding.exception:
-                  break
-                complete_frac = max(len(population) - len(Outstanding.population) - len(Outstanding.threads), 0)
-                complete_frac += sum([thread.get_complete_frac() for thread in Outstanding.threads])
-                complete_frac /= float(len(population))
-                remaining_str = ""
-                if complete_frac > 0:
-                  start_elapsed = time.time() - iteration_start_time
-                  total_time_estimated = start_elapsed / complete_frac
-                  remaining_estimated = total_time_estimated - start_elapsed
-                  remaining_str = hms(remaining_estimated)
-                if interactive:
-                  progress_bar(complete_frac, prefix=remaining_str, file=sys.__stdout__)
-                else:
-                  print(
-                    "Progress: %.02f%%" % (complete_frac * 100),
-                    "remaining:", remaining_str or "unknown", file=sys.__stdout__)
-                  sys.__stdout__.flush()
-                Outstanding.cond.wait(1 if interactive else 10)
-            for thread in Outstanding.threads:
-              thread.join()
-          finally:
-            Outstanding.exit = True
-            for thread in Outstanding.threads:
-              thread.cancel(join=True)
-        Outstanding.threads = []
-        print("Training iteration elapsed time:", hms(time.time() - iteration_start_time))
-        if Outstanding.exception:
-          raise Outstanding.exception
-        assert not Outstanding.population
-        print("Training iteration finished.")
-        population.sort(key=lambda p: p.cost)
-        del population[-self.num_kill_individuals:]
-        best_individuals.extend(population)
-        best_individuals.sort(key=lambda p: p.cost)
-        del best_individuals[self.num_best:]
-        population = best_individuals[:self.num_kill_individuals // 4] + population
-        print("Current best setting, individual %s" % best_individuals[0].name, "cost:", best_individuals[0].cost)
-        for p in self.hyper_params:
-          print(" %s -> %s" % (p.description(), best_individuals[0].hyper_param_mapping[p]))
-    except KeyboardInterrupt:
-      print("KeyboardInterrupt, canceled search.")
-      canceled = True
+      while outstanding or running:
+        for proc in list(running):
+          if proc.proc.poll() is None:
+            continue
+          running.remove(proc)
+          proc.device.free_memory_add(proc.memory)
+          proc.finish(num_epochs=num_epochs)
+          print(
+            "Finished %i/%i individuals of this rung, elapsed time %s." % (
+              len(individuals) - len(outstanding) - len(running), len(individuals), hms(time.time() - start_time)),
+            file=log.v3)
+        while outstanding and len(running) < self.num_threads:
+          memory = None
+          if self.memory_per_individual:
+            memory = self.memory_per_individual * 1024 * 1024
+          device = _Device.select(devices, memory=memory)
+          if not device:
+            assert running, "hyper_param_tuning: memory_per_individual %r MB does not fit on any device" % (
+              self.memory_per_individual,)
+            break
+          if memory is None:
+            memory = device.total_memory  # one individual per device
+          if memory is not None:
+            device.free_memory_add(-memory)
+          running.append(_IndividualProcess(
+            optim=self, individual=outstanding.pop(0), num_epochs=num_epochs, device=device, memory=memory))
+        time.sleep(1)
+    finally:
+      for proc in running:
+        proc.proc.terminate()
+        proc.proc.wait()
+        proc.log_file.close()
+
+  def get_individual_work_dir(self, individual):
+    """
+    :param Individual individual:
+    :return: dir where we keep the model, learning-rate-file and logs of this individual
+    :rtype: str
+    """
+    return os.path.join(self.work_dir, individual.name)
 
-    print("Best %i settings:" % len(best_individuals))
-    for individual in best_individuals:
-      print("Individual %s" % individual.name, "cost:", individual.cost)
-      for p in self.hyper_params:
-        print(" %s -> %s" % (p.description(), individual.hyper_param_mapping[p]))
+  def get_individual_score(self, individual, epoch):
+    """
+    :param Individual individual:
+    :param int epoch:
+    :return: score of the epoch via the learning-rate-file of the individual, or None if not trained that far
+    :rtype: float|None
+    """
+    from LearningRateControl import LearningRateControl
+    filename = os.path.join(self.get_individual_work_dir(individual), "learning_rates")
+    if not os.path.exists(filename):
+      return None
+    lr_control = LearningRateControl(
+      default_learning_rate=1.0, filename=filename,
+      error_measure_key=(
+        self.config.typed_value('learning_rate_control_error_measure')
+        or self.config.value('learning_rate_control_error_measure', None)))
+    return lr_control.get_epoch_error_value(epoch)
+
+  def run_individual_from_file(self, filename):
+    """
+    This is called in the subprocess of an individual (via the ``hyper_param_tuning_individual`` option),
+    see :class:`_IndividualProcess`.
+
+    :param str filename: JSON file with the individual
+    """
+    import json
+    with open(filename) as f:
+      opts = json.load(f)
+    assert set(opts["hyper_params"].keys()) == {p.description() for p in self.hyper_params}
+    individual = Individual(
+      {p: p.decode_value(opts["hyper_params"][p.description()]) for p in self.hyper_params},
+      name=opts["name"])
+    # The parent sets CUDA_VISIBLE_DEVICES, thus we always see only one GPU.
+    trainer = _IndividualTrainer(optim=self, individual=individual, gpu_ids={0})
+    trainer.run_epochs(
+      work_dir=opts["work_dir"], num_epochs=opts["num_epochs"], gpu_memory_fraction=opts["gpu_memory_fraction"])
+
+  def save_population(self, filename, iteration_idx, population, best_individuals):
+    """
+    Stores the state of the search as JSON, such that it can be resumed via :func:`load_population`.
+
+    :param str filename:
+    :param int iteration_idx: the current iteration
+    :param list[Individual] population:
+    :param list[Individual] best_individuals:
+    """
+    import json
+    individuals = []  # type: list[Individual]  # unique
+    for individual in population + best_individuals:
+      if not any([individual is other for other in individuals]):
+        individuals.append(individual)
+
+    def _index(individual):
+      """
+      :param Individual individual:
+      :rtype: int
+      """
+      return [i for (i, other) in enumerate(individuals) if individual is other][0]
+
+    state = {
+      "iteration": iteration_idx,
+      "individuals": [
+        {"name": individual.name, "cost": individual.cost, "num_epochs": individual.num_epochs,
+         "hyper_params": {
+           p.description(): p.encode_value(individual.hyper_param_mapping[p]) for p in self.hyper_params}}
+        for individual in individuals],
+      "population": [_index(individual) for individual in population],
+      "best_individuals": [_index(individual) for individual in best_individuals]}
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+      os.makedirs(dirname)
+    # Write to a temp file first, such that we never have a broken file, like LearningRateControl.save.
+    tmp_filename = filename + ".new_tmp"
+    with open(tmp_filename, "w") as f:
+      json.dump(state, f, indent=1, sort_keys=True)
+    os.rename(tmp_filename, filename)
+
+  def load_population(self, filename):
+    """
+    :param str filename: via :func:`save_population`
+    :return: iteration idx, population, best individuals
+    :rtype: (int, list[Individual], list[Individual])
+    """
+    import json
+    with open(filename) as f:
+      state = json.load(f)
+    individuals = []
+    for opts in state["individuals"]:
+      assert set(opts["hyper_params"].keys()) == {p.description() for p in self.hyper_params}, (
+        "%r: hyper params do not match the config" % filename)
+      individual = Individual(
+        {p: p.decode_value(opts["hyper_params"][p.description()]) for p in self.hyper_params},
+        name=opts["name"])
+      individual.cost = opts["cost"]
+      individual.num_epochs = opts["num_epochs"]
+      individuals.append(individual)
+    return (
+      state["iteration"],
+      [individuals[i] for i in state["population"]],
+      [individuals[i] for i in state["best_individuals"]])
+
+
+class _Device:
+  """
+  A device for :class:`_IndividualProcess`, with the memory which is still free.
+  """
+
+  def __init__(self, gpu_id, memory):
+    """
+    :param int|None gpu_id: None for the CPU
+    :param int|None memory: total memory in bytes, or None if unlimited
+    """
+    self.gpu_id = gpu_id
+    self.total_memory = memory
+    self.free_memory = memory
+
+  def free_memory_add(self, memory):
+    """
+    :param int|None memory: in bytes, negative to allocate
+    """
+    if self.free_memory is not None:
+      self.free_memory += memory
+
+  @classmethod
+  def select(cls, devices, memory):
+    """
+    :param list[_Device] devices:
+    :param int|None memory: needed memory in bytes, or None for a whole device
+    :return: the device with the most free memory where it fits, or None
+    :rtype: _Device|None
+    """
+    candidates = []
+    for device in devices:
+      if device.free_memory is None:
+        return device  # unlimited
+      needed = memory if memory is not None else device.total_memory
+      if device.free_memory >= needed:
+        candidates.append(device)
+    if not candidates:
+      return None
+    return max(candidates, key=lambda device: device.free_memory)
+
+
+class _IndividualProcess:
+  """
+  Trains an individual in a RETURNN subprocess, via :func:`Optimization.run_individual_from_file`.
+  """
+
+  def __init__(self, optim, individual, num_epochs, device, memory):
+    """
+    :param Optimization optim:
+    :param Individual individual:
+    :param int num_epochs:
+    :param _Device device:
+    :param int|None memory: in bytes, reserved on the device
+    """
+    import json
+    import subprocess
+    self.optim = optim
+    self.individual = individual
+    self.device = device
+    self.memory = memory
+    self.work_dir = optim.get_individual_work_dir(individual)
+    if not os.path.exists(self.work_dir):
+      os.makedirs(self.work_dir)
+    gpu_memory_fraction = None
+    if device.gpu_id is not None and optim.memory_per_individual:
+      gpu_memory_fraction = float(memory) / device.total_memory
+    filename = os.path.join(self.work_dir, "individual.json")
+    with open(filename, "w") as f:
+      json.dump({
+        "name": individual.name,
+        "work_dir": self.work_dir,
+        "num_epochs": num_epochs,
+        "gpu_memory_fraction": gpu_memory_fraction,
+        "hyper_params": {
+          p.description(): p.encode_value(individual.hyper_param_mapping[p]) for p in optim.hyper_params}}, f)
+    args = optim.worker_args + [
+      "++hyper_param_tuning_individual", filename,
+      "++log", os.path.join(self.work_dir, "returnn.log")]
+    env = dict(os.environ)
+    if device.gpu_id is not None:
+      env["CUDA_VISIBLE_DEVICES"] = str(device.gpu_id)
+    print("Start training individual %s up to epoch %i on %s." % (
+      individual.name, num_epochs, "GPU %i" % device.gpu_id if device.gpu_id is not None else "CPU"), file=log.v3)
+    self.log_file = open(os.path.join(self.work_dir, "stdout.txt"), "a")
+    self.proc = subprocess.Popen(args, env=env, stdout=self.log_file, stderr=subprocess.STDOUT)
+
+  def finish(self, num_epochs):
+    """
+    Called when the process has finished. Sets the cost of the individual.
+    If it failed, the cost is inf, and num_epochs stays at the last successful rung,
+    such that it is ranked behind all the individuals which came as far (see :func:`Optimization.work`).
+
+    :param int num_epochs:
+    """
+    self.log_file.close()
+    cost = self.optim.get_individual_score(self.individual, epoch=num_epochs)
+    if self.proc.returncode != 0 or cost is None:
+      # Only this individual is lost. E.g. it might have run out of memory, or the training diverged.
+      print("Individual %s failed with exit code %i, see %r." % (
+        self.individual.name, self.proc.returncode, os.path.join(self.work_dir, "stdout.txt")), file=log.v1)
+      self.individual.cost = float("inf")
+      return
+    print("Individual %s:" % self.individual.name, "epoch:", num_epochs, "cost:", cost, file=log.v2)
+    self.individual.cost = cost
+    self.individual.num_epochs = num_epochs
 
 
 class _IndividualTrainer:
@@ -615,6 +1004,43 @@ class _IndividualTrainer:
       "elapsed time:", hms_fraction(time.time() - start_time),
       file=self.optim.log)
     self.individual.cost = cost
+    self.individual.num_epochs = 1
+
+  def run_epochs(self, work_dir, num_epochs, gpu_memory_fraction=None):
+    """
+    Regular training, via :func:`Engine.train`, up to the given epoch.
+    If there are already models in the work dir, this continues the training from the last one.
+
+    :param str work_dir: for the model and the learning-rate-file
+    :param int num_epochs:
+    :param float|None gpu_memory_fraction:
+    """
+    start_time = time.time()
+    print("Training %r up to epoch %i using hyper params:" % (self.individual.name, num_epochs), file=log.v2)
+    for p in self.optim.hyper_params:
+      print(" %s -> %s" % (p.description(), self.individual.hyper_param_mapping[p]), file=log.v2)
+    config = self.optim.create_config_instance(
+      self.individual.hyper_param_mapping, gpu_ids=self.gpu_ids, gpu_memory_fraction=gpu_memory_fraction)
+    model_dir = os.path.join(work_dir, "net-model")
+    if not os.path.exists(model_dir):
+      os.makedirs(model_dir)
+    config.set("model", os.path.join(model_dir, "network"))
+    config.set("learning_rate_file", os.path.join(work_dir, "learning_rates"))
+    config.set("num_epochs", num_epochs)
+    config.set("save_interval", 1)
+    engine = Engine(config=config)
+    train_data = StaticDataset.copy_from_dataset(self.optim.train_data)
+    engine.init_train_from_config(config=config, train_data=train_data)
+    engine.train()
+    cost = engine.learning_rate_control.get_epoch_error_value(num_epochs)
+    print(
+      "Individual %s:" % self.individual.name,
+      "Epoch:", num_epochs,
+      "Train cost:", cost,
+      "elapsed time:", hms_fraction(time.time() - start_time),
+      file=self.optim.log)
+    self.individual.cost = cost
+    self.individual.num_epochs = num_epochs
 
 
 class _AttribOrKey:
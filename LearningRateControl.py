@@ -65,6 +65,7 @@ class LearningRateControl(object):
       "min_num_epochs_per_new_learning_rate": config.int("learning_rate_control_min_num_epochs_per_new_lr", 0),
       "relative_error_div_by_old": config.bool('newbob_relative_error_div_by_old', False),
       "filename": config.value('learning_rate_file', None),
+      "file_format": config.value('learning_rate_file_format', None),
     }
 
   @classmethod
@@ -81,7 +82,7 @@ class LearningRateControl(object):
                relative_error_also_relative_to_learning_rate=False,
                min_num_epochs_per_new_learning_rate=0,
                relative_error_div_by_old=False,
-               filename=None):
+               filename=None, file_format=None):
     """
     :param float default_learning_rate: default learning rate. usually for epoch 1
     :param list[float] | dict[int,float] default_learning_rates: learning rates
@@ -89,9 +90,14 @@ class LearningRateControl(object):
     :param int min_num_epochs_per_new_learning_rate: if the lr was recently updated, use it for at least N epochs
     :param bool relative_error_div_by_old: if True, compute relative error as (new - old) / old.
     :param str filename: load from and save to file
+    :param str|None file_format: for :func:`save`. "repr" (default) or "jsonl". :func:`load` supports both
     """
     self.epoch_data = {}  # type: typing.Dict[int,LearningRateControl.EpochData]
     self.filename = filename
+    self.file_format = file_format or "repr"
+    assert self.file_format in self.FileFormats, "invalid learning_rate_file_format %r" % file_format
+    # For the "jsonl" format: what is in the file. None if we need to rewrite it.
+    self._saved_state = None  # type: typing.Optional[typing.Dict[int,typing.Tuple[float,typing.Dict[str,float]]]]
     if filename:
       if os.path.exists(filename):
         print("Learning-rate-control: loading file %s" % filename, file=log.v4)
@@ -366,7 +372,9 @@ class LearningRateControl(object):
     """
     if first_epoch > last_epoch:
       return None
-    values = [(self.get_epoch_error_key_value(ep), ep) for ep in range(first_epoch, last_epoch + 1)]
+    # Only the epochs where we have data. There might be many more epochs in the range.
+    epochs = sorted([ep for ep in self.epoch_data.keys() if first_epoch <= ep <= last_epoch])
+    values = [(self.get_epoch_error_key_value(ep), ep) for ep in epochs]
     # Note that the order of the checks here is a bit arbitrary but I had some thoughts on it.
     # Changing the order will also slightly change the behavior, so be sure it make sense.
     values = [((key, v), ep) for ((key, v), ep) in values if v is not None]
@@ -384,12 +392,24 @@ class LearningRateControl(object):
       return None
     return min(values)[1]
 
+  FileFormats = ("repr", "jsonl")
+  JsonlHeader = {"format": "returnn-learning-rate-control", "version": 1}
+
   def save(self):
     """
     Save the current epoch data to file (self.filename).
+
+    With the "repr" file format, this writes the whole epoch data as a Python literal.
+    With the "jsonl" file format, the first line is :data:`JsonlHeader`, and then each line is a JSON record
+    ``{"epoch": ..., "learning_rate": ..., "error": {...}}``, where the records of the same epoch are merged.
+    Here, we only append the records for what has changed since the last save (or load),
+    which is much cheaper when there are many epochs.
     """
     if not self.filename:
       return
+    if self.file_format == "jsonl":
+      self._save_jsonl()
+      return
     # First write to a temp-file, to be sure that the write happens without errors.
     # Otherwise, it could happen that we delete the old existing file, then
     # some error happens (e.g. disk quota), and we loose the newbob data.
@@ -400,13 +420,97 @@ class LearningRateControl(object):
     f.write("\n")
     f.close()
     os.rename(tmp_filename, self.filename)
+    self._saved_state = None
 
-  def load(self):
+  def _get_state(self):
     """
-    Loads the saved epoch data from file (self.filename).
+    :return: copy of the epoch data, epoch -> (learning rate, error dict)
+    :rtype: dict[int,(float,dict[str,float])]
     """
-    s = open(self.filename).read()
-    self.epoch_data = eval(s, {"nan": float("nan"), "inf": float("inf")}, ObjAsDict(self))
+    return {epoch: (data.learning_rate, dict(data.error)) for (epoch, data) in self.epoch_data.items()}
+
+  def _save_jsonl(self):
+    import json
+
+    def _same(v1, v2):
+      """
+      :param float|None v1:
+      :param float|None v2:
+      :rtype: bool
+      """
+      return v1 == v2 or (v1 != v1 and v2 != v2)  # nan
+
+    state = self._get_state()
+    old_state = self._saved_state
+    if old_state is not None:
+      for epoch, (_, old_error) in old_state.items():
+        if epoch not in state or not set(old_error.keys()).issubset(state[epoch][1].keys()):
+          old_state = None  # something was removed. we cannot express that by appending
+          break
+    if old_state is None:
+      # Like for the "repr" format, write to a temp-file first.
+      tmp_filename = self.filename + ".new_tmp"
+      with open(tmp_filename, "w") as f:
+        f.write(json.dumps(self.JsonlHeader) + "\n")
+        for epoch, (learning_rate, error) in sorted(state.items()):
+          f.write(json.dumps({"epoch": epoch, "learning_rate": learning_rate, "error": error}) + "\n")
+      os.rename(tmp_filename, self.filename)
+    else:
+      lines = []
+      for epoch, (learning_rate, error) in sorted(state.items()):
+        old_learning_rate, old_error = old_state.get(epoch, (None, None))
+        if old_error is not None:
+          error = {k: v for (k, v) in error.items() if k not in old_error or not _same(v, old_error[k])}
+          if _same(learning_rate, old_learning_rate) and not error:
+            continue
+        lines.append(json.dumps({"epoch": epoch, "learning_rate": learning_rate, "error": error}) + "\n")
+      if lines:
+        with open(self.filename, "a") as f:
+          f.write("".join(lines))
+          f.flush()
+          os.fsync(f.fileno())
+    self._saved_state = state
+
+  def load(self):
+    """
+    Loads the saved epoch data from file (self.filename). Supports all :data:`FileFormats`.
+    """
+    import json
+    with open(self.filename) as f:
+      first_line = f.readline()
+    try:
+      header = json.loads(first_line)
+    except ValueError:
+      header = None
+    if not isinstance(header, dict) or header.get("format") != self.JsonlHeader["format"]:
+      s = open(self.filename).read()
+      self.epoch_data = eval(s, {"nan": float("nan"), "inf": float("inf")}, ObjAsDict(self))
+      self._saved_state = None
+      return
+    assert header["version"] == self.JsonlHeader["version"], "%s: unsupported version %r" % (
+      self.filename, header["version"])
+    self.epoch_data = {}
+    complete = True
+    with open(self.filename) as f:
+      f.readline()  # header
+      for line in f:
+        if not line.endswith("\n"):
+          # The last line can be incomplete when we crashed while appending to the file.
+          complete = False
+          try:
+            record = json.loads(line)
+          except ValueError:
+            print("Learning-rate-control: %s: ignore incomplete last line %r" % (self.filename, line), file=log.v2)
+            break
+        else:
+          record = json.loads(line)
+        epoch = record["epoch"]
+        if epoch not in self.epoch_data:
+          self.epoch_data[epoch] = self.EpochData(record["learning_rate"])
+        self.epoch_data[epoch].learning_rate = record["learning_rate"]
+        self.epoch_data[epoch].error.update(record["error"])
+    # If incomplete, the next save() should rewrite the file.
+    self._saved_state = self._get_state() if complete else None
 
 
 class ConstantLearningRate(LearningRateControl):
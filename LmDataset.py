@@ -14,6 +14,7 @@ from CachedDataset2 import CachedDataset2
 import gzip
 import xml.etree.ElementTree as ElementTree
 from Util import parse_orthography, parse_orthography_into_symbols, load_json, BackendEngine, unicode
+from Util import OptionalNotImplementedError
 from Log import log
 import numpy
 import time
@@ -46,6 +47,7 @@ class LmDataset(CachedDataset2):
                error_on_invalid_seq=True,
                add_delayed_seq_data=False,
                delayed_seq_data_start_symbol="[START]",
+               corpus_index=False,
                **kwargs):
     """
     After initialization, the corpus is represented by self.orths (as a list of sequences).
@@ -73,6 +75,10 @@ class LmDataset(CachedDataset2):
     :param bool add_delayed_seq_data: will add another data-key "delayed" which will have the sequence.
       delayed_seq_data_start_symbol + original_sequence[:-1].
     :param str delayed_seq_data_start_symbol: used for add_delayed_seq_data.
+    :param bool|str|list[str] corpus_index: if set, instead of reading the whole corpus into memory,
+      uses the binary index (see :func:`build_txt_corpus_index`, ``tools/build-lm-corpus-index.py``),
+      and keeps the (txt) corpus memory-mapped, i.e. self.orths is a :class:`IndexedTxtCorpus`.
+      True means the default index filename(s) next to the corpus file(s), otherwise the index filename(s).
     """
     super(LmDataset, self).__init__(**kwargs)
 
@@ -170,6 +176,8 @@ class LmDataset(CachedDataset2):
     self.num_outputs = {"data": [len(self.labels["data"]), 1]}
     self.num_inputs = self.num_outputs["data"][0]
     self.seq_order = None
+    # corpus seq idx -> seq len, see get_all_seq_lengths
+    self._orth_seq_lens = None  # type: typing.Optional[numpy.ndarray]
     self._tag_prefix = "line-"  # sequence tag is "line-n", where n is the line number (to be compatible with translation)  # nopep8
     self.auto_replace_unknown_symbol = auto_replace_unknown_symbol
     self.log_auto_replace_unknown_symbols = log_auto_replace_unknown_symbols
@@ -184,7 +192,10 @@ class LmDataset(CachedDataset2):
       self.num_outputs["delayed"] = self.num_outputs["data"]
       self.labels["delayed"] = self.labels["data"]
 
-    if isinstance(corpus_file, list):  # If a list of files is provided, concatenate all.
+    if corpus_index:
+      self.orths = IndexedTxtCorpus(
+        corpus_file, index_filenames=corpus_index if not isinstance(corpus_index, bool) else None)
+    elif isinstance(corpus_file, list):  # If a list of files is provided, concatenate all.
       self.orths = []
       for file_name in corpus_file:
         self.orths += read_corpus(file_name)
@@ -244,8 +255,13 @@ class LmDataset(CachedDataset2):
     if seq_list is not None:
       self.seq_order = [int(s[len(self._tag_prefix):]) for s in seq_list]
     else:
+      if isinstance(self.orths, IndexedTxtCorpus):
+        seq_lens = self.orths.get_seq_lens()
+        get_seq_len = seq_lens.__getitem__  # without decoding the lines
+      else:
+        get_seq_len = lambda i: len(self.orths[i])
       self.seq_order = self.get_seq_order_for_epoch(
-        epoch=epoch, num_seqs=len(self.orths), get_seq_len=lambda i: len(self.orths[i]))
+        epoch=epoch, num_seqs=len(self.orths), get_seq_len=get_seq_len)
     self.next_orth_idx = 0
     self.next_seq_idx = 0
     self.num_skipped = 0
@@ -306,33 +322,7 @@ class LmDataset(CachedDataset2):
         data = self.seq_gen.seq_to_class_idxs(phones, dtype=self.dtype)
 
       elif self.orth_symbols:
-        orth_syms = parse_orthography(orth, **self.parse_orth_opts)
-        while True:
-          orth_syms = sum([self.orth_replace_map.get(s, [s]) for s in orth_syms], [])
-          i = 0
-          # For the character-based case, spaces have been replaced by word_end_symbol.
-          space_symbol = self.word_end_symbol if self.word_end_symbol and not self.word_based else " "
-          while i < len(orth_syms) - 1:
-            if orth_syms[i:i+2] == [space_symbol, space_symbol]:
-              orth_syms[i:i+2] = [space_symbol]  # collapse two spaces
-            else:
-              i += 1
-          if self.auto_replace_unknown_symbol:
-            try:
-              list(map(self.orth_symbols_map.__getitem__, orth_syms))  # convert to list to trigger map (it's lazy)
-            except KeyError as e:
-              if sys.version_info >= (3, 0):
-                orth_sym = e.args[0]
-              else:
-                # noinspection PyUnresolvedReferences
-                orth_sym = e.message
-              if self.log_auto_replace_unknown_symbols:
-                print("LmDataset: unknown orth symbol %r, adding to orth_replace_map as %r" % (
-                  orth_sym, self.unknown_symbol), file=log.v3)
-                self._reduce_log_auto_replace_unknown_symbols()
-              self.orth_replace_map[orth_sym] = [self.unknown_symbol] if self.unknown_symbol is not None else []
-              continue  # try this seq again with updated orth_replace_map
-          break
+        orth_syms = self._get_orth_syms(orth)
         self.num_unknown += orth_syms.count(self.unknown_symbol)
         if self.word_based:
           orth_debug_str = repr(orth_syms)
@@ -365,6 +355,76 @@ class LmDataset(CachedDataset2):
       self.next_seq_idx = seq_idx + 1
       return DatasetSeq(seq_idx=seq_idx, features=data, targets=targets, seq_tag=seq_tag)
 
+  def _get_orth_syms(self, orth):
+    """
+    :param str orth:
+    :return: orth symbols, after orth_replace_map. with auto_replace_unknown_symbol, unknown symbols are replaced
+    :rtype: list[str]
+    """
+    orth_syms = parse_orthography(orth, **self.parse_orth_opts)
+    while True:
+      orth_syms = sum([self.orth_replace_map.get(s, [s]) for s in orth_syms], [])
+      i = 0
+      # For the character-based case, spaces have been replaced by word_end_symbol.
+      space_symbol = self.word_end_symbol if self.word_end_symbol and not self.word_based else " "
+      while i < len(orth_syms) - 1:
+        if orth_syms[i:i+2] == [space_symbol, space_symbol]:
+          orth_syms[i:i+2] = [space_symbol]  # collapse two spaces
+        else:
+          i += 1
+      if self.auto_replace_unknown_symbol:
+        try:
+          list(map(self.orth_symbols_map.__getitem__, orth_syms))  # convert to list to trigger map (it's lazy)
+        except KeyError as e:
+          if sys.version_info >= (3, 0):
+            orth_sym = e.args[0]
+          else:
+            # noinspection PyUnresolvedReferences
+            orth_sym = e.message
+          if self.log_auto_replace_unknown_symbols:
+            print("LmDataset: unknown orth symbol %r, adding to orth_replace_map as %r" % (
+              orth_sym, self.unknown_symbol), file=log.v3)
+            self._reduce_log_auto_replace_unknown_symbols()
+          self.orth_replace_map[orth_sym] = [self.unknown_symbol] if self.unknown_symbol is not None else []
+          continue  # try this seq again with updated orth_replace_map
+      break
+    return orth_syms
+
+  def _get_orth_seq_len(self, orth):
+    """
+    :param str orth:
+    :return: seq len as in :func:`_collect_single_seq`, or -1 if the seq would be skipped there
+    :rtype: int
+    """
+    if orth == "</s>":
+      return -1
+    orth_syms = self._get_orth_syms(orth)
+    if not all([s in self.orth_symbols_map for s in orth_syms]):
+      return -1
+    return len(orth_syms)
+
+  def get_all_seq_lengths(self):
+    """
+    Only for orth symbol seqs. Phone seqs are generated randomly, so we cannot know their lengths in advance.
+    The seq lens per corpus seq are cached, so only the first epoch which covers some seq needs to parse it.
+
+    :return: data-key -> seq lengths, for all seqs of the current epoch, in the current seq order
+    :rtype: dict[str,numpy.ndarray]
+    """
+    if self.seq_gen or not self.orth_symbols:
+      raise OptionalNotImplementedError
+    if self._orth_seq_lens is None:
+      self._orth_seq_lens = numpy.full((len(self.orths),), -2, dtype="int64")  # -2: not yet known
+    seq_order = numpy.array(self.seq_order, dtype="int64")
+    for true_idx in seq_order[self._orth_seq_lens[seq_order] == -2].tolist():
+      self._orth_seq_lens[true_idx] = self._get_orth_seq_len(self.orths[true_idx])
+    seq_lens = self._orth_seq_lens[seq_order]
+    seq_lens = seq_lens[seq_lens >= 0]  # skipped seqs do not get a seq idx
+    res = {"data": seq_lens}
+    if self.add_delayed_seq_data:
+      res["delayed"] = seq_lens
+    return res
+
 
 def _is_bliss(filename):
   """
@@ -433,16 +493,25 @@ def _iter_txt(filename, callback):
     f = gzip.GzipFile(fileobj=f)
 
   for line in f:
-    try:
-      line = line.decode("utf8")
-    except UnicodeDecodeError:
-      line = line.decode("latin_1")  # or iso8859_15?
-    line = line.strip()
+    line = _decode_txt_line(line)
     if not line:
       continue
     callback(line)
 
 
+def _decode_txt_line(line):
+  """
+  :param bytes line:
+  :return: decoded and stripped line
+  :rtype: str
+  """
+  try:
+    line = line.decode("utf8")
+  except UnicodeDecodeError:
+    line = line.decode("latin_1")  # or iso8859_15?
+  return line.strip()
+
+
 def iter_corpus(filename, callback):
   """
   :param str filename:
@@ -466,6 +535,120 @@ def read_corpus(filename):
   return out_list
 
 
+def get_txt_corpus_index_filename(filename):
+  """
+  :param str filename: txt corpus
+  :return: default filename for the index, see :func:`build_txt_corpus_index`
+  :rtype: str
+  """
+  return filename + ".index.npy"
+
+
+def build_txt_corpus_index(filename, index_filename=None):
+  """
+  Builds the binary index for :class:`IndexedTxtCorpus`.
+  This is a numpy array (num_seqs, 3), int64, with the columns (byte offset, num bytes, seq len),
+  for exactly the same seqs (non-empty lines) as :func:`read_corpus` would return.
+  The seq len is the len of the str, like ``len(orth)``.
+
+  :param str filename: txt corpus, not compressed
+  :param str|None index_filename: defaults to :func:`get_txt_corpus_index_filename`
+  :return: index_filename
+  :rtype: str
+  """
+  assert not filename.endswith(".gz"), "need uncompressed txt file for random access: %r" % filename
+  assert not _is_bliss(filename), "Bliss XML not supported, only txt: %r" % filename
+  if not index_filename:
+    index_filename = get_txt_corpus_index_filename(filename)
+  entries = []
+  offset = 0
+  with open(filename, "rb") as f:
+    for line in f:
+      orth = _decode_txt_line(line)
+      if orth:
+        entries.append((offset, len(line), len(orth)))
+      offset += len(line)
+  index = numpy.array(entries, dtype="int64").reshape((len(entries), 3))
+  with open(index_filename, "wb") as f:
+    numpy.save(f, index)
+  return index_filename
+
+
+class IndexedTxtCorpus:
+  """
+  Random access to the seqs (non-empty lines) of txt corpus files,
+  via the binary index (:func:`build_txt_corpus_index`).
+  The corpus files are memory-mapped, and only the accessed lines are decoded.
+  Behaves like the list of orthographies from :func:`read_corpus`.
+  """
+
+  def __init__(self, filenames, index_filenames=None):
+    """
+    :param str|list[str] filenames: txt corpus files
+    :param str|list[str]|None index_filenames: defaults to :func:`get_txt_corpus_index_filename`
+    """
+    import mmap
+    if not isinstance(filenames, list):
+      filenames = [filenames]
+    if index_filenames is None:
+      index_filenames = [get_txt_corpus_index_filename(fn) for fn in filenames]
+    if not isinstance(index_filenames, list):
+      index_filenames = [index_filenames]
+    assert len(filenames) == len(index_filenames)
+    self.filenames = filenames
+    self._mmaps = []  # type: typing.List[typing.Optional[mmap.mmap]]
+    self._indices = []  # type: typing.List[numpy.ndarray]
+    for filename, index_filename in zip(filenames, index_filenames):
+      if not os.path.exists(index_filename):
+        raise Exception("%s: index %r not found, create it via tools/build-lm-corpus-index.py %s" % (
+          self.__class__.__name__, index_filename, filename))
+      index = numpy.load(index_filename, mmap_mode="r")
+      assert index.ndim == 2 and index.shape[1] == 3
+      file_size = os.path.getsize(filename)
+      if len(index) > 0:
+        assert index[-1, 0] + index[-1, 1] <= file_size, "%s: index %r does not match %r" % (
+          self.__class__.__name__, index_filename, filename)
+      if os.path.getmtime(index_filename) < os.path.getmtime(filename):
+        print("%s: warning: index %r is older than corpus %r" % (
+          self.__class__.__name__, index_filename, filename), file=log.v2)
+      self._indices.append(index)
+      if file_size > 0:
+        with open(filename, "rb") as f:
+          self._mmaps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+      else:
+        self._mmaps.append(None)
+    self._file_seq_starts = numpy.cumsum([0] + [len(index) for index in self._indices])
+
+  def __len__(self):
+    return int(self._file_seq_starts[-1])
+
+  def __getitem__(self, idx):
+    """
+    :param int idx:
+    :rtype: str
+    """
+    if idx < 0:
+      idx += len(self)
+    if not 0 <= idx < len(self):
+      raise IndexError("%s: index %i out of range" % (self.__class__.__name__, idx))
+    file_idx = int(numpy.searchsorted(self._file_seq_starts, idx, side="right")) - 1
+    offset, num_bytes, _ = self._indices[file_idx][idx - self._file_seq_starts[file_idx]]
+    return _decode_txt_line(self._mmaps[file_idx][offset:offset + num_bytes])
+
+  def __iter__(self):
+    for idx in range(len(self)):
+      yield self[idx]
+
+  def get_seq_lens(self):
+    """
+    :return: seq lens (in chars, like ``len(orth)``) of all seqs, without decoding the seqs
+    :rtype: numpy.ndarray
+    """
+    if len(self._indices) == 1:
+      return self._indices[0][:, 2]
+    return numpy.concatenate([index[:, 2] for index in self._indices])
+
+
 class AllophoneState:
   """
   Represents one allophone (phone with context) state (number, boundary).
@@ -1036,6 +1219,16 @@ class TranslationDataset(CachedDataset2):
       target.dev(.gz)?
       target.train(.gz)?
       target.vocab.pkl
+
+  Optionally, the text files can be converted once into a packed binary format
+  (via ``tools/pack-translation-dataset.py``, see :func:`write_packed_data`), per prefix and file postfix:
+
+      source.train.packed.tokens.npy  # int32, all label indices, concatenated
+      source.train.packed.offsets.npy  # int64, (num_seqs + 1,), seq i is tokens[offsets[i]:offsets[i + 1]]
+      source.train.packed.info.json  # vocab fingerprint and options used for the conversion
+
+  With ``use_packed=True``, these are memory-mapped,
+  so there is no startup time and no tokenization, and getting a seq is just slicing.
   """
 
   MapToDataKeys = {"source": "data", "target": "classes"}  # just by our convention
@@ -1047,6 +1240,7 @@ class TranslationDataset(CachedDataset2):
                unknown_label=None,
                seq_list_file=None,
                use_cache_manager=False,
+               use_packed=False,
                **kwargs):
     """
     :param str path: the directory containing the files
@@ -1060,6 +1254,7 @@ class TranslationDataset(CachedDataset2):
     :param str seq_list_file: filename. line-separated list of line numbers defining fixed sequence order.
       multiple occurrences supported, thus allows for repeating examples while loading only once.
     :param bool use_cache_manager: uses :func:`Util.cf` for files
+    :param bool use_packed: use the packed binary format, see :func:`write_packed_data`
     """
 
     super(TranslationDataset, self).__init__(**kwargs)
@@ -1080,22 +1275,34 @@ class TranslationDataset(CachedDataset2):
     if source_only:
       self.MapToDataKeys = self.__class__.MapToDataKeys.copy()
       del self.MapToDataKeys["target"]
-    self._data_files = {data_key: self._get_data_file(prefix) for (prefix, data_key) in self.MapToDataKeys.items()}
+    self._unknown_label = unknown_label
+    self._vocabs = {data_key: self._get_vocab(prefix) for (prefix, data_key) in self.MapToDataKeys.items()}
+    self._packed = None  # type: typing.Optional[typing.Dict[str,typing.Tuple[numpy.ndarray,numpy.ndarray]]]
+    self._data_files = {}  # type: typing.Dict[str,typing.Optional[typing.BinaryIO]]
     self._data = {
-      data_key: [] for data_key in self._data_files.keys()}  # type: typing.Dict[str,typing.List[numpy.ndarray]]
+      data_key: [] for data_key in self._vocabs.keys()}  # type: typing.Dict[str,typing.List[numpy.ndarray]]
     self._data_len = None  # type: typing.Optional[int]
-    self._vocabs = {data_key: self._get_vocab(prefix) for (prefix, data_key) in self.MapToDataKeys.items()}
+    if use_packed:
+      self._packed = {
+        data_key: self._load_packed_data(prefix, data_key) for (prefix, data_key) in self.MapToDataKeys.items()}
+      data_lens = set(len(offsets) - 1 for (_, offsets) in self._packed.values())
+      assert len(data_lens) == 1, "%r: packed data has different num seqs: %r" % (self, data_lens)
+      self._data_len = data_lens.pop()
+    else:
+      self._data_files = {
+        data_key: self._get_data_file(prefix) for (prefix, data_key) in self.MapToDataKeys.items()}
     self.num_outputs = {k: [max(self._vocabs[k].values()) + 1, 1] for k in self._vocabs.keys()}  # all sparse
     assert all([v1 <= 2 ** 31 for (k, (v1, v2)) in self.num_outputs.items()])  # we use int32
     self.num_inputs = self.num_outputs[self._main_data_key][0]
     self._reversed_vocabs = {k: self._reverse_vocab(k) for k in self._vocabs.keys()}
     self.labels = {k: self._get_label_list(k) for k in self._vocabs.keys()}
-    self._unknown_label = unknown_label
     self._seq_order = None  # type: typing.Optional[typing.List[int]]  # seq_idx -> line_nr
     self._tag_prefix = "line-"  # sequence tag is "line-n", where n is the line number
-    self._thread = Thread(name="%r reader" % self, target=self._thread_main)
-    self._thread.daemon = True
-    self._thread.start()
+    self._thread = None  # type: typing.Optional[Thread]
+    if not self._packed:
+      self._thread = Thread(name="%r reader" % self, target=self._thread_main)
+      self._thread.daemon = True
+      self._thread.start()
 
   def _extend_data(self, k, data_strs):
     vocab = self._vocabs[k]
@@ -1171,6 +1378,71 @@ class TranslationDataset(CachedDataset2):
       return gzip.GzipFile(self._transform_filename(filename + ".gz"), "rb")
     raise Exception("Data file not found: %r (.gz)?" % filename)
 
+  def _get_packed_filename_prefix(self, prefix):
+    """
+    :param str prefix: e.g. "source" or "target"
+    :rtype: str
+    """
+    return "%s/%s.%s.packed" % (self.path, prefix, self.file_postfix)
+
+  def _get_packed_info(self, data_key):
+    """
+    :param str data_key: e.g. "data" or "classes"
+    :return: everything which influences the packed data, to check whether it is still valid
+    :rtype: dict[str]
+    """
+    import hashlib
+    vocab_hash = hashlib.sha1(repr(sorted(self._vocabs[data_key].items())).encode("utf8")).hexdigest()
+    return {
+      "vocab_sha1": vocab_hash, "postfix": self._add_postfix[data_key], "unknown_label": self._unknown_label}
+
+  def _load_packed_data(self, prefix, data_key):
+    """
+    :param str prefix: e.g. "source" or "target"
+    :param str data_key: e.g. "data" or "classes"
+    :return: tokens, offsets; memory-mapped
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    filename_prefix = self._get_packed_filename_prefix(prefix)
+    info = load_json(filename=self._transform_filename(filename_prefix + ".info.json"))
+    expected_info = self._get_packed_info(data_key)
+    for key, value in expected_info.items():
+      if info.get(key) != value:
+        raise Exception(
+          "%r: packed data %r does not match, %r: %r, expected %r. "
+          "Recreate it via tools/pack-translation-dataset.py." % (
+            self, filename_prefix, key, info.get(key), value))
+    tokens = numpy.load(self._transform_filename(filename_prefix + ".tokens.npy"), mmap_mode="r")
+    offsets = numpy.load(self._transform_filename(filename_prefix + ".offsets.npy"), mmap_mode="r")
+    assert tokens.dtype == numpy.int32 and tokens.ndim == 1
+    assert offsets.ndim == 1 and offsets[-1] == len(tokens)
+    return tokens, offsets
+
+  def write_packed_data(self):
+    """
+    Writes the data in the packed binary format (see class docstring), to be used with ``use_packed=True``.
+    This reads all the data (like for the normal usage) and thus can take a while.
+    """
+    import json
+    assert not self._packed, "%r: already using packed data" % self
+    num_seqs = self._get_data_len()
+    for prefix, data_key in self.MapToDataKeys.items():
+      filename_prefix = self._get_packed_filename_prefix(prefix)
+      seqs = [self._get_data(key=data_key, line_nr=line_nr) for line_nr in range(num_seqs)]
+      for seq in seqs[:1]:
+        assert isinstance(seq, numpy.ndarray) and seq.ndim == 1, "%r: packed format needs 1D label seqs" % self
+      offsets = numpy.zeros((num_seqs + 1,), dtype="int64")
+      numpy.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+      tokens = numpy.concatenate(seqs).astype("int32") if seqs else numpy.zeros((0,), dtype="int32")
+      numpy.save(filename_prefix + ".tokens.npy", tokens)
+      numpy.save(filename_prefix + ".offsets.npy", offsets)
+      info = self._get_packed_info(data_key)
+      info.update({"num_seqs": num_seqs, "num_tokens": len(tokens)})
+      with open(filename_prefix + ".info.json", "w") as f:
+        json.dump(info, f, indent=2, sort_keys=True)
+        f.write("\n")
+      print("%r: wrote %s.* (%i seqs, %i tokens)" % (self, filename_prefix, num_seqs, len(tokens)), file=log.v3)
+
   def _get_vocab(self, prefix):
     """
     :param str prefix: e.g. "source" or "target"
@@ -1232,6 +1504,9 @@ class TranslationDataset(CachedDataset2):
     :return: 1D array
     :rtype: numpy.ndarray
     """
+    if self._packed:
+      tokens, offsets = self._packed[key]
+      return numpy.asarray(tokens[offsets[line_nr]:offsets[line_nr + 1]])
     import time
     last_print_time = 0
     last_print_len = None
@@ -1313,8 +1588,12 @@ class TranslationDataset(CachedDataset2):
       self._seq_order = [int(s[len(self._tag_prefix):]) for s in seq_list]
     else:
       num_seqs = self._get_data_len()
-      self._seq_order = self.get_seq_order_for_epoch(
-        epoch=epoch, num_seqs=num_seqs, get_seq_len=lambda i: len(self._get_data(key=self._main_data_key, line_nr=i)))
+      if self._packed:
+        _, offsets = self._packed[self._main_data_key]
+        get_seq_len = numpy.diff(offsets).__getitem__
+      else:
+        get_seq_len = lambda i: len(self._get_data(key=self._main_data_key, line_nr=i))
+      self._seq_order = self.get_seq_order_for_epoch(epoch=epoch, num_seqs=num_seqs, get_seq_len=get_seq_len)
     self._num_seqs = len(self._seq_order)
     return True
 
@@ -1366,6 +1645,7 @@ class ConfusionNetworkDataset(TranslationDataset):
     :param str|None unknown_label: "UNK" or so. if not given, then will not replace unknowns but throw an error
     :param int max_density: the density of the confusion network: max number of arcs per slot
     """
+    assert not kwargs.get("use_packed"), "%s: packed format not supported" % self.__class__.__name__
     self._main_data_key = "sparse_inputs"
     self._keys_to_read = ["sparse_inputs", "classes"]
     self.density = max_density
@@ -161,9 +161,8 @@ class Log:
     log_verbosity = config.int_list('log_verbosity', [])
     log_format = config.list('log_format', [])
     if config.is_true("use_horovod"):
-      # noinspection PyPackageRequirements,PyUnresolvedReferences
-      import horovod.tensorflow as hvd
-      from TFUtil import init_horovod
+      from TFUtil import get_horovod, init_horovod
+      hvd = get_horovod()
       init_horovod()  # make sure it is initialized
       new_logs = []
       for fn in logs:
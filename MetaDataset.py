@@ -508,8 +508,10 @@ class ClusteringDataset(CachedDataset2):
     :param list[str]|int seq_list:
     :rtype: bool
     """
+    # Call super first, such that a read-ahead thread (see CachedDataset2) is stopped before the sub dataset changes.
+    res = super(ClusteringDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
     self.dataset.init_seq_order(epoch=epoch, seq_list=seq_list)
-    return super(ClusteringDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
+    return res
 
   def get_data_keys(self):
     """
@@ -1359,6 +1361,255 @@ class ChunkShuffleDataset(CachedDataset2):
     return self.dataset.get_target_list()
 
 
+class MultiProcDataset(CachedDataset2):
+  """
+  Runs the sub dataset in multiple worker processes, to parallelize the data loading and preprocessing
+  (e.g. audio decoding and feature extraction in :class:`OggZipDataset`),
+  which would otherwise run in a single Python thread because of the GIL.
+
+  Each worker has its own instance of the sub dataset, with the same seq order for every epoch.
+  Worker i produces the seqs i, i + num_workers, i + 2 * num_workers, ... of the epoch,
+  and the seqs are collected here again in the original order,
+  so the data and the batches are exactly the same as with the sub dataset directly.
+  The numpy arrays are transferred via shared memory (:class:`TaskSystem.SharedNumpyArray`) when possible.
+
+  This requires that the data of a seq only depends on the seq idx (e.g. not the case for most
+  generating datasets, which draw from a random state sequentially).
+  It is most efficient when the sub dataset knows its num_seqs after init_seq_order,
+  otherwise each worker would need to go through all the seqs to find the end.
+  """
+
+  def __init__(self, dataset, num_workers, buffer_size=10, **kwargs):
+    """
+    :param dict[str] dataset: kwargs for init_dataset
+    :param int num_workers: number of worker processes
+    :param int buffer_size: max number of seqs which a worker prepares ahead
+    """
+    super(MultiProcDataset, self).__init__(**kwargs)
+    assert isinstance(dataset, dict), "%s: dataset must be given as dict for init_dataset" % self
+    assert num_workers > 0 and buffer_size > 0
+    self.dataset = dataset.copy()
+    self.dataset.setdefault("name", "%s_subdataset" % self.name)
+    self.num_workers = num_workers
+    self.buffer_size = buffer_size
+    self._init_seq_order_id = 0
+    self._end_seq_idx = None  # type: typing.Optional[int]
+    from TaskSystem import AsyncTask
+    self._workers = [
+      AsyncTask(
+        func=self._make_worker_proc_func(worker_idx),
+        name="%s worker %i/%i" % (self, worker_idx + 1, num_workers), mustExec=False)
+      for worker_idx in range(num_workers)]
+    info = None
+    for worker_idx in range(num_workers):
+      info = self._worker_recv(worker_idx, msg_type="info")  # all the same
+    self.num_inputs = info["num_inputs"]
+    self.num_outputs = info["num_outputs"]
+    self.labels = info["labels"]
+    self._info = info
+
+  def _make_worker_proc_func(self, worker_idx):
+    """
+    :param int worker_idx:
+    :rtype: (TaskSystem.AsyncTask)->None
+    """
+    dataset_kwargs = self.dataset
+    num_workers = self.num_workers
+    buffer_size = self.buffer_size
+
+    def worker_proc(async_task):
+      """
+      :param TaskSystem.AsyncTask async_task:
+      """
+      _multi_proc_dataset_worker_loop(
+        conn=async_task.conn, dataset_kwargs=dataset_kwargs,
+        worker_idx=worker_idx, num_workers=num_workers, buffer_size=buffer_size)
+
+    return worker_proc
+
+  def __del__(self):
+    for worker in getattr(self, "_workers", []):
+      # noinspection PyBroadException
+      try:
+        worker.conn.send(("exit",))
+      except Exception:  # e.g. at shutdown. but does not matter
+        pass
+
+  def _worker_recv(self, worker_idx, msg_type):
+    """
+    Ignores the outdated msgs from previous calls to :func:`init_seq_order`.
+
+    :param int worker_idx:
+    :param str msg_type: expected type
+    :return: msg without type and init seq order id
+    :rtype: tuple
+    """
+    while True:
+      msg = self._workers[worker_idx].conn.recv()
+      if msg[0] == "error":
+        raise Exception("%s: worker %i failed: %s" % (self, worker_idx, msg[1]))
+      if msg[0] == "info":
+        assert msg_type == "info"
+        return msg[1]
+      if msg[1] != self._init_seq_order_id:
+        continue  # outdated
+      assert msg[0] == msg_type, "%s: expected msg %r, got %r" % (self, msg_type, msg)
+      return msg[2:]
+
+  def init_seq_order(self, epoch=None, seq_list=None):
+    """
+    :param int|None epoch:
+    :param list[str]|None seq_list:
+    :rtype: bool
+    """
+    super(MultiProcDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
+    self._init_seq_order_id += 1
+    self._end_seq_idx = None
+    for worker in self._workers:
+      worker.conn.send(("init_seq_order", self._init_seq_order_id, {"epoch": epoch, "seq_list": seq_list}))
+    num_seqs = None
+    for worker_idx in range(self.num_workers):
+      num_seqs, = self._worker_recv(worker_idx, msg_type="init_seq_order")
+    self._num_seqs = num_seqs
+    return True
+
+  def _collect_single_seq(self, seq_idx):
+    """
+    :param int seq_idx:
+    :rtype: DatasetSeq|None
+    """
+    if self._end_seq_idx is not None and seq_idx >= self._end_seq_idx:
+      return None
+    worker_idx = seq_idx % self.num_workers
+    msg = self._worker_recv(worker_idx, msg_type="seq")
+    worker_seq_idx, seq_tag, features = msg
+    assert worker_seq_idx == seq_idx, "%s: worker %i: expected seq %i, got %i" % (
+      self, worker_idx, seq_idx, worker_seq_idx)
+    self._workers[worker_idx].conn.send(("ack", self._init_seq_order_id))
+    if features is None:  # end of epoch
+      self._end_seq_idx = seq_idx
+      return None
+    from TaskSystem import numpy_copy_and_set_unused
+    features = numpy_copy_and_set_unused(features)
+    return DatasetSeq(seq_idx=seq_idx, seq_tag=seq_tag, features=features)
+
+  def get_data_keys(self):
+    """
+    :rtype: list[str]
+    """
+    return self._info["data_keys"]
+
+  def get_target_list(self):
+    """
+    :rtype: list[str]
+    """
+    return self._info["target_list"]
+
+  def get_data_dtype(self, key):
+    """
+    :param str key:
+    :rtype: str
+    """
+    return self._info["data_dtype"][key]
+
+  def get_data_dim(self, key):
+    """
+    :param str key:
+    :rtype: int
+    """
+    return self._info["data_dim"][key]
+
+  def is_data_sparse(self, key):
+    """
+    :param str key:
+    :rtype: bool
+    """
+    return self._info["data_sparse"][key]
+
+  def get_data_shape(self, key):
+    """
+    :param str key:
+    :rtype: list[int]
+    """
+    return self._info["data_shape"][key]
+
+
+def _multi_proc_dataset_worker_loop(conn, dataset_kwargs, worker_idx, num_workers, buffer_size):
+  """
+  Main loop of a worker process of :class:`MultiProcDataset`.
+
+  Msgs to the worker: ("init_seq_order", id, kwargs), ("ack", id), ("exit",).
+  Msgs from the worker: ("info", dict), ("init_seq_order", id, num_seqs), ("seq", id, seq_idx, tag, features),
+  where features is None at the end of the epoch, and ("error", str).
+
+  :param TaskSystem.ExecingProcess_ConnectionWrapper conn:
+  :param dict[str] dataset_kwargs:
+  :param int worker_idx:
+  :param int num_workers:
+  :param int buffer_size:
+  """
+  import TaskSystem
+  from Util import try_run
+  try:
+    dataset = init_dataset(dataset_kwargs)
+    data_keys = dataset.get_data_keys()
+    if TaskSystem.SharedMem.is_shmget_functioning():
+      # Then the seq features will be pickled via SharedNumpyArray.
+      TaskSystem.SharedMemNumpyConfig["enabled"] = True
+      TaskSystem.SharedMemNumpyConfig["auto_pickling_min_size"] = 64 * 1024
+      # One instance per data key for each unacked seq, and for the seq which is currently sent.
+      TaskSystem.SharedMemNumpyConfig["max_server_instances"] = (buffer_size + 1) * len(data_keys) + 2
+      # We sized it such that it should always be enough. Otherwise, report the error (see below).
+      TaskSystem.SharedMemNumpyConfig["fallback_on_exception"] = False
+    conn.send(("info", {
+      "num_inputs": dataset.num_inputs, "num_outputs": dataset.num_outputs, "labels": dataset.labels,
+      "data_keys": data_keys, "target_list": dataset.get_target_list(),
+      "data_dtype": {key: dataset.get_data_dtype(key) for key in data_keys},
+      "data_dim": {key: dataset.get_data_dim(key) for key in data_keys},
+      "data_sparse": {key: dataset.is_data_sparse(key) for key in data_keys},
+      "data_shape": {key: dataset.get_data_shape(key) for key in data_keys}}))
+  except Exception as exc:
+    conn.send(("error", "init: %r" % exc))
+    raise
+  init_id = None
+  seq_idx = None  # next seq idx to produce, or None if we are at the end
+  num_unacked = 0
+  while True:
+    if seq_idx is not None and num_unacked < buffer_size and not conn.poll():
+      try:
+        if dataset.is_less_than_num_seqs(seq_idx):
+          dataset.load_seqs(seq_idx, seq_idx + 1)
+          features = {key: dataset.get_data(seq_idx, key) for key in data_keys}
+          conn.send(("seq", init_id, seq_idx, dataset.get_tag(seq_idx), features))
+          seq_idx += num_workers
+        else:
+          conn.send(("seq", init_id, seq_idx, None, None))
+          seq_idx = None
+      except Exception as exc:
+        conn.send(("error", "seq %i: %r" % (seq_idx, exc)))
+        raise
+      num_unacked += 1
+      continue
+    msg = conn.recv()
+    if msg[0] == "exit":
+      break
+    elif msg[0] == "ack":
+      if msg[1] == init_id:
+        num_unacked -= 1
+    elif msg[0] == "init_seq_order":
+      init_id = msg[1]
+      try:
+        dataset.init_seq_order(**msg[2])
+      except Exception as exc:
+        conn.send(("error", "init_seq_order: %r" % exc))
+        raise
+      conn.send(("init_seq_order", init_id, try_run(lambda: dataset.num_seqs, default=None)))
+      seq_idx = worker_idx
+      num_unacked = 0
+    else:
+      raise Exception("MultiProcDataset worker %i: unexpected msg %r" % (worker_idx, msg))
+
+
 def _simple_to_bool(v):
   if v == 0:
     v = False
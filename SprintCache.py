@@ -12,7 +12,7 @@ import sys
 import os
 import typing
 import array
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 import numpy
 import zlib
 import mmap
@@ -121,9 +121,11 @@ class FileArchive:
   # write routines
   def write_str(self, s):
     """
-    :param str s:
+    :param str|bytes s:
     :rtype: int
     """
+    if not isinstance(s, bytes):
+      s = s.encode("ascii")
     return self.f.write(pack("%ds" % len(s), s))
 
   def write_char(self, i):
@@ -178,7 +180,10 @@ class FileArchive:
     self.ft = {}  # type: typing.Dict[str,FileInfo]
     if os.path.exists(filename):
       self.allophones = []
-      self.f = open(filename, 'rb')
+      # We map the whole archive into memory, and all reading goes through the mmap.
+      # mmap.mmap supports read/seek/tell, so all the read routines work as before.
+      with open(filename, 'rb') as f:
+        self.f = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
       header = self.read_str(len(self.SprintCacheHeader))
       assert header == self.SprintCacheHeader
 
@@ -278,82 +283,134 @@ class FileArchive:
       # raise NotImplementedError("Need to scan archive if no "
       #                           "file info table found.")
 
-  def _raw_read(self, size, typ):
+  def _get_entry_buffer(self, filename):
     """
-    :param int|None size: needed for typ == "str"
-    :param str typ: "str", "feat" or "align"
-    :return: depending on typ, "str" -> string, "feat" -> (time, data), "align" -> align,
-      where string is a str,
-      time is list of time-stamp tuples (start-time,end-time) in millisecs,
-        data is a list of features, each a numpy vector,
-      align is a list of (time, allophone, state), time is an int from 0 to len of align,
-        allophone is some int, state is e.g. in [0,1,2].
-    :rtype: str|(list[numpy.ndarray],list[numpy.ndarray])|list[(int,int,int)]
+    :param str filename: the entry-name in the archive
+    :return: (buffer, offset, fi), where the raw (uncompressed) entry content starts at buffer[offset:],
+      or None if the entry is empty.
+      The buffer is either the mmap of the whole archive, or the decompressed content.
+    :rtype: (mmap.mmap|bytes,int,FileInfo)|None
     """
+    if filename not in self.ft:
+      if filename in self._short_seg_names:
+        filename = self._short_seg_names[filename]
 
-    if typ == "str":
-      return self.read_str(size)
-
-    elif typ == "feat":
-      type_len = self.read_U32()
-      typ = self.read_str(type_len)
-      # print(typ)
-      assert typ == "vector-f32"
-      count = self.read_U32()
-      data = [None] * count  # type: typing.List[typing.Optional[numpy.ndarray]]
-      time_ = [None] * count  # type: typing.List[typing.Optional[numpy.ndarray]]
-      for i in range(count):
-        size = self.read_U32()
-        data[i] = self.read_v("f", size)  # size x f32
-        time_[i] = self.read_v("d", 2)  # 2    x f64
-      return time_, data
-
-    elif typ in ["align", "align_raw"]:
-      type_len = self.read_U32()
-      typ = self.read_str(type_len)
-      assert typ == "flow-alignment"
-      self.read_u32()  # flag ?
-      typ = self.read_str(8)
-      if typ in ["ALIGNRLE", "AALPHRLE"]:
-        # In case of AALPHRLE, after the alignment, we include the alphabet of the used labels.
-        # We ignore this at the moment.
-        size = self.read_U32()
-        if size < (1 << 31):
-          # RLE scheme
-          time = 0
-          alignment = []
-          while len(alignment) < size:
-            n = self.read_char()
-            # print(n)
-            if n > 0:
-              while n > 0:
-                mix, state = self.read_u32(), None
-                if typ != "align_raw":
-                  mix, state = self.get_state(mix)
-                # print(mix, state)
-                # print(time, self.allophones[mix])
-                alignment.append((time, mix, state))
-                time += 1
-                n -= 1
-            elif n < 0:
-              mix, state = self.read_u32(), None
-              if typ != "align_raw":
-                mix, state = self.get_state(mix)
-              while n < 0:
-                # print(mix, state)
-                # print(time, self.allophones[mix])
-                alignment.append((time, mix, state))
-                time += 1
-                n += 1
-            else:
-              time = self.read_u32()
-              # print("time", time)
-          return alignment
-        else:
-          raise NotImplementedError("No support for weighted "
-                                    "alignments yet.")
+    fi = self.ft[filename]
+    size, comp, _ = unpack_from("III", self.f, fi.pos)  # size, comp, chk
+    if size == 0:
+      return None
+    pos = fi.pos + 12
+    if comp > 0:
+      b = zlib.decompress(self.f[pos:pos + comp], 15+32)
+      return b, 0, fi
+    return self.f, pos, fi
+
+  @staticmethod
+  def _read_features_from_buffer(buf, pos, allow_var_dim=False):
+    """
+    :param mmap.mmap|bytes buf:
+    :param int pos: offset into buf
+    :param bool allow_var_dim: if the frames are not of the same dim, return lists instead of raising an exception
+    :return: (times, features). times is float64 of shape (time,2), features float32 of shape (time,dim).
+      If allow_var_dim and the dims differ, both are lists (of rows) instead.
+    :rtype: (numpy.ndarray,numpy.ndarray)|(list[numpy.ndarray],list[numpy.ndarray])
+    """
+    type_len, = unpack_from("I", buf, pos)
+    typ = bytes(buf[pos + 4:pos + 4 + type_len]).decode("ascii")
+    assert typ == "vector-f32"
+    pos += 4 + type_len
+    count, = unpack_from("I", buf, pos)
+    pos += 4
+    if count == 0:
+      return numpy.zeros((0, 2), dtype="float64"), numpy.zeros((0, 0), dtype="float32")
+    # Each frame is: dim (u32), data (dim x f32), time (2 x f64).
+    # In the common case, all frames have the same dim, and we can read all of them with strided views.
+    dim, = unpack_from("I", buf, pos)
+    stride = 4 + dim * 4 + 2 * 8
+    if len(buf) >= pos + count * stride:
+      dims = numpy.ndarray(shape=(count,), dtype="uint32", buffer=buf, offset=pos, strides=(stride,))
+      if (dims == dim).all():
+        del dims
+        features = numpy.ndarray(
+          shape=(count, dim), dtype="float32", buffer=buf, offset=pos + 4, strides=(stride, 4)).copy()
+        times = numpy.ndarray(
+          shape=(count, 2), dtype="float64", buffer=buf, offset=pos + 4 + dim * 4, strides=(stride, 8)).copy()
+        return times, features
+      del dims
+    # Fallback, frame by frame.
+    data = [None] * count  # type: typing.List[typing.Optional[numpy.ndarray]]
+    time_ = [None] * count  # type: typing.List[typing.Optional[numpy.ndarray]]
+    for i in range(count):
+      size, = unpack_from("I", buf, pos)
+      data[i] = numpy.frombuffer(buf, "float32", size, pos + 4).copy()
+      time_[i] = numpy.frombuffer(buf, "float64", 2, pos + 4 + size * 4).copy()
+      pos += 4 + size * 4 + 2 * 8
+    if not allow_var_dim:
+      raise Exception("SprintCache: features of varying dim: %r" % sorted(set(len(x) for x in data)))
+    return time_, data
+
+  def _read_alignment_from_buffer(self, buf, pos, typ):
+    """
+    :param mmap.mmap|bytes buf:
+    :param int pos: offset into buf
+    :param str typ: "align" or "align_raw"
+    :return: int32 array of shape (time,3) with columns (time, allophone, state) for typ "align",
+      or of shape (time,2) with columns (time, mix) for typ "align_raw"
+    :rtype: numpy.ndarray
+    """
+    type_len, = unpack_from("I", buf, pos)
+    align_typ = bytes(buf[pos + 4:pos + 4 + type_len]).decode("ascii")
+    assert align_typ == "flow-alignment"
+    pos += 4 + type_len + 4  # flag ?
+    header = bytes(buf[pos:pos + 8]).decode("ascii")
+    pos += 8
+    if header not in ["ALIGNRLE", "AALPHRLE"]:
+      raise Exception("No valid alignment header found (found: %r). Wrong cache?" % header)
+    # In case of AALPHRLE, after the alignment, we include the alphabet of the used labels.
+    # We ignore this at the moment.
+    size, = unpack_from("I", buf, pos)
+    pos += 4
+    if size >= (1 << 31):
+      raise NotImplementedError("No support for weighted alignments yet.")
+    # RLE scheme. We loop over the runs (not the frames), and collect the mixtures per run.
+    # n > 0: n mixtures follow. n < 0: one mixture follows, repeated -n times. n == 0: new time follows.
+    mix_chunks = []  # type: typing.List[numpy.ndarray]
+    run_starts = []  # type: typing.List[int]  # time of the first frame of the run
+    run_lens = []  # type: typing.List[int]
+    time = 0
+    count = 0
+    while count < size:
+      n, = unpack_from("b", buf, pos)
+      pos += 1
+      if n > 0:
+        mix_chunks.append(numpy.frombuffer(buf, "int32", n, pos).copy())
+        pos += 4 * n
+      elif n < 0:
+        mix, = unpack_from("i", buf, pos)
+        pos += 4
+        n = -n
+        mix_chunks.append(numpy.full((n,), mix, dtype="int32"))
       else:
-        raise Exception("No valid alignment header found (found: %r). Wrong cache?" % typ)
+        time, = unpack_from("i", buf, pos)
+        pos += 4
+        continue
+      run_starts.append(time)
+      run_lens.append(n)
+      time += n
+      count += n
+    if mix_chunks:
+      mixes = numpy.concatenate(mix_chunks)
+      run_lens = numpy.array(run_lens, dtype="int32")
+      run_offsets = numpy.cumsum(run_lens) - run_lens
+      times = numpy.arange(count, dtype="int32") + numpy.repeat(
+        numpy.array(run_starts, dtype="int32") - run_offsets.astype("int32"), run_lens)
+    else:
+      mixes = numpy.zeros((0,), dtype="int32")
+      times = numpy.zeros((0,), dtype="int32")
+    if typ == "align_raw":
+      return numpy.stack([times, mixes], axis=1)
+    mixes, states = self.get_states(mixes)
+    return numpy.stack([times, mixes, states], axis=1)
 
   def has_entry(self, filename):
     """
@@ -373,38 +430,49 @@ class FileArchive:
       align is a list of (time, allophone, state), time is an int from 0 to len of align,
         allophone is some int, state is e.g. in [0,1,2].
     :rtype: str|(list[numpy.ndarray],list[numpy.ndarray])|list[(int,int,int)]
-    """
-
-    if filename not in self.ft:
-      if filename in self._short_seg_names:
-        filename = self._short_seg_names[filename]
 
-    fi = self.ft[filename]
-    self.f.seek(fi.pos)
-    size = self.read_U32()
-    comp = self.read_U32()
-    self.read_U32()  # chk
-    if size == 0:
+    See :func:`read_array` for a faster variant which returns numpy arrays.
+    """
+    entry = self._get_entry_buffer(filename)
+    if entry is None:
       return None
+    buf, pos, fi = entry
+    if typ == "str":
+      return bytes(buf[pos:pos + fi.size]).decode("ascii")
+    elif typ == "feat":
+      time_, data = self._read_features_from_buffer(buf, pos, allow_var_dim=True)
+      return list(time_), list(data)
+    elif typ in ["align", "align_raw"]:
+      align = self._read_alignment_from_buffer(buf, pos, typ=typ)
+      if typ == "align_raw":
+        return list(zip(align[:, 0].tolist(), align[:, 1].tolist(), [None] * len(align)))
+      return list(zip(*[align[:, i].tolist() for i in range(3)]))
+    else:
+      raise NotImplementedError("typ: %r" % typ)
 
-    if comp > 0:
-      # read compressed bytes into memory as 'bytearray'
-      a = array.array('b')
-      a.fromfile(self.f, comp)
-      # unpack
-      b = zlib.decompress(a.tostring(), 15+32)
-      # substitute self.f by an anonymous memmap file object
-      # restore original file handle after we're done
-      backup_f = self.f
-      self.f = mmap.mmap(-1, len(b))
-      self.f.write(b)
-      self.f.seek(0)
-      try:
-        return self._raw_read(size=fi.size, typ=typ)
-      finally:
-        self.f = backup_f
+  def read_array(self, filename, typ):
+    """
+    Like :func:`read`, but decodes the whole entry at once, and returns numpy arrays.
 
-    return self._raw_read(size=fi.size, typ=typ)
+    :param str filename: the entry-name in the archive
+    :param str typ: "feat", "align" or "align_raw"
+    :return: depending on typ, "feat" -> (times, features), "align"/"align_raw" -> align,
+      where times is float64 of shape (time,2) with (start-time,end-time) in millisecs,
+      features is float32 of shape (time,dim),
+      align is int32 of shape (time,3) with columns (time,allophone,state) for "align",
+      or of shape (time,2) with columns (time,mix) for "align_raw".
+    :rtype: (numpy.ndarray,numpy.ndarray)|numpy.ndarray|None
+    """
+    entry = self._get_entry_buffer(filename)
+    if entry is None:
+      return None
+    buf, pos, fi = entry
+    if typ == "feat":
+      return self._read_features_from_buffer(buf, pos)
+    elif typ in ["align", "align_raw"]:
+      return self._read_alignment_from_buffer(buf, pos, typ=typ)
+    else:
+      raise NotImplementedError("typ: %r" % typ)
 
   def get_state(self, mix):
     """
@@ -424,6 +492,27 @@ class FileArchive:
     assert mix >= 0
     return mix, state
 
+  def get_states(self, mixes):
+    """
+    Vectorized variant of :func:`get_state`.
+
+    :param numpy.ndarray mixes: int32, shape (time,)
+    :return: (mixes, states), both int32 of shape (time,)
+    :rtype: (numpy.ndarray,numpy.ndarray)
+    """
+    assert self.allophones
+    max_states = 6
+    mixes = mixes.copy()
+    states = numpy.zeros_like(mixes)
+    for state in range(max_states):
+      mask = mixes >= len(self.allophones)
+      if not mask.any():
+        break
+      mixes[mask] -= (1 << 26)
+      states[mask] = min(state + 1, max_states - 1)
+    assert (mixes >= 0).all()
+    return mixes, states
+
   def set_allophones(self, f):
     """
     :param str f: allophone filename. line-separated. will ignore lines starting with "#"
@@ -569,6 +658,20 @@ class FileArchiveBundle:
         filename = self._short_seg_names[filename]
     return self.files[filename].read(filename, typ)
 
+  def read_array(self, filename, typ):
+    """
+    :param str filename: the entry-name in the archive
+    :param str typ: "feat", "align" or "align_raw"
+    :return: see FileArchive.read_array()
+    :rtype: (numpy.ndarray,numpy.ndarray)|numpy.ndarray|None
+
+    Uses FileArchive.read_array().
+    """
+    if filename not in self.files:
+      if filename in self._short_seg_names:
+        filename = self._short_seg_names[filename]
+    return self.files[filename].read_array(filename, typ)
+
   def set_allophones(self, filename):
     """
     :param str filename: allophone filename
@@ -1045,12 +1045,11 @@ class SprintCacheDataset(CachedDataset2):
       """
       assert self.type == "feat"
       assert self.content_keys
-      times, feats = self.sprint_cache.read(self.content_keys[0], "feat")
+      times, feats = self.sprint_cache.read_array(self.content_keys[0], "feat")
       assert len(times) == len(feats) > 0
-      feat = feats[0]
-      assert isinstance(feat, numpy.ndarray)
-      assert feat.ndim == 1
-      return feat.shape[0]
+      assert isinstance(feats, numpy.ndarray)
+      assert feats.ndim == 2
+      return feats.shape[1]
 
     def read(self, name):
       """
@@ -1058,20 +1057,26 @@ class SprintCacheDataset(CachedDataset2):
       :return: numpy array of shape (time, [num_labels])
       :rtype: numpy.ndarray
       """
-      res = self.sprint_cache.read(name, typ=self.type)
-      if self.type == "align":
-        label_seq = numpy.array([self.allophone_labeling.get_label_idx(a, s) for (t, a, s) in res], dtype=self.dtype)
-        assert label_seq.shape == (len(res),)
-        return label_seq
-      elif self.type == "align_raw":
-        label_seq = numpy.array(
-          [self.allophone_labeling.state_tying_by_allo_state_idx[a] for (t, a, s) in res], dtype=self.dtype)
+      res = self.sprint_cache.read_array(name, typ=self.type)
+      if self.type in ["align", "align_raw"]:
+        # Map each distinct (allophone, state) (or raw mix) only once, not every frame.
+        if self.type == "align":
+          allo_state_idxs = res[:, 1].astype("int64") + res[:, 2].astype("int64") * (1 << 26)
+        else:
+          allo_state_idxs = res[:, 1]
+        uniq_idxs, uniq_inverse = numpy.unique(allo_state_idxs, return_inverse=True)
+        if self.type == "align":
+          uniq_labels = [
+            self.allophone_labeling.get_label_idx(int(idx) % (1 << 26), int(idx) // (1 << 26)) for idx in uniq_idxs]
+        else:
+          uniq_labels = [self.allophone_labeling.state_tying_by_allo_state_idx[int(idx)] for idx in uniq_idxs]
+        label_seq = numpy.array(uniq_labels, dtype=self.dtype)[uniq_inverse]
         assert label_seq.shape == (len(res),)
         return label_seq
       elif self.type == "feat":
         times, feats = res
         assert len(times) == len(feats) > 0
-        feat_mat = numpy.array(feats, dtype=self.dtype)
+        feat_mat = feats.astype(self.dtype, copy=False)
         assert feat_mat.shape == (len(times), self.num_labels)
         return feat_mat
       else:
@@ -0,0 +1,532 @@
+"""
+Decoding runtime for the step-by-step graph which was compiled via ``tools/compile_tf_graph.py``
+with the option ``--rec_step_by_step`` (see :class:`RecStepByStepLayer` there).
+
+The exported graph keeps the decoder state in variables (the state vars).
+We keep all of them on the device, and the hypotheses of all utterances in flight
+are stacked along the batch dim of the state vars.
+Per decoder step, the host only gets the scores of the stochastic vars
+(e.g. the output label distribution), selects the new hypotheses (beam search),
+and then feeds back the source rows and the chosen labels.
+The selection of the source rows is a single in-graph gather over all state vars,
+which also drops the rows of finished hypotheses.
+
+Continuous batching: When an utterance is finished, a new utterance can join the batch in flight.
+For that, we run the init op of the compiled graph for the new utterances,
+and concatenate the new state rows to the ones of the utterances in flight
+(non-batch dims, e.g. the encoder time, are zero-padded, the sizes are kept in separate state vars).
+This is only correct if the states of different rows do not interfere,
+i.e. the scores must not depend on the global step counter ``i`` of the rec loop
+(e.g. via positional encodings), and no ``state_*`` var has a dynamic non-batch dim
+(e.g. the accumulated keys/values of self-attention).
+This is checked automatically, and otherwise we fall back to static batches,
+where new utterances only join when the whole batch is finished.
+
+See :func:`CompiledGraphDecoder.decode_iter`, and ``tools/decode-compiled-graph.py`` for benchmarking.
+"""
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import typing
+import numpy
+import tensorflow as tf
+from Log import log
+
+
+_VarOpTypes = ("Variable", "VariableV2", "VarHandleOp")
+
+
+def _var_read(var_op):
+  """
+  :param tf.Operation var_op:
+  :return: value of the variable
+  :rtype: tf.Tensor
+  """
+  if var_op.type == "VarHandleOp":
+    from tensorflow.python.ops import resource_variable_ops
+    return resource_variable_ops.read_variable_op(var_op.outputs[0], dtype=var_op.get_attr("dtype"))
+  return tf.identity(var_op.outputs[0])
+
+
+def _var_assign(var_op, value):
+  """
+  :param tf.Operation var_op:
+  :param tf.Tensor value: can have a different shape than the variable before
+  :rtype: tf.Operation
+  """
+  if var_op.type == "VarHandleOp":
+    from tensorflow.python.ops import resource_variable_ops
+    return resource_variable_ops.assign_variable_op(var_op.outputs[0], value)
+  return tf.assign(var_op.outputs[0], value, validate_shape=False).op
+
+
+def _concat_batch_padded(old, new, ndim):
+  """
+  :param tf.Tensor old: batch-major
+  :param tf.Tensor new: batch-major, same ndim as old
+  :param int ndim:
+  :return: concatenated along the batch dim. other dims are zero-padded to the max of both
+  :rtype: tf.Tensor
+  """
+  if ndim > 1:
+    old_shape, new_shape = tf.shape(old)[1:], tf.shape(new)[1:]
+    max_shape = tf.maximum(old_shape, new_shape)
+
+    def _pad(x, x_shape):
+      paddings = tf.stack([tf.zeros_like(max_shape), max_shape - x_shape], axis=1)  # (ndim - 1, 2)
+      return tf.pad(x, tf.concat([[[0, 0]], paddings], axis=0))
+
+    old, new = _pad(old, old_shape), _pad(new, new_shape)
+  return tf.concat([old, new], axis=0)
+
+
+class _Utterance(object):
+  """
+  Utterance in flight in :class:`CompiledGraphDecoder`.
+  """
+
+  def __init__(self, idx, inputs, max_seq_len):
+    """
+    :param int idx: index in the input sequence
+    :param numpy.ndarray inputs: (time,...)
+    :param int max_seq_len: max num of decoder steps
+    """
+    self.idx = idx
+    self.inputs = inputs
+    self.max_seq_len = max_seq_len
+    self.num_steps = 0
+    self.finals = []  # type: typing.List[typing.Tuple[float,int,typing.Optional[tuple]]]  # score, len, hist
+    self.start_time = time.time()
+
+
+class CompiledGraphDecoder(object):
+  """
+  Beam search over the compiled step-by-step graph, for multiple utterances in flight.
+  """
+
+  def __init__(self, graph_filename, checkpoint_filename, rec_step_by_step_json,
+               beam_size=12, max_batch_size=32, data_key="data",
+               max_seq_len=100, max_seq_len_factor=None, length_normalization=True, end_label=0,
+               continuous_batching=None, session_config=None):
+    """
+    :param str graph_filename: pb, pbtxt, meta or metatxt, from compile_tf_graph.py
+    :param str checkpoint_filename: TF checkpoint with the model params
+    :param str rec_step_by_step_json: via --rec_step_by_step_output_file of compile_tf_graph.py
+    :param int beam_size:
+    :param int max_batch_size: max num of utterances in flight
+    :param str data_key: extern data key of the encoder input
+    :param int max_seq_len: max num of decoder steps
+    :param float|None max_seq_len_factor: if given, the max num of decoder steps is relative to the input len
+    :param bool length_normalization: for the final ranking and the stopping criterion
+    :param int end_label: only used if the graph has no "end_flag" state var (i.e. the rec layer has no "end" layer)
+    :param bool|None continuous_batching: None means to use it if it is safe for this graph (see module doc)
+    :param tf.ConfigProto|None session_config:
+    """
+    assert beam_size >= 1 and max_batch_size >= 1
+    self.beam_size = beam_size
+    self.max_batch_size = max_batch_size
+    self.max_seq_len = max_seq_len
+    self.max_seq_len_factor = max_seq_len_factor
+    self.length_normalization = length_normalization
+    self.end_label = end_label
+    with open(rec_step_by_step_json) as f:
+      self.info = json.load(f)
+    assert isinstance(self.info, dict)
+    self.stochastic_var_order = self.info["stochastic_var_order"]  # type: typing.List[str]
+    assert self.stochastic_var_order, "%s: no stochastic vars (choice layers)" % self
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      self._import_graph(graph_filename)
+      self._var_ops = {
+        name: self.graph.get_operation_by_name(var_info["var_op"])
+        for (name, var_info) in self.info["state_vars"].items()}  # type: typing.Dict[str,tf.Operation]
+      self._data_placeholder = self.graph.get_tensor_by_name(
+        "extern_data/placeholders/%s/%s:0" % (data_key, data_key))
+      self._data_size_placeholder = self.graph.get_tensor_by_name(
+        "extern_data/placeholders/%s/%s_dim0_size:0" % (data_key, data_key))
+      try:
+        self._train_flag = self.graph.get_tensor_by_name("globals/train_flag:0")  # type: typing.Optional[tf.Tensor]
+      except KeyError:
+        self._train_flag = None
+      safe, reason = self._is_continuous_batching_safe()
+      if continuous_batching is None:
+        continuous_batching = safe
+        if not safe:
+          print("%s: Not using continuous batching: %s" % (self.__class__.__name__, reason), file=log.v3)
+      elif continuous_batching and not safe:
+        print("%s: Warning: continuous batching enabled, but: %s" % (self.__class__.__name__, reason), file=log.v2)
+      self.continuous_batching = continuous_batching
+      with tf.name_scope("compiled_graph_decoder"):
+        self._build_ops()
+    self.session = tf.Session(graph=self.graph, config=session_config)
+    self._restore_params(checkpoint_filename)
+    self._row_utts = numpy.zeros((0,), dtype="int32")  # utterance idx per row of the state vars, -1 if dead
+    self._row_scores = numpy.zeros((0,), dtype="float32")
+    self._row_hists = []  # type: typing.List[typing.Optional[tuple]]  # label history, as linked tuples
+    self._utterances = {}  # type: typing.Dict[int,_Utterance]  # in flight
+    self.start_time = time.time()
+    self.num_utterances = 0
+    self.num_steps = 0
+    self.num_rows = 0  # sum over the steps
+    self.num_session_runs = 0
+    self.num_joins = 0
+    self.latencies = []  # type: typing.List[float]
+
+  def __repr__(self):
+    return "<%s beam_size=%i max_batch_size=%i>" % (self.__class__.__name__, self.beam_size, self.max_batch_size)
+
+  def _import_graph(self, filename):
+    """
+    :param str filename:
+    """
+    ext = os.path.splitext(filename)[1]
+    if ext in [".meta", ".metatxt"]:
+      tf.train.import_meta_graph(filename, clear_devices=True)
+    else:
+      assert ext in [".pb", ".pbtxt"], "%s: graph filename %r invalid" % (self, filename)
+      graph_def = tf.GraphDef()
+      if ext == ".pbtxt":
+        from google.protobuf import text_format
+        with open(filename) as f:
+          text_format.Merge(f.read(), graph_def)
+      else:
+        with open(filename, "rb") as f:
+          graph_def.ParseFromString(f.read())
+      tf.import_graph_def(graph_def, name="")
+
+  def _depends_on_var(self, ops, var_op):
+    """
+    :param list[tf.Operation] ops:
+    :param tf.Operation var_op:
+    :return: whether any of the ops reads the variable
+    :rtype: bool
+    """
+    visited = set()
+    queue = list(ops)
+    while queue:
+      op = queue.pop()
+      if op in visited:
+        continue
+      visited.add(op)
+      if op.type in _VarOpTypes:
+        if op is var_op:
+          return True
+        continue
+      queue.extend([x.op for x in op.inputs])
+      queue.extend(op.control_inputs)
+    return False
+
+  def _is_continuous_batching_safe(self):
+    """
+    :return: whether it is safe, and otherwise the reason
+    :rtype: (bool, str|None)
+    """
+    for name, var_info in sorted(self.info["state_vars"].items()):
+      if name.startswith("state_") and None in var_info["shape"][1:]:
+        return False, "state var %r has a dynamic non-batch dim, shape %r" % (name, var_info["shape"])
+    if "i" in self._var_ops:
+      ops = [
+        self.graph.get_operation_by_name(self.info["stochastic_vars"][name]["calc_scores_op"])
+        for name in self.stochastic_var_order]
+      if "end_flag" in self._var_ops:
+        next_step_op = self.graph.get_operation_by_name(self.info["next_step_op"])
+        ops.extend([
+          op for op in next_step_op.control_inputs
+          if op.inputs and op.inputs[0].op is self._var_ops["end_flag"]])
+      if self._depends_on_var(ops, self._var_ops["i"]):
+        return False, "the scores depend on the rec loop step counter"
+    return True, None
+
+  def _build_ops(self):
+    """
+    Creates the ops for the beam selection, and to join new utterances.
+    """
+    self._batch_var_names = [
+      name for (name, var_info) in sorted(self.info["state_vars"].items())
+      if not name.startswith("stochastic_var_") and len(var_info["shape"]) > 0]
+    self._join_var_names = [
+      name for name in sorted(self.info["state_vars"].keys()) if not name.startswith("stochastic_var_")]
+    self._scores = {}  # type: typing.Dict[str,tf.Tensor]
+    self._choices = {}  # type: typing.Dict[str,tf.Tensor]
+    self._select_ops = {}  # type: typing.Dict[str,tf.Operation]
+    self._src_rows = tf.placeholder(tf.int32, shape=(None,), name="src_rows")
+    gather_ops = [
+      _var_assign(self._var_ops[name], tf.gather(_var_read(self._var_ops[name]), self._src_rows))
+      for name in self._batch_var_names]
+    for name in self.stochastic_var_order:
+      var_info = self.info["stochastic_vars"][name]
+      calc_scores_op = self.graph.get_operation_by_name(var_info["calc_scores_op"])
+      with tf.control_dependencies([calc_scores_op]):
+        self._scores[name] = _var_read(self._var_ops[var_info["scores_state_var"]])
+      choice_var_info = self.info["state_vars"][var_info["choice_state_var"]]
+      self._choices[name] = tf.placeholder(
+        choice_var_info["dtype"], shape=choice_var_info["shape"], name="choice_%s" % name)
+      self._select_ops[name] = tf.group(
+        _var_assign(self._var_ops[var_info["choice_state_var"]], self._choices[name]), *gather_ops)
+    self._next_step_op = self.graph.get_operation_by_name(self.info["next_step_op"])
+    self._end_flag = None  # type: typing.Optional[tf.Tensor]
+    if "end_flag" in self._var_ops:
+      with tf.control_dependencies([self._next_step_op]):
+        self._end_flag = _var_read(self._var_ops["end_flag"])
+    self._init_op = self.graph.get_operation_by_name(self.info["init_op"])
+    # For continuous batching. Backup the states of the utterances in flight, init, then concat.
+    backup_ops = []
+    merge_ops = []
+    self._backup_vars_initializer = []  # type: typing.List[tf.Operation]
+    for name in self._join_var_names:
+      var_info = self.info["state_vars"][name]
+      ndim = len(var_info["shape"])
+      backup = tf.Variable(
+        tf.zeros([0] * ndim, dtype=var_info["dtype"]), name="backup_%s" % name,
+        trainable=False, validate_shape=False, collections=[])
+      self._backup_vars_initializer.append(backup.initializer)
+      backup_ops.append(tf.assign(backup, _var_read(self._var_ops[name]), validate_shape=False).op)
+      if ndim == 0:  # e.g. the step counter. we keep the one of the utterances in flight
+        merged = backup.read_value()
+      else:
+        merged = _concat_batch_padded(backup.read_value(), _var_read(self._var_ops[name]), ndim=ndim)
+      merge_ops.append(_var_assign(self._var_ops[name], merged))
+    self._backup_op = tf.group(*backup_ops, name="backup_op")
+    self._merge_op = tf.group(*merge_ops, name="merge_op")
+
+  def _restore_params(self, checkpoint_filename):
+    """
+    We do not depend on a saver in the graph (pb files do not have one),
+    but assign all variables which exist in the checkpoint directly.
+    All other variables (e.g. the state vars) get their initial value.
+
+    :param str checkpoint_filename:
+    """
+    reader = tf.train.NewCheckpointReader(checkpoint_filename)
+    feed_dict = {}
+    ops = list(self._backup_vars_initializer)
+    names = set([op.name for op in self.graph.get_operations()])
+    with self.graph.as_default():
+      with tf.name_scope("compiled_graph_decoder/restore"):
+        for op in self.graph.get_operations():
+          if op.type not in _VarOpTypes or op.name.startswith("compiled_graph_decoder/"):
+            continue
+          if reader.has_tensor(op.name):
+            value = reader.get_tensor(op.name)
+            placeholder = tf.placeholder(op.get_attr("dtype"), shape=value.shape)
+            feed_dict[placeholder] = value
+            ops.append(_var_assign(op, placeholder))
+          elif op.name + "/Assign" in names:  # the initializer
+            ops.append(self.graph.get_operation_by_name(op.name + "/Assign"))
+    self.session.run(ops, feed_dict=feed_dict)
+
+  def _run(self, fetches, feed_dict=None):
+    """
+    :param fetches:
+    :param dict|None feed_dict:
+    """
+    self.num_session_runs += 1
+    return self.session.run(fetches, feed_dict=feed_dict)
+
+  def _join(self, utterances):
+    """
+    Runs the encoder (init op) for the new utterances, and adds them to the rows in flight.
+
+    :param list[_Utterance] utterances:
+    """
+    lens = [len(utt.inputs) for utt in utterances]
+    inputs = numpy.zeros(
+      (len(utterances), max(lens)) + utterances[0].inputs.shape[1:], dtype=self._data_placeholder.dtype.as_numpy_dtype)
+    for i, utt in enumerate(utterances):
+      inputs[i, :lens[i]] = utt.inputs
+    feed_dict = {self._data_placeholder: inputs, self._data_size_placeholder: lens}
+    if self._train_flag is not None:
+      feed_dict[self._train_flag] = False
+    if len(self._row_utts) > 0:
+      self._run(self._backup_op)
+      self._run(self._init_op, feed_dict=feed_dict)
+      self._run(self._merge_op)
+    else:
+      self._run(self._init_op, feed_dict=feed_dict)
+    for utt in utterances:
+      self._utterances[utt.idx] = utt
+    self._row_utts = numpy.concatenate([self._row_utts, [utt.idx for utt in utterances]]).astype("int32")
+    self._row_scores = numpy.concatenate([self._row_scores, numpy.zeros((len(utterances),), dtype="float32")])
+    self._row_hists = self._row_hists + [None] * len(utterances)
+    self.num_joins += 1
+
+  def _select(self, name, scores):
+    """
+    Beam search, for each utterance in flight.
+
+    :param str name: stochastic var
+    :param numpy.ndarray scores: (rows, dim), log probs, for all rows of the state vars
+    """
+    src_rows, labels = [], []
+    new_utts, new_scores = [], []
+    for utt_idx in sorted(self._utterances.keys()):
+      rows = numpy.nonzero(self._row_utts == utt_idx)[0]
+      if len(rows) == 0:
+        continue
+      total = (scores[rows] + self._row_scores[rows, None]).ravel()
+      k = min(self.beam_size, total.size)
+      if k < total.size:
+        best = numpy.argpartition(-total, k - 1)[:k]
+        best = best[numpy.argsort(-total[best], kind="stable")]
+      else:
+        best = numpy.argsort(-total, kind="stable")
+      src_rows.append(rows[best // scores.shape[1]])
+      labels.append(best % scores.shape[1])
+      new_utts.append(numpy.full((k,), utt_idx, dtype="int32"))
+      new_scores.append(total[best])
+    src_rows = numpy.concatenate(src_rows)
+    labels = numpy.concatenate(labels)
+    self._run(self._select_ops[name], feed_dict={self._src_rows: src_rows, self._choices[name]: labels})
+    self._row_hists = [(int(label), self._row_hists[src]) for (src, label) in zip(src_rows, labels)]
+    self._row_utts = numpy.concatenate(new_utts)
+    self._row_scores = numpy.concatenate(new_scores).astype("float32")
+    return labels
+
+  def _final_score(self, score, length):
+    """
+    :param float score:
+    :param int length:
+    :rtype: float
+    """
+    if self.length_normalization:
+      return score / max(length, 1)
+    return score
+
+  def _make_result(self, utt):
+    """
+    :param _Utterance utt:
+    :return: n-best list of (score, label seq), best first.
+      if there are multiple stochastic vars, the label seq consists of tuples (one label per stochastic var)
+    :rtype: list[(float,list[int]|list[tuple[int]])]
+    """
+    res = []
+    for score, length, hist in utt.finals:
+      seq = []
+      while hist is not None:
+        seq.append(hist[0])
+        hist = hist[1]
+      seq.reverse()
+      num_vars = len(self.stochastic_var_order)
+      if num_vars > 1:
+        seq = [tuple(seq[i:i + num_vars]) for i in range(0, len(seq), num_vars)]
+      res.append((self._final_score(score, length), seq))
+    res.sort(key=lambda x: -x[0])
+    return res[:self.beam_size]
+
+  def _step(self):
+    """
+    One decoder step for all utterances in flight.
+
+    :return: finished utterances
+    :rtype: list[_Utterance]
+    """
+    labels = None
+    for name in self.stochastic_var_order:
+      scores = self._run(self._scores[name])
+      labels = self._select(name, scores)
+    if self._end_flag is not None:
+      ended = self._run(self._end_flag)
+    else:
+      self._run(self._next_step_op)
+      ended = labels == self.end_label
+    self.num_steps += 1
+    self.num_rows += len(self._row_utts)
+    for row in numpy.nonzero(ended)[0]:
+      utt = self._utterances[self._row_utts[row]]
+      utt.finals.append((float(self._row_scores[row]), utt.num_steps + 1, self._row_hists[row]))
+      self._row_utts[row] = -1
+    finished = []
+    for utt_idx, utt in sorted(self._utterances.items()):
+      utt.num_steps += 1
+      rows = numpy.nonzero(self._row_utts == utt_idx)[0]
+      if len(rows) > 0 and utt.num_steps < utt.max_seq_len:
+        if len(utt.finals) < self.beam_size:
+          if self.length_normalization or not utt.finals:
+            continue
+          # Without length normalization, the scores of the active hyps can only get worse.
+          if max([score for (score, _, _) in utt.finals]) < numpy.max(self._row_scores[rows]):
+            continue
+      if len(rows) > 0 and not utt.finals:  # max seq len reached
+        utt.finals.extend([(float(self._row_scores[row]), utt.num_steps, self._row_hists[row]) for row in rows])
+      self._row_utts[rows] = -1
+      finished.append(utt)
+    return finished
+
+  def decode_iter(self, inputs):
+    """
+    :param typing.Iterable[numpy.ndarray] inputs: (time,...) each. can be a lazy iterator, e.g. for streaming
+    :return: yields (idx, n-best list) as soon as the utterance is finished, i.e. not necessarily in order.
+      see :func:`_make_result` for the format of the n-best list
+    :rtype: typing.Iterator[(int,list[(float,list[int])])]
+    """
+    inputs = iter(inputs)
+    inputs_finished = False
+    next_idx = 0
+    while True:
+      num_free = self.max_batch_size - len(self._utterances)
+      if not inputs_finished and num_free > 0 and (self.continuous_batching or not self._utterances):
+        new_utts = []
+        for utt_inputs in inputs:
+          utt_inputs = numpy.asarray(utt_inputs)
+          max_seq_len = self.max_seq_len
+          if self.max_seq_len_factor is not None:
+            max_seq_len = max(int(self.max_seq_len_factor * len(utt_inputs)), 1)
+          new_utts.append(_Utterance(idx=next_idx, inputs=utt_inputs, max_seq_len=max_seq_len))
+          next_idx += 1
+          if len(new_utts) >= num_free:
+            break
+        else:
+          inputs_finished = True
+        if new_utts:
+          self._join(new_utts)
+      if not self._utterances:
+        assert inputs_finished
+        break
+      for utt in self._step():
+        del self._utterances[utt.idx]
+        self.num_utterances += 1
+        self.latencies.append(time.time() - utt.start_time)
+        yield utt.idx, self._make_result(utt)
+      if not self._utterances:
+        # Reset such that the next join does not need to merge.
+        self._row_utts = self._row_utts[:0]
+        self._row_scores = self._row_scores[:0]
+        self._row_hists = []
+
+  def decode(self, inputs):
+    """
+    :param list[numpy.ndarray] inputs: (time,...) each
+    :return: n-best list per input, in the same order
+    :rtype: list[list[(float,list[int])]]
+    """
+    results = [None] * len(inputs)  # type: typing.List[typing.Optional[list]]
+    for idx, res in self.decode_iter(inputs):
+      results[idx] = res
+    return results
+
+  def get_stats(self):
+    """
+    :return: counters for benchmarking
+    :rtype: dict[str]
+    """
+    elapsed = time.time() - self.start_time
+    return {
+      "continuous_batching": self.continuous_batching,
+      "num_utterances": self.num_utterances,
+      "num_steps": self.num_steps,
+      "num_joins": self.num_joins,
+      "num_session_runs": self.num_session_runs,
+      "avg_rows_per_step": float(self.num_rows) / max(self.num_steps, 1),
+      "utterances_per_sec": self.num_utterances / elapsed if elapsed > 0 else 0.,
+      "avg_latency": float(numpy.mean(self.latencies)) if self.latencies else None,
+      "max_latency": float(numpy.max(self.latencies)) if self.latencies else None,
+      "elapsed": elapsed}
+
+  def close(self):
+    """
+    Closes the session.
+    """
+    self.session.close()
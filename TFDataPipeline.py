@@ -133,6 +133,7 @@ It depends on whether the full network is recurrent or not.
 from __future__ import print_function
 
 import sys
+import time
 import typing
 try:
   # noinspection PyCompatibility
@@ -866,6 +867,9 @@ class DataProviderBase(object):
     if data_keys is None:
       data_keys = extern_data.data.keys()
     self.data_keys = sorted(data_keys)  # type: typing.List[str]
+    # If set (e.g. a bounded deque), the data threads append (name, start time, end time) of what they are doing.
+    # This is used for the timelines, see TFEngine.TimelineTraces.
+    self.thread_events = None  # type: typing.Optional[typing.MutableSequence[typing.Tuple[str,float,float]]]
 
   def start_threads(self):
     """
@@ -1054,20 +1058,53 @@ class FeedDictDataProvider(DataProviderBase):
         data["seq_tag"][q] = self.dataset.get_tag(seq.seq_idx)
     for k in seq_lens.keys():
       data["%s_seq_lens" % k] = seq_lens[k]
+    for k, (ids_key, positions_key) in sorted(self.extern_data.packed_segments.items()):
+      if k not in self.data_keys:
+        continue
+      data[ids_key], data[positions_key] = self._get_packed_segments(batch, key=k, shape=shapes[k][:2])
     return data
 
+  @staticmethod
+  def _get_packed_segments(batch, key, shape):
+    """
+    See :func:`TFNetwork.ExternData.register_packed_segments`.
+
+    :param EngineBatch.Batch batch:
+    :param str key:
+    :param list[int] shape: (batch,time)
+    :return: segment ids, segment positions, both of the given shape
+    :rtype: (numpy.ndarray,numpy.ndarray)
+    """
+    segment_ids = numpy.full(shape, -1, dtype="int32")
+    segment_positions = numpy.zeros(shape, dtype="int32")
+    num_segments = [0] * batch.num_slices
+    for seq in sorted(batch.seqs, key=lambda s: (s.batch_slice, s.batch_frame_offset[key])):
+      o = seq.batch_frame_offset[key]
+      q = seq.batch_slice
+      length = seq.frame_length[key]
+      segment_ids[q, o:o + length] = num_segments[q]
+      segment_positions[q, o:o + length] = numpy.arange(length)
+      num_segments[q] += 1
+    return segment_ids, segment_positions
+
   def _thread_main(self):
     try:
       import better_exchook
       better_exchook.install()
 
       while self.batches.has_more() and not self.coord.should_stop():
+        start_time = time.time()
         enqueue_args = self.get_next_batch(consider_batch_slice=True)
+        if self.thread_events is not None:
+          self.thread_events.append(("get_next_batch %i" % (self.cur_batch_idx - 1), start_time, time.time()))
         if enqueue_args is not None:
+          start_time = time.time()
           if self.queue:
             self.queue.put(enqueue_args)
           else:
             self.tf_queue.enqueue(tf_session=self.tf_session, data=enqueue_args)
+          if self.thread_events is not None:
+            self.thread_events.append(("enqueue", start_time, time.time()))
         with self.state_change_cond:
           self.state_change_cond.notifyAll()
         self.batches.advance(1)
@@ -1153,6 +1190,12 @@ class FeedDictDataProvider(DataProviderBase):
           raise Exception(
             "dataset currently does not support variable shape in other dimensions than the first. "
             "dim=%i, placeholder=%r" % (dim, len_placeholder))
+    # The segment info with seq packing. The seq lengths are shared with the data key.
+    for k, segment_keys in self.extern_data.packed_segments.items():
+      if k not in self.data_keys:
+        continue
+      for segment_key in segment_keys:
+        d[self.extern_data.get_data(segment_key).placeholder] = output[segment_key]
     return d, {"seq_idx": output["seq_idx"], "seq_tag": output["seq_tag"]}
 
   def get_dataset_name(self):
@@ -32,7 +32,7 @@ from Dataset import Dataset, Batch, BatchSetGenerator
 from LearningRateControl import load_learning_rate_control_from_config, LearningRateControl
 from Log import log
 from Pretrain import pretrain_from_config
-from TFNetwork import TFNetwork, help_on_tf_exception
+from TFNetwork import TFNetwork, AsyncCheckpointSaver, help_on_tf_exception
 from TFUpdater import Updater
 from Util import hms, NumbersDict, BackendEngine
 from pprint import pprint
@@ -44,6 +44,246 @@ class CancelTrainingException(Exception):
   """
 
 
+class StepTimings(object):
+  """
+  Per-step timing breakdown of :class:`Runner`, enabled via the config option ``step_timing``.
+
+  Phases:
+
+  - ``data_wait``: waiting for the next batch (``have_more_data`` of the data provider)
+  - ``feed``: construction of the feed dict (``get_feed_dict``)
+  - ``session_run``: the ``session.run`` call
+  - ``post_process``: eval info, extra fetches callback, summaries
+  - ``horovod``: Horovod signals and param sync
+
+  Every ``log_interval`` steps, the step is written as a JSON line and as TF summaries.
+  The JSON lines also contain the epoch and the dataset, as train and dev runners append to the same file.
+  At the end, :func:`get_summary` gives the totals, which :class:`Runner` prints.
+  """
+
+  phases = ("data_wait", "feed", "session_run", "post_process", "horovod")
+
+  def __init__(self, log_interval=1, json_filename=None, summary_writer=None, step_offset=0,
+               epoch=None, dataset_name=None, report_prefix=None):
+    """
+    :param int log_interval: sampling rate, in steps, for the JSON lines and the summaries
+    :param str|None json_filename:
+    :param tf.summary.FileWriter|None summary_writer:
+    :param int step_offset: global train step at the start, for the summaries
+    :param int|None epoch: for the JSON lines
+    :param str|None dataset_name: for the JSON lines
+    :param str|None report_prefix: for the JSON lines, e.g. "train epoch 3"
+    """
+    assert log_interval >= 1
+    self.json_info = {"epoch": epoch, "dataset": dataset_name, "report_prefix": report_prefix}
+    self.log_interval = log_interval
+    self.summary_writer = summary_writer
+    self.step_offset = step_offset
+    self.json_file = open(json_filename, "a") if json_filename else None
+    self.total = {phase: 0.0 for phase in self.phases}
+    self.max = {phase: 0.0 for phase in self.phases}
+    self.num_steps = 0
+    self.num_seqs = 0
+    self.num_frames = 0
+    self.num_padded_frames = 0
+    self._cur = {phase: 0.0 for phase in self.phases}
+
+  def add(self, phase, duration):
+    """
+    :param str phase: one of :data:`phases`
+    :param float duration: in secs
+    """
+    self._cur[phase] += duration
+
+  def finish_step(self, step, seq_lens=None):
+    """
+    :param int step: step of this epoch
+    :param numpy.ndarray|None seq_lens: of the main input, to get the number of frames and the padding
+    """
+    step_time = sum(self._cur.values())
+    info = {"step": step, "global_step": step + self.step_offset, "total": step_time}
+    info.update(self.json_info)
+    for phase in self.phases:
+      info[phase] = self._cur[phase]
+      self.total[phase] += self._cur[phase]
+      self.max[phase] = max(self.max[phase], self._cur[phase])
+      self._cur[phase] = 0.0
+    if seq_lens is not None and len(seq_lens) > 0:
+      num_frames = int(numpy.sum(seq_lens))
+      num_padded_frames = len(seq_lens) * int(numpy.max(seq_lens))
+      self.num_seqs += len(seq_lens)
+      self.num_frames += num_frames
+      self.num_padded_frames += num_padded_frames
+      info["num_seqs"] = len(seq_lens)
+      info["num_frames"] = num_frames
+      info["padding_ratio"] = 1. - float(num_frames) / max(num_padded_frames, 1)
+      info["frames_per_sec"] = num_frames / step_time if step_time > 0 else 0.
+    self.num_steps += 1
+    if step % self.log_interval != 0:
+      return
+    if self.json_file:
+      import json
+      self.json_file.write("%s\n" % json.dumps(info, sort_keys=True))
+    if self.summary_writer:
+      self.summary_writer.add_summary(
+        tf.Summary(value=[
+          tf.Summary.Value(tag="step_timing/%s" % key, simple_value=value)
+          for (key, value) in sorted(info.items()) if key not in ["step", "global_step"] + list(self.json_info)]),
+        info["global_step"])
+
+  def get_summary(self):
+    """
+    :return: totals over all steps
+    :rtype: dict[str,float|int]
+    """
+    total_time = sum(self.total.values())
+    summary = {"num_steps": self.num_steps, "total": total_time}
+    for phase in self.phases:
+      summary[phase] = self.total[phase]
+      summary["%s_max" % phase] = self.max[phase]
+      summary["%s_frac" % phase] = self.total[phase] / total_time if total_time > 0 else 0.
+    if self.num_padded_frames:
+      summary["num_seqs"] = self.num_seqs
+      summary["num_frames"] = self.num_frames
+      summary["padding_ratio"] = 1. - float(self.num_frames) / self.num_padded_frames
+      summary["frames_per_sec"] = self.num_frames / total_time if total_time > 0 else 0.
+    return summary
+
+  def format_summary(self):
+    """
+    :return: one line with the most relevant info of :func:`get_summary`
+    :rtype: str
+    """
+    summary = self.get_summary()
+    info = [
+      "%s %.1f%% (max %.3f sec)" % (phase, summary["%s_frac" % phase] * 100., summary["%s_max" % phase])
+      for phase in self.phases]
+    if "padding_ratio" in summary:
+      info += ["padding %.1f%%" % (summary["padding_ratio"] * 100.), "%.1f frames/sec" % summary["frames_per_sec"]]
+    return ", ".join(info)
+
+  def close(self):
+    """
+    Writes the summary as the last JSON line, and closes the file.
+    """
+    if self.json_file:
+      import json
+      info = {"summary": self.get_summary()}
+      info.update(self.json_info)
+      self.json_file.write("%s\n" % json.dumps(info, sort_keys=True))
+      self.json_file.close()
+      self.json_file = None
+
+
+class TimelineTraces(object):
+  """
+  Captures TF timelines (Chrome trace format) for selected steps of :class:`Runner`.
+  Steps are selected via the config options ``store_metadata_mod_step`` (every N steps)
+  and ``store_metadata_steps`` (list of steps of the epoch).
+  Each trace is written as ``timeline.step<step>.trace`` into the TF log dir,
+  together with the activity of the data pipeline thread and of the runner itself.
+  The oldest traces (also from previous epochs, i.e. in the parent dir) are deleted
+  such that all of them stay within ``store_metadata_max_bytes``.
+  Over all traced steps, we collect the time per op type, see :func:`format_top_ops_report`.
+  """
+
+  def __init__(self, logdir, mod_step=0, steps=(), max_bytes=1024 ** 3):
+    """
+    :param str logdir: the TF log dir of this runner
+    :param int mod_step: trace every N steps, if > 0
+    :param list[int]|tuple[int] steps: trace these steps
+    :param int max_bytes: disk budget for all traces in the parent dir of logdir
+    """
+    self.logdir = logdir
+    self.mod_step = mod_step
+    self.steps = set(steps)
+    self.max_bytes = max_bytes
+    self.num_traces = 0
+    self.op_type_micros = {}  # type: typing.Dict[str,int]
+    self.op_type_count = {}  # type: typing.Dict[str,int]
+
+  def should_trace(self, step):
+    """
+    :param int step: step of this epoch
+    :rtype: bool
+    """
+    if self.mod_step and step % self.mod_step == 0:
+      return True
+    return step in self.steps
+
+  def _collect_op_stats(self, step_stats):
+    """
+    :param tensorflow.core.framework.step_stats_pb2.StepStats step_stats:
+    """
+    for dev_stats in step_stats.dev_stats:
+      for node_stats in dev_stats.node_stats:
+        # timeline_label is like "name = OpType(inputs)".
+        label = node_stats.timeline_label
+        if " = " in label and "(" in label:
+          op_type = label.split(" = ", 1)[1].split("(", 1)[0]
+        else:
+          op_type = node_stats.node_name.split(":")[0]
+        self.op_type_micros[op_type] = self.op_type_micros.get(op_type, 0) + node_stats.all_end_rel_micros
+        self.op_type_count[op_type] = self.op_type_count.get(op_type, 0) + 1
+
+  def write(self, step, run_metadata, events):
+    """
+    :param int step: step of this epoch
+    :param tf.RunMetadata run_metadata:
+    :param list[(str,str,float,float)] events: (thread name, event name, start time, end time), via time.time()
+    """
+    import json
+    self._collect_op_stats(run_metadata.step_stats)
+    trace = json.loads(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format(show_memory=True))
+    pid = max([event.get("pid", 0) for event in trace["traceEvents"]] + [0]) + 1
+    trace["traceEvents"].append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "RETURNN"}})
+    thread_ids = {}  # type: typing.Dict[str,int]
+    for thread_name, name, start_time, end_time in events:
+      if thread_name not in thread_ids:
+        thread_ids[thread_name] = len(thread_ids)
+        trace["traceEvents"].append({
+          "name": "thread_name", "ph": "M", "pid": pid, "tid": thread_ids[thread_name],
+          "args": {"name": thread_name}})
+      trace["traceEvents"].append({
+        "name": name, "ph": "X", "pid": pid, "tid": thread_ids[thread_name], "cat": thread_name,
+        "ts": start_time * 1e6, "dur": (end_time - start_time) * 1e6, "args": {}})
+    filename = os.path.join(self.logdir, "timeline.step%04i.trace" % step)
+    with open(filename, "w") as f:
+      json.dump(trace, f)
+    self.num_traces += 1
+    print("Stored timeline in %s." % filename, file=log.v5)
+    self._cleanup()
+
+  def _cleanup(self):
+    """
+    Deletes the oldest traces if we are above the disk budget.
+    """
+    from glob import glob
+    filenames = glob(os.path.join(os.path.dirname(os.path.abspath(self.logdir)), "*", "timeline.step*.trace"))
+    sizes = {fn: os.stat(fn).st_size for fn in filenames}
+    total_size = sum(sizes.values())
+    for fn in sorted(filenames, key=lambda fn_: os.stat(fn_).st_mtime):
+      if total_size <= self.max_bytes:
+        break
+      print("Timelines above disk budget, delete %s." % fn, file=log.v4)
+      os.remove(fn)
+      total_size -= sizes[fn]
+
+  def format_top_ops_report(self, num_ops=20):
+    """
+    :param int num_ops:
+    :return: the op types with the most time, over all traced steps
+    :rtype: str
+    """
+    total = sum(self.op_type_micros.values())
+    lines = ["Top ops over %i traced steps (%.3f ms per step):" % (
+      self.num_traces, total / 1000. / max(self.num_traces, 1))]
+    for op_type, micros in sorted(self.op_type_micros.items(), key=lambda item: -item[1])[:num_ops]:
+      lines.append("  %s: %.3f ms per step, %.1f%%, %i calls" % (
+        op_type, micros / 1000. / max(self.num_traces, 1), micros * 100. / max(total, 1), self.op_type_count[op_type]))
+    return "\n".join(lines)
+
+
 class Runner(object):
   """
   This encapsulates the logic around TF ``session.run``, i.e. iterating over the dataset.
@@ -79,6 +319,8 @@ class Runner(object):
     self._should_train = train
     self._should_eval = eval
     self.store_metadata_mod_step = engine.config.int("store_metadata_mod_step", 0)
+    self.store_metadata_steps = engine.config.int_list("store_metadata_steps", [])
+    self.timeline_traces = None  # type: typing.Optional[TimelineTraces]
     self.reset_updater_vars_mod_step = engine.config.int("reset_updater_vars_mod_step", 0)
     self.finalized = False
     self.cancel_flag = False
@@ -87,6 +329,7 @@ class Runner(object):
     self.device_crash_batch = None  # type: typing.Optional[int]
     self.start_time = None
     self.elapsed = None
+    self.step_timings = None  # type: typing.Optional[StepTimings]
     self._results_accumulated = NumbersDict()  # entries like "cost:output" or "loss"
     self._inv_norm_accumulated = NumbersDict()  # entries like "output"
     self.num_frames_accumulated = NumbersDict()  # for each data key (eg. "classes"), corresponding number of frames
@@ -398,21 +641,21 @@ class Runner(object):
     # Stopped before? Keep in sync -> Don't send anything anymore, other peers do not expect it.
     if self._horovod_stopped_runner:
       return True, False
-    # noinspection PyUnresolvedReferences,PyPackageRequirements
-    import horovod.tensorflow as hvd
-    from TFUtil import global_tensor
-    have_more_data_placeholder = global_tensor(
-      lambda: tf.placeholder(tf.int32, shape=(), name="horovod_have_more_data_placeholder"),
-      name="horovod_have_more_data_placeholder")  # 0 or 1
-    sum_have_data_t = global_tensor(
-      lambda: hvd.allreduce(have_more_data_placeholder, average=False),
-      name="horovod_sum_have_data")  # 0..size
-    have_error_placeholder = global_tensor(
-      lambda: tf.placeholder(tf.int32, shape=(), name="horovod_have_error_placeholder"),
-      name="horovod_have_error_placeholder")  # 0 or 1
-    sum_have_error_t = global_tensor(
-      lambda: hvd.allreduce(have_error_placeholder, average=False),
-      name="horovod_sum_have_error")  # 0..size
+    from TFUtil import get_horovod, global_tensor, horovod_reductions_in_order
+    hvd = get_horovod()
+    with horovod_reductions_in_order():  # both are run together
+      have_more_data_placeholder = global_tensor(
+        lambda: tf.placeholder(tf.int32, shape=(), name="horovod_have_more_data_placeholder"),
+        name="horovod_have_more_data_placeholder")  # 0 or 1
+      sum_have_data_t = global_tensor(
+        lambda: hvd.allreduce(have_more_data_placeholder, average=False),
+        name="horovod_sum_have_data")  # 0..size
+      have_error_placeholder = global_tensor(
+        lambda: tf.placeholder(tf.int32, shape=(), name="horovod_have_error_placeholder"),
+        name="horovod_have_error_placeholder")  # 0 or 1
+      sum_have_error_t = global_tensor(
+        lambda: hvd.allreduce(have_error_placeholder, average=False),
+        name="horovod_sum_have_error")  # 0..size
     sum_have_data, sum_have_error = self.engine.tf_session.run(
       (sum_have_data_t, sum_have_error_t),
       feed_dict={
@@ -447,25 +690,27 @@ class Runner(object):
     assert sync_step >= 1
     if not is_final and local_step % sync_step != sync_step - 1:
       return 0.0
-    from TFUtil import global_tensor
-    # noinspection PyUnresolvedReferences,PyPackageRequirements
-    import horovod.tensorflow as hvd
+    import hashlib
+    from TFUtil import get_horovod, global_tensor, allreduce_bucketed
+    hvd = get_horovod()
+    trainable_vars = self.engine.updater.trainable_vars
 
-    # noinspection PyShadowingNames
-    def assign_avg_var(var):
+    def assign_avg_vars():
       """
-      :param tf.Variable var:
+      :return: tensor with control deps on all the assigns
       :rtype: tf.Tensor
       """
-      return tf.assign(var, hvd.allreduce(var.read_value(), average=True))
-
-    assign_ops = []
-    for var in self.engine.updater.trainable_vars:
-      assign_ops.append(global_tensor(
-        lambda: assign_avg_var(var),
-        name="horovod_sync_params__var_%s" % var.name[:-2].replace("/", "_")).op)
+      values = allreduce_bucketed(
+        [var.read_value() for var in trainable_vars],
+        allreduce_func=lambda x: hvd.allreduce(x, average=True),
+        max_bucket_bytes=self.engine.config.int("horovod_bucket_size", None))
+      with tf.control_dependencies([tf.assign(var, value) for (var, value) in zip(trainable_vars, values)]):
+        return tf.constant(True)
+
+    vars_hash = hashlib.md5(" ".join([var.name for var in trainable_vars]).encode("utf8")).hexdigest()[:10]
+    sync_op = global_tensor(assign_avg_vars, name="horovod_sync_params_%s" % vars_hash).op
     start_time = time.time()
-    self.engine.tf_session.run(assign_ops)
+    self.engine.tf_session.run(sync_op)
     return time.time() - start_time
 
   def run(self, report_prefix):
@@ -506,6 +751,33 @@ class Runner(object):
     # We could also set it to 0 for non train epochs.
     step_offset = self.engine.network.get_global_train_step(session=sess)
 
+    if self.engine.config.bool("step_timing", False):
+      json_filename = self.engine.config.value("step_timing_file", None)
+      if not json_filename and logdir:
+        json_filename = "%s/step_timings.jsonl" % logdir
+      if json_filename:
+        if self.engine.config.is_true("use_horovod"):
+          # Each rank writes its own file.
+          from TFUtil import get_horovod
+          hvd = get_horovod()
+          base, ext = os.path.splitext(json_filename)
+          json_filename = "%s.rank%i%s" % (base, hvd.rank(), ext)
+        from Util import maybe_make_dirs
+        maybe_make_dirs(os.path.dirname(os.path.abspath(json_filename)))
+      self.step_timings = StepTimings(
+        log_interval=self.engine.config.int("step_timing_log_interval", 1),
+        json_filename=json_filename, summary_writer=writer, step_offset=step_offset,
+        epoch=self.engine.epoch, dataset_name=self.dataset.name, report_prefix=report_prefix)
+    step_timings = self.step_timings
+    if self.store_metadata_mod_step or self.store_metadata_steps:
+      assert writer, "store_metadata_mod_step/store_metadata_steps: need TF log dir"
+      from collections import deque
+      self.timeline_traces = TimelineTraces(
+        logdir=logdir, mod_step=self.store_metadata_mod_step, steps=self.store_metadata_steps,
+        max_bytes=self.engine.config.int("store_metadata_max_bytes", 1024 ** 3))
+      self.data_provider.thread_events = deque(maxlen=1000)
+    seq_lens_key = "size:%s:0" % self.data_provider.extern_data.default_input
+
     coord = self.data_provider.coord
 
     threads = tf.train.start_queue_runners(sess=sess, coord=coord)
@@ -526,19 +798,32 @@ class Runner(object):
       if writer:
         writer.add_graph(sess.graph)
       hvd_stop = hvd_error = False
-      while self.data_provider.have_more_data(session=sess):
+      while True:
+        phase_start_time = step_start_time = time.time()
+        if not self.data_provider.have_more_data(session=sess):
+          break
+        data_wait_end_time = time.time()
+        if step_timings:
+          step_timings.add("data_wait", time.time() - phase_start_time)
+          phase_start_time = time.time()
         hvd_stop, hvd_error = self._horovod_signal_have_more_data()
         if hvd_error:
           raise Exception("Some other Horovod peer failed.")
         if hvd_stop:
           # Some other peer does not have data anymore, but no error occurred.
           break
+        if step_timings:
+          step_timings.add("horovod", time.time() - phase_start_time)
+          phase_start_time = time.time()
         feed_dict, meta_step_info = self.data_provider.get_feed_dict()
         if isinstance(self.engine.network.train_flag, tf.Tensor):
           feed_dict[self.engine.network.train_flag] = self._train_flag
         if isinstance(self.engine.network.epoch_step, tf.Tensor):
           feed_dict[self.engine.network.epoch_step] = step
         start_time = time.time()
+        if step_timings:
+          step_timings.add("feed", start_time - phase_start_time)
+        feed_start_time = phase_start_time
         if self._should_train and self.reset_updater_vars_mod_step and step % self.reset_updater_vars_mod_step == 0:
           print("Reset updater vars in step %i." % step, file=log.v5)
           self.engine.updater.init_optimizer_vars(session=sess)
@@ -560,7 +845,7 @@ class Runner(object):
 
         # Now do one calculation step. Optionally with metadata.
         try:
-          if self.store_metadata_mod_step and step % self.store_metadata_mod_step == 0:
+          if self.timeline_traces and self.timeline_traces.should_trace(step):
             # Slow run that stores extra information for debugging.
             print('Storing metadata', file=log.v5)
             run_options = tf.RunOptions(
@@ -572,18 +857,25 @@ class Runner(object):
               feed_dict=feed_dict,
               options=run_options,
               run_metadata=run_metadata)  # type: typing.Dict[str,typing.Union[numpy.ndarray,str]]
-            elapsed_time_tf += time.time() - session_run_start_time
-            writer.add_summary(fetches_results["summary"], step + step_offset)
+            session_run_end_time = time.time()
+            elapsed_time_tf += session_run_end_time - session_run_start_time
+            if step_timings:
+              step_timings.add("session_run", session_run_end_time - session_run_start_time)
+            if "summary" in fetches_results:
+              writer.add_summary(fetches_results["summary"], step + step_offset)
             writer.add_run_metadata(run_metadata, 'step_{:04d}'.format(step + step_offset))
-            tl = timeline.Timeline(run_metadata.step_stats)
-            timeline_path = os.path.join(logdir, 'timeline.trace')
-            with open(timeline_path, 'w') as f:
-              f.write(tl.generate_chrome_trace_format(show_memory=True))
+            trace_times = [
+              ("data_wait", step_start_time, data_wait_end_time),
+              ("feed", feed_start_time, start_time),
+              ("session_run", session_run_start_time, session_run_end_time)]
           else:
+            trace_times = None
             session_run_start_time = time.time()
             fetches_results = sess.run(
               fetches_dict, feed_dict=feed_dict)  # type: typing.Dict[str,typing.Union[numpy.ndarray,str]]
             elapsed_time_tf += time.time() - session_run_start_time
+            if step_timings:
+              step_timings.add("session_run", time.time() - session_run_start_time)
             if writer and "summary" in fetches_results:
               writer.add_summary(fetches_results["summary"], step + step_offset)
         except tf.errors.OpError as exc:
@@ -591,9 +883,24 @@ class Runner(object):
           # Extra info will be printed below.
           raise
 
+        post_process_start_time = time.time()
         eval_info = self._collect_eval_info(fetches_results=fetches_results)
         self._maybe_handle_extra_fetches(fetches_results)
-        elapsed_time_tf += self._horovod_sync_params(local_step=step)
+        if step_timings:
+          step_timings.add("post_process", time.time() - post_process_start_time)
+        if trace_times:
+          trace_times.append(("post_process", post_process_start_time, time.time()))
+          events = [("Runner", name, t0, t1) for (name, t0, t1) in trace_times]
+          events += [
+            ("DataProvider thread", name, t0, t1)
+            for (name, t0, t1) in list(self.data_provider.thread_events)
+            if t1 >= step_start_time and t0 <= trace_times[-1][2]]
+          self.timeline_traces.write(step=step, run_metadata=run_metadata, events=events)
+        horovod_sync_time = self._horovod_sync_params(local_step=step)
+        elapsed_time_tf += horovod_sync_time
+        if step_timings:
+          step_timings.add("horovod", horovod_sync_time)
+          step_timings.finish_step(step=step, seq_lens=fetches_results.get(seq_lens_key))
         duration = time.time() - start_time
         self._print_process(report_prefix=report_prefix, step=step, step_duration=duration, eval_info=eval_info)
 
@@ -629,6 +936,13 @@ class Runner(object):
       elapsed_tf_percentage = (elapsed_time_tf / elapsed) if (elapsed > 0) else 0.0
       print("%s, finished after %i steps, %s elapsed (%.1f%% computing time)" % (
         report_prefix, step, hms(elapsed), (elapsed_tf_percentage * 100.)), file=log.v3)
+      if step_timings:
+        print("%s, step timings: %s" % (report_prefix, step_timings.format_summary()), file=log.v3)
+      if self.timeline_traces and self.timeline_traces.num_traces:
+        report = self.timeline_traces.format_top_ops_report()
+        print("%s, %s" % (report_prefix, report), file=log.v3)
+        with open(os.path.join(logdir, "top_ops.txt"), "w") as f:
+          f.write(report + "\n")
 
     except KeyboardInterrupt as exc:
       print("KeyboardInterrupt in step %r." % step)
@@ -650,6 +964,8 @@ class Runner(object):
       from Util import try_and_ignore_exception
       from TFUtil import stop_event_writer_thread
       try_and_ignore_exception(self._horovod_signal_error)  # ignored if _horovod_finish_data was called before
+      if step_timings:
+        try_and_ignore_exception(step_timings.close)
       if writer:
         try_and_ignore_exception(writer.close)
         try_and_ignore_exception(lambda: stop_event_writer_thread(writer.event_writer))
@@ -697,6 +1013,7 @@ class Engine(EngineBase):
     self._const_cache = {}  # type: typing.Dict[str,tf.Tensor]
     self.preload_from_files = None  # type: typing.Optional[typing.Dict[str,typing.Dict[str]]]
     self.max_seqs = None  # type: typing.Optional[int]
+    self._async_saver = None  # type: typing.Optional[AsyncCheckpointSaver]
 
   def finalize(self):
     """
@@ -748,6 +1065,7 @@ class Engine(EngineBase):
         print("Note: There is a GPU available but you have set device=cpu.", file=log.v2)
 
   def _close_tf_session(self):
+    self._finish_async_saves()
     if self.tf_session:
       self.tf_session.close()
     self.tf_session = None
@@ -808,6 +1126,8 @@ class Engine(EngineBase):
     if epoch:
       assert not filename
       filename = self.get_epoch_model_filename(epoch=epoch)
+    if self._async_saver:
+      self._async_saver.join()
     print("Load model %s" % (filename,), file=log.v4)
     self.network.load_params_from_file(filename, session=self.tf_session)
 
@@ -819,9 +1139,26 @@ class Engine(EngineBase):
       return
     if not filename:
       filename = self.get_epoch_model_filename()
+    if self.config.bool("save_model_async", False) and AsyncCheckpointSaver.is_supported(self.network):
+      if self._async_saver and (
+            self._async_saver.network is not self.network or self._async_saver.session is not self.tf_session):
+        self._finish_async_saves()
+      if not self._async_saver:
+        self._async_saver = AsyncCheckpointSaver(network=self.network, session=self.tf_session)
+      print("Save model under %s (in background)" % (filename,), file=log.v4)
+      self._async_saver.save(filename)
+      return
     print("Save model under %s" % (filename,), file=log.v4)
     self.network.save_params_to_file(filename, session=self.tf_session)
 
+  def _finish_async_saves(self):
+    """
+    Waits until the models of :func:`save_model` are written (if ``save_model_async``), and stops the saver thread.
+    """
+    if self._async_saver:
+      saver, self._async_saver = self._async_saver, None
+      saver.close()
+
   @staticmethod
   def delete_model(filename):
     """
@@ -887,6 +1224,8 @@ class Engine(EngineBase):
       self.max_seq_length = NumbersDict(self.max_seq_length)
     assert isinstance(self.max_seq_length, (int, float, NumbersDict))
     self.max_pad_size = config.typed_value("max_pad_size", None)
+    # Max frames per batch entry. See Dataset._generate_batches and ExternData.register_packed_segments.
+    self.seq_packing = config.typed_value("seq_packing", None)
     # And also initialize the network. That depends on some vars here such as pretrain.
     self.init_network_from_config(config)
 
@@ -1080,12 +1419,13 @@ class Engine(EngineBase):
     self.network.initialize_params(session=self.tf_session)
     if self.config.is_true("use_horovod"):
       # Note: Might not be needed as it should be deterministic. But just to be sure...
-      # noinspection PyPackageRequirements,PyUnresolvedReferences
-      import horovod.tensorflow as hvd
+      from TFUtil import get_horovod, horovod_reductions_in_order
+      hvd = get_horovod()
       # like hvd.broadcast_global_variables but selected vars only:
-      bcast_op = tf.group(*[
-        tf.assign(var, hvd.broadcast(var, root_rank=0))
-        for var in self.network.get_params_list() + self.network.get_auxiliary_params()])
+      with horovod_reductions_in_order():
+        bcast_op = tf.group(*[
+          tf.assign(var, hvd.broadcast(var, root_rank=0))
+          for var in self.network.get_params_list() + self.network.get_auxiliary_params()])
       self.tf_session.run(bcast_op)
 
   @classmethod
@@ -1314,6 +1654,7 @@ class Engine(EngineBase):
         max_seqs=self.max_seqs,
         max_seq_length=self.max_seq_length,
         max_pad_size=self.max_pad_size,
+        seq_packing=self.seq_packing,
         seq_drop=self.seq_drop,
         shuffle_batches=self.shuffle_batches,
         used_data_keys=self.network.get_used_data_keys())
@@ -1333,12 +1674,14 @@ class Engine(EngineBase):
       if trainer.device_crash_batch is not None:  # Otherwise we got an unexpected exception - a bug in our code.
         self.save_model(self.get_epoch_model_filename() + ".crash_%i" % trainer.device_crash_batch)
       print("Trainer not finalized, quitting.", file=log.v1)
+      self._finish_async_saves()
       sys.exit(1)
 
     if any(numpy.isinf(list(trainer.score.values()))) or any(numpy.isnan(list(trainer.score.values()))):
       print("Model seems broken, got inf or nan final score: %s" % trainer.score, file=log.v1)
       if self.config.bool("stop_on_nonfinite_train_score", True):
         self.save_model(self.get_epoch_model_filename() + ".broken")
+        self._finish_async_saves()
         sys.exit(1)
 
     if self.model_filename and (self.epoch % self.save_model_epoch_interval == 0):
@@ -1407,8 +1750,8 @@ class Engine(EngineBase):
     :rtype: bool
     """
     if self.config.is_true("use_horovod"):
-      # noinspection PyPackageRequirements,PyUnresolvedReferences
-      import horovod.tensorflow as hvd
+      from TFUtil import get_horovod
+      hvd = get_horovod()
       if hvd.rank() != 0:
         return False
     if self.config.is_true("dry_run"):
@@ -1529,6 +1872,8 @@ class Engine(EngineBase):
           batch_size=self.batch_size,
           max_seqs=self.max_seqs,
           max_seq_length=(self.max_seq_length if dataset_name == 'dev' else sys.maxsize),
+          # The per-seq outputs need one seq per batch entry.
+          seq_packing=None if output_per_seq_file else self.seq_packing,
           used_data_keys=self.network.get_used_data_keys())
       else:
         print("reusing previous dataset batch order for %r dataset" % dataset_name, file=log.v4)
@@ -1600,14 +1945,27 @@ class Engine(EngineBase):
     """
     if not self._do_save():
       return
-    from Util import CollectionReadCheckCovered, human_bytes_size, confirm
-    from itertools import count
-    opts = CollectionReadCheckCovered(self.config.get_of_type("cleanup_old_models", dict, {}))
-    existing_models = self.get_existing_models(config=self.config)
     if hasattr(self, "learning_rate_control"):
       lr_control = self.learning_rate_control
     else:
       lr_control = load_learning_rate_control_from_config(self.config)
+    # Copy, such that it can be used in the saver thread while the training continues.
+    epoch_errors = {epoch: dict(data.error) for (epoch, data) in lr_control.epoch_data.items()}
+    if self._async_saver and not ask_for_confirmation:
+      # The models of the pending saves are not on disk yet. Do the cleanup after them, in the saver thread.
+      self._async_saver.add_callback(lambda: self._cleanup_old_models(epoch_errors=epoch_errors))
+      return
+    self._cleanup_old_models(epoch_errors=epoch_errors, ask_for_confirmation=ask_for_confirmation)
+
+  def _cleanup_old_models(self, epoch_errors, ask_for_confirmation=False):
+    """
+    :param dict[int,dict[str,float]] epoch_errors: epoch -> score key -> value, from the learning rate control
+    :param bool ask_for_confirmation: if True, will ask the user interactively to confirm
+    """
+    from Util import CollectionReadCheckCovered, human_bytes_size, confirm
+    from itertools import count
+    opts = CollectionReadCheckCovered(self.config.get_of_type("cleanup_old_models", dict, {}))
+    existing_models = self.get_existing_models(config=self.config)
     epochs = sorted(existing_models.keys())
     if not epochs:
       print("Cannot cleanup models, no models found.", file=log.v2)
@@ -1649,13 +2007,13 @@ class Engine(EngineBase):
     keep_epochs.update(epochs[-keep_last_n:])
     score_keys = set()  # e.g. "dev_error", "dev_score", etc.
     # Collect all possible score keys. Note that we could have different ones for different epochs.
-    for data in lr_control.epoch_data.values():
-      score_keys.update(data.error.keys())
+    for error in epoch_errors.values():
+      score_keys.update(error.keys())
     assert score_keys
     score_keys = sorted(score_keys)
     score_values = {key: [] for key in score_keys}
     for epoch in epochs:
-      epoch_scores = lr_control.epoch_data[epoch].error
+      epoch_scores = epoch_errors[epoch]
       for key in epoch_scores.keys():
         score_values[key].append(epoch_scores[key])
     for key in list(score_keys):
@@ -1669,7 +2027,7 @@ class Engine(EngineBase):
     worst_score_values = {key: max(scores) for (key, scores) in score_values.items()}
     for key in score_keys:
       scores = sorted([
-        (lr_control.epoch_data[epoch].error.get(key, worst_score_values[key]), epoch) for epoch in epochs])
+        (epoch_errors[epoch].get(key, worst_score_values[key]), epoch) for epoch in epochs])
       scores = scores[:keep_best_n]
       keep_epochs.update([v[1] for v in scores])
     keep_epochs.intersection_update(epochs)
@@ -1729,8 +2087,8 @@ class Engine(EngineBase):
     """
     batch_slice = None
     if self.config.is_true("use_horovod"):
-      # noinspection PyPackageRequirements,PyUnresolvedReferences
-      import horovod.tensorflow as hvd
+      from TFUtil import get_horovod
+      hvd = get_horovod()
       batch_slice = slice(hvd.rank(), None, hvd.size())
     from TFDataPipeline import FeedDictDataProvider
     data_provider = FeedDictDataProvider(
@@ -1825,7 +2183,7 @@ class Engine(EngineBase):
     :param int batch_size:
     :param LayerBase output_layer:
     """
-    from HDFDataset import SimpleHDFWriter
+    from HDFDataset import SimpleHDFWriter, BackgroundHDFWriter
 
     if not output_layer:
       output_layer = self._get_output_layer()
@@ -1849,14 +2207,83 @@ class Engine(EngineBase):
     else:
       assert not os.path.exists(output_file)
     print("Forward output:", output, file=log.v3)
-    writer = SimpleHDFWriter(filename=output_file, dim=output.dim, ndim=output.ndim, labels=labels)
+    # With forward_resume_hdf_output, we write to <output_file>.partial,
+    # and a restarted forward continues it and skips the seqs which were already written.
+    resume = self.config.bool("forward_resume_hdf_output", False)
+    writer = SimpleHDFWriter(
+      filename=output_file, dim=output.dim, ndim=output.ndim, labels=labels, resume_partial=resume)
+    done_seq_tags = set(writer.get_seq_tags())
+    if done_seq_tags:
+      print("Resume forward, %i seqs were already written." % len(done_seq_tags), file=log.v2)
+      # noinspection PyBroadException
+      try:
+        remaining_seq_tags = [tag for tag in data.get_all_tags() if tag not in done_seq_tags]
+        data.init_seq_order(epoch=data.epoch or 1, seq_list=remaining_seq_tags)
+      except Exception as exc:
+        # Not all datasets support this. We still skip the seqs when we write them.
+        print("Cannot restrict dataset to the remaining seqs (%s: %s), forwarding all seqs." % (
+          type(exc).__name__, exc), file=log.v3)
+    # Writing in the background, such that the network does not need to wait for the HDF writes.
+    writer_queue_size = self.config.int("forward_hdf_writer_queue_size", 10)
+    if writer_queue_size > 0:
+      writer = BackgroundHDFWriter(writer, max_queue_size=writer_queue_size)
+
+    # With forward_sort_window, the seqs are batched by length within windows of this number of seqs,
+    # and we write them in the original dataset order. See Dataset._generate_batches.
+    sort_window = self.config.int("forward_sort_window", 0)
+    pending_seqs = {}  # seq_idx -> (inputs, seq_len, seq_tag), only used with sort_window
+    next_seq_idx = [0]  # next seq idx to write, only used with sort_window
+
+    def write_batch(inputs, seq_len, seq_tag):
+      """
+      :param numpy.ndarray inputs: shape=(n_batch,time,data) (or whatever the output layer is...)
+      :param dict[int,list[int]|numpy.ndarray] seq_len: axis -> seq lens of length n_batch
+      :param list[str] seq_tag: sequence tags of length n_batch
+      """
+      n_batch = len(seq_tag)
+      if done_seq_tags:
+        seq_idxs = [i for i in range(n_batch) if seq_tag[i] not in done_seq_tags]
+        if not seq_idxs:
+          return
+        if len(seq_idxs) < n_batch:
+          seq_tag = [seq_tag[i] for i in seq_idxs]
+          seq_len = {axis: numpy.array(v)[seq_idxs] for (axis, v) in seq_len.items()}
+          inputs = inputs[seq_idxs]
+          inputs = inputs[(slice(None),) + tuple([slice(0, max(seq_len[axis])) for axis in sorted(seq_len.keys())])]
+      writer.insert_batch(inputs=inputs, seq_len=seq_len, seq_tag=seq_tag)
+
+    def flush_pending_seqs(final=False):
+      """
+      Writes the pending seqs which are next in the dataset order (or all of them, if final).
 
-    def extra_fetches_cb(inputs, seq_tag, **kwargs):
+      :param bool final:
+      """
+      seq_idxs = []
+      if final:
+        seq_idxs = sorted(pending_seqs.keys())
+      else:
+        while next_seq_idx[0] in pending_seqs:
+          seq_idxs.append(next_seq_idx[0])
+          next_seq_idx[0] += 1
+      if not seq_idxs:
+        return
+      seqs = [pending_seqs.pop(i) for i in seq_idxs]
+      shape = [len(seqs)] + [max([seq[0].shape[i] for seq in seqs]) for i in range(seqs[0][0].ndim)]
+      inputs = numpy.zeros(shape, dtype=seqs[0][0].dtype)
+      for i, seq in enumerate(seqs):
+        inputs[(i,) + tuple([slice(0, d) for d in seq[0].shape])] = seq[0]
+      write_batch(
+        inputs=inputs,
+        seq_len={axis: numpy.array([seq[1][axis] for seq in seqs]) for axis in seqs[0][1].keys()},
+        seq_tag=[seq[2] for seq in seqs])
+
+    def extra_fetches_cb(inputs, seq_tag, seq_idx=None, **kwargs):
       """
       Insert each batch into the output_file (hdf).
 
       :param numpy.ndarray inputs: shape=(n_batch,time,data) (or whatever the output layer is...)
       :param list[str] seq_tag: sequence tags of length n_batch
+      :param list[int]|None seq_idx: of length n_batch, only with sort_window
       :param kwargs: e.g. seq_len_i (list[int])
       """
       n_batch = len(seq_tag)
@@ -1864,19 +2291,30 @@ class Engine(EngineBase):
       # noinspection PyShadowingNames
       seq_len = {i: kwargs["seq_len_%i" % i] for i in output.size_placeholder.keys()}
       assert all([len(v) == n_batch for v in seq_len.values()])
-      writer.insert_batch(inputs=inputs, seq_len=seq_len, seq_tag=seq_tag)
+      if seq_idx is None:
+        write_batch(inputs=inputs, seq_len=seq_len, seq_tag=seq_tag)
+        return
+      for i in range(n_batch):
+        pending_seqs[seq_idx[i]] = (
+          inputs[(i,) + tuple([slice(0, seq_len[axis][i]) for axis in sorted(seq_len.keys())])],
+          {axis: seq_len[axis][i] for axis in seq_len.keys()},
+          seq_tag[i])
+      flush_pending_seqs()
 
     extra_fetches = {
       'inputs': output.placeholder,
       "seq_tag": self.network.get_seq_tags(),
     }
+    if sort_window:
+      extra_fetches["seq_idx"] = self.network.get_extern_data("seq_idx", mark_data_key_as_used=True)
     for i, seq_len in output.size_placeholder.items():
       extra_fetches["seq_len_%i" % i] = seq_len
     batches = data.generate_batches(
       recurrent_net=self.network.recurrent,
       batch_size=batch_size,
       max_seqs=self.max_seqs,
-      used_data_keys=self.network.get_used_data_keys())
+      used_data_keys=self.network.get_used_data_keys(),
+      sort_window=sort_window)
     forwarder = Runner(
       engine=self, dataset=data, batches=batches,
       train=False, eval=False,
@@ -1887,6 +2325,7 @@ class Engine(EngineBase):
       print("Error happened. Exit now.")
       sys.exit(1)
 
+    flush_pending_seqs(final=True)
     writer.close()
 
   # noinspection PyUnusedLocal
@@ -1963,13 +2402,18 @@ class Engine(EngineBase):
     if do_eval:
       # It's constructed lazily and it will set used_data_keys, so make sure that we have it now.
       self.network.maybe_construct_objective()
+    # Within windows of this number of seqs, the seqs are batched by length. See Dataset._generate_batches.
+    sort_window = self.config.int("search_sort_window", 100)
     if output_file:
       if dataset.have_corpus_seq_idx():
         # We can sort it. Sort it in reverse to make sure that we have enough memory right at the beginning.
         print("Dataset have_corpus_seq_idx == True, i.e. it will be sorted for optimal performance.", file=log.v3)
         dataset.seq_ordering = "sorted_reverse"
+        sort_window = 0  # already sorted globally
       else:
-        print("Dataset have_corpus_seq_idx == False, i.e. it will not be sorted for optimal performance.", file=log.v3)
+        print("Dataset have_corpus_seq_idx == False, i.e. it will not be sorted,", file=log.v3)
+        print("but seqs are batched by length within windows of %i seqs (search_sort_window)." % sort_window,
+              file=log.v3)
         dataset.seq_ordering = "default"  # enforce order as-is, so that the order in the written file corresponds
 
     max_seq_length = self.config.typed_value('max_seq_length', None) or self.config.float('max_seq_length', 0)
@@ -1982,7 +2426,8 @@ class Engine(EngineBase):
       batch_size=self.config.int('batch_size', 1),
       max_seqs=self.config.int('max_seqs', -1),
       max_seq_length=max_seq_length,
-      used_data_keys=self.network.get_used_data_keys())
+      used_data_keys=self.network.get_used_data_keys(),
+      sort_window=sort_window)
 
     output_is_dict = isinstance(output_layer_names, list)
     if not output_is_dict:
@@ -2227,7 +2672,8 @@ class Engine(EngineBase):
     assert target_voc.num_labels == self.network.extern_data.data["classes"].dim
     if not isinstance(sources, list):
       sources = [sources]
-    source_seq_lists = [source_voc.get_seq(s) for s in sources]
+    labels, offsets = source_voc.get_seqs(sources)
+    source_seq_lists = [labels[offsets[i]:offsets[i + 1]] for i in range(len(sources))]
     results_raw = self.search_single_seq(sources=source_seq_lists, output_layer_name=output_layer_name)
     results = []
     for (score, raw) in results_raw:
@@ -2311,19 +2757,17 @@ class Engine(EngineBase):
       numpy.savetxt(f, log_average_posterior, delimiter=' ')
     print("Saved prior in %r in +log space." % output_file, file=log.v1)
 
-  def web_server(self, port):
+  def get_search_server_setup(self):
     """
-    Starts a web-server with a simple API to forward data through the network
-    (or search if the flag is set).
+    Initializes the network with search flag (if not yet done),
+    and collects everything needed by :func:`web_server` and :func:`inference_server`.
 
-    :param int port: for the http server
-    :return:
+    :return: dict with input_data, output_data (:class:`TFUtil.Data`),
+      input_vocab, output_vocab, input_audio_feature_extractor (or None),
+      output_t (batch major), output_seq_lens_t, output_beam_size (or None), output_beam_scores_t (or None)
+    :rtype: dict[str]
     """
-    assert sys.version_info[0] >= 3, "only Python 3 supported"
-    # noinspection PyCompatibility
-    from http.server import HTTPServer, BaseHTTPRequestHandler
-    from GeneratingDataset import StaticDataset, Vocabulary, BytePairEncoding, ExtractAudioFeatures
-
+    from GeneratingDataset import Vocabulary, BytePairEncoding, ExtractAudioFeatures
     if not self.use_search_flag or not self.network or self.use_dynamic_train_flag:
       self.use_search_flag = True
       # At the moment this is probably not intended to use search with train flag.
@@ -2334,8 +2778,6 @@ class Engine(EngineBase):
         print("Reinit network with search flag.", file=log.v3)
       self.init_network_from_config(self.config)
 
-    engine = self
-    soundfile = None
     input_data = self.network.extern_data.get_default_input_data()
     input_vocab = input_data.vocab
     input_audio_feature_extractor = None
@@ -2344,8 +2786,6 @@ class Engine(EngineBase):
     if (isinstance(self.config.typed_dict.get("dev", None), dict)
             and self.config.typed_dict["dev"]["class"] == "LibriSpeechCorpus"):
       # A bit hacky. Assumes that this is a dataset description for e.g. LibriSpeechCorpus.
-      # noinspection PyPackageRequirements,PyUnresolvedReferences
-      import soundfile  # pip install pysoundfile
       bpe_opts = self.config.typed_dict["dev"]["bpe"]
       audio_opts = self.config.typed_dict["dev"]["audio"]
       bpe = BytePairEncoding(**bpe_opts)
@@ -2356,14 +2796,9 @@ class Engine(EngineBase):
     else:
       assert isinstance(input_vocab, Vocabulary)
     assert isinstance(output_vocab, Vocabulary)
-    num_outputs = {
-      input_data.name: [input_data.dim, input_data.ndim],
-      output_data.name: [output_data.dim, output_data.ndim]}
 
     output_layer_name = self.config.value("search_output_layer", "output")
     output_layer = self.network.layers[output_layer_name]
-    output_t = output_layer.output.get_placeholder_as_batch_major()
-    output_seq_lens_t = output_layer.output.get_sequence_lengths()
     out_beam_size = output_layer.output.beam.beam_size
     output_layer_beam_scores_t = None
     if out_beam_size is None:
@@ -2371,6 +2806,42 @@ class Engine(EngineBase):
     else:
       print("Given output %r has beam size %i." % (output_layer, out_beam_size), file=log.v1)
       output_layer_beam_scores_t = output_layer.get_search_choices().beam_scores
+    return {
+      "input_data": input_data, "output_data": output_data,
+      "input_vocab": input_vocab, "output_vocab": output_vocab,
+      "input_audio_feature_extractor": input_audio_feature_extractor,
+      "output_t": output_layer.output.get_placeholder_as_batch_major(),
+      "output_seq_lens_t": output_layer.output.get_sequence_lengths(),
+      "output_beam_size": out_beam_size, "output_beam_scores_t": output_layer_beam_scores_t}
+
+  def web_server(self, port):
+    """
+    Starts a web-server with a simple API to forward data through the network
+    (or search if the flag is set).
+
+    :param int port: for the http server
+    :return:
+    """
+    assert sys.version_info[0] >= 3, "only Python 3 supported"
+    # noinspection PyCompatibility
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from GeneratingDataset import StaticDataset
+
+    setup = self.get_search_server_setup()
+    engine = self
+    soundfile = None
+    input_data, output_data = setup["input_data"], setup["output_data"]
+    input_vocab, output_vocab = setup["input_vocab"], setup["output_vocab"]
+    input_audio_feature_extractor = setup["input_audio_feature_extractor"]
+    if input_audio_feature_extractor:
+      # noinspection PyPackageRequirements,PyUnresolvedReferences
+      import soundfile  # pip install pysoundfile
+    num_outputs = {
+      input_data.name: [input_data.dim, input_data.ndim],
+      output_data.name: [output_data.dim, output_data.ndim]}
+    output_t, output_seq_lens_t = setup["output_t"], setup["output_seq_lens_t"]
+    out_beam_size = setup["output_beam_size"]
+    output_layer_beam_scores_t = setup["output_beam_scores_t"]
 
     class Handler(BaseHTTPRequestHandler):
       """
@@ -2460,6 +2931,23 @@ class Engine(EngineBase):
     self.httpd = HTTPServer(server_address, Handler)
     self.httpd.serve_forever()
 
+  def inference_server(self, port):
+    """
+    Like :func:`web_server`, but handles concurrent requests,
+    and runs them in dynamically collected batches through the network.
+    See :class:`TFInferenceServer.InferenceServer`.
+
+    :param int port: for the http server
+    """
+    from TFInferenceServer import InferenceServer
+    # noinspection PyAttributeOutsideInit
+    self.inference_server_instance = InferenceServer(
+      engine=self, port=port,
+      max_batch_seqs=self.config.int("inference_server_max_batch_seqs", 32),
+      max_batch_frames=self.config.int("inference_server_max_batch_frames", 0) or None,
+      max_latency=self.config.float("inference_server_max_latency", 0.05))
+    self.inference_server_instance.serve_forever()
+
 
 def get_global_engine():
   """
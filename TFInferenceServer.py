@@ -0,0 +1,523 @@
+"""
+Inference server with dynamic batching, on top of :class:`TFEngine.Engine`.
+
+Concurrent requests are put into a queue, and the :class:`DynamicBatcher` collects them
+into batches of similar length (within a latency budget),
+which are then run through the network with a single ``tf.Session.run`` call.
+Use it via the task ``search_inference_server`` (see :func:`TFEngine.Engine.inference_server`).
+
+HTTP API:
+
+- ``POST /``: the input (text or audio file), either as the raw body or as multipart form field ``file``.
+  Returns the hypotheses, in the same format as :func:`TFEngine.Engine.web_server`.
+- ``GET /stats``: JSON with the counters of the :class:`DynamicBatcher` (latency, throughput, batch sizes).
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import typing
+import numpy
+from threading import Thread, Condition
+from collections import deque
+from Log import log
+
+
+class _Future(object):
+  """
+  Result of a request submitted to :class:`DynamicBatcher`.
+  Like ``concurrent.futures.Future`` (which is not in the Python 2 stdlib), but only what we need.
+  """
+
+  def __init__(self):
+    self._cond = Condition()
+    self._done = False
+    self._result = None
+    self._exception = None  # type: typing.Optional[BaseException]
+
+  def set_result(self, result):
+    """
+    :param result:
+    """
+    with self._cond:
+      self._result = result
+      self._done = True
+      self._cond.notify_all()
+
+  def set_exception(self, exception):
+    """
+    :param BaseException exception:
+    """
+    with self._cond:
+      self._exception = exception
+      self._done = True
+      self._cond.notify_all()
+
+  def done(self):
+    """
+    :rtype: bool
+    """
+    with self._cond:
+      return self._done
+
+  def result(self, timeout=None):
+    """
+    Waits until the result is available, and returns it, or raises the exception.
+
+    :param float|None timeout: in secs
+    :return: the result
+    """
+    with self._cond:
+      end_time = (time.time() + timeout) if timeout is not None else None
+      while not self._done:
+        if end_time is None:
+          self._cond.wait()
+          continue
+        remaining = end_time - time.time()
+        if remaining <= 0:
+          raise Exception("timeout after %.1f secs while waiting for result" % timeout)
+        self._cond.wait(remaining)
+      if self._exception is not None:
+        raise self._exception
+      return self._result
+
+
+class _Request(object):
+  """
+  Single request in the queue of :class:`DynamicBatcher`.
+  """
+
+  def __init__(self, inputs, length, future):
+    """
+    :param inputs:
+    :param int length:
+    :param _Future future:
+    """
+    self.inputs = inputs
+    self.length = length
+    self.future = future
+    self.arrival_time = time.time()
+
+
+class DynamicBatcher(object):
+  """
+  Collects concurrent requests into batches.
+
+  A batch is processed as soon as it is full (``max_batch_seqs`` or ``max_batch_frames``),
+  or when the oldest request waited ``max_latency`` seconds.
+  The oldest request always goes into the next batch,
+  and it is combined with the pending requests which are closest to it in length,
+  to minimize the padding.
+  The batches are processed sequentially in a single background thread.
+  """
+
+  def __init__(self, process_batch_func, max_batch_seqs=32, max_batch_frames=None, max_latency=0.05,
+               name="dynamic batcher", num_latencies_for_stats=1000):
+    """
+    :param (list)->list process_batch_func: gets a list of inputs, returns the list of outputs (same order)
+    :param int max_batch_seqs:
+    :param int|None max_batch_frames: max padded frames (max length * num seqs) per batch.
+      we always allow at least one seq per batch
+    :param float max_latency: in secs. max time a request waits in the queue to collect a bigger batch
+    :param str name:
+    :param int num_latencies_for_stats: we keep that many latencies of the most recent requests for the stats
+    """
+    assert max_batch_seqs >= 1
+    self.process_batch_func = process_batch_func
+    self.max_batch_seqs = max_batch_seqs
+    self.max_batch_frames = max_batch_frames
+    self.max_latency = max_latency
+    self.name = name
+    self._cond = Condition()
+    self._pending = []  # type: typing.List[_Request]  # ordered by arrival
+    self._stop = False
+    self.start_time = time.time()
+    self.num_requests = 0
+    self.num_failed_requests = 0
+    self.num_batches = 0
+    self.num_frames = 0
+    self.num_padded_frames = 0
+    self.process_time = 0.0
+    self._latencies = deque(maxlen=num_latencies_for_stats)
+    self._thread = Thread(target=self._thread_main, name=name)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def submit(self, inputs, length):
+    """
+    :param inputs: passed to process_batch_func (as part of the list)
+    :param int length: e.g. num frames of the input. used to group requests of similar length
+    :return: future, which will get the output for inputs
+    :rtype: _Future
+    """
+    future = _Future()
+    with self._cond:
+      assert not self._stop, "%s: already stopped" % self.name
+      self._pending.append(_Request(inputs=inputs, length=length, future=future))
+      self._cond.notify_all()
+    return future
+
+  def stop(self):
+    """
+    Stops the background thread. Pending requests get an exception.
+    """
+    with self._cond:
+      self._stop = True
+      self._cond.notify_all()
+    self._thread.join()
+    for request in self._pending:
+      request.future.set_exception(Exception("%s: stopped" % self.name))
+    del self._pending[:]
+
+  def _is_batch_full(self):
+    """
+    :rtype: bool
+    """
+    if len(self._pending) >= self.max_batch_seqs:
+      return True
+    if self.max_batch_frames is not None:
+      if max([r.length for r in self._pending]) * len(self._pending) >= self.max_batch_frames:
+        return True
+    return False
+
+  def _select_batch(self):
+    """
+    Removes the requests for the next batch from the pending list.
+
+    :rtype: list[_Request]
+    """
+    first = self._pending[0]
+    candidates = sorted(self._pending[1:], key=lambda r: abs(r.length - first.length))
+    batch = [first]
+    max_len = first.length
+    for request in candidates:
+      if len(batch) >= self.max_batch_seqs:
+        break
+      if self.max_batch_frames is not None:
+        if max(max_len, request.length) * (len(batch) + 1) > self.max_batch_frames:
+          continue
+      batch.append(request)
+      max_len = max(max_len, request.length)
+    batch_ids = set(map(id, batch))
+    self._pending = [r for r in self._pending if id(r) not in batch_ids]
+    return batch
+
+  def _thread_main(self):
+    while True:
+      with self._cond:
+        while True:
+          if self._stop:
+            return
+          if self._pending:
+            if self._is_batch_full():
+              break
+            wait_time = self._pending[0].arrival_time + self.max_latency - time.time()
+            if wait_time <= 0:
+              break
+            self._cond.wait(wait_time)
+          else:
+            self._cond.wait()
+        batch = self._select_batch()
+      self._process_batch(batch)
+
+  def _process_batch(self, batch):
+    """
+    :param list[_Request] batch:
+    """
+    start_time = time.time()
+    # noinspection PyBroadException
+    try:
+      outputs = self.process_batch_func([r.inputs for r in batch])
+      assert len(outputs) == len(batch)
+    except Exception as exc:
+      print("%s: exception while processing a batch of %i seqs:" % (self.name, len(batch)), file=log.v1)
+      sys.excepthook(*sys.exc_info())
+      outputs = None
+      for request in batch:
+        request.future.set_exception(exc)
+    end_time = time.time()
+    with self._cond:
+      self.num_batches += 1
+      self.num_requests += len(batch)
+      self.process_time += end_time - start_time
+      self.num_frames += sum([r.length for r in batch])
+      self.num_padded_frames += max([r.length for r in batch]) * len(batch)
+      if outputs is None:
+        self.num_failed_requests += len(batch)
+      for request in batch:
+        self._latencies.append(end_time - request.arrival_time)
+    if outputs is not None:
+      for request, output in zip(batch, outputs):
+        request.future.set_result(output)
+
+  def get_stats(self):
+    """
+    :return: counters, e.g. num_requests, avg_batch_seqs, padding_frac, latency_mean, latency_p95, seqs_per_sec
+    :rtype: dict[str,int|float]
+    """
+    with self._cond:
+      latencies = numpy.array(self._latencies, dtype="float64")
+      elapsed = max(time.time() - self.start_time, 1e-6)
+      return {
+        "num_requests": self.num_requests,
+        "num_failed_requests": self.num_failed_requests,
+        "num_pending_requests": len(self._pending),
+        "num_batches": self.num_batches,
+        "avg_batch_seqs": float(self.num_requests) / max(self.num_batches, 1),
+        "padding_frac": 1.0 - float(self.num_frames) / max(self.num_padded_frames, 1),
+        "process_time": self.process_time,
+        "seqs_per_sec": self.num_requests / elapsed,
+        "frames_per_sec": self.num_frames / elapsed,
+        "latency_mean": float(numpy.mean(latencies)) if len(latencies) else 0.0,
+        "latency_p50": float(numpy.percentile(latencies, 50)) if len(latencies) else 0.0,
+        "latency_p95": float(numpy.percentile(latencies, 95)) if len(latencies) else 0.0,
+        "latency_max": float(numpy.max(latencies)) if len(latencies) else 0.0}
+
+
+class InferenceServer(object):
+  """
+  Threaded HTTP front end, which passes the requests through a :class:`DynamicBatcher`
+  to the network of the engine.
+  Each connection is handled in its own thread, which blocks until the batcher has the result for it.
+  """
+
+  def __init__(self, engine, port, max_batch_seqs=32, max_batch_frames=None, max_latency=0.05):
+    """
+    :param TFEngine.Engine engine: the network is initialized via :func:`TFEngine.Engine.get_search_server_setup`
+    :param int port:
+    :param int max_batch_seqs: see :class:`DynamicBatcher`
+    :param int|None max_batch_frames: see :class:`DynamicBatcher`
+    :param float max_latency: see :class:`DynamicBatcher`
+    """
+    self.engine = engine
+    self.port = port
+    self.setup = engine.get_search_server_setup()
+    self.fetches = {"output": self.setup["output_t"], "seq_lens": self.setup["output_seq_lens_t"]}
+    if self.setup["output_beam_scores_t"] is not None:
+      self.fetches["beam_scores"] = self.setup["output_beam_scores_t"]
+    engine.check_uninitialized_vars()
+    self.batcher = DynamicBatcher(
+      process_batch_func=self._process_batch, name="inference server batcher",
+      max_batch_seqs=max_batch_seqs, max_batch_frames=max_batch_frames, max_latency=max_latency)
+
+  def _get_feed_dict(self, features_list):
+    """
+    :param list[numpy.ndarray] features_list: each (time,...)
+    :rtype: dict[tf.Tensor,numpy.ndarray]
+    """
+    input_data = self.setup["input_data"]
+    output_data = self.setup["output_data"]
+    assert input_data.batch_dim_axis == 0 and input_data.time_dim_axis == 1
+    n_batch = len(features_list)
+    seq_lens = numpy.array([len(x) for x in features_list], dtype=input_data.size_dtype)
+    data = numpy.zeros(
+      (n_batch, max(seq_lens)) + features_list[0].shape[1:], dtype=input_data.dtype)
+    for i, features in enumerate(features_list):
+      data[i, :len(features)] = features
+    feed_dict = {input_data.placeholder: data, input_data.size_placeholder[0]: seq_lens}
+    # Like in web_server, the targets are empty.
+    if output_data.placeholder is not None:
+      feed_dict[output_data.placeholder] = numpy.zeros(
+        (n_batch, 0) + output_data.shape[1:], dtype=output_data.dtype)
+      feed_dict[output_data.size_placeholder[0]] = numpy.zeros((n_batch,), dtype=output_data.size_dtype)
+    return feed_dict
+
+  def _process_batch(self, features_list):
+    """
+    Called by the :class:`DynamicBatcher` thread.
+
+    :param list[numpy.ndarray] features_list:
+    :return: per seq, list of (score, txt) for beam search, or the first-best txt
+    :rtype: list[list[(float,str)]|str]
+    """
+    n_batch = len(features_list)
+    values = self.engine.tf_session.run(self.fetches, feed_dict=self._get_feed_dict(features_list))
+    output, seq_lens = values["output"], values["seq_lens"]
+    beam_size = self.setup["output_beam_size"]
+    output_vocab = self.setup["output_vocab"]
+    assert len(output) == len(seq_lens) == n_batch * (beam_size or 1)
+    res = []
+    for b in range(n_batch):
+      if beam_size:
+        assert values["beam_scores"].shape == (n_batch, beam_size)
+        res.append([
+          (values["beam_scores"][b][i],
+           output_vocab.get_seq_labels(output[b * beam_size + i][:seq_lens[b * beam_size + i]]))
+          for i in range(beam_size)])
+      else:
+        res.append(output_vocab.get_seq_labels(output[b][:seq_lens[b]]))
+    return res
+
+  def _get_features(self, raw_bytes):
+    """
+    Runs in the thread of the request.
+
+    :param bytes raw_bytes:
+    :rtype: numpy.ndarray
+    """
+    feature_extractor = self.setup["input_audio_feature_extractor"]
+    if feature_extractor:
+      from io import BytesIO
+      # noinspection PyPackageRequirements
+      import soundfile  # pip install pysoundfile
+      audio, sample_rate = soundfile.read(BytesIO(raw_bytes))
+      if audio.ndim == 2:  # multiple channels:
+        audio = numpy.mean(audio, axis=1)  # mix together
+      return feature_extractor.get_audio_features(audio=audio, sample_rate=sample_rate)
+    sentence = raw_bytes.decode("utf8").strip()
+    return numpy.array(self.setup["input_vocab"].get_seq(sentence), dtype="int32")
+
+  @staticmethod
+  def _get_input_bytes(headers, body):
+    """
+    :param dict[str,str] headers: lower-case names
+    :param bytes body:
+    :return: the file content. like :func:`TFEngine.Engine.web_server`, supports multipart form field "file"
+    :rtype: bytes
+    """
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+      return InferenceServer._get_multipart_field(content_type=content_type, body=body, name="file")
+    return body
+
+  @staticmethod
+  def _get_multipart_field(content_type, body, name):
+    """
+    Minimal multipart/form-data parsing, as we do not want to depend on the deprecated ``cgi`` module.
+
+    :param str content_type: e.g. 'multipart/form-data; boundary=...'
+    :param bytes body:
+    :param str name: form field name
+    :return: content of the form field
+    :rtype: bytes
+    """
+    import re
+    m = re.search(r'boundary="?([^";]+)"?', content_type)
+    assert m, "no boundary in content type %r" % content_type
+    delimiter = b"--" + m.group(1).encode("latin1")
+    for part in body.split(delimiter)[1:]:
+      if part.startswith(b"--"):  # closing delimiter
+        break
+      part_headers, _, content = part.partition(b"\r\n\r\n")
+      for line in part_headers.decode("latin1").split("\r\n"):
+        if not line.lower().startswith("content-disposition:"):
+          continue
+        if re.search(r'\bname="?%s"?(;|\s|$)' % re.escape(name), line):
+          # The CRLF before the next delimiter belongs to the delimiter.
+          if content.endswith(b"\r\n"):
+            content = content[:-2]
+          return content
+    raise KeyError("multipart form field %r not found" % name)
+
+  @staticmethod
+  def _format_result(result):
+    """
+    :param list[(float,str)]|str result: from :func:`_process_batch`
+    :rtype: bytes
+    """
+    if isinstance(result, list):
+      return ("[\n" + "".join(["(%r, %r)\n" % (score, txt) for (score, txt) in result]) + "]\n").encode("utf8")
+    return ("%r\n" % result).encode("utf8")
+
+  def _handle_request(self, method, path, headers, body):
+    """
+    Called in the thread of the request.
+
+    :param str method: e.g. "GET" or "POST"
+    :param str path:
+    :param dict[str,str] headers: lower-case names
+    :param bytes body:
+    :return: status, content type, content
+    :rtype: (int,str,bytes)
+    """
+    import json
+    # noinspection PyBroadException
+    try:
+      if method == "GET" and path == "/stats":
+        return 200, "application/json", json.dumps(self.batcher.get_stats()).encode("utf8")
+      if method == "POST":
+        features = self._get_features(self._get_input_bytes(headers, body))
+        result = self.batcher.submit(features, length=len(features)).result()
+        return 200, "text/plain", self._format_result(result)
+      return 404, "text/plain", b"not found\n"
+    except Exception as exc:
+      print("Inference server, exception while handling request:", file=log.v2)
+      sys.excepthook(*sys.exc_info())
+      return 500, "text/plain", ("%s: %s\n" % (type(exc).__name__, exc)).encode("utf8")
+
+  def _make_http_server(self):
+    """
+    :return: threaded HTTP server, one thread per connection
+    :rtype: BaseHTTPServer.HTTPServer|http.server.HTTPServer
+    """
+    try:
+      # noinspection PyCompatibility
+      from http.server import HTTPServer, BaseHTTPRequestHandler
+      # noinspection PyCompatibility
+      from socketserver import ThreadingMixIn
+    except ImportError:  # Python 2
+      # noinspection PyUnresolvedReferences,PyCompatibility
+      from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+      # noinspection PyUnresolvedReferences,PyCompatibility
+      from SocketServer import ThreadingMixIn
+    inference_server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      """
+      Forwards GET and POST requests to :func:`InferenceServer._handle_request`.
+      """
+
+      def _handle(self):
+        headers = dict([(key.lower(), value) for (key, value) in self.headers.items()])
+        body = self.rfile.read(int(headers.get("content-length", 0)))
+        status, content_type, content = inference_server._handle_request(
+          method=self.command, path=self.path, headers=headers, body=body)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+      # noinspection PyPep8Naming
+      def do_GET(self):
+        """
+        Handle GET request.
+        """
+        self._handle()
+
+      # noinspection PyPep8Naming
+      def do_POST(self):
+        """
+        Handle POST request.
+        """
+        self._handle()
+
+      # noinspection PyShadowingBuiltins
+      def log_message(self, format, *args):
+        """
+        :param str format:
+        """
+        print("Inference server: %s - %s" % (self.address_string(), format % args), file=log.v5)
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+      """
+      Handles each connection in a new thread.
+      """
+      daemon_threads = True
+
+    return ThreadingHTTPServer(("", self.port), Handler)
+
+  def serve_forever(self):
+    """
+    Runs the HTTP server, until interrupted.
+    """
+    # noinspection PyAttributeOutsideInit
+    self.httpd = self._make_http_server()
+    print("Inference server (dynamic batching, max %i seqs, max latency %.3f secs), listening on port %i." % (
+      self.batcher.max_batch_seqs, self.batcher.max_latency, self.port), file=log.v2)
+    try:
+      self.httpd.serve_forever()
+    finally:
+      self.httpd.server_close()
+      self.batcher.stop()
@@ -0,0 +1,414 @@
+"""
+Local data-parallel training on a single machine, without Horovod/MPI.
+
+With the config option ``local_data_parallel = N``, ``rnn.py`` does not train itself
+but starts N worker processes of itself (see :func:`run_workers`), and waits for them.
+The workers behave exactly like Horovod ranks (``use_horovod`` is set for them),
+i.e. ``horovod_reduce_type`` ("grad" or "param"), ``horovod_param_sync_step`` etc. work as usual,
+and each worker gets every N-th batch.
+This module provides the subset of the ``horovod.tensorflow`` API which we use (see :func:`TFUtil.get_horovod`).
+
+The reductions go over local sockets (:mod:`multiprocessing.connection`) to a :class:`Hub` in the parent process,
+which matches the requests of all workers by key, and sums the values in rank order,
+i.e. the results are deterministic.
+The key of a reduction op is derived from the name of its input tensor,
+i.e. all workers must construct the same graph, as it is the case with Horovod.
+Each reduction op blocks a TF inter-op thread until all workers have sent it,
+thus the reductions which run together must run in a fixed order (see :func:`reductions_in_order`).
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import contextlib
+import numpy
+import typing
+from threading import Thread, Lock, Condition
+
+
+EnvRank = "RETURNN_LOCAL_DATA_PARALLEL_RANK"
+EnvSize = "RETURNN_LOCAL_DATA_PARALLEL_SIZE"
+EnvAddress = "RETURNN_LOCAL_DATA_PARALLEL_ADDRESS"
+EnvAuthKey = "RETURNN_LOCAL_DATA_PARALLEL_AUTHKEY"
+
+
+class Hub(object):
+  """
+  Runs in the parent process. Each worker connects to it (:class:`HubClient`),
+  and sends its reduction requests, which are answered when all workers have sent the request with the same key.
+  """
+
+  def __init__(self, num_workers, authkey):
+    """
+    :param int num_workers:
+    :param bytes authkey:
+    """
+    from multiprocessing.connection import Listener
+    self.num_workers = num_workers
+    self.listener = Listener(address=("localhost", 0), authkey=authkey)
+    self.address = self.listener.address  # type: typing.Tuple[str,int]
+    self.lock = Lock()
+    self.conns = {}  # rank -> (Connection, Lock)
+    self.pending = {}  # type: typing.Dict[str,typing.List[typing.List[tuple]]]  # key -> per rank, list of requests
+    self.thread = Thread(target=self._accept_main, name="LocalDataParallel hub")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _accept_main(self):
+    for _ in range(self.num_workers):
+      try:
+        conn = self.listener.accept()
+      except (OSError, EOFError):
+        return  # closed
+      rank = conn.recv()
+      assert isinstance(rank, int) and 0 <= rank < self.num_workers and rank not in self.conns
+      self.conns[rank] = (conn, Lock())
+      thread = Thread(target=self._conn_main, args=(rank, conn), name="LocalDataParallel hub rank %i" % rank)
+      thread.daemon = True
+      thread.start()
+
+  def _conn_main(self, rank, conn):
+    """
+    :param int rank:
+    :param multiprocessing.connection.Connection conn:
+    """
+    while True:
+      try:
+        kind, key, seq, value, opt = conn.recv()
+      except (OSError, EOFError):
+        return  # worker quit
+      with self.lock:
+        queues = self.pending.setdefault(key, [[] for _ in range(self.num_workers)])
+        queues[rank].append((kind, seq, value, opt))
+        if not all(queues):
+          continue
+        requests = [queue.pop(0) for queue in queues]
+        if not any(queues):
+          del self.pending[key]
+      assert all([request[0] == kind for request in requests]), "key %r: mismatch %r" % (key, requests)
+      result = self._reduce(kind=kind, values=[request[2] for request in requests], opt=opt)
+      for other_rank, request in enumerate(requests):
+        other_conn, send_lock = self.conns[other_rank]
+        with send_lock:
+          other_conn.send((key, request[1], result))
+
+  def _reduce(self, kind, values, opt):
+    """
+    :param str kind: "allreduce" or "broadcast"
+    :param list[numpy.ndarray] values: per rank
+    :param opt: average (bool) for allreduce, root_rank (int) for broadcast
+    :rtype: numpy.ndarray
+    """
+    if kind == "broadcast":
+      return values[opt]
+    assert kind == "allreduce"
+    result = numpy.array(values[0], copy=True)
+    for value in values[1:]:  # always in rank order, such that it is deterministic
+      result += value
+    if opt:  # average
+      result = numpy.asarray(result / self.num_workers, dtype=result.dtype)
+    return result
+
+  def close(self):
+    """
+    Closes the listener and all connections.
+    """
+    self.listener.close()
+    for conn, _ in self.conns.values():
+      conn.close()
+
+
+class HubClient(object):
+  """
+  Runs in a worker process, and sends the reduction requests to the :class:`Hub`.
+  This is thread-safe, i.e. multiple reductions can be pending at the same time
+  (e.g. TF runs independent ops in parallel).
+  """
+
+  def __init__(self, address, authkey, rank):
+    """
+    :param (str,int) address:
+    :param bytes authkey:
+    :param int rank:
+    """
+    from multiprocessing.connection import Client
+    self.rank = rank
+    self.conn = Client(address=tuple(address), authkey=authkey)
+    self.conn.send(rank)
+    self.send_lock = Lock()
+    self.cond = Condition()
+    self.next_seq = {}  # type: typing.Dict[str,int]  # key -> seq
+    self.results = {}  # type: typing.Dict[typing.Tuple[str,int],numpy.ndarray]  # (key, seq) -> value
+    self.closed = False
+    self.thread = Thread(target=self._recv_main, name="LocalDataParallel client")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _recv_main(self):
+    while True:
+      try:
+        key, seq, value = self.conn.recv()
+      except (OSError, EOFError):
+        break
+      with self.cond:
+        self.results[(key, seq)] = value
+        self.cond.notify_all()
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+
+  def _request(self, kind, key, value, opt):
+    """
+    :param str kind:
+    :param str key: the same in all workers
+    :param numpy.ndarray value:
+    :param opt:
+    :rtype: numpy.ndarray
+    """
+    with self.send_lock:
+      # The hub answers the requests per key in the order it gets them.
+      seq = self.next_seq.get(key, 0)
+      self.next_seq[key] = seq + 1
+      self.conn.send((kind, key, seq, value, opt))
+    with self.cond:
+      while (key, seq) not in self.results:
+        if self.closed:
+          raise Exception("LocalDataParallel: connection to hub closed, key %r" % key)
+        self.cond.wait()
+      return self.results.pop((key, seq))
+
+  def allreduce(self, key, value, average):
+    """
+    :param str key:
+    :param numpy.ndarray value:
+    :param bool average:
+    :return: sum (or average) over all workers
+    :rtype: numpy.ndarray
+    """
+    return self._request(kind="allreduce", key=key, value=value, opt=average)
+
+  def broadcast(self, key, value, root_rank):
+    """
+    :param str key:
+    :param numpy.ndarray value:
+    :param int root_rank:
+    :return: value of root_rank
+    :rtype: numpy.ndarray
+    """
+    return self._request(kind="broadcast", key=key, value=value, opt=root_rank)
+
+  def close(self):
+    """
+    Closes the connection.
+    """
+    self.conn.close()
+
+
+def run_workers(num_workers, args):
+  """
+  Runs in the parent process.
+
+  :param int num_workers:
+  :param list[str] args: command line of a worker, e.g. ``[sys.executable, "rnn.py", "config"]``
+  :return: exit code, i.e. 0 if all workers finished successfully
+  :rtype: int
+  """
+  import subprocess
+  authkey = os.urandom(16)
+  hub = Hub(num_workers=num_workers, authkey=authkey)
+  print("LocalDataParallel: Start %i workers, hub at %s:%i." % ((num_workers,) + tuple(hub.address)))
+  procs = []
+  for rank in range(num_workers):
+    env = dict(os.environ)
+    env[EnvRank] = str(rank)
+    env[EnvSize] = str(num_workers)
+    env[EnvAddress] = "%s:%i" % tuple(hub.address)
+    env[EnvAuthKey] = authkey.hex() if sys.version_info[0] >= 3 else authkey.encode("hex")
+    procs.append(subprocess.Popen(args, env=env))
+  return_code = 0
+  try:
+    while any([proc.poll() is None for proc in procs]):
+      failed = [proc for proc in procs if proc.returncode]
+      if failed:
+        # The other workers would wait forever for their next reduction.
+        return_code = failed[0].returncode
+        print("LocalDataParallel: Worker %i failed with exit code %i, stopping the other workers." % (
+          procs.index(failed[0]), return_code))
+        break
+      time.sleep(0.1)
+  finally:
+    for proc in procs:
+      if proc.poll() is None:
+        proc.terminate()
+    for proc in procs:
+      proc.wait()
+    hub.close()
+  return return_code or max([abs(proc.returncode) for proc in procs])
+
+
+_client = None  # type: typing.Optional[HubClient]
+_reduce_chain = None  # type: typing.Optional[typing.List[tf.Operation]]  # see reductions_in_order
+
+
+def is_worker_process():
+  """
+  :return: whether we are a worker process started by :func:`run_workers`
+  :rtype: bool
+  """
+  return EnvRank in os.environ
+
+
+def init():
+  """
+  Connects to the hub. Like ``hvd.init()``.
+  """
+  global _client
+  if _client:
+    return
+  assert is_worker_process()
+  host, port = os.environ[EnvAddress].rsplit(":", 1)
+  authkey_hex = os.environ[EnvAuthKey]
+  authkey = bytes.fromhex(authkey_hex) if sys.version_info[0] >= 3 else authkey_hex.decode("hex")
+  _client = HubClient(address=(host, int(port)), authkey=authkey, rank=rank())
+
+
+def rank():
+  """
+  :rtype: int
+  """
+  return int(os.environ[EnvRank])
+
+
+def size():
+  """
+  :rtype: int
+  """
+  return int(os.environ[EnvSize])
+
+
+def local_rank():
+  """
+  :return: same as :func:`rank`, as all workers are local
+  :rtype: int
+  """
+  return rank()
+
+
+def local_size():
+  """
+  :rtype: int
+  """
+  return size()
+
+
+def _get_reduce_key(kind, tensor):
+  """
+  :param str kind:
+  :param tf.Tensor tensor:
+  :return: unique key in the current graph, which is the same in all workers
+  :rtype: str
+  """
+  import tensorflow as tf
+  used_keys = tf.get_default_graph().get_collection_ref("_LocalDataParallel_keys")
+  key = "%s:%s" % (kind, tensor.name)
+  num_used = used_keys.count(key)
+  used_keys.append(key)
+  if num_used:
+    return "%s#%i" % (key, num_used)
+  return key
+
+
+@contextlib.contextmanager
+def reductions_in_order(after=None):
+  """
+  Each reduction op (:func:`allreduce`, :func:`broadcast`) created within this context
+  gets a control dependency on the one created before, i.e. they are executed in the order of creation,
+  which is the same in all workers.
+  Otherwise the workers could execute them in different orders, and with a small ``inter_op_parallelism_threads``,
+  all threads of each worker could block in reductions which the other workers did not start yet, i.e. deadlock.
+  All reductions which run together (in one ``session.run``) must be created within one such context,
+  or continue such a chain via `after`.
+  Nested contexts continue the outer chain.
+
+  :param tf.Tensor|tf.Operation|None after: the first reduction gets a control dependency on this,
+    i.e. this continues the chain which ends with this reduction
+  """
+  global _reduce_chain
+  if _reduce_chain is not None:
+    assert after is None, "reductions_in_order: cannot continue another chain when nested"
+    yield
+    return
+  import tensorflow as tf
+  if isinstance(after, tf.Tensor):
+    after = after.op
+  _reduce_chain = [after] if after is not None else []
+  try:
+    yield
+  finally:
+    _reduce_chain = None
+
+
+def _make_reduce_op(py_func, tensor, name):
+  """
+  :param (numpy.ndarray)->numpy.ndarray py_func: does the blocking request to the hub
+  :param tf.Tensor tensor:
+  :param str name:
+  :rtype: tf.Tensor
+  """
+  import tensorflow as tf
+  with tf.control_dependencies(_reduce_chain[-1:] if _reduce_chain else []):
+    y = tf.py_func(py_func, [tensor], tensor.dtype, stateful=True, name=name)
+  y.set_shape(tensor.get_shape())
+  if _reduce_chain is not None:
+    _reduce_chain.append(y.op)
+  return y
+
+
+def allreduce(tensor, average=True):
+  """
+  Like ``hvd.allreduce``.
+
+  :param tf.Tensor|tf.IndexedSlices tensor:
+  :param bool average:
+  :return: sum (or average) over all workers
+  :rtype: tf.Tensor
+  """
+  import tensorflow as tf
+  init()
+  tensor = tf.convert_to_tensor(tensor)  # tf.IndexedSlices will become dense
+  key = _get_reduce_key("allreduce", tensor)
+
+  def _py_allreduce(x):
+    """
+    :param numpy.ndarray x:
+    :rtype: numpy.ndarray
+    """
+    return numpy.asarray(_client.allreduce(key=key, value=x, average=average), dtype=x.dtype)
+
+  return _make_reduce_op(_py_allreduce, tensor, name="LocalDataParallelAllreduce")
+
+
+def broadcast(tensor, root_rank):
+  """
+  Like ``hvd.broadcast``.
+
+  :param tf.Tensor|tf.Variable tensor:
+  :param int root_rank:
+  :return: value of root_rank
+  :rtype: tf.Tensor
+  """
+  import tensorflow as tf
+  init()
+  tensor = tf.convert_to_tensor(tensor)
+  key = _get_reduce_key("broadcast", tensor)
+
+  def _py_broadcast(x):
+    """
+    :param numpy.ndarray x:
+    :rtype: numpy.ndarray
+    """
+    return numpy.asarray(_client.broadcast(key=key, value=x, root_rank=root_rank), dtype=x.dtype)
+
+  return _make_reduce_op(_py_broadcast, tensor, name="LocalDataParallelBroadcast")
@@ -33,6 +33,8 @@ class ExternData(object):
     if data:
       self.register_data_from_dict(data)
     self.extra_added_keys = set()  # set[str]
+    # data key -> (segment ids key, segment positions key). see register_packed_segments
+    self.packed_segments = {}  # type: typing.Dict[str,typing.Tuple[str,str]]
 
   def __repr__(self):
     return "<ExternData data=%r>" % self.data
@@ -50,6 +52,33 @@ class ExternData(object):
       # batch_dim_axis=0, time_dim_axis=1. See TFEngine.DataProvider._get_next_batch().
       self.data[key] = Data(name=key, auto_create_placeholders=True, **init_args)
     self.default_target = config.value('target', 'classes')
+    if config.typed_value("seq_packing", None):
+      for key, data in sorted(self.data.items()):
+        if data.batch_dim_axis == 0 and data.time_dim_axis == 1 and 0 in data.size_placeholder:
+          self.register_packed_segments(key)
+
+  def register_packed_segments(self, key):
+    """
+    With seq packing (see :func:`Dataset.Dataset._generate_batches`), one batch entry can contain multiple seqs.
+    This registers the data "<key>_segment_ids" and "<key>_segment_positions",
+    both int32 of shape (batch,time), with the same time dim (size_placeholder) as the data `key`.
+    The segment id is the index of the seq within the batch entry, or -1 for padding frames,
+    and the segment position is the frame index within the seq.
+    E.g. :class:`SelfAttentionLayer` can use the segment ids to mask across the seq boundaries.
+    These are filled by the data provider (:class:`TFDataPipeline.FeedDictDataProvider`), not by the dataset.
+
+    :param str key:
+    """
+    data = self.data[key]
+    assert data.batch_dim_axis == 0 and data.time_dim_axis == 1, "%s: need batch-major data with time" % data
+    ids_key, positions_key = "%s_segment_ids" % key, "%s_segment_positions" % key
+    for segment_key in (ids_key, positions_key):
+      self.register_data(Data(
+        name=segment_key, shape=(None,), dtype="int32", sparse=True, dim=None,
+        batch_dim_axis=0, time_dim_axis=1, size_placeholder={0: data.size_placeholder[0]},
+        available_for_inference=data.available_for_inference, auto_create_placeholders=True))
+      self.extra_added_keys.add(segment_key)
+    self.packed_segments[key] = (ids_key, positions_key)
 
   @classmethod
   def data_kwargs_from_dataset_key(cls, dataset, key):
@@ -345,6 +374,7 @@ class TFNetwork(object):
     self.concat_sources_dropout_cache = {}  # type: typing.Dict[typing.Tuple[typing.Tuple[LayerBase,...],float,typing.Optional[typing.Tuple[typing.Optional[int],...]]],Data]  # nopep8
     self._batch_dim = None  # see get_data_batch_dim
     self._merge_all_summaries = None  # type: typing.Optional[tf.Tensor]
+    self._horovod_fetch_reductions = None  # type: typing.Optional[typing.Tuple[typing.Dict[str,tf.Tensor],typing.Dict[str,tf.Tensor],tf.Tensor]]  # nopep8
     self._graph_reset_callbacks = []  # type: typing.List[typing.Callable]
 
   def __repr__(self):
@@ -774,6 +804,9 @@ class TFNetwork(object):
       return self.parent_net.get_extern_data(key, mark_data_key_as_used=mark_data_key_as_used)
     if mark_data_key_as_used:
       self.used_data_keys.add(key)
+      for data_key, segment_keys in self.extern_data.packed_segments.items():
+        if key in segment_keys:
+          self.used_data_keys.add(data_key)  # the data provider fills the segment info along with this key
     if key == "seq_idx" and key not in self.extern_data.data:
       self.extern_data.data[key] = Data(
         name="seq_idx", shape=(), dtype="int32", sparse=False, auto_create_placeholders=True)
@@ -950,37 +983,6 @@ class TFNetwork(object):
     if should_eval is None:
       should_eval = self.eval_flag
 
-    def reduce_sum(x, name, average=False):
-      """
-      :param tf.Tensor x:
-      :param str name:
-      :param bool average:
-      :return: sum(x) if horovod else x
-      :rtype: tf.Tensor
-      """
-      if not config.is_true("use_horovod"):
-        return x
-      from TFUtil import global_tensor
-      # noinspection PyUnresolvedReferences,PyPackageRequirements
-      import horovod.tensorflow as hvd
-      return global_tensor(
-        lambda: hvd.allreduce(x, average=average),
-        name="fetch_reduce_sum__" + name.replace(":", "__").replace("/", "_"))
-
-    def inv_reduce_sum(x, name):
-      """
-      :param tf.Tensor x:
-      :param str name:
-      :return: reciprocal(sum(reciprocal(x))) if horovod else x
-      :rtype: tf.Tensor
-      """
-      if not config.is_true("use_horovod"):
-        return x
-      from TFUtil import global_tensor
-      return global_tensor(
-        lambda: tf.reciprocal(reduce_sum(tf.reciprocal(x), name=name)),
-        name="fetch_inv_reduce_sum__" + name.replace(":", "__").replace("/", "_"))
-
     d = {}
     if with_size:
       for key in self.used_data_keys:
@@ -989,22 +991,13 @@ class TFNetwork(object):
           d["size:%s:%i" % (key, dim)] = v
 
     if should_train or should_eval:
-      # These values are cached internally and the graph nodes are created on the first call.
-      loss = self.get_objective()
-      if loss is 0:
-        loss = TFUtil.global_tensor(lambda: tf.constant(0.0), name="zero_loss")
-      else:  # non-constant-zero loss
-        assert self.losses_dict
-      d["loss"] = reduce_sum(loss, name="loss", average=True)
-      for loss_name, loss in self.losses_dict.items():
-        if loss.get_only_on_eval() and should_train:
-          continue
-        if loss.get_loss_value_for_fetch() is not None:
-          d["cost:%s" % loss_name] = reduce_sum(loss.get_loss_value_for_fetch(), name="cost:%s" % loss_name)
-        if loss.get_error_value() is not None:
-          d["error:%s" % loss_name] = reduce_sum(loss.get_error_value(), name="error:%s" % loss_name)
-        d["loss_norm_factor:%s" % loss_name] = inv_reduce_sum(
-          loss.get_norm_factor(), name="loss_norm_factor:%s" % loss_name)
+      if config.is_true("use_horovod"):
+        fetches, fetches_only_on_eval, _ = self.get_horovod_fetch_reductions()
+      else:
+        fetches, fetches_only_on_eval = self._get_loss_fetches(), self._get_loss_fetches(only_on_eval=True)
+      d.update(fetches)
+      if not should_train:
+        d.update(fetches_only_on_eval)
       if with_size:
         for layer in self.layers.values():
           if layer.only_on_eval and should_train:
@@ -1034,6 +1027,75 @@ class TFNetwork(object):
 
     return d
 
+  def _get_loss_fetches(self, only_on_eval=False):
+    """
+    :param bool only_on_eval: if True, only the losses with get_only_on_eval(). otherwise "loss" and all others
+    :return: "loss", and "cost:*", "error:*", "loss_norm_factor:*" of the losses
+    :rtype: dict[str,tf.Tensor]
+    """
+    import TFUtil
+    d = {}
+    if not only_on_eval:
+      # These values are cached internally and the graph nodes are created on the first call.
+      loss = self.get_objective()
+      if loss is 0:
+        loss = TFUtil.global_tensor(lambda: tf.constant(0.0), name="zero_loss")
+      else:  # non-constant-zero loss
+        assert self.losses_dict
+      d["loss"] = loss
+    for loss_name, loss in self.losses_dict.items():
+      if bool(loss.get_only_on_eval()) != only_on_eval:
+        continue
+      if loss.get_loss_value_for_fetch() is not None:
+        d["cost:%s" % loss_name] = loss.get_loss_value_for_fetch()
+      if loss.get_error_value() is not None:
+        d["error:%s" % loss_name] = loss.get_error_value()
+      d["loss_norm_factor:%s" % loss_name] = loss.get_norm_factor()
+    return d
+
+  def get_horovod_fetch_reductions(self):
+    """
+    The loss fetches (see :func:`get_fetches_dict`) summed (or averaged) over all Horovod instances.
+    All the reductions are created once, in one chain (see :func:`TFUtil.horovod_reductions_in_order`),
+    first the ones which are fetched in training, then the ones of the losses which are only used in eval.
+    The gradient reductions of the optimizer continue the chain after the ones which are fetched in training
+    (see :func:`TFUpdater.Updater.create_optim_op`),
+    i.e. the reductions of one ``session.run`` are always in one chain.
+
+    :return: fetches in training, additional fetches in eval, the last reduction of the fetches in training
+    :rtype: (dict[str,tf.Tensor], dict[str,tf.Tensor], tf.Tensor)
+    """
+    if self._horovod_fetch_reductions is not None:
+      return self._horovod_fetch_reductions
+    from TFUtil import get_horovod, global_tensor, horovod_reductions_in_order
+    hvd = get_horovod()
+
+    def reduce_all(fetches):
+      """
+      :param dict[str,tf.Tensor] fetches:
+      :return: same keys, reduced. created in sorted order, such that it is the same in all instances
+      :rtype: dict[str,tf.Tensor]
+      """
+      res = {}
+      for name, x in sorted(fetches.items()):
+        name_ = name.replace(":", "__").replace("/", "_")
+        if name.startswith("loss_norm_factor:"):  # reciprocal(sum(reciprocal(x)))
+          res[name] = global_tensor(
+            lambda: tf.reciprocal(hvd.allreduce(tf.reciprocal(x), average=False)),
+            name="fetch_inv_reduce_sum__" + name_)
+        else:
+          res[name] = global_tensor(
+            lambda: hvd.allreduce(x, average=(name == "loss")),
+            name="fetch_reduce_sum__" + name_)
+      return res
+
+    with horovod_reductions_in_order():
+      train_fetches = reduce_all(self._get_loss_fetches())
+      train_tail = train_fetches[max(train_fetches.keys())]
+      eval_fetches = reduce_all(self._get_loss_fetches(only_on_eval=True))
+    self._horovod_fetch_reductions = train_fetches, eval_fetches, train_tail
+    return self._horovod_fetch_reductions
+
   def get_used_targets(self):
     """
     :return: sorted list of targets
@@ -1390,22 +1452,7 @@ class TFNetwork(object):
     maybe_make_dirs(os.path.dirname(filename))
     if not self.saver:
       self._create_saver()
-    # We add some extra logic to try again for DiskQuota and other errors.
-    # This could save us multiple hours of computation.
-    try_again_wait_time = 10
-    while True:
-      try:
-        self.saver.save(sess=session, save_path=filename)
-        break
-      except IOError as e:
-        import errno
-        import time
-        if e.errno in [errno.EBUSY, errno.EDQUOT, errno.EIO, errno.ENOSPC]:
-          print("Exception while saving:", e, file=log.v3)
-          print("Trying again in %s secs." % try_again_wait_time, file=log.v3)
-          time.sleep(try_again_wait_time)
-          continue
-        raise
+    _call_with_retry_on_io_error(lambda: self.saver.save(sess=session, save_path=filename))
 
   def load_params_from_file(self, filename, session):
     """
@@ -2494,6 +2541,216 @@ def help_on_tf_exception(
     pprint(feed_dict, stream=file)
 
 
+def _call_with_retry_on_io_error(func):
+  """
+  We add some extra logic to try again for DiskQuota and other errors.
+  This could save us multiple hours of computation.
+
+  :param ()->None func: e.g. saves a checkpoint
+  """
+  try_again_wait_time = 10
+  while True:
+    try:
+      func()
+      break
+    except IOError as e:
+      import errno
+      import time
+      if e.errno in [errno.EBUSY, errno.EDQUOT, errno.EIO, errno.ENOSPC]:
+        print("Exception while saving:", e, file=log.v3)
+        print("Trying again in %s secs." % try_again_wait_time, file=log.v3)
+        time.sleep(try_again_wait_time)
+        continue
+      raise
+
+
+class AsyncCheckpointSaver(object):
+  """
+  Saves the params of a :class:`TFNetwork` in a background thread,
+  such that the training does not need to wait for a slow file system.
+
+  :func:`save` takes a snapshot of the params into host memory (a single ``session.run``),
+  and the background thread writes it as a normal TF checkpoint (without ``.meta`` file)
+  via its own graph and session on the CPU.
+  It writes to a temporary filename first and renames the files when done, the ``.index`` file last,
+  thus a checkpoint is either complete or not visible (see :func:`EngineBase.get_existing_models`).
+  Other jobs, e.g. the cleanup of old models, can be queued via :func:`add_callback`,
+  and they run after the pending saves.
+  Any exception in the thread is raised again in the next call of :func:`save`, :func:`join` or :func:`close`.
+  """
+
+  def __init__(self, network, session, max_pending_saves=1):
+    """
+    :param TFNetwork network:
+    :param tf.Session session:
+    :param int max_pending_saves: :func:`save` blocks if there are so many snapshots not written yet
+    """
+    from threading import Thread, Condition
+    assert self.is_supported(network)
+    assert max_pending_saves >= 1
+    self.network = network
+    self.session = session
+    self.max_pending_saves = max_pending_saves
+    self.params = network.get_saveable_params_list()  # type: typing.List[tf.Variable]
+    self.param_names = [param.op.name for param in self.params]  # like tf.train.Saver
+    self._writer = None  # type: typing.Optional[typing.Tuple[tf.Session,tf.train.Saver,list,list]]
+    self._writer_signature = None
+    self._cond = Condition()
+    self._queue = []  # type: typing.List[typing.Tuple[str,object]]  # ("save", (filename, values)) or ("call", func)
+    self._num_pending_saves = 0
+    self._exc_info = None
+    self._stop = False
+    self._thread = Thread(target=self._thread_main, name="AsyncCheckpointSaver")
+    self._thread.daemon = True
+    self._thread.start()
+
+  @classmethod
+  def is_supported(cls, network):
+    """
+    :param TFNetwork network:
+    :return: whether all saveable params are plain variables. otherwise, use :func:`TFNetwork.save_params_to_file`
+    :rtype: bool
+    """
+    for param in network.get_saveable_params_list():
+      if not isinstance(param, tf.Variable) or getattr(param, "_save_slice_info", None):
+        return False
+    return True
+
+  def _check_exception(self):
+    """
+    Raises the exception of the thread, if there was any.
+    """
+    if self._exc_info:
+      exc_info, self._exc_info = self._exc_info, None
+      if sys.version_info[0] >= 3:
+        raise exc_info[1].with_traceback(exc_info[2])
+      raise exc_info[1]
+
+  def save(self, filename):
+    """
+    :param str filename: like for :func:`TFNetwork.save_params_to_file`
+    """
+    import os
+    filename = os.path.abspath(filename)
+    with self._cond:
+      while self._num_pending_saves >= self.max_pending_saves and not self._exc_info:
+        self._cond.wait()
+      self._check_exception()
+    values = self.session.run(self.params)
+    with self._cond:
+      self._queue.append(("save", (filename, [numpy.asarray(value) for value in values])))
+      self._num_pending_saves += 1
+      self._cond.notify_all()
+
+  def add_callback(self, func):
+    """
+    :param ()->None func: will be called in the thread, after all pending saves
+    """
+    with self._cond:
+      self._check_exception()
+      self._queue.append(("call", func))
+      self._cond.notify_all()
+
+  def join(self):
+    """
+    Waits until all pending saves and callbacks are done.
+    """
+    with self._cond:
+      while self._queue and not self._exc_info:
+        self._cond.wait()
+      self._check_exception()
+
+  def close(self):
+    """
+    Waits for the pending saves, and stops the thread.
+    """
+    try:
+      self.join()
+    finally:
+      with self._cond:
+        self._stop = True
+        self._cond.notify_all()
+      self._thread.join()
+      if self._writer:
+        self._writer[0].close()
+        self._writer = None
+
+  def _thread_main(self):
+    while True:
+      with self._cond:
+        while not self._queue and not self._stop:
+          self._cond.wait()
+        if not self._queue:
+          return
+        # Keep it in the queue while it is running, see join().
+        kind, job = self._queue[0]
+      # noinspection PyBroadException
+      try:
+        if kind == "save":
+          self._write(*job)
+        else:
+          job()
+      except Exception:
+        with self._cond:
+          self._exc_info = sys.exc_info()
+          self._num_pending_saves = 0
+          del self._queue[:]
+          self._cond.notify_all()
+        continue
+      with self._cond:
+        self._queue.pop(0)
+        if kind == "save":
+          self._num_pending_saves -= 1
+        self._cond.notify_all()
+
+  def _get_writer(self, values):
+    """
+    :param list[numpy.ndarray] values:
+    :return: session, saver, placeholders, initializers
+    :rtype: (tf.Session, tf.train.Saver, list[tf.Tensor], list[tf.Operation])
+    """
+    signature = [(value.dtype, value.shape) for value in values]
+    if self._writer and self._writer_signature == signature:
+      return self._writer
+    if self._writer:
+      self._writer[0].close()
+    with tf.Graph().as_default() as graph:
+      with tf.device("/cpu:0"):
+        placeholders = [
+          tf.placeholder(dtype=value.dtype, shape=value.shape, name="param_value_%i" % i)
+          for (i, value) in enumerate(values)]
+        variables = [
+          tf.Variable(placeholder, trainable=False, name="param_%i" % i)
+          for (i, placeholder) in enumerate(placeholders)]
+        saver = tf.train.Saver(var_list=dict(zip(self.param_names, variables)), max_to_keep=2 ** 31 - 1)
+    session = tf.Session(graph=graph, config=tf.ConfigProto(device_count={"GPU": 0}))
+    self._writer = (session, saver, placeholders, [v.initializer for v in variables])
+    self._writer_signature = signature
+    return self._writer
+
+  def _write(self, filename, values):
+    """
+    :param str filename:
+    :param list[numpy.ndarray] values:
+    """
+    import os
+    from glob import glob
+    from Util import maybe_make_dirs
+    session, saver, placeholders, initializers = self._get_writer(values)
+    session.run(initializers, feed_dict=dict(zip(placeholders, values)))
+    maybe_make_dirs(os.path.dirname(filename))
+    tmp_filename = "%s/.tmp.%s" % (os.path.dirname(filename), os.path.basename(filename))
+    for fn in glob(tmp_filename + ".*"):  # leftovers, e.g. from a crash
+      os.remove(fn)
+    _call_with_retry_on_io_error(
+      lambda: saver.save(sess=session, save_path=tmp_filename, write_meta_graph=False, write_state=False))
+    tmp_files = sorted(glob(tmp_filename + ".*"), key=lambda fn: fn.endswith(".index"))  # index file last
+    assert any([fn.endswith(".index") for fn in tmp_files]), "%s: no index file for %r" % (self, tmp_filename)
+    for fn in tmp_files:
+      os.rename(fn, filename + fn[len(tmp_filename):])
+    print("%s: Saved model under %s" % (self.__class__.__name__, filename), file=log.v5)
+
+
 class CustomCheckpointLoader:
   """
   This uses `tf.train.NewCheckpointReader`.
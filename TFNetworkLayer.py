@@ -1212,6 +1212,15 @@ class LayerBase(object):
     """
     return rec_vars_outputs
 
+  @classmethod
+  def get_rec_vars_outputs_beam_independent_keys(cls):
+    """
+    :return: keys of rec_vars_outputs which do not have the batch (incl. beam) dim,
+      and thus must not be reordered by :class:`SelectSearchSourcesLayer`
+    :rtype: set[str]
+    """
+    return set()
+
   @classmethod
   def get_rec_initial_output(cls, batch_dim, name, output, rec_layer, initial_output=None, **kwargs):
     """
@@ -2243,7 +2252,15 @@ class SelectSearchSourcesLayer(InternalLayer):
         self.output.placeholder = transform(src_output.placeholder)
       if src_output.size_placeholder:
         self.output.size_placeholder = {i: transform(size) for (i, size) in src_output.size_placeholder.items()}
-      self.rec_vars_outputs = {k: transform(v) for (k, v) in src.rec_vars_outputs.items()}  # assumes batch-major
+      src_layer = src
+      while isinstance(src_layer, SelectSearchSourcesLayer):
+        src_layer = src_layer.sources[0]
+      # "prev:" layers are templates, with the real layer class in layer_class_type.
+      src_layer_class = getattr(src_layer, "layer_class_type", None) or type(src_layer)
+      beam_independent_keys = src_layer_class.get_rec_vars_outputs_beam_independent_keys()
+      self.rec_vars_outputs = {
+        k: v if k in beam_independent_keys else transform(v)  # assumes batch-major
+        for (k, v) in src.rec_vars_outputs.items()}
 
     for src in self.sources:
       if src.allow_inf_in_output:
@@ -89,6 +89,7 @@ class RecLayer(_ConcatInputLayer):
                unroll=False, back_prop=None,
                use_global_rec_step_offset=False,
                include_eos=False,
+               compact_finished_batch_entries=False,
                debug=None,
                **kwargs):
     """
@@ -109,6 +110,9 @@ class RecLayer(_ConcatInputLayer):
     :param bool|None back_prop: for tf.while_loop. the default will use self.network.train_flag
     :param bool use_global_rec_step_offset:
     :param bool include_eos: for search, whether we should include the frame where "end" is True
+    :param bool compact_finished_batch_entries: for search with a dynamic end, the loop body is computed only
+      for the batch entries which still have active (not ended) hyps. The state of the finished batch entries
+      stays as it is. Useful together with `early_exit_end_label` of :class:`ChoiceLayer`.
     :param bool|None debug:
     """
     super(RecLayer, self).__init__(**kwargs)
@@ -129,6 +133,7 @@ class RecLayer(_ConcatInputLayer):
     self._input_projection = input_projection
     self._max_seq_len = max_seq_len
     self.include_eos = include_eos
+    self._compact_finished_batch_entries = compact_finished_batch_entries
     if optimize_move_layers_out is None:
       optimize_move_layers_out = self.network.get_config().bool("optimize_move_layers_out", True)
     self._optimize_move_layers_out = optimize_move_layers_out
@@ -920,6 +925,9 @@ class _SubnetworkRecCell(object):
     self.final_acc_tas_dict = None  # type: typing.Optional[typing.Dict[str, tf.TensorArray]]
     self.get_final_rec_vars = None
     self.accumulated_losses = {}  # type: typing.Dict[str,LossHolder]
+    # See RecLayer compact_finished_batch_entries. Set while the loop body is constructed.
+    self._compact_batch_idx = None  # type: typing.Optional[tf.Tensor]  # (n,) -> batch idx
+    self._compact_layers = {}  # type: typing.Dict[str,LayerBase]
 
   def __repr__(self):
     return "<%s of %r>" % (self.__class__.__name__, self.parent_rec_layer)
@@ -1279,6 +1287,86 @@ class _SubnetworkRecCell(object):
     """
     return self.parent_net.get_layer(layer_name)
 
+  def _gather_batch_entries(self, x, axis=0):
+    """
+    With compaction of finished batch entries (see RecLayer `compact_finished_batch_entries`),
+    select the active batch entries. Otherwise just returns x.
+
+    :param tf.Tensor|list|tuple|None x: (..., batch * beam, ...). scalars are left as-is
+    :param int|None axis: batch axis. None if there is no batch dim
+    :rtype: tf.Tensor|list|tuple|None
+    """
+    if self._compact_batch_idx is None or x is None or axis is None:
+      return x
+    if isinstance(x, (tuple, list)):
+      from Util import make_seq_of_type
+      return make_seq_of_type(type(x), [self._gather_batch_entries(x_, axis=axis) for x_ in x])
+    assert isinstance(x, tf.Tensor)
+    if x.get_shape().ndims == 0:
+      return x
+    from TFUtil import gather_batch_entries
+    return gather_batch_entries(
+      x, batch_idx=self._compact_batch_idx, batch_dim=self.parent_net.get_data_batch_dim(), axis=axis)
+
+  def _scatter_batch_entries(self, x, default=None, axis=0):
+    """
+    The inverse of :func:`_gather_batch_entries`.
+    The finished batch entries are taken from default (or are zero).
+
+    :param tf.Tensor|list|tuple x: (..., n * beam, ...)
+    :param tf.Tensor|list|tuple|None default: (..., batch * beam, ...)
+    :param int|None axis: batch axis. None if there is no batch dim
+    :rtype: tf.Tensor|list|tuple
+    """
+    if self._compact_batch_idx is None or axis is None:
+      return x
+    if isinstance(x, (tuple, list)):
+      from Util import make_seq_of_type
+      if default is None:
+        default = [None] * len(x)
+      return make_seq_of_type(
+        type(x), [self._scatter_batch_entries(x_, default=d_, axis=axis) for (x_, d_) in zip(x, default)])
+    assert isinstance(x, tf.Tensor)
+    if x.get_shape().ndims == 0:
+      return x
+    from TFUtil import scatter_batch_entries
+    return scatter_batch_entries(
+      x, batch_idx=self._compact_batch_idx, batch_dim=self.parent_net.get_data_batch_dim(),
+      default=default, axis=axis)
+
+  def _get_compact_layer(self, layer):
+    """
+    With compaction of finished batch entries, layers from outside the loop
+    (e.g. via "base:" or moved out of the loop, without time dim)
+    need to be reduced to the active batch entries as well.
+
+    :param LayerBase layer: from outside the loop
+    :rtype: LayerBase
+    """
+    if self._compact_batch_idx is None or layer.output.batch_dim_axis is None:
+      return layer
+    key = layer.get_absolute_name()
+    if key in self._compact_layers:
+      return self._compact_layers[key]
+    from TFNetworkLayer import WrappedInternalLayer
+    from TFUtil import DimensionTag
+    output = layer.output.copy(name="%s_compact" % layer.output.name)
+    if output.placeholder is not None:
+      output.placeholder = self._gather_batch_entries(output.placeholder, axis=output.batch_dim_axis)
+    if output.size_placeholder:
+      size_placeholder = {}
+      for i, size in output.size_placeholder.items():
+        tag = DimensionTag.get_tag_from_size_tensor(size)
+        size = self._gather_batch_entries(size)
+        if tag:
+          tag.set_tag_on_size_tensor(size)
+        size_placeholder[i] = size
+      output.size_placeholder = size_placeholder
+    compact_layer = WrappedInternalLayer(
+      base_layer=layer, network=layer.network, name=layer.name, output=output, sources=[layer])
+    self._compact_layers[key] = compact_layer
+    return compact_layer
+
   def _construct(self, prev_outputs, prev_extra, i, data=None,
                  inputs_moved_out_tas=None, needed_outputs=("output",)):
     """
@@ -1344,7 +1432,7 @@ class _SubnetworkRecCell(object):
         assert not prev, "Time dim does not match: RecLayer %s (%r) vs sub layer %s (%r)." % (
           self.parent_rec_layer, self.parent_rec_layer.output.get_time_dim_tag(),
           layer, layer.output.get_time_dim_tag())
-        return layer
+        return self._get_compact_layer(layer)
       output = layer.output.copy_template_excluding_time_dim()
       with tf.name_scope("%s_moved_input" % name.replace(":", "_")):
         if prev:
@@ -1354,6 +1442,7 @@ class _SubnetworkRecCell(object):
             lambda: inputs_moved_out_tas[layer_name].read(i - 1))
         else:
           output.placeholder = inputs_moved_out_tas[layer_name].read(i)
+        output.placeholder = self._gather_batch_entries(output.placeholder, axis=output.batch_dim_axis)
         output.sanity_check()
       layer = self.net.add_layer(name=name, output=output, layer_class=InternalLayer, sources=[layer])
       inputs_moved_out[name] = layer
@@ -1372,7 +1461,7 @@ class _SubnetworkRecCell(object):
         return prev_layers[sub_name]
       if name.startswith("base:"):
         layer = self._get_parent_layer(name[len("base:"):])
-        return layer
+        return self._get_compact_layer(layer)
       if name in self.input_layers_moved_out:
         return get_input_moved_out(name)
       if name in self.output_layers_moved_out:
@@ -1620,23 +1709,26 @@ class _SubnetworkRecCell(object):
     """
 
     # noinspection PyShadowingNames
-    def __init__(self, name, dtype, element_shape, get):
+    def __init__(self, name, dtype, element_shape, get, batch_dim_axis=0):
       """
       :param str name:
       :param tf.DType|str dtype:
       :param tuple[int|None] element_shape:
       :param ()->(tf.Tensor|None) get:
+      :param int|None batch_dim_axis: in element_shape
       """
       self.name = name
       self.dtype = dtype
       self.element_shape = element_shape
       self.get = get
+      self.batch_dim_axis = batch_dim_axis
       self.get_returned_none = None  # type: typing.Optional[bool]
 
-    def write_to_tensor_array(self, ta, index):
+    def write_to_tensor_array(self, ta, index, transform=None):
       """
       :param tf.TensorArray ta:
       :param tf.Tensor index:
+      :param ((_SubnetworkRecCell.OutputToAccumulate,tf.Tensor)->tf.Tensor)|None transform: applied on the value
       :return: new ta
       :rtype: tf.TensorArray
       """
@@ -1647,6 +1739,8 @@ class _SubnetworkRecCell(object):
         return ta
       else:
         self.get_returned_none = False
+        if transform:
+          value = transform(self, value)
         return ta.write(index=index, value=value, name="%s_acc_ta_write" % self.name)
 
     def get_final_tensor_array(self, ta):
@@ -1812,7 +1906,8 @@ class _SubnetworkRecCell(object):
           name=name_,
           dtype=self.layer_data_templates[layer_name].output.dtype,
           element_shape=self.layer_data_templates[layer_name].output.batch_shape,
-          get=lambda: self.net.get_layer(layer_name).output.placeholder))
+          get=lambda: self.net.get_layer(layer_name).output.placeholder,
+          batch_dim_axis=self.layer_data_templates[layer_name].output.batch_dim_axis))
 
       for name, template in self.layer_data_templates.items():
         if template.is_output_layer():
@@ -1887,6 +1982,9 @@ class _SubnetworkRecCell(object):
         assert tf.as_dtype(end_template.output.dtype) is tf.bool
         assert end_template.output.batch_shape == (None,)  # (batch*beam,)
       else:
+        # noinspection PyProtectedMember
+        assert not rec_layer._compact_finished_batch_entries, (
+          "%r: compact_finished_batch_entries needs an 'end' layer" % rec_layer)
         assert have_known_seq_len, (
           "You need to have an 'end' layer in your rec subnet if the generated seq len is unknown.")
 
@@ -1973,7 +2071,8 @@ class _SubnetworkRecCell(object):
             name="debug_output_%s" % layer_name,
             dtype=self.layer_data_templates[layer_name].output.dtype,
             element_shape=self.layer_data_templates[layer_name].output.batch_shape,
-            get=lambda name_=layer_name: self.net.get_layer(name_).output.placeholder))
+            get=lambda name_=layer_name: self.net.get_layer(name_).output.placeholder,
+            batch_dim_axis=self.layer_data_templates[layer_name].output.batch_dim_axis))
 
       # Maybe some of the moved-out output-layers depend on data inside the loop,
       # so we should accumulate it to have access to it.
@@ -2054,7 +2153,23 @@ class _SubnetworkRecCell(object):
           step_info_i += global_tensor(
             lambda: tf.placeholder(tf.int32, (), name="global_rec_step_offset"),
             name="global_rec_step_offset")
-        rec_step_info = dict(i=step_info_i, end_flag=None, seq_lens=fixed_seq_len)
+        full_seq_len_info, compact_all_active = seq_len_info, None
+        # noinspection PyProtectedMember
+        if seq_len_info and rec_layer._compact_finished_batch_entries:
+          # Only compute the loop body for the batch entries with active hyps.
+          # Everything which comes into the loop is reduced to those (see _gather_batch_entries),
+          # and everything which goes out of it is extended to the full batch again (see _scatter_batch_entries).
+          with tf.name_scope("compact_batch"):
+            end_flag, _ = seq_len_info
+            batch_dim = rec_layer.network.get_data_batch_dim()
+            active = tf.reduce_any(tf.logical_not(tf.reshape(end_flag, [batch_dim, -1])), axis=1)  # (batch,)
+            compact_all_active = tf.reduce_all(active)
+            self._compact_batch_idx = tf.cast(tf.reshape(tf.where(active), [-1]), tf.int32)  # (n,)
+            self._compact_layers = {}
+            # noinspection PyProtectedMember
+            self.net._batch_dim = tf.shape(self._compact_batch_idx)[0]
+            seq_len_info = tuple([self._gather_batch_entries(x) for x in seq_len_info])
+        rec_step_info = dict(i=step_info_i, end_flag=None, seq_lens=self._gather_batch_entries(fixed_seq_len))
         end_flag, dyn_seq_len, prev_end_layer = None, None, None
         if seq_len_info:
           end_flag, dyn_seq_len = seq_len_info
@@ -2079,6 +2194,21 @@ class _SubnetworkRecCell(object):
           prev_extra = identity_op_nested(prev_extra)
         data_ = {
           key_: ta.read(i, name="{}_ta_read".format(key_)) for key_, ta in data_tensor_arrays.items()}
+        if self._compact_batch_idx is not None:
+          with tf.name_scope("compact_batch"):
+            prev_outputs = {
+              k: self._gather_batch_entries(v, axis=self.layer_data_templates[k].output.batch_dim_axis)
+              for (k, v) in prev_outputs.items()}
+            for k, v in prev_extra.items():
+              beam_independent_keys = (
+                self.layer_data_templates[k].layer_class_type.get_rec_vars_outputs_beam_independent_keys())
+              assert not beam_independent_keys.intersection(v.keys()), (
+                "%r: compact_finished_batch_entries does not support the rec vars %r of layer %r" % (
+                  rec_layer, beam_independent_keys, k))
+              prev_extra[k] = {k2: self._gather_batch_entries(v2) for (k2, v2) in v.items()}
+            data_ = {
+              k: self._gather_batch_entries(v, axis=self.net.extern_data.data[k].batch_dim_axis)
+              for (k, v) in data_.items()}
         # noinspection PyProtectedMember
         with reuse_name_scope(self.parent_rec_layer._rec_scope):
           self._construct(
@@ -2161,10 +2291,60 @@ class _SubnetworkRecCell(object):
                 constant_with_shape(1, shape=tf.shape(end_flag)))  # (batch * beam,)
               seq_len_info = (end_flag, dyn_seq_len)
 
+        acc_transform = None
+        if self._compact_batch_idx is not None:
+          # noinspection PyShadowingNames
+          def uncompact(x, default=None, axis=0):
+            """
+            :param tf.Tensor|list|tuple x: with the active batch entries
+            :param tf.Tensor|list|tuple|None default: with all batch entries, used for the finished ones
+            :param int|None axis: batch axis
+            :return: with all batch entries
+            :rtype: tf.Tensor|list|tuple
+            """
+            if isinstance(x, (tuple, list)):
+              from Util import make_seq_of_type
+              return make_seq_of_type(
+                type(x), [uncompact(x_, default=d_, axis=axis) for (x_, d_) in zip(x, default or [None] * len(x))])
+            if axis is None or x.get_shape().ndims == 0:
+              return x
+            # Shortcut if nothing was compacted. This is also always the case in the first frame,
+            # where the beam of the prev outputs can differ, so the scatter could not be used there.
+            return tf.cond(
+              compact_all_active,
+              lambda: x, lambda: self._scatter_batch_entries(x, default=default, axis=axis))
+
+          # noinspection PyShadowingNames
+          def acc_transform(out, value):
+            """
+            :param _SubnetworkRecCell.OutputToAccumulate out:
+            :param tf.Tensor value:
+            :rtype: tf.Tensor
+            """
+            if out.name.startswith("choice_"):
+              # The src beams (batch, beam). The hyps of the finished batch entries stay as they are.
+              default = tf.tile(
+                tf.expand_dims(tf.range(tf.shape(value)[1]), 0), [rec_layer.network.get_data_batch_dim(), 1])
+              return uncompact(value, default=default)
+            return uncompact(value, axis=out.batch_dim_axis)  # not needed anymore after the end, thus zero
+
+          with tf.name_scope("uncompact_batch"):
+            outputs_flat = [
+              uncompact(v, default=prev_v, axis=self.layer_data_templates[k].output.batch_dim_axis)
+              for (k, v, prev_v) in zip(sorted(self._initial_outputs), outputs_flat, prev_outputs_flat)]
+            extra_flat = [uncompact(v, default=prev_v) for (v, prev_v) in zip(extra_flat, prev_extra_flat)]
+            net_vars = (outputs_flat, extra_flat)
+            seq_len_info = tuple([uncompact(v, default=prev_v) for (v, prev_v) in zip(seq_len_info, full_seq_len_info)])
+
         assert len(acc_tas) == len(outputs_to_accumulate)
         acc_tas = [
-          out.write_to_tensor_array(acc_ta, index=i)
+          out.write_to_tensor_array(acc_ta, index=i, transform=acc_transform)
           for (acc_ta, out) in zip(acc_tas, outputs_to_accumulate)]
+        if self._compact_batch_idx is not None:
+          self._compact_batch_idx = None
+          self._compact_layers = {}
+          # noinspection PyProtectedMember
+          self.net._batch_dim = None
         next_i = tf.add(i, 1, name="next_i")
         res = (next_i, net_vars, acc_tas)
         if seq_len_info is not None:
@@ -4085,6 +4265,7 @@ class ChoiceLayer(BaseChoiceLayer):
                custom_score_combine=None,
                source_beam_sizes=None, scheduled_sampling=False, cheating=False,
                explicit_search_sources=None,
+               prune_score_threshold=None, early_exit_end_label=None,
                **kwargs):
     """
     :param int beam_size: the outgoing beam size. i.e. our output will be (batch * beam_size, ...)
@@ -4106,6 +4287,17 @@ class ChoiceLayer(BaseChoiceLayer):
     :param list[LayerBase]|None explicit_search_sources: will mark it as an additional dependency.
       You might use these also in custom_score_combine.
     :param callable|None custom_score_combine:
+    :param float|None prune_score_threshold: in search, hyps which are worse than the best hyp
+      of the same batch entry by more than this (in +log space) get score -inf,
+      i.e. they are dropped from the beam as soon as there are enough other hyps.
+    :param int|None early_exit_end_label: in search, if set, once no active hyp of a batch entry can get a better
+      score than the best ended hyp of this entry anymore (the scores only decrease),
+      all active hyps of this entry are ended with this label (and score -inf).
+      The "end" layer must mark this label as end (e.g. compare to this value).
+      Thus finished batch entries do not keep the rec loop running until max_seq_len.
+      With the :class:`RecLayer` option `compact_finished_batch_entries`,
+      the loop body is also not computed anymore for them.
+      Requires length_normalization=False. See :func:`_prune_search_hyps`.
     """
     super(ChoiceLayer, self).__init__(beam_size=beam_size, search=search, **kwargs)
     from Util import CollectionReadCheckCovered
@@ -4263,6 +4455,14 @@ class ChoiceLayer(BaseChoiceLayer):
         src_beams, labels, scores = beam_search(
           scores=scores_comb, beam_size=beam_size, keep_beams=keep_beams,
           cheating_gold_targets=cheating_gold_targets, cheating_src_beam_idx=cheating_src_beam_idx)
+        if prune_score_threshold is not None or early_exit_end_label is not None:
+          labels, scores = self._prune_search_hyps(
+            src_beams=src_beams, labels=labels, scores=scores,
+            base_search_choices=base_search_choices, base_beam_in=base_beam_in,
+            prune_score_threshold=prune_score_threshold, early_exit_end_label=early_exit_end_label,
+            length_normalization=length_normalization, prob_scale=prob_scale,
+            base_beam_score_scale=base_beam_score_scale, random_sample_scale=random_sample_scale,
+            custom_score_combine=custom_score_combine)
         self.search_choices.set_src_beams(src_beams)  # (batch, beam) -> beam_in idx
         labels = tf.reshape(labels, [net_batch_dim * beam_size])  # (batch * beam)
         labels = tf.cast(labels, self.output.dtype)
@@ -4403,6 +4603,57 @@ class ChoiceLayer(BaseChoiceLayer):
       self.search_scores_combined = scores_comb
       self.search_choices.set_beam_scores(scores_comb)
 
+  def _prune_search_hyps(self, src_beams, labels, scores, base_search_choices, base_beam_in,
+                         prune_score_threshold, early_exit_end_label,
+                         length_normalization, prob_scale, base_beam_score_scale, random_sample_scale,
+                         custom_score_combine):
+    """
+    Score-threshold pruning and early exit of finished batch entries.
+    See the `prune_score_threshold` and `early_exit_end_label` options.
+
+    :param tf.Tensor src_beams: (batch, beam) -> beam_in idx
+    :param tf.Tensor labels: (batch, beam) -> label
+    :param tf.Tensor scores: (batch, beam) -> combined score
+    :param SearchChoices base_search_choices:
+    :param tf.Tensor base_beam_in: 1 in the first frame, then beam_in
+    :param float|None prune_score_threshold:
+    :param int|None early_exit_end_label:
+    :param bool length_normalization:
+    :param float prob_scale:
+    :param float base_beam_score_scale:
+    :param float random_sample_scale:
+    :param callable|None custom_score_combine:
+    :return: labels, scores, both (batch, beam)
+    :rtype: (tf.Tensor, tf.Tensor)
+    """
+    from TFUtil import nd_indices
+    with tf.name_scope("prune_search_hyps"):
+      neg_inf = float("-inf") * tf.ones_like(scores)
+      if prune_score_threshold is not None:
+        best_scores = tf.reduce_max(scores, axis=1, keepdims=True)  # (batch, 1)
+        pruned = tf.less(scores, best_scores - prune_score_threshold)  # (batch, beam)
+        if self.cheating:  # do not prune the gold hyp, which is the last beam entry
+          pruned = tf.concat([pruned[:, :-1], tf.zeros_like(pruned[:, -1:])], axis=1)
+        scores = tf.where(pruned, neg_inf, scores)
+      if early_exit_end_label is not None:
+        # Our argument that an active hyp cannot get better holds only if the scores never increase.
+        assert not length_normalization, "%s: early_exit_end_label requires length_normalization=False" % self
+        assert prob_scale >= 0 and base_beam_score_scale == 1 and not random_sample_scale
+        assert not custom_score_combine and not self.cheating and len(self.sources) == 1
+        assert self.network.have_rec_step_info()
+        beam_in = base_search_choices.beam_size
+        end_flags = self.network.get_rec_step_info().get_end_flag(
+          target_search_choices=base_search_choices)  # (batch * beam_in,)
+        end_flags = tf.reshape(end_flags, [tf.shape(scores)[0], beam_in])[:, :base_beam_in]  # (batch, beam_in)
+        src_ended = tf.gather_nd(end_flags, nd_indices(src_beams))  # (batch, beam)
+        best_ended = tf.reduce_max(tf.where(src_ended, scores, neg_inf), axis=1)  # (batch,)
+        best_active = tf.reduce_max(tf.where(src_ended, neg_inf, scores), axis=1)  # (batch,)
+        finished = tf.greater_equal(best_ended, best_active)  # (batch,)
+        force_end = tf.logical_and(tf.expand_dims(finished, axis=1), tf.logical_not(src_ended))  # (batch, beam)
+        labels = tf.where(force_end, tf.fill(tf.shape(labels), tf.cast(early_exit_end_label, labels.dtype)), labels)
+        scores = tf.where(force_end, neg_inf, scores)
+      return labels, scores
+
   def _get_scores(self, source):
     """
     :param LayerBase source:
@@ -5519,7 +5770,7 @@ class SelfAttentionLayer(_ConcatInputLayer):
                key_shift=None,
                forward_weights_init="glorot_uniform", attention_dropout=0.0,
                attention_left_only=False, initial_state=None, restrict_state_to_last_seq=False,
-               state_var_lengths=None, **kwargs):
+               state_var_lengths=None, preallocated_kv_cache=None, segment_ids=None, **kwargs):
     """
     :param int num_heads:
     :param int total_key_dim: i.e. key_dim == total_key_dim // num_heads
@@ -5533,6 +5784,20 @@ class SelfAttentionLayer(_ConcatInputLayer):
     :param bool restrict_state_to_last_seq: see code comment below
     :param None|tf.Tensor state_var_lengths: if passed, a Tensor containing the number of keys in the state_var for
       each batch-entry, used for decoding in RASR.
+    :param bool|int|None preallocated_kv_cache: only inside a RecLayer (e.g. for decoding).
+      Instead of the "kv_left" state which is concatenated (i.e. copied) in every step,
+      the keys/values are written in place at the current frame into the preallocated buffers "k_buf"/"v_buf"
+      of shape (batch,heads,time,beam,dim), and the attention is done over the full buffers,
+      where the frames after the current one are masked out.
+      Each hyp refers to the beam entry of its ancestor in every frame via the index table "kv_ptr" (batch*beam,time),
+      i.e. beam pruning only reorders this small table, not the keys/values.
+      The energies are calculated for all beam entries of a frame, i.e. this needs beam-times more FLOPs
+      than "kv_left", but there is no copying of the history per step.
+      If int, the number of frames to preallocate, e.g. the max seq len. Otherwise 32.
+      If more frames are needed, the buffers grow by doubling. See :func:`_kv_buf_attention`.
+    :param LayerBase|None segment_ids: (batch,time), e.g. "data:data_segment_ids" with seq packing
+      (see :func:`TFNetwork.ExternData.register_packed_segments`).
+      The attention is then restricted to the keys of the same segment (seq) as the query.
     """
     super(SelfAttentionLayer, self).__init__(**kwargs)
     self._restrict_state_to_last_seq = restrict_state_to_last_seq
@@ -5550,7 +5815,16 @@ class SelfAttentionLayer(_ConcatInputLayer):
       mat = self.add_param(tf.get_variable(
         name="QKV", shape=(n_in, mat_n_out), dtype=tf.float32, initializer=fwd_weights_initializer),
         axes_split_info=[[n_in], [total_key_dim, total_key_dim, total_value_dim]])
-      if self._rec_previous_layer:
+      prev_kv_buf = None
+      if self._rec_previous_layer and preallocated_kv_cache:
+        assert self.input_data.time_dim_axis is None
+        assert attention_left_only
+        assert (
+          initial_state is None and not restrict_state_to_last_seq and state_var_lengths is None and not key_shift), (
+          "%s: preallocated_kv_cache not supported with these options" % self)
+        prev_kv_left = None
+        prev_kv_buf = {k: self._rec_previous_layer.rec_vars_outputs[k] for k in ["k_buf", "v_buf", "kv_ptr"]}
+      elif self._rec_previous_layer:
         assert self.input_data.time_dim_axis is None
         assert attention_left_only
         # (batch,heads,time,kv-dim//heads)
@@ -5613,6 +5887,11 @@ class SelfAttentionLayer(_ConcatInputLayer):
       else:  # this is usually the case
         self.rec_vars_outputs["kv_left"] = kv
       k, v = tf.split(kv, [total_key_dim // num_heads, total_value_dim // num_heads], axis=-1)
+    if prev_kv_buf is not None:
+      v = self._kv_buf_attention(prev_kv_buf=prev_kv_buf, q=q, k=k, v=v, attention_dropout=attention_dropout)
+      self.output.placeholder = tf.reshape(v, [batch_dim, total_value_dim])
+      self.output.size_placeholder = self.input_data.size_placeholder.copy()
+      return
     # Dot-attention. Resulting last time dimension will be used to perform the softmax over, and will the be reduced.
     # (batch,heads,num_queries|1,num_keys) e.g. (batch,heads,time|1,time)
     energy = tf.matmul(q, k, transpose_b=True, name="energy")
@@ -5659,6 +5938,15 @@ class SelfAttentionLayer(_ConcatInputLayer):
         # shape: (batch,1,1,time)
         inverted_prefix_mask = tf.reshape(inverted_prefix_mask, [tf.shape(energy)[0], 1, 1, tf.shape(energy)[-1]])
         energy_mask = tf.math.logical_xor(energy_mask, inverted_prefix_mask)
+      if segment_ids:
+        assert prev_kv_left is None, "%s: segment_ids not supported with initial_state" % self
+        segment_ids_ = segment_ids.output.copy_as_batch_major().placeholder  # (batch,time)
+        # (batch,1,num_queries,num_keys)
+        segment_mask = tf.logical_or(
+          tf.equal(segment_ids_[:, None, :, None], segment_ids_[:, None, None, :]),
+          # Padding frames (segment id -1) can attend everywhere, to not get only -inf (NaN after the softmax).
+          tf.less(segment_ids_[:, None, :, None], 0))
+        energy_mask = tf.logical_and(energy_mask, segment_mask)
       # Currently tf.where does not support broadcasting...
       energy_mask = tf.logical_and(energy_mask, tf.ones_like(energy, dtype=tf.bool))
       energy = tf.where(energy_mask, energy, float("-inf") * tf.ones_like(energy), name="energy_masked")
@@ -5682,6 +5970,110 @@ class SelfAttentionLayer(_ConcatInputLayer):
     self.output.placeholder = v
     self.output.size_placeholder = self.input_data.size_placeholder.copy()
 
+  def _kv_buf_attention(self, prev_kv_buf, q, k, v, attention_dropout):
+    """
+    Writes the keys/values of the current frame in place into the buffers,
+    and does the attention over the full buffers, where the frames after the current one are masked out.
+    See `preallocated_kv_cache`.
+
+    :param dict[str,tf.Tensor] prev_kv_buf: "k_buf" (batch,heads,time,beam,k-dim//heads), "v_buf" likewise,
+      "kv_ptr" (batch*beam,t) -> beam entry (ancestor of the hyp) for each previous frame
+    :param tf.Tensor q: (batch*beam,heads,1,k-dim//heads)
+    :param tf.Tensor k: (batch*beam,heads,1,k-dim//heads)
+    :param tf.Tensor v: (batch*beam,heads,1,v-dim//heads)
+    :param float attention_dropout:
+    :return: (batch*beam,heads,1,v-dim//heads)
+    :rtype: tf.Tensor
+    """
+    from TFUtil import get_shape
+    # Newer TF versions have tf.tensor_scatter_nd_update (earlier named tf.tensor_scatter_update).
+    scatter_update = getattr(tf, "tensor_scatter_nd_update", None) or getattr(tf, "tensor_scatter_update", None)
+    assert scatter_update, "%s: preallocated_kv_cache needs tf.tensor_scatter_nd_update (TF >= 1.14)" % self
+    prev_k_buf, prev_v_buf, prev_ptr = prev_kv_buf["k_buf"], prev_kv_buf["v_buf"], prev_kv_buf["kv_ptr"]
+    num_heads, key_dim, value_dim = q.get_shape().as_list()[1], q.get_shape().as_list()[-1], v.get_shape().as_list()[-1]
+    with tf.name_scope("kv_buf"):
+      n = tf.shape(q)[0]  # batch*beam
+      batch_dim = tf.shape(prev_k_buf)[0]
+      beam_dim = n // batch_dim
+      i = tf.shape(prev_ptr)[1]  # current frame
+      prev_buf_time, prev_buf_beam = tf.shape(prev_k_buf)[2], tf.shape(prev_k_buf)[3]
+
+      def _grow():
+        """
+        :return: k_buf, v_buf, with space for frame i and the current beam. time grows by doubling
+        :rtype: (tf.Tensor, tf.Tensor)
+        """
+        new_time = tf.where(
+          tf.greater_equal(i, prev_buf_time), tf.maximum(prev_buf_time * 2, i + 1), prev_buf_time)
+        new_beam = tf.maximum(prev_buf_beam, beam_dim)
+        paddings = [[0, 0], [0, 0], [0, new_time - prev_buf_time], [0, new_beam - prev_buf_beam], [0, 0]]
+        return tf.pad(prev_k_buf, paddings), tf.pad(prev_v_buf, paddings)
+
+      k_buf, v_buf = tf.cond(
+        tf.logical_or(tf.greater_equal(i, prev_buf_time), tf.greater(beam_dim, prev_buf_beam)),
+        _grow, lambda: (prev_k_buf, prev_v_buf))
+      k_buf.set_shape((None, num_heads, None, None, key_dim))
+      v_buf.set_shape((None, num_heads, None, None, value_dim))
+      buf_time, buf_beam = tf.shape(k_buf)[2], tf.shape(k_buf)[3]
+
+      def _split_beam(x):
+        """
+        :param tf.Tensor x: (batch*beam,heads,1,dim)
+        :return: (batch,heads,beam,dim)
+        :rtype: tf.Tensor
+        """
+        x = tf.reshape(x, [batch_dim, beam_dim, num_heads, get_shape(x)[-1]])
+        return tf.transpose(x, [0, 2, 1, 3])
+
+      # (batch,heads,3) -> [b,h,i], i.e. the updates are slices of shape (beam,dim).
+      indices = tf.stack([
+        tf.tile(tf.expand_dims(tf.range(batch_dim), 1), [1, num_heads]),
+        tf.tile(tf.expand_dims(tf.range(num_heads), 0), [batch_dim, 1]),
+        tf.fill([batch_dim, num_heads], i)], axis=-1)
+      beam_paddings = [[0, 0], [0, 0], [0, buf_beam - beam_dim], [0, 0]]
+      # This will reuse the buffer memory if possible, i.e. it usually is an inplace update.
+      k_buf = scatter_update(k_buf, indices=indices, updates=tf.pad(_split_beam(k), beam_paddings))
+      v_buf = scatter_update(v_buf, indices=indices, updates=tf.pad(_split_beam(v), beam_paddings))
+      ptr = tf.concat([prev_ptr, tf.expand_dims(tf.range(n) % beam_dim, axis=1)], axis=1)  # (batch*beam,i+1)
+      self.rec_vars_outputs["k_buf"] = k_buf
+      self.rec_vars_outputs["v_buf"] = v_buf
+      self.rec_vars_outputs["kv_ptr"] = ptr
+      # (batch,1,beam,time,buf-beam). Selects the beam entry of the hyp in each frame. Zero for frames after i.
+      ptr_one_hot = tf.one_hot(tf.reshape(ptr, [batch_dim, beam_dim, i + 1]), depth=buf_beam, dtype=q.dtype)
+      ptr_one_hot = tf.pad(ptr_one_hot, [[0, 0], [0, 0], [0, buf_time - i - 1], [0, 0]])
+      ptr_one_hot = tf.expand_dims(ptr_one_hot, axis=1)
+      # The reshapes of the buffers are without copying.
+      keys = tf.reshape(k_buf, [batch_dim, num_heads, buf_time * buf_beam, key_dim])
+      values = tf.reshape(v_buf, [batch_dim, num_heads, buf_time * buf_beam, value_dim])
+      energy = tf.matmul(_split_beam(q), keys, transpose_b=True)  # (batch,heads,beam,time*buf-beam)
+      energy = tf.reshape(energy, [batch_dim, num_heads, beam_dim, buf_time, buf_beam])
+      energy = tf.reduce_sum(energy * ptr_one_hot, axis=-1, name="energy")  # (batch,heads,beam,time)
+      energy_mask = tf.sequence_mask(i + 1, maxlen=buf_time)  # (time,)
+      energy_mask = tf.logical_and(energy_mask, tf.ones_like(energy, dtype=tf.bool))
+      energy = tf.where(energy_mask, energy, float("-inf") * tf.ones_like(energy), name="energy_masked")
+      weights = tf.nn.softmax(energy)  # (batch,heads,beam,time)
+      if attention_dropout:
+        import TFUtil
+        weights = self.network.cond_on_train(
+          fn_train=lambda: TFUtil.dropout(
+            weights,
+            keep_prob=1 - attention_dropout,
+            seed=self.network.random.randint(2 ** 31)),
+          fn_eval=lambda: weights)
+      weights = tf.reshape(
+        tf.expand_dims(weights, axis=-1) * ptr_one_hot, [batch_dim, num_heads, beam_dim, buf_time * buf_beam])
+      out = tf.matmul(weights, values, name="reduce_att")  # (batch,heads,beam,v-dim//heads)
+      out = tf.transpose(out, [0, 2, 1, 3])  # (batch,beam,heads,v-dim//heads)
+      out = tf.reshape(out, [n, num_heads, 1, value_dim])
+      return out
+
+  @classmethod
+  def get_rec_vars_outputs_beam_independent_keys(cls):
+    """
+    :rtype: set[str]
+    """
+    return {"k_buf", "v_buf"}
+
   @classmethod
   def transform_config_dict(cls, d, network, get_layer):
     """
@@ -5692,6 +6084,8 @@ class SelfAttentionLayer(_ConcatInputLayer):
     super(SelfAttentionLayer, cls).transform_config_dict(d, network=network, get_layer=get_layer)
     if d.get("key_shift", None):
       d["key_shift"] = get_layer(d["key_shift"])
+    if d.get("segment_ids", None):
+      d["segment_ids"] = get_layer(d["segment_ids"])
 
   @classmethod
   def get_out_data_from_opts(cls, n_out, name, sources, **kwargs):
@@ -5726,7 +6120,7 @@ class SelfAttentionLayer(_ConcatInputLayer):
   # noinspection PyMethodOverriding
   @classmethod
   def get_rec_initial_extra_outputs(cls, batch_dim, rec_layer, num_heads, total_key_dim, n_out, name,
-                                    initial_state=None, sources=(), **kwargs):
+                                    initial_state=None, sources=(), preallocated_kv_cache=None, **kwargs):
     """
     :param tf.Tensor batch_dim:
     :param RecLayer|LayerBase rec_layer:
@@ -5736,10 +6130,19 @@ class SelfAttentionLayer(_ConcatInputLayer):
     :param str name:
     :param str|float|int|None initial_state:
     :param list[LayerBase] sources:
+    :param bool|int|None preallocated_kv_cache:
     :rtype: dict[str, tf.Tensor]
     """
     data = get_concat_sources_data_template(sources)
     data = data.copy_as_batch_major()
+    if data.time_dim_axis is None and preallocated_kv_cache:
+      assert initial_state is None
+      num_frames = 32 if preallocated_kv_cache is True else preallocated_kv_cache
+      # (batch,heads,time,beam,dim). The beam dim grows to the beam size in the first step with beam.
+      return {
+        "k_buf": tf.zeros((batch_dim, num_heads, num_frames, 1, total_key_dim // num_heads), name="k_buf"),
+        "v_buf": tf.zeros((batch_dim, num_heads, num_frames, 1, n_out // num_heads), name="v_buf"),
+        "kv_ptr": tf.zeros((batch_dim, 0), dtype=tf.int32, name="kv_ptr")}
     if data.time_dim_axis is None or initial_state is not None:
       kv_dim = total_key_dim + n_out
       # Assume inside RecLayer, or initial_state set explicitly.
@@ -5754,16 +6157,24 @@ class SelfAttentionLayer(_ConcatInputLayer):
     return {}
 
   @classmethod
-  def get_rec_initial_extra_outputs_shape_invariants(cls, num_heads, total_key_dim, n_out, sources, **kwargs):
+  def get_rec_initial_extra_outputs_shape_invariants(cls, num_heads, total_key_dim, n_out, sources,
+                                                    preallocated_kv_cache=None, **kwargs):
     """
     :param int num_heads:
     :param int total_key_dim:
     :param int n_out:
     :param list[LayerBase] sources:
+    :param bool|int|None preallocated_kv_cache:
     :rtype: dict[str, tf.TensorShape]
     """
     data = get_concat_sources_data_template(sources)
     data = data.copy_as_batch_major()
+    if data.time_dim_axis is None and preallocated_kv_cache:
+      total_value_dim = n_out
+      return {
+        "k_buf": tf.TensorShape((None, num_heads, None, None, total_key_dim // num_heads)),
+        "v_buf": tf.TensorShape((None, num_heads, None, None, total_value_dim // num_heads)),
+        "kv_ptr": tf.TensorShape((None, None))}
     if data.time_dim_axis is None:
       # Assume inside RecLayer. See get_rec_initial_extra_outputs.
       total_value_dim = n_out
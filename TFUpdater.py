@@ -187,8 +187,8 @@ class Updater(object):
         lr *= factor
         opts.assert_all_read()
     if self.config.is_true("use_horovod") and self.config.is_true("horovod_scale_lr"):
-      # noinspection PyPackageRequirements,PyUnresolvedReferences
-      import horovod.tensorflow as hvd
+      from TFUtil import get_horovod
+      hvd = get_horovod()
       lr *= hvd.size()
     return lr
 
@@ -200,7 +200,7 @@ class Updater(object):
     """
     assert isinstance(self.loss, tf.Tensor), "no loss defined?"
     assert self.trainable_vars, "no variables to update/optimize"
-    from TFUtil import MetaLosses
+    from TFUtil import MetaLosses, horovod_reductions_in_order
 
     # Keep track of all current available vars.
     # The optimizer could add some, even some which are not so-called "slot-vars",
@@ -222,7 +222,12 @@ class Updater(object):
         use_locking=self.use_locking)
       self.optimizer.create_all_needed_optimizers(trainable_vars_for_gradients)
 
-    with tf.variable_scope("optimize"):
+    # All the gradient reductions (if any, see get_apply_grads_op) are run together with the optim op,
+    # and together with the reductions of the loss fetches, thus they continue that chain.
+    reductions_after = None
+    if self.config.is_true("use_horovod"):
+      _, _, reductions_after = self.network.get_horovod_fetch_reductions()
+    with tf.variable_scope("optimize"), horovod_reductions_in_order(after=reductions_after):
       meta_losses_scope = MetaLosses.enter_gradient_scope()
       apply_grads = self.optimizer.get_apply_grads_op(self.loss, trainable_vars_for_gradients)
       meta_losses_scope.exit()
@@ -863,11 +868,14 @@ class WrapOptimizer:
 
     grads_and_vars = self._compute_gradients(loss, var_list=var_list)
     if self.config.is_true("use_horovod") and self.config.value("horovod_reduce_type", "") == "grad":
-      # noinspection PyPackageRequirements,PyUnresolvedReferences
-      import horovod.tensorflow as hvd
-      grads_and_vars = [
-        (hvd.allreduce(grad, average=self.config.is_true("horovod_avg_grad")) if grad is not None else None, var)
-        for (grad, var) in grads_and_vars]
+      from TFUtil import get_horovod, allreduce_bucketed
+      hvd = get_horovod()
+      average = self.config.is_true("horovod_avg_grad")
+      grads = allreduce_bucketed(
+        [grad for (grad, _) in grads_and_vars],
+        allreduce_func=lambda x: hvd.allreduce(x, average=average),
+        max_bucket_bytes=self.config.int("horovod_bucket_size", None))
+      grads_and_vars = [(grad, var) for (grad, (_, var)) in zip(grads, grads_and_vars)]
 
     var_grads = {var: grad for (grad, var) in grads_and_vars if grad is not None}
     if not var_grads:
@@ -2499,6 +2499,34 @@ class Data(object):
 _horovod_is_initialized = False
 
 
+def get_horovod():
+  """
+  :return: the Horovod TF module (``horovod.tensorflow``),
+    or :mod:`TFLocalDataParallel` in a worker process of the local data-parallel training,
+    which provides the same API for what we use
+  """
+  import TFLocalDataParallel
+  if TFLocalDataParallel.is_worker_process():
+    return TFLocalDataParallel
+  # noinspection PyUnresolvedReferences,PyPackageRequirements
+  import horovod.tensorflow as hvd
+  return hvd
+
+
+def horovod_reductions_in_order(after=None):
+  """
+  :param tf.Tensor|tf.Operation|None after: continue the chain which ends with this reduction
+  :return: context manager. The Horovod reductions (e.g. ``hvd.allreduce``) created within it
+    are executed in the order of creation. This is needed for :mod:`TFLocalDataParallel`,
+    see :func:`TFLocalDataParallel.reductions_in_order`. Horovod itself does not need it.
+  """
+  import TFLocalDataParallel
+  if TFLocalDataParallel.is_worker_process():
+    return TFLocalDataParallel.reductions_in_order(after=after)
+  from Util import dummy_noop_ctx
+  return dummy_noop_ctx()
+
+
 def init_horovod():
   """
   Initializes Horovod.
@@ -2508,8 +2536,7 @@ def init_horovod():
   if _horovod_is_initialized:
     return
   import socket
-  # noinspection PyUnresolvedReferences,PyPackageRequirements
-  import horovod.tensorflow as hvd
+  hvd = get_horovod()
   hvd.init()
   print(
     "Horovod initialized. Hostname %s, pid %i, rank %i / size %i, local rank %i / local size %i." % (
@@ -2517,6 +2544,62 @@ def init_horovod():
   _horovod_is_initialized = True
 
 
+def allreduce_bucketed(tensors, allreduce_func, max_bucket_bytes=None):
+  """
+  Fusion of many small allreduce ops (e.g. ``hvd.allreduce``) into fewer large ones.
+  The tensors are grouped into buckets of up to max_bucket_bytes, in the order they were created
+  (for gradients, this is the order in which backprop computes them, i.e. reverse-topological order
+  w.r.t. the forward graph), such that the allreduce of the first buckets can overlap with the remaining backprop.
+  Each bucket is flattened and concatenated, reduced at once, and split back.
+  Sparse tensors (tf.IndexedSlices) and tensors with unknown shape are reduced individually.
+
+  :param list[tf.Tensor|tf.IndexedSlices|None] tensors:
+  :param (tf.Tensor|tf.IndexedSlices)->(tf.Tensor|tf.IndexedSlices) allreduce_func: e.g. ``hvd.allreduce``
+  :param int|None max_bucket_bytes: 32MB by default. 0 means one allreduce per tensor
+  :return: reduced tensors, same order as tensors. None entries stay None
+  :rtype: list[tf.Tensor|tf.IndexedSlices|None]
+  """
+  if max_bucket_bytes is None:
+    max_bucket_bytes = 32 * 1024 * 1024
+  res = [None] * len(tensors)  # type: typing.List[typing.Union[tf.Tensor,tf.IndexedSlices,None]]
+  op_idx = {op: i for (i, op) in enumerate(tf.get_default_graph().get_operations())}
+  buckets = {}  # dtype -> list of idx
+  bucket_bytes = {}  # dtype -> int
+
+  def _flush(dtype):
+    """
+    :param tf.DType dtype:
+    """
+    bucket = buckets.pop(dtype, [])
+    bucket_bytes.pop(dtype, None)
+    if len(bucket) == 1:
+      res[bucket[0]] = allreduce_func(tensors[bucket[0]])
+    elif len(bucket) > 1:
+      shapes = [tensors[i].get_shape() for i in bucket]
+      flat = tf.concat([tf.reshape(tensors[i], [-1]) for i in bucket], axis=0)
+      reduced = allreduce_func(flat)
+      parts = tf.split(reduced, [shape.num_elements() for shape in shapes])
+      for i, part, shape in zip(bucket, parts, shapes):
+        res[i] = tf.reshape(part, shape)
+
+  # All the buckets are reduced together, thus in a fixed order.
+  with tf.name_scope("allreduce_bucketed"), horovod_reductions_in_order():
+    for i in sorted(
+          [i for (i, x) in enumerate(tensors) if x is not None], key=lambda i: op_idx.get(tensors[i].op, -1)):
+      x = tensors[i]
+      if not max_bucket_bytes or isinstance(x, tf.IndexedSlices) or not x.get_shape().is_fully_defined():
+        res[i] = allreduce_func(x)
+        continue
+      num_bytes = x.get_shape().num_elements() * x.dtype.size
+      if buckets.get(x.dtype) and bucket_bytes[x.dtype] + num_bytes > max_bucket_bytes:
+        _flush(x.dtype)
+      buckets.setdefault(x.dtype, []).append(i)
+      bucket_bytes[x.dtype] = bucket_bytes.get(x.dtype, 0) + num_bytes
+    for dtype in list(buckets.keys()):
+      _flush(dtype)
+  return res
+
+
 class CustomUpdate(object):
   """
   Custom updates will be handled by :class:`TFUpdater`.
@@ -8196,6 +8279,65 @@ def select_src_beams(x, src_beams, name="select_src_beams"):
     return x
 
 
+def gather_batch_entries(x, batch_idx, batch_dim, axis=0, name="gather_batch_entries"):
+  """
+  Selects some of the batch entries, where each batch entry can have a beam.
+  Also see :func:`scatter_batch_entries`.
+
+  :param tf.Tensor x: (..., batch * beam, ...), where the batch dim is in axis
+  :param tf.Tensor batch_idx: (n,) -> batch idx, int32
+  :param tf.Tensor|int batch_dim:
+  :param int axis:
+  :return: (..., n * beam, ...)
+  :rtype: tf.Tensor
+  """
+  with tf.name_scope(name):
+    x_tshape = x.get_shape()
+    x = move_axis(x, old_axis=axis, new_axis=0)
+    x_shape = get_shape(x)
+    beam_dim = x_shape[0] // batch_dim
+    x = tf.reshape(x, [batch_dim, beam_dim] + x_shape[1:])  # (batch, beam, ...)
+    x = tf.gather(x, batch_idx)  # (n, beam, ...)
+    x = tf.reshape(x, [tf.shape(batch_idx)[0] * beam_dim] + x_shape[1:])  # (n * beam, ...)
+    x = move_axis(x, old_axis=0, new_axis=axis)
+    x.set_shape(tf.TensorShape([None if i == axis else d for (i, d) in enumerate(x_tshape.as_list())]))
+    return x
+
+
+def scatter_batch_entries(x, batch_idx, batch_dim, default=None, axis=0, name="scatter_batch_entries"):
+  """
+  The inverse of :func:`gather_batch_entries`.
+  The batch entries which are not in batch_idx are taken from default.
+
+  :param tf.Tensor x: (..., n * beam, ...), where the batch dim is in axis
+  :param tf.Tensor batch_idx: (n,) -> batch idx, int32, sorted, like from :func:`tf.where`
+  :param tf.Tensor|int batch_dim:
+  :param tf.Tensor|None default: (..., batch * beam, ...). zeros if None
+  :param int axis:
+  :return: (..., batch * beam, ...)
+  :rtype: tf.Tensor
+  """
+  with tf.name_scope(name):
+    x_tshape = x.get_shape()
+    x = move_axis(x, old_axis=axis, new_axis=0)
+    x_shape = get_shape(x)
+    beam_dim = x_shape[0] // tf.maximum(tf.shape(batch_idx)[0], 1)
+    x = tf.reshape(x, [tf.shape(batch_idx)[0], -1])  # (n, beam * ...)
+    # For every batch entry, the position in x, if it is in batch_idx.
+    mask = tf.reduce_any(tf.equal(tf.expand_dims(tf.range(batch_dim), 1), tf.expand_dims(batch_idx, 0)), axis=1)
+    pos = tf.maximum(tf.cumsum(tf.cast(mask, tf.int32)) - 1, 0)  # (batch,)
+    x = tf.gather(x, pos)  # (batch, beam * ...)
+    if default is None:
+      default = tf.zeros_like(x)
+    else:
+      default = tf.reshape(move_axis(default, old_axis=axis, new_axis=0), [batch_dim, -1])
+    x = tf.where(mask, x, default)  # (batch, beam * ...)
+    x = tf.reshape(x, [batch_dim * beam_dim] + x_shape[1:])
+    x = move_axis(x, old_axis=0, new_axis=axis)
+    x.set_shape(tf.TensorShape([None if i == axis else d for (i, d) in enumerate(x_tshape.as_list())]))
+    return x
+
+
 def filter_ended_scores(x, end_flags, batch_dim=None, dim=None, score_zero=0.0, score_rem=-1.e30):
   """
   This can e.g. used before tf.nn.top_k to let only one beam through for an ended hypothesis.
@@ -603,6 +603,7 @@ SharedMemNumpyConfig = {
   "auto_pickling_min_size": 8 * 1024 * 1024,  # 8MB
   "min_shared_mem_size": 32 * 1024 * 1024,  # 32MB
   "max_server_instances": 10,
+  "fallback_on_exception": True,  # if False, Pickler.save_ndarray raises, instead of pickling the data itself
 }
 
 def use_shared_mem_for_numpy_array(obj):
@@ -776,6 +777,8 @@ class Pickler(_BasePickler):
       try:
         shared = SharedNumpyArray.as_shared(obj)
       except SharedMem.ShmException as e:
+        if not SharedMemNumpyConfig["fallback_on_exception"]:
+          raise
         print("SharedNumpyArray exception: %s" % e)
         # fallback to default
       else:
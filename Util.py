@@ -1048,7 +1048,7 @@ def init_thread_join_hack():
       # them for delayed handling to the main thread which hangs.
       # See CPython signalmodule.c.
       # Currently the best solution I can think of:
-      while thread_obj.isAlive():
+      while thread_obj.is_alive():
         join_orig(thread_obj, timeout=0.1)
     elif thread.get_ident() == main_thread_id and timeout > 0.1:
       # Limit the timeout. This should not matter for the underlying code.
@@ -3061,6 +3061,9 @@ class NativeCodeCompiler(object):
 
   CacheDirName = "returnn_native"
   CollectedCompilers = None  # type: None|typing.List[NativeCodeCompiler]
+  # Prebuilt libs, e.g. via tools/compile_native_op.py, with the same layout as get_temp_dir().
+  # It is only read from, and it is checked before the own cache dir. See :func:`_maybe_use_shared_cache`.
+  SharedCacheDir = os.environ.get("RETURNN_NATIVE_SHARED_CACHE_DIR", None)  # type: typing.Optional[str]
 
   def __init__(self, base_name, code_version, code,
                is_cpp=True, c_macro_defines=None, ld_flags=None,
@@ -3088,6 +3091,7 @@ class NativeCodeCompiler(object):
       self.CollectedCompilers.append(self)
     self.verbose = verbose
     self.cache_dir = "%s/%s" % (get_temp_dir(), self.CacheDirName)
+    self._own_cache_dir = self.cache_dir
     self._include_paths = list(include_paths)
     self.base_name = base_name
     self.code_version = code_version
@@ -3243,10 +3247,29 @@ class NativeCodeCompiler(object):
     # But I think this is overkill.
     return False
 
+  def _maybe_use_shared_cache(self):
+    """
+    If there is an up-to-date lib in the shared cache dir (:class:`SharedCacheDir`), switch our cache dir to it.
+
+    :return: whether we use the shared cache
+    :rtype: bool
+    """
+    if not self.SharedCacheDir:
+      return False
+    self.cache_dir = "%s/%s" % (self.SharedCacheDir, self.CacheDirName)
+    if not self._need_recompile():
+      return True
+    self.cache_dir = self._own_cache_dir
+    return False
+
   def _maybe_compile(self):
     """
     On successful return, self._so_filename should exist and be up-to-date.
     """
+    if self._maybe_use_shared_cache():
+      if self.verbose:
+        print("%s: Use prebuilt from shared cache: %s" % (self.__class__.__name__, self._so_filename))
+      return
     if not self._need_recompile():
       if self.verbose:
         print("%s: No need to recompile: %s" % (self.__class__.__name__, self._so_filename))
@@ -4,6 +4,8 @@
 This is intended to test a compiled TF graph which was compiled via `compile_tf_graph.py`
 with the option `--rec_step_by_step`.
 This is just for demonstration, testing and debugging purpose. The search itself is performed in pure Python.
+For a real decoding runtime (batched, with continuous batching), see :mod:`TFCompiledGraphDecoder`
+and ``tools/decode-compiled-graph.py``.
 """
 
 # No RETURNN dependency needed for the basic search. Just TF itself.
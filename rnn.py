@@ -321,6 +321,10 @@ def init_backend_engine():
   Initializes ``engine``, which is either :class:`TFEngine.Engine` or Theano :class:`Engine.Engine`.
   """
   BackendEngine.select_engine(config=config)
+  if config.value("native_shared_cache_dir", None):
+    # Prebuilt native ops, see tools/compile_native_op.py.
+    from Util import NativeCodeCompiler
+    NativeCodeCompiler.SharedCacheDir = config.value("native_shared_cache_dir", None)
   if BackendEngine.is_theano_selected():
     print("Theano:", describe_theano_version(), file=log.v3)
     import TheanoUtil
@@ -335,9 +339,8 @@ def init_backend_engine():
       config.set("device", os.environ.get("TF_DEVICE"))
     if config.is_true("use_horovod"):
       import socket
-      # noinspection PyPackageRequirements,PyUnresolvedReferences
-      import horovod.tensorflow as hvd
-      from TFUtil import init_horovod
+      from TFUtil import get_horovod, init_horovod
+      hvd = get_horovod()
       init_horovod()  # make sure it is initialized
       if "gpu" in config.value("device", "") or os.environ.get("CUDA_VISIBLE_DEVICES", ""):
         # We assume that we want to use a GPU.
@@ -379,6 +382,19 @@ def init(config_filename=None, command_line_options=(), config_updates=None, ext
   init_better_exchook()
   init_thread_join_hack()
   init_config(config_filename=config_filename, command_line_options=command_line_options, extra_updates=config_updates)
+  if config.int("local_data_parallel", 0) > 1:
+    import TFLocalDataParallel
+    if TFLocalDataParallel.is_worker_process():
+      # The workers behave like Horovod ranks.
+      config.set("use_horovod", True)
+    else:
+      assert not config.is_true("use_horovod"), "local_data_parallel cannot be combined with use_horovod"
+      assert not config_updates, "local_data_parallel: config_updates cannot be passed to the workers"
+      args = [sys.executable, os.path.abspath(__file__)]
+      if config_filename:
+        args.append(config_filename)
+      args += list(command_line_options or [])
+      sys.exit(TFLocalDataParallel.run_workers(num_workers=config.int("local_data_parallel", 0), args=args))
   if config.bool("patch_atfork", False):
     from Util import maybe_restart_returnn_with_atfork_patch
     maybe_restart_returnn_with_atfork_patch()
@@ -534,7 +550,10 @@ def execute_main_task():
   elif task == "hyper_param_tuning":
     import HyperParamTuning
     tuner = HyperParamTuning.Optimization(config=config, train_data=train_data)
-    tuner.work()
+    if config.has("hyper_param_tuning_individual"):  # we are a subprocess of the tuner
+      tuner.run_individual_from_file(config.value("hyper_param_tuning_individual", None))
+    else:
+      tuner.work()
   elif task == "cleanup_old_models":
     engine.cleanup_old_models(ask_for_confirmation=True)
   elif task == "daemon":
@@ -547,6 +566,10 @@ def execute_main_task():
     engine.use_search_flag = True
     engine.init_network_from_config(config)
     engine.web_server(port=config.int("web_server_port", 12380))
+  elif task == "search_inference_server":
+    engine.use_search_flag = True
+    engine.init_network_from_config(config)
+    engine.inference_server(port=config.int("web_server_port", 12380))
   elif task.startswith("config:"):
     action = config.typed_dict[task[len("config:"):]]
     print("Task: %r" % action, file=log.v1)
@@ -326,6 +326,223 @@ def test_task12ax_window():
   assert_equal(list(data2a[-1, 2]), [0] * input_dim)  # zero-padded right
 
 
+def _get_batches_as_list(dataset, **kwargs):
+  """
+  :param Dataset.Dataset dataset:
+  :return: per batch: (max_num_frames_per_slice, num_slices, list of (seq_idx, seq_start_frame, seq_end_frame, slice))
+  :rtype: list
+  """
+  batch_gen = dataset.generate_batches(**kwargs)
+  res = []
+  while batch_gen.has_more():
+    batch, = batch_gen.peek_next_n(1)
+    res.append((
+      batch.max_num_frames_per_slice, batch.num_slices,
+      [(s.seq_idx, s.seq_start_frame, s.seq_end_frame, s.batch_slice, s.batch_frame_offset) for s in batch.seqs]))
+    batch_gen.advance(1)
+  return res
+
+
+def test_generate_batches_from_seq_lengths_same_as_generic():
+  from GeneratingDataset import StaticDataset
+  from Util import OptionalNotImplementedError
+  rnd = np.random.RandomState(42)
+  data = []
+  for _ in range(200):
+    seq_len = rnd.randint(1, 30)
+    data.append({
+      "data": rnd.normal(size=(seq_len, 3)).astype("float32"),
+      "classes": rnd.randint(0, 5, size=(rnd.randint(1, 10),)).astype("int32")})
+
+  def get_all_seq_lengths():
+    raise OptionalNotImplementedError
+
+  for kwargs in [
+        dict(batch_size=50),
+        dict(batch_size=100, max_seqs=7),
+        dict(batch_size={"data": 100, "classes": 30}, max_seqs=10),
+        dict(batch_size=200, max_pad_size=20),
+        dict(batch_size=200, max_seq_length=20, min_seq_length=3),
+        dict(batch_size=200, max_seq_length=-5, seq_drop=0.3),
+        dict(batch_size=10, max_total_num_seqs=50)]:
+    print("kwargs:", kwargs)
+    dataset = StaticDataset(data=data, output_dim={"data": (3, 2), "classes": (5, 1)})
+    dataset.init_seq_order(epoch=1)
+    batches = _get_batches_as_list(dataset, recurrent_net=True, **kwargs)
+    dataset = StaticDataset(data=data, output_dim={"data": (3, 2), "classes": (5, 1)})
+    dataset.get_all_seq_lengths = get_all_seq_lengths
+    dataset.init_seq_order(epoch=1)
+    batches_generic = _get_batches_as_list(dataset, recurrent_net=True, **kwargs)
+    assert len(batches) > 1
+    assert_equal(batches, batches_generic)
+
+
+def test_generate_batches_sort_window():
+  from GeneratingDataset import StaticDataset
+  from Util import OptionalNotImplementedError
+  rnd = np.random.RandomState(42)
+  data = []
+  for _ in range(100):
+    seq_len = rnd.randint(1, 30)
+    data.append({
+      "data": rnd.normal(size=(seq_len, 3)).astype("float32"),
+      "classes": rnd.randint(0, 5, size=(rnd.randint(1, 10),)).astype("int32")})
+
+  def get_all_seq_lengths():
+    raise OptionalNotImplementedError
+
+  def get_num_padded_frames(batches):
+    return sum([max_num_frames["data"] * num_slices for (max_num_frames, num_slices, _) in batches])
+
+  kwargs = dict(recurrent_net=True, batch_size=60, max_seqs=10)
+  dataset = StaticDataset(data=data, output_dim={"data": (3, 2), "classes": (5, 1)})
+  dataset.init_seq_order(epoch=1)
+  batches_unsorted = _get_batches_as_list(dataset, **kwargs)
+  dataset.init_seq_order(epoch=1)
+  batches = _get_batches_as_list(dataset, sort_window=20, **kwargs)
+  dataset = StaticDataset(data=data, output_dim={"data": (3, 2), "classes": (5, 1)})
+  dataset.get_all_seq_lengths = get_all_seq_lengths
+  dataset.init_seq_order(epoch=1)
+  batches_generic = _get_batches_as_list(dataset, sort_window=20, **kwargs)
+  assert_equal(batches, batches_generic)
+  seq_idxs = [[s[0] for s in seqs] for (_, _, seqs) in batches]
+  assert_equal(sorted(sum(seq_idxs, [])), list(range(len(data))))
+  start_seqs = [min(s) for s in seq_idxs]
+  assert_equal(start_seqs, sorted(start_seqs))  # monotonic load_seqs
+  for s in seq_idxs:
+    assert_equal(min(s) // 20, max(s) // 20)  # all within one window
+    assert len(s) <= 10
+  print("padded frames:", get_num_padded_frames(batches), "unsorted:", get_num_padded_frames(batches_unsorted))
+  assert get_num_padded_frames(batches) < get_num_padded_frames(batches_unsorted)
+
+
+def test_generate_batches_seq_packing():
+  from GeneratingDataset import StaticDataset
+  rnd = np.random.RandomState(42)
+  data = []
+  for _ in range(100):
+    seq_len = rnd.randint(1, 30)
+    data.append({
+      "data": rnd.normal(size=(seq_len, 3)).astype("float32"),
+      "classes": rnd.randint(0, 5, size=(rnd.randint(1, 10),)).astype("int32")})
+
+  def get_num_padded_frames(batches):
+    return sum([max_num_frames["data"] * num_slices for (max_num_frames, num_slices, _) in batches])
+
+  kwargs = dict(batch_size=120, max_seqs=20)
+  dataset = StaticDataset(data=data, output_dim={"data": (3, 2), "classes": (5, 1)})
+  dataset.init_seq_order(epoch=1)
+  batches_unpacked = _get_batches_as_list(dataset, recurrent_net=True, **kwargs)
+  dataset.init_seq_order(epoch=1)
+  # Ignored for a recurrent net.
+  assert_equal(_get_batches_as_list(dataset, recurrent_net=True, seq_packing=40, **kwargs), batches_unpacked)
+  dataset.init_seq_order(epoch=1)
+  batches = _get_batches_as_list(dataset, recurrent_net=False, seq_packing=40, **kwargs)
+  seq_idxs = [[s[0] for s in seqs] for (_, _, seqs) in batches]
+  assert_equal(sum(seq_idxs, []), list(range(len(data))))
+  for max_num_frames, num_slices, seqs in batches:
+    assert max_num_frames["data"] * num_slices <= 120
+    assert len(seqs) <= 20
+    assert num_slices < len(seqs)  # some seqs are packed together
+    for key in ["data", "classes"]:
+      slice_num_frames = [0] * num_slices
+      for seq_idx, start, end, batch_slice, offset in seqs:
+        # Each key is packed on its own, directly after the previous seq in the slice.
+        assert_equal(offset[key], slice_num_frames[batch_slice])
+        assert_equal(end[key] - start[key], data[seq_idx][key].shape[0])
+        slice_num_frames[batch_slice] += end[key] - start[key]
+      assert max(slice_num_frames) <= 40
+      assert_equal(max(slice_num_frames), max_num_frames[key])
+  print("padded frames:", get_num_padded_frames(batches), "unpacked:", get_num_padded_frames(batches_unpacked))
+  assert get_num_padded_frames(batches) < get_num_padded_frames(batches_unpacked)
+
+
+def test_MultiProcDataset_same_as_sub_dataset():
+  from Dataset import init_dataset
+  from MetaDataset import MultiProcDataset
+  rnd = np.random.RandomState(42)
+  data = []
+  for _ in range(23):
+    seq_len = rnd.randint(1, 30)
+    data.append({
+      "data": rnd.normal(size=(seq_len, 3)).astype("float32"),
+      "classes": rnd.randint(0, 5, size=(rnd.randint(1, 10),)).astype("int32")})
+  sub_dataset_opts = {
+    "class": "StaticDataset", "data": data, "output_dim": {"data": (3, 2), "classes": (5, 1)},
+    "seq_ordering": "random"}
+  sub_dataset = init_dataset(sub_dataset_opts)
+  dataset = MultiProcDataset(dataset=sub_dataset_opts, num_workers=3, buffer_size=2)
+  assert_equal(dataset.num_inputs, 3)
+  assert_equal(dataset.num_outputs, sub_dataset.num_outputs)
+  assert_equal(sorted(dataset.get_data_keys()), ["classes", "data"])
+  assert_equal(dataset.get_data_dtype("classes"), "int32")
+  for epoch in [1, 2, 1]:
+    sub_dataset.init_seq_order(epoch=epoch)
+    dataset.init_seq_order(epoch=epoch)
+    seq_idx = 0
+    while sub_dataset.is_less_than_num_seqs(seq_idx):
+      assert dataset.is_less_than_num_seqs(seq_idx)
+      sub_dataset.load_seqs(seq_idx, seq_idx + 1)
+      dataset.load_seqs(seq_idx, seq_idx + 1)
+      assert_equal(dataset.get_tag(seq_idx), sub_dataset.get_tag(seq_idx))
+      for key in ["data", "classes"]:
+        np.testing.assert_array_equal(dataset.get_data(seq_idx, key), sub_dataset.get_data(seq_idx, key))
+      seq_idx += 1
+    assert not dataset.is_less_than_num_seqs(seq_idx)
+    assert_equal(seq_idx, len(data))
+
+
+def test_CachedDataset2_read_ahead():
+  from CachedDataset2 import CachedDataset2
+  from Dataset import DatasetSeq
+  import threading
+
+  class _Dataset(CachedDataset2):
+    def __init__(self, num_seqs, **kwargs):
+      super(_Dataset, self).__init__(**kwargs)
+      self.num_inputs = 2
+      self.num_outputs = {"data": (2, 2)}
+      self.total_num_seqs = num_seqs
+      self.collected_seq_idxs = []
+      self.collect_threads = set()
+
+    def init_seq_order(self, epoch=None, seq_list=None):
+      super(_Dataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
+      self.collected_seq_idxs = []
+      return True
+
+    def _collect_single_seq(self, seq_idx):
+      self.collected_seq_idxs.append(seq_idx)
+      self.collect_threads.add(threading.current_thread())
+      if seq_idx >= self.total_num_seqs:
+        return None
+      return DatasetSeq(seq_idx=seq_idx, features=np.full((seq_idx % 3 + 1, 2), seq_idx + self.epoch, "float32"))
+
+  dataset = _Dataset(num_seqs=11, read_ahead={"num_seqs": 4, "max_bytes": 40})
+  assert dataset.get_read_ahead_stats()["num_gets"] == 0
+  ref_dataset = _Dataset(num_seqs=11)
+  for epoch in [1, 2]:
+    dataset.init_seq_order(epoch=epoch)
+    ref_dataset.init_seq_order(epoch=epoch)
+    seq_idx = 0
+    while ref_dataset.is_less_than_num_seqs(seq_idx):
+      assert dataset.is_less_than_num_seqs(seq_idx)
+      dataset.load_seqs(seq_idx, seq_idx + 2)
+      ref_dataset.load_seqs(seq_idx, seq_idx + 2)
+      np.testing.assert_array_equal(dataset.get_data(seq_idx, "data"), ref_dataset.get_data(seq_idx, "data"))
+      seq_idx += 1
+    assert not dataset.is_less_than_num_seqs(seq_idx)
+    assert_equal(seq_idx, 11)
+    stats = dataset.get_read_ahead_stats()
+    print("epoch %i read ahead stats:" % epoch, stats)
+    assert stats["num_gets"] >= 11
+    assert stats["max_buffer_bytes"] <= 40 + 3 * 2 * 4
+    assert_equal(dataset.collected_seq_idxs, list(range(12)))
+    assert threading.current_thread() not in dataset.collect_threads
+  dataset.finish_epoch()
+  assert_equal(dataset.get_read_ahead_stats()["num_gets"], 0)
+
+
 if __name__ == "__main__":
   better_exchook.install()
   if len(sys.argv) <= 1:
@@ -144,6 +144,151 @@ def test_BytePairEncoding_unicode():
     u"råt råt iz ďër iz ďër ám à@@ n iz ďër ë låk ë k@@ o@@ d áv d@@ r@@ e@@ s w@@ ër yù w@@ ê@@ k dù ďë à@@ s@@ k")
 
 
+def test_BytePairEncoding_word_cache():
+  bpe = BytePairEncoding(
+    bpe_file="%s/bpe-unicode-demo.codes" % my_dir,
+    vocab_file="%s/bpe-unicode-demo.vocab" % my_dir,
+    unknown_label="<unk>", seq_postfix=[0], cache_size=3)
+  sentences = [u"råt iz ďër", u"", u"kod kod dres àsk", u"råt àn"]
+  seqs = [bpe.get_seq(sentence) for sentence in sentences]
+  assert_equal(len(bpe._bpe_encode_cache), 3)
+  assert_equal(list(bpe._bpe_encode_cache.keys()), [u"àsk", u"råt", u"àn"])
+  assert_equal(seqs[1], [0])
+  assert_equal(seqs, [bpe.get_seq(sentence) for sentence in sentences])  # same with cache hits
+
+
+def test_BytePairEncoding_get_seqs():
+  bpe = BytePairEncoding(
+    bpe_file="%s/bpe-unicode-demo.codes" % my_dir,
+    vocab_file="%s/bpe-unicode-demo.vocab" % my_dir,
+    unknown_label="<unk>", seq_postfix=[0], cache_size=3)
+  sentences = [u"råt iz ďër", u"", u"kod kod dres àsk", u"råt àn"]
+  labels, offsets = bpe.get_seqs(sentences)
+  seqs = [bpe.get_seq(sentence) for sentence in sentences]
+  assert_equal(labels.dtype, numpy.int32)
+  assert_equal(offsets.dtype, numpy.int64)
+  assert_equal(offsets.shape, (len(sentences) + 1,))
+  assert_equal(offsets.tolist(), [0] + numpy.cumsum([len(seq) for seq in seqs]).tolist())
+  assert_equal([labels[offsets[i]:offsets[i + 1]].tolist() for i in range(len(sentences))], seqs)
+
+
+def test_ExtractAudioFeatures_batch_same_as_single():
+  try:
+    # noinspection PyPackageRequirements
+    import librosa
+  except ImportError:
+    raise unittest.SkipTest("librosa not installed")
+  rnd = numpy.random.RandomState(42)
+  audios = [rnd.uniform(-1., 1., size=(audio_len,)) for audio_len in [1500, 3000, 16000, 16011]]
+  for opts in [
+        {"features": "mfcc"},
+        {"features": "mfcc", "num_feature_filters": 13, "with_delta": 2},
+        {"features": "log_mel_filterbank"},
+        {"features": "log_log_mel_filterbank"},
+        {"features": "log_mel_filterbank", "with_delta": True, "norm_mean": 0.5},
+        {"features": "db_mel_filterbank", "feature_options": {"fmin": 60}},
+        {"features": "linear_spectrogram", "num_feature_filters": 256},
+        {"features": "raw"}]:
+    print("opts:", opts)
+    extractor = ExtractAudioFeatures(**opts)
+    single = [extractor.get_audio_features(audio=audio.copy(), sample_rate=16000) for audio in audios]
+    batch = extractor.get_audio_features_batch(audios=[audio.copy() for audio in audios], sample_rate=16000)
+    assert_equal(len(single), len(batch))
+    for a, b in zip(single, batch):
+      assert_equal(a.shape, b.shape)
+      assert_equal(a.dtype, b.dtype)
+      numpy.testing.assert_allclose(a, b, rtol=1e-3, atol=1e-3)
+
+
+def test_FeatureCacheFile():
+  import tempfile
+  import shutil
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    fn = "%s/features.cache" % tmp_dir
+    rnd = numpy.random.RandomState(42)
+    values = [rnd.normal(size=(rnd.randint(1, 20), 3)).astype("float32") for _ in range(10)]
+    keys = [FeatureCacheFile.make_key("seq-%i" % i) for i in range(len(values))]
+    cache = FeatureCacheFile(fn)
+    assert cache.get(keys[0]) is None
+    for key, value in zip(keys, values):
+      cache.add(key, value)
+    cache2 = FeatureCacheFile(fn)  # e.g. another process, or the next run
+    for key, value in zip(keys, values):
+      numpy.testing.assert_array_equal(cache.get(key), value)
+      numpy.testing.assert_array_equal(cache2.get(key), value)
+    # Incomplete last record, e.g. the writer was killed.
+    with open(fn, "ab") as f:
+      f.write(b"FEAT" + b"\0" * 10)
+    cache3 = FeatureCacheFile(fn)
+    assert_equal(len(cache3._index), len(values))
+    new_key = FeatureCacheFile.make_key("new")
+    cache3.add(new_key, values[0])
+    numpy.testing.assert_array_equal(cache2.get(new_key), values[0])
+    # Eviction.
+    max_size = 1000
+    small_cache = FeatureCacheFile("%s/small.cache" % tmp_dir, max_size=max_size)
+    for key, value in zip(keys, values):
+      small_cache.add(key, value)
+      numpy.testing.assert_array_equal(small_cache.get(keys[0]), values[0])  # always used, thus kept
+      assert os.path.getsize(small_cache.filename) <= max_size
+    numpy.testing.assert_array_equal(small_cache.get(keys[-1]), values[-1])
+    assert 1 < len(small_cache._index) < len(values)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def _custom_audio_features(audio, sample_rate, **kwargs):
+  return numpy.zeros((len(audio) // 160, 1), dtype="float32")
+
+
+def test_ExtractAudioFeatures_get_cache_hash_callable():
+  import types
+  h1 = ExtractAudioFeatures(features=_custom_audio_features).get_cache_hash()
+  assert h1
+  # Same function, but another object (at another address), like in the next run.
+  func_copy = types.FunctionType(
+    _custom_audio_features.__code__, _custom_audio_features.__globals__, _custom_audio_features.__name__)
+  assert func_copy is not _custom_audio_features
+  assert_equal(ExtractAudioFeatures(features=func_copy).get_cache_hash(), h1)
+  assert ExtractAudioFeatures(features="mfcc").get_cache_hash() != h1
+
+
+def test_OggZipDataset_feature_cache():
+  try:
+    # noinspection PyPackageRequirements
+    import soundfile
+  except ImportError:
+    raise unittest.SkipTest("soundfile not installed")
+  import tempfile
+  import shutil
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    os.mkdir("%s/corpus" % tmp_dir)
+    rnd = numpy.random.RandomState(42)
+    entries = []
+    for i in range(3):
+      audio = rnd.uniform(-0.5, 0.5, size=(1000 + i * 100,))
+      soundfile.write("%s/corpus/seq%i.wav" % (tmp_dir, i), audio, 16000)
+      entries.append({"file": "seq%i.wav" % i, "text": "hello", "duration": len(audio) / 16000.})
+    with open("%s/corpus.txt" % tmp_dir, "w") as f:
+      f.write(repr(entries))
+    features = []
+    for _ in range(2):
+      dataset = OggZipDataset(
+        path="%s/corpus" % tmp_dir, audio={"features": "raw"}, targets=None,
+        feature_cache="%s/features.cache" % tmp_dir)
+      dataset.init_seq_order(epoch=1)
+      dataset.load_seqs(0, 3)
+      features.append([dataset.get_data(seq_idx, "data") for seq_idx in range(3)])
+    assert_equal(dataset.feature_cache.num_hits, 3)
+    assert_equal(dataset.feature_cache.num_misses, 0)
+    for a, b in zip(features[0], features[1]):
+      numpy.testing.assert_array_equal(a, b)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
 if __name__ == "__main__":
   better_exchook.install()
   if len(sys.argv) <= 1:
@@ -362,6 +362,52 @@ def test_read_simple_hdf():
   assert reader.data_dtype["data"] == "float32"
 
 
+def test_SimpleHDFWriter_resume_partial_background():
+  fn = get_test_tmp_file(suffix=".hdf")
+  os.remove(fn)  # SimpleHDFWriter expects that the file does not exist
+  n_dim = 3
+  rnd = numpy.random.RandomState(42)
+  seq_lens = [7, 2, 5, 3, 1200, 4]
+  seqs = [rnd.normal(size=(seq_len, n_dim)).astype("float32") for seq_len in seq_lens]
+  seq_tags = ["seq-%i" % i for i in range(len(seq_lens))]
+
+  def insert_batch(writer_, seq_idxs):
+    """
+    :param SimpleHDFWriter|BackgroundHDFWriter writer_:
+    :param list[int] seq_idxs:
+    """
+    inputs = numpy.zeros((len(seq_idxs), max([seq_lens[i] for i in seq_idxs]), n_dim), dtype="float32")
+    for j, i in enumerate(seq_idxs):
+      inputs[j, :seq_lens[i]] = seqs[i]
+    writer_.insert_batch(
+      inputs=inputs, seq_len=[seq_lens[i] for i in seq_idxs], seq_tag=[seq_tags[i] for i in seq_idxs])
+
+  writer = SimpleHDFWriter(filename=fn, dim=n_dim, resume_partial=True)
+  insert_batch(writer, [0, 1])
+  insert_batch(writer, [2])
+  # Simulate a crash in the middle of the next batch.
+  writer._insert_h5_inputs(seqs[3])
+  del writer
+  assert not os.path.exists(fn)
+  assert os.path.exists(fn + ".partial")
+
+  writer = SimpleHDFWriter(filename=fn, dim=n_dim, resume_partial=True)
+  assert_equal(writer.get_seq_tags(), seq_tags[:3])
+  writer = BackgroundHDFWriter(writer, max_queue_size=1)
+  insert_batch(writer, [3, 4])
+  insert_batch(writer, [5])
+  writer.close()
+  assert not os.path.exists(fn + ".partial")
+
+  dataset = HDFDataset(files=[fn])
+  reader = DatasetTestReader(dataset=dataset)
+  reader.read_all()
+  assert_equal(reader.seq_tags, seq_tags)
+  for i, seq in enumerate(seqs):
+    assert_equal(reader.seq_lens[i]["data"], seq_lens[i])
+    numpy.testing.assert_array_equal(reader.data["data"][i], seq)
+
+
 def test_SimpleHDFWriter_ndim1_var_len():
   # E.g. attention weights, shape (dec-time,enc-time) per seq.
   fn = get_test_tmp_file(suffix=".hdf")
@@ -674,6 +720,24 @@ def test_HDFDataset_no_cache_efficiency():
   # TODO... check alloc intervals etc
 
 
+def test_hdf_use_mmap():
+  hdf_fn = generate_hdf_from_other({"class": "TaskNumberBaseConvertDataset", "num_seqs": 11})
+  hdf = HDFDataset(files=[hdf_fn])
+  hdf_mmap = HDFDataset(files=[hdf_fn], use_mmap=True)
+  assert_equal(sorted(hdf_mmap.mmap_data[0].keys()), ["classes", "data"])
+  hdf_reader = DatasetTestReader(hdf)
+  hdf_mmap_reader = DatasetTestReader(hdf_mmap)
+  hdf_reader.read_all()
+  hdf_mmap_reader.read_all()
+  assert hdf_reader.num_seqs == hdf_mmap_reader.num_seqs == 11
+  for seq_idx in range(hdf_reader.num_seqs):
+    for key in hdf_reader.data_keys:
+      data = hdf_mmap_reader.data[key][seq_idx]
+      assert isinstance(data, numpy.memmap)
+      assert_equal(data.dtype, hdf_reader.data[key][seq_idx].dtype)
+      assert_equal(data.tolist(), hdf_reader.data[key][seq_idx].tolist())
+
+
 def test_siamese_triplet_sampling():
   datasets_path = generate_dummy_hdf(3)
   dataset = SiameseHDFDataset(input_stream_name="features", seq_label_stream="classes", files=datasets_path)
@@ -0,0 +1,285 @@
+from __future__ import print_function
+
+import logging
+logging.getLogger('tensorflow').disabled = True
+
+import os
+import sys
+my_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, "%s/.." % my_dir)
+
+import unittest
+import json
+import subprocess
+import tempfile
+import atexit
+import shutil
+from nose.tools import assert_equal, assert_is, assert_is_none
+from HyperParamTuning import *
+from HyperParamTuning import _Device, _IndividualProcess
+from Config import Config
+from GeneratingDataset import DummyDataset
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+from Log import log
+log.initialize(verbosity=[5])
+
+
+returnn_dir = os.path.dirname(my_dir)
+
+
+def _get_tmp_dir():
+  """
+  :return: dirname
+  :rtype: str
+  """
+  name = tempfile.mkdtemp()
+  atexit.register(lambda: shutil.rmtree(name))
+  return name
+
+
+def _make_optimization(**tuning_opts):
+  """
+  :param tuning_opts: for the ``hyper_param_tuning`` option
+  :rtype: Optimization
+  """
+  opts = {"num_tune_iterations": 2, "num_individuals": 4, "work_dir": _get_tmp_dir()}
+  opts.update(tuning_opts)
+  config = Config()
+  config.update({
+    "num_inputs": 3,
+    "num_outputs": 2,
+    "network": {
+      "hidden": {"class": "linear", "activation": HyperParam(["tanh", "relu"]), "n_out": HyperParam(int, [2, 10])},
+      "output": {"class": "softmax", "loss": "ce", "from": ["hidden"]}},
+    "learning_rate": HyperParam(float, [1e-4, 1], log=True, default=0.01),
+    "hyper_param_tuning": opts})
+  train_data = DummyDataset(input_dim=3, output_dim=2, num_seqs=4)
+  return Optimization(config=config, train_data=train_data)
+
+
+def test_Device_select():
+  devices = [_Device(gpu_id=0, memory=1000), _Device(gpu_id=1, memory=2000)]
+  # The device with the most free memory where it fits.
+  device = _Device.select(devices, memory=800)
+  assert_is(device, devices[1])
+  device.free_memory_add(-800)
+  device = _Device.select(devices, memory=800)
+  assert_is(device, devices[1])
+  device.free_memory_add(-800)
+  assert_equal(devices[1].free_memory, 400)
+  device = _Device.select(devices, memory=800)
+  assert_is(device, devices[0])
+  device.free_memory_add(-800)
+  assert_is_none(_Device.select(devices, memory=800))
+  device.free_memory_add(800)
+  # A whole device (memory None) needs the total memory of that device.
+  assert_is(_Device.select(devices, memory=None), devices[0])
+  devices[0].free_memory_add(-1)
+  assert_is_none(_Device.select(devices, memory=None))
+  # The CPU is unlimited.
+  cpu = _Device(gpu_id=None, memory=None)
+  assert_is(_Device.select([cpu], memory=10 ** 12), cpu)
+  cpu.free_memory_add(-10 ** 12)
+  assert_is_none(cpu.free_memory)
+
+
+def test_Optimization_save_load_population():
+  optim = _make_optimization()
+  assert_equal(len(optim.hyper_params), 3)
+  population = optim.get_population(iteration_idx=2, num_individuals=4)
+  for i, individual in enumerate(population):
+    individual.cost = 1.5 - i if i < 3 else float("inf")
+    individual.num_epochs = 2 if i < 2 else 1
+  best_individuals = [population[1], population[0]]
+  filename = "%s/population.json" % optim.work_dir
+  optim.save_population(filename, iteration_idx=2, population=population, best_individuals=best_individuals)
+  assert not os.path.exists(filename + ".new_tmp")
+  with open(filename) as f:
+    state = json.load(f)
+  assert_equal(len(state["individuals"]), 4)  # the best individuals are not stored twice
+  iteration_idx, population2, best_individuals2 = optim.load_population(filename)
+  assert_equal(iteration_idx, 2)
+  assert_equal(len(population2), len(population))
+  for individual, individual2 in zip(population, population2):
+    assert_equal(individual2.name, individual.name)
+    assert_equal(individual2.cost, individual.cost)
+    assert_equal(individual2.num_epochs, individual.num_epochs)
+    for p in optim.hyper_params:
+      assert_equal(individual2.hyper_param_mapping[p], individual.hyper_param_mapping[p])
+  # Same objects as in the population, like before.
+  assert_is(best_individuals2[0], population2[1])
+  assert_is(best_individuals2[1], population2[0])
+
+
+def test_Optimization_resume():
+  optim = _make_optimization(use_processes=True, num_tune_iterations=3)
+  assert_equal(optim.population_file, os.path.join(optim.work_dir, "population.json"))
+  population = optim.get_population(iteration_idx=2, num_individuals=4)
+  optim.save_population(optim.population_file, iteration_idx=2, population=population, best_individuals=[])
+  trained = []
+
+  def train_population_processes(population_, on_rung_finished=None):
+    """
+    :param list[Individual] population_:
+    :param (()->None)|None on_rung_finished:
+    """
+    trained.append([individual.name for individual in population_])
+    for i, individual in enumerate(population_):
+      individual.cost = float(i)
+      individual.num_epochs = 1
+    if on_rung_finished:
+      on_rung_finished()
+
+  optim._train_population_processes = train_population_processes
+  optim.work()
+  print("trained:", trained)
+  # Resumed in iteration 2 with the stored population, then iteration 3.
+  assert_equal(len(trained), 2)
+  assert_equal(trained[0], [individual.name for individual in population])
+  iteration_idx, population3, best_individuals3 = optim.load_population(optim.population_file)
+  assert_equal(iteration_idx, 4)  # finished
+  assert best_individuals3
+  assert_equal(best_individuals3[0].cost, 0.)
+
+
+def test_Optimization_successive_halving():
+  optim = _make_optimization(use_processes=True, min_num_epochs=1, max_num_epochs=4, halving_factor=2)
+  population = optim.get_population(iteration_idx=1, num_individuals=8)
+  costs = {individual.name: float((i * 5) % 8) for (i, individual) in enumerate(population)}
+  rungs = []
+
+  def train_individuals_processes(individuals, num_epochs):
+    """
+    :param list[Individual] individuals:
+    :param int num_epochs:
+    """
+    rungs.append((sorted([individual.name for individual in individuals]), num_epochs))
+    for individual in individuals:
+      # Like it would be the score after num_epochs.
+      individual.cost = costs[individual.name] / num_epochs
+      individual.num_epochs = num_epochs
+
+  optim._train_individuals_processes = train_individuals_processes
+  num_rungs_finished = []
+  # The first individual twice (e.g. the best one from the last iteration), but it is trained only once.
+  optim._train_population_processes(
+    [population[0]] + population, on_rung_finished=lambda: num_rungs_finished.append(True))
+  print("rungs:", rungs)
+  best = sorted(population, key=lambda p: costs[p.name])
+  assert_equal([num_epochs for (_, num_epochs) in rungs], [1, 2, 4])
+  assert_equal(rungs[0][0], sorted([individual.name for individual in population]))
+  assert_equal(rungs[1][0], sorted([individual.name for individual in best[:4]]))
+  assert_equal(rungs[2][0], sorted([individual.name for individual in best[:2]]))
+  assert_equal(len(num_rungs_finished), 3)
+  assert_equal([individual.num_epochs for individual in best], [4, 4, 2, 2, 1, 1, 1, 1])
+
+
+def test_Optimization_crash_in_second_rung():
+  optim = _make_optimization(
+    use_processes=True, num_tune_iterations=1, min_num_epochs=1, max_num_epochs=2, halving_factor=2)
+  costs = {}  # name -> cost in epoch 1
+  crashed = []
+
+  class FakeProc:
+    def __init__(self, returncode):
+      self.returncode = returncode
+
+  def train_individuals_processes(individuals, num_epochs):
+    """
+    :param list[Individual] individuals:
+    :param int num_epochs:
+    """
+    for individual in individuals:
+      costs.setdefault(individual.name, float(len(costs)))
+      returncode = 0
+      if num_epochs == 2 and not crashed:  # the best one crashes in the second rung
+        crashed.append(individual)
+        returncode = 1
+      proc = object.__new__(_IndividualProcess)  # like it was started and has finished
+      proc.optim, proc.individual, proc.work_dir = optim, individual, optim.work_dir
+      proc.log_file = open(os.devnull, "w")
+      proc.proc = FakeProc(returncode=returncode)
+      proc.finish(num_epochs=num_epochs)
+
+  optim._train_individuals_processes = train_individuals_processes
+  optim.get_individual_score = lambda individual, epoch: (
+    None if individual in crashed else costs[individual.name] / epoch)
+  optim.work()
+  _, _, best_individuals = optim.load_population(optim.population_file)
+  print("best:", [(p.name, p.num_epochs, p.cost) for p in best_individuals])
+  assert_equal(len(crashed), 1)
+  assert_equal(crashed[0].num_epochs, 1)  # the last successful rung
+  assert_equal(crashed[0].cost, float("inf"))
+  # The other one from the second rung is the best, and the crashed one is behind all from the first rung.
+  assert_equal(best_individuals[0].num_epochs, 2)
+  assert best_individuals[0].cost < float("inf")
+  best_names = [p.name for p in best_individuals]
+  if crashed[0].name in best_names:
+    assert_equal(best_names[-1], crashed[0].name)
+
+
+def test_hyper_param_tuning_use_processes():
+  tmp_dir = _get_tmp_dir()
+  config_filename = "%s/returnn.config" % tmp_dir
+  with open(config_filename, "w") as f:
+    f.write("""#!rnn.py
+from HyperParamTuning import HyperParam
+use_tensorflow = True
+task = "hyper_param_tuning"
+train = {"class": "Task12AXDataset", "num_seqs": 10}
+num_inputs = 9
+num_outputs = 2
+batch_size = 1000
+max_seqs = 5
+network = {
+  # The initial value of this hyper param is the invalid activation, thus the training will crash for some.
+  "hidden": {"class": "linear", "activation": HyperParam(["tanh", "no_such_activation", "relu"]), "n_out": 5},
+  "output": {"class": "softmax", "loss": "ce", "from": ["hidden"]}}
+learning_rate = HyperParam(float, [1e-4, 1e-1], log=True, default=0.01)
+hyper_param_tuning = {
+  "num_train_steps": 10, "num_tune_iterations": 1, "num_individuals": 4, "num_threads": 2,
+  "use_processes": True, "work_dir": %r, "min_num_epochs": 1, "max_num_epochs": 2}
+log_verbosity = 4
+""" % ("%s/work" % tmp_dir,))
+  subprocess.check_call([sys.executable, "%s/rnn.py" % returnn_dir, config_filename], cwd=tmp_dir)
+  with open("%s/work/population.json" % tmp_dir) as f:
+    state = json.load(f)
+  print("population:", state)
+  assert_equal(state["iteration"], 2)  # finished
+  activation_key = [key for key in state["individuals"][0]["hyper_params"] if "activation" in key][0]
+  individuals = {opts["name"]: opts for opts in state["individuals"]}
+  # The canonical individual has the initial value, which fails. That did not stop the search.
+  assert_equal(individuals["canonical"]["hyper_params"][activation_key], 1)
+  assert_equal(individuals["canonical"]["cost"], float("inf"))
+  for opts in state["individuals"]:
+    if opts["hyper_params"][activation_key] != 1:
+      assert opts["num_epochs"] in [1, 2]
+      assert opts["cost"] < float("inf")
+    else:
+      assert_equal(opts["num_epochs"], 0)  # failed in the first rung
+      assert_equal(opts["cost"], float("inf"))
+      assert os.path.exists("%s/work/%s/stdout.txt" % (tmp_dir, opts["name"]))
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  if len(sys.argv) <= 1:
+    for k, v in sorted(globals().items()):
+      if k.startswith("test_"):
+        print("-" * 40)
+        print("Executing: %s" % k)
+        try:
+          v()
+        except unittest.SkipTest as exc:
+          print("SkipTest:", exc)
+        print("-" * 40)
+    print("Finished all tests.")
+  else:
+    assert len(sys.argv) >= 2
+    for arg in sys.argv[1:]:
+      print("Executing: %s" % arg)
+      if arg in globals():
+        globals()[arg]()  # assume function and execute
+      else:
+        eval(arg)  # assume Python code and execute
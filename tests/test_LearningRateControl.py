@@ -82,6 +82,60 @@ def test_load():
     numpy.testing.assert_allclose(data.error["dev_error_output/output_prob"], 0.16270349413262444)
 
 
+def test_save_load_jsonl():
+  import tempfile
+  filename = tempfile.mktemp(suffix=".jsonl")
+  control = ConstantLearningRate(default_learning_rate=1.0, filename=filename, file_format="jsonl")
+  for epoch in range(1, 11):
+    control.get_learning_rate_for_epoch(epoch)
+    control.set_epoch_error(epoch, {"train_score": 1.0 / epoch})
+    control.save()
+    control.set_epoch_error(epoch, {"dev_score": 2.0 / epoch, "dev_error": float("nan")})
+    control.save()
+  control.save()  # nothing changed
+  lines = open(filename).read().splitlines()
+  assert_equal(len(lines), 1 + 20)  # header + 2 records per epoch, i.e. we only appended
+  control = ConstantLearningRate(default_learning_rate=1.0, filename=filename, file_format="jsonl")
+  assert_equal(set(control.epoch_data.keys()), set(range(1, 11)))
+  assert_equal(set(control.epoch_data[5].error.keys()), {"train_score", "dev_score", "dev_error"})
+  numpy.testing.assert_allclose(control.get_epoch_error_value(5), 0.4)
+  assert_equal(control.get_last_best_epoch(last_epoch=10, first_epoch=3), None)  # no better epoch than the last
+  assert_equal(control.get_last_best_epoch(last_epoch=10, first_epoch=3, min_score_dist=-1.0), 10)
+  control.get_learning_rate_for_epoch(11)
+  control.save()
+  assert_equal(len(open(filename).read().splitlines()), 1 + 20 + 1)
+  os.remove(filename)
+
+
+def test_jsonl_import_old_and_incomplete():
+  import tempfile
+  filename = tempfile.mktemp()
+  control = ConstantLearningRate(default_learning_rate=1.0, filename=filename)  # old format
+  for epoch in range(1, 4):
+    control.get_learning_rate_for_epoch(epoch)
+    control.set_epoch_error(epoch, {"dev_score": 1.0 / epoch})
+  control.save()
+  assert open(filename).read().startswith("{")
+  control = ConstantLearningRate(default_learning_rate=1.0, filename=filename, file_format="jsonl")
+  assert_equal(set(control.epoch_data.keys()), {1, 2, 3})
+  control.get_learning_rate_for_epoch(4)
+  control.save()  # converts the file
+  lines = open(filename).read().splitlines()
+  assert_equal(len(lines), 1 + 4)
+  # Simulate a crash while appending.
+  with open(filename, "a") as f:
+    f.write('{"epoch": 4, "learning_rate": 1.0, "err')
+  control = ConstantLearningRate(default_learning_rate=1.0, filename=filename, file_format="jsonl")
+  assert_equal(set(control.epoch_data.keys()), {1, 2, 3, 4})
+  control.set_epoch_error(4, {"dev_score": 0.25})
+  control.save()  # rewrites the file
+  lines = open(filename).read().splitlines()
+  assert_equal(len(lines), 1 + 4)
+  control = ConstantLearningRate(default_learning_rate=1.0, filename=filename)  # old format again
+  numpy.testing.assert_allclose(control.get_epoch_error_value(4), 0.25)
+  os.remove(filename)
+
+
 def test_init_error_old():
   config = Config()
   config.update({"learning_rate_control": "newbob", "learning_rate_control_error_measure": "dev_score"})
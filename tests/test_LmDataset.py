@@ -0,0 +1,178 @@
+from __future__ import print_function
+
+import os
+import sys
+my_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, "%s/.." % my_dir)
+
+import unittest
+import tempfile
+import shutil
+import pickle
+from nose.tools import assert_equal
+from LmDataset import *
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+from Log import log
+log.initialize(verbosity=[5])
+
+
+def _get_dataset_seqs(dataset, epoch=1):
+  """
+  :param Dataset.Dataset dataset:
+  :param int epoch:
+  :return: list of (tag, data)
+  :rtype: list[(str,list[int])]
+  """
+  dataset.init_seq_order(epoch=epoch)
+  res = []
+  seq_idx = 0
+  while dataset.is_less_than_num_seqs(seq_idx):
+    dataset.load_seqs(seq_idx, seq_idx + 1)
+    res.append((dataset.get_tag(seq_idx), dataset.get_data(seq_idx, "data").tolist()))
+    seq_idx += 1
+  return res
+
+
+def _write_test_corpus(tmp_dir):
+  """
+  :param str tmp_dir:
+  :return: corpus files, orth symbols map file
+  :rtype: (list[str], str)
+  """
+  corpus_files = ["%s/corpus1.txt" % tmp_dir, "%s/corpus2.txt" % tmp_dir]
+  with open(corpus_files[0], "wb") as f:
+    f.write(u"hello world\n\n  abc  \r\nhällo\nx".encode("utf8"))
+  with open(corpus_files[1], "wb") as f:
+    f.write(b"a b c\n\n\nlatin \xe4\n")
+  symbols_file = "%s/symbols.pkl" % tmp_dir
+  with open(symbols_file, "wb") as f:
+    pickle.dump({sym: i for (i, sym) in enumerate(["[END]", " "] + list(u"helowrdabcxtinä"))}, f)
+  return corpus_files, symbols_file
+
+
+def test_IndexedTxtCorpus():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    corpus_files, _ = _write_test_corpus(tmp_dir)
+    for corpus_file in corpus_files:
+      build_txt_corpus_index(corpus_file)
+    corpus = IndexedTxtCorpus(corpus_files)
+    orths = read_corpus(corpus_files[0]) + read_corpus(corpus_files[1])
+    assert_equal(len(orths), 6)
+    assert_equal(len(corpus), len(orths))
+    assert_equal(list(corpus), orths)
+    assert_equal(corpus[-1], orths[-1])
+    assert_equal(corpus.get_seq_lens().tolist(), [len(orth) for orth in orths])
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_LmDataset_corpus_index():
+  try:
+    BackendEngine.get_selected_engine()
+  except BackendEngine.CannotSelectEngine:
+    raise unittest.SkipTest("no backend engine")
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    corpus_files, symbols_file = _write_test_corpus(tmp_dir)
+    for corpus_file in corpus_files:
+      build_txt_corpus_index(corpus_file)
+    opts = dict(corpus_file=corpus_files, orth_symbols_map_file=symbols_file, seq_ordering="sorted")
+    assert_equal(
+      _get_dataset_seqs(LmDataset(corpus_index=True, **opts)),
+      _get_dataset_seqs(LmDataset(**opts)))
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_LmDataset_get_all_seq_lengths():
+  try:
+    BackendEngine.get_selected_engine()
+  except BackendEngine.CannotSelectEngine:
+    raise unittest.SkipTest("no backend engine")
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    corpus_files, symbols_file = _write_test_corpus(tmp_dir)
+    with open(symbols_file, "rb") as f:
+      symbols = pickle.load(f)
+    del symbols["x"]
+    symbols_no_x_file = "%s/symbols_no_x.pkl" % tmp_dir
+    with open(symbols_no_x_file, "wb") as f:
+      pickle.dump(symbols, f)
+    for opts in [
+          dict(orth_symbols_map_file=symbols_file, add_delayed_seq_data=True, delayed_seq_data_start_symbol="[END]"),
+          dict(orth_symbols_map_file=symbols_no_x_file, error_on_invalid_seq=False, seq_ordering="random")]:
+      print("opts:", opts)
+      dataset = LmDataset(corpus_file=corpus_files, **opts)
+      for epoch in [1, 2]:
+        dataset.init_seq_order(epoch=epoch)
+        seq_lengths = dataset.get_all_seq_lengths()
+        seqs = _get_dataset_seqs(dataset, epoch=epoch)
+        assert_equal(seq_lengths["data"].tolist(), [len(data) for (_, data) in seqs])
+        if opts.get("add_delayed_seq_data"):
+          assert_equal(seq_lengths["delayed"].tolist(), seq_lengths["data"].tolist())
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_TranslationDataset_packed():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    with open("%s/source.train" % tmp_dir, "w") as f:
+      f.write("a b c\nb\nc c a x\n")
+    with open("%s/target.train" % tmp_dir, "w") as f:
+      f.write("d\ne e\nd e d\n")
+    for prefix, vocab in [("source", ["a", "b", "c", "<unk>", "</s>"]), ("target", ["d", "e", "<unk>", "</s>"])]:
+      with open("%s/%s.vocab.pkl" % (tmp_dir, prefix), "wb") as f:
+        pickle.dump({label: i for (i, label) in enumerate(vocab)}, f)
+    opts = dict(
+      path=tmp_dir, file_postfix="train", source_postfix=" </s>", target_postfix=" </s>", unknown_label="<unk>",
+      seq_ordering="sorted")
+    TranslationDataset(**opts).write_packed_data()
+    dataset = TranslationDataset(**opts)
+    dataset.init_seq_order(epoch=1)
+    dataset_packed = TranslationDataset(use_packed=True, **opts)
+    dataset_packed.init_seq_order(epoch=1)
+    assert_equal(dataset_packed.num_seqs, 3)
+    dataset.load_seqs(0, 3)
+    dataset_packed.load_seqs(0, 3)
+    for seq_idx in range(3):
+      assert_equal(dataset_packed.get_tag(seq_idx), dataset.get_tag(seq_idx))
+      for key in ["data", "classes"]:
+        assert_equal(dataset_packed.get_data(seq_idx, key).tolist(), dataset.get_data(seq_idx, key).tolist())
+    assert_equal(dataset_packed.get_data(0, "data").dtype, numpy.int32)
+    # Different options than used for the packed data.
+    opts["target_postfix"] = ""
+    try:
+      TranslationDataset(use_packed=True, **opts)
+    except Exception as exc:
+      print("Expected exception:", exc)
+      assert "does not match" in str(exc)
+    else:
+      assert False, "expected exception"
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  if len(sys.argv) <= 1:
+    for k, v in sorted(globals().items()):
+      if k.startswith("test_"):
+        print("-" * 40)
+        print("Executing: %s" % k)
+        try:
+          v()
+        except unittest.SkipTest as exc:
+          print("SkipTest:", exc)
+        print("-" * 40)
+    print("Finished all tests.")
+  else:
+    assert len(sys.argv) >= 2
+    for arg in sys.argv[1:]:
+      print("Executing: %s" % arg)
+      if arg in globals():
+        globals()[arg]()  # assume function and execute
+      else:
+        eval(arg)  # assume Python code and execute
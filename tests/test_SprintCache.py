@@ -0,0 +1,141 @@
+from __future__ import print_function
+
+import os
+import sys
+my_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, "%s/.." % my_dir)
+
+import unittest
+import tempfile
+import shutil
+import zlib
+from struct import pack
+import numpy
+from nose.tools import assert_equal
+from SprintCache import *
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+
+
+def _add_raw_entry(archive, name, payload, compress=False):
+  """
+  :param FileArchive archive: opened for writing
+  :param str name:
+  :param bytes payload: uncompressed entry content
+  :param bool compress:
+  """
+  archive.write_U32(archive.start_recovery_tag)
+  archive.write_u32(len(name))
+  archive.write_str(name)
+  pos = archive.f.tell()
+  data = zlib.compress(payload) if compress else payload
+  archive.write_u32(len(payload))
+  archive.write_u32(len(data) if compress else 0)
+  archive.write_u32(0)  # chk
+  archive.f.write(data)
+  archive.write_U32(archive.end_recovery_tag)
+  archive.ft[name] = FileInfo(name, pos, len(payload), len(data) if compress else 0, len(archive.ft))
+
+
+def _make_feat_payload(times, features):
+  """
+  :param numpy.ndarray times: (time,2)
+  :param list[numpy.ndarray] features:
+  :rtype: bytes
+  """
+  payload = pack("I", 10) + b"vector-f32" + pack("I", len(features))
+  for t, f in zip(times, features):
+    payload += pack("I", len(f)) + numpy.array(f, dtype="float32").tobytes() + pack("dd", t[0], t[1])
+  return payload
+
+
+def _make_align_payload(runs):
+  """
+  :param list[(int,list[int]|int)] runs: (n, mixes) for the RLE scheme. n == 0: mixes is the new time
+  :rtype: bytes
+  """
+  size = sum(abs(n) for (n, _) in runs)
+  payload = pack("I", 14) + b"flow-alignment" + pack("i", 0) + b"ALIGNRLE" + pack("I", size)
+  for n, mixes in runs:
+    payload += pack("b", n)
+    if n > 0:
+      payload += pack("%ii" % n, *mixes)
+    else:
+      payload += pack("i", mixes)
+  return payload
+
+
+def test_FileArchive_read_array():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    filename = "%s/test.cache" % tmp_dir
+    archive = FileArchive(filename, must_exists=False)
+    rnd = numpy.random.RandomState(42)
+    feats = rnd.normal(size=(7, 3)).astype("float32")
+    times = numpy.array([(i * 10., i * 10. + 25.) for i in range(7)])
+    _add_raw_entry(archive, "corpus/seq1", _make_feat_payload(times, feats))
+    _add_raw_entry(archive, "corpus/seq2", _make_feat_payload(times[:3], feats[:3]), compress=True)
+    _add_raw_entry(archive, "corpus/var-dim", _make_feat_payload(times[:2], [feats[0], feats[1, :2]]))
+    allo_state = 2 + (1 << 26)  # allophone 2, state 1
+    runs = [(2, [0, 1]), (-3, allo_state), (0, 10), (1, [2])]
+    _add_raw_entry(archive, "corpus/align1", _make_align_payload(runs), compress=True)
+    _add_raw_entry(archive, "corpus/align2", _make_align_payload(runs))
+    archive.finalize()
+    archive.f.close()
+    del archive
+
+    archive = FileArchive(filename)
+    assert_equal(sorted(archive.file_list())[:2], ["corpus/align1", "corpus/align2"])
+    times_, feats_ = archive.read_array("corpus/seq1", "feat")
+    assert_equal(feats_.dtype, numpy.float32)
+    assert_equal(feats_.tolist(), feats.tolist())
+    assert_equal(times_.tolist(), times.tolist())
+    times_, feats_ = archive.read_array("seq2", "feat")  # short name, compressed
+    assert_equal(feats_.tolist(), feats[:3].tolist())
+    times_, feats_ = archive.read("corpus/seq1", "feat")
+    assert isinstance(feats_, list) and isinstance(times_, list)
+    assert_equal([f.tolist() for f in feats_], feats.tolist())
+    times_, feats_ = archive.read("corpus/var-dim", "feat")
+    assert_equal([f.tolist() for f in feats_], [feats[0].tolist(), feats[1, :2].tolist()])
+    try:
+      archive.read_array("corpus/var-dim", "feat")
+    except Exception as exc:
+      print("Expected exception:", exc)
+    else:
+      assert False, "expected exception"
+
+    archive.allophones[:] = ["a", "b", "c"]
+    expected_align = [(0, 0, 0), (1, 1, 0), (2, 2, 1), (3, 2, 1), (4, 2, 1), (10, 2, 0)]
+    for name in ["corpus/align1", "corpus/align2"]:
+      align = archive.read_array(name, "align")
+      assert_equal(align.dtype, numpy.int32)
+      assert_equal([tuple(frame) for frame in align.tolist()], expected_align)
+      assert_equal(archive.read(name, "align"), expected_align)
+      assert_equal(
+        archive.read_array(name, "align_raw").tolist(),
+        [[0, 0], [1, 1], [2, allo_state], [3, allo_state], [4, allo_state], [10, 2]])
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  if len(sys.argv) <= 1:
+    for k, v in sorted(globals().items()):
+      if k.startswith("test_"):
+        print("-" * 40)
+        print("Executing: %s" % k)
+        try:
+          v()
+        except unittest.SkipTest as exc:
+          print("SkipTest:", exc)
+        print("-" * 40)
+    print("Finished all tests.")
+  else:
+    assert len(sys.argv) >= 2
+    for arg in sys.argv[1:]:
+      print("Executing: %s" % arg)
+      if arg in globals():
+        globals()[arg]()  # assume function and execute
+      else:
+        eval(arg)  # assume Python code and execute
@@ -0,0 +1,372 @@
+from __future__ import print_function
+
+import logging
+logging.getLogger('tensorflow').disabled = True
+
+import os
+import sys
+my_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, "%s/.." % my_dir)
+
+import unittest
+import subprocess
+import tempfile
+import atexit
+import shutil
+import numpy
+import numpy.testing
+import tensorflow as tf
+from nose.tools import assert_equal, assert_true, assert_false
+from TFCompiledGraphDecoder import *
+from TFCompiledGraphDecoder import _concat_batch_padded, _Utterance
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+from Log import log
+log.initialize(verbosity=[5])
+
+
+returnn_dir = os.path.dirname(my_dir)
+n_data_dim = 3
+n_classes_dim = 6
+max_seq_len = 8
+
+config_dict = {
+  "num_inputs": n_data_dim,
+  "num_outputs": n_classes_dim,
+  "allow_random_model_init": True,
+  "network": {
+    "encoder": {"class": "linear", "activation": "tanh", "n_out": 5},
+    "output": {
+      "class": "rec", "from": [], "target": "classes", "max_seq_len": max_seq_len,
+      "unit": {
+        "output": {"class": "choice", "target": "classes", "beam_size": 1, "from": ["output_prob"]},
+        "end": {"class": "compare", "from": ["output"], "value": 0},
+        "orth_embed": {"class": "linear", "activation": None, "from": ["output"], "n_out": 7},
+        "s": {"class": "rnn_cell", "unit": "LSTMBlock", "from": ["prev:c", "prev:orth_embed"], "n_out": 7},
+        "c_in": {"class": "linear", "activation": "tanh", "from": ["s", "prev:orth_embed"], "n_out": 5},
+        "c": {"class": "dot_attention", "from": ["c_in"], "base": "base:encoder", "base_ctx": "base:encoder"},
+        "output_prob": {"class": "softmax", "from": ["prev:s", "c"], "target": "classes", "loss": "ce"}}},
+    "decision": {"class": "decide", "from": ["output"], "loss": "edit_distance"}}
+}
+
+
+def _get_tmp_dir():
+  """
+  :return: dirname
+  :rtype: str
+  """
+  name = tempfile.mkdtemp()
+  atexit.register(lambda: shutil.rmtree(name))
+  return name
+
+
+def _get_inputs(num_seqs):
+  """
+  :param int num_seqs:
+  :return: dense inputs of different lengths, such that the zero-padding matters
+  :rtype: list[numpy.ndarray]
+  """
+  rnd = numpy.random.RandomState(42)
+  return [rnd.uniform(-1., 1., size=(2 + (i * 3) % 5, n_data_dim)).astype("float32") for i in range(num_seqs)]
+
+
+_compiled = {}
+
+
+def _get_compiled():
+  """
+  Creates the model params (random init), the in-graph search results for :func:`_get_inputs`,
+  and compiles the step-by-step graph via ``compile_tf_graph.py --rec_step_by_step``.
+
+  :return: dict with graph, chkpt, info_json, config, search_results
+  :rtype: dict[str]
+  """
+  if _compiled:
+    return _compiled
+  from Config import Config
+  from TFEngine import Engine
+  tmp_dir = _get_tmp_dir()
+  config_filename = "%s/returnn.config" % tmp_dir
+  with open(config_filename, "w") as f:
+    f.write("#!rnn.py\n")
+    for key, value in sorted(config_dict.items()):
+      f.write("%s = %r\n" % (key, value))
+  config = Config()
+  config.update(config_dict)
+  config.update({"model": "%s/model" % tmp_dir})
+
+  # The reference: the search in the normal graph, via the ChoiceLayer.
+  engine = Engine(config=config)
+  engine.start_epoch = 1
+  engine.use_dynamic_train_flag = False
+  engine.use_search_flag = True
+  engine.init_network_from_config(config)
+  chkpt = "%s/model.001" % tmp_dir
+  engine.network.save_params_to_file(chkpt, session=engine.tf_session)
+  inputs = _get_inputs(num_seqs=5)
+  extern_data = engine.network.extern_data
+  rec_layer = engine.network.layers["output"]
+  output, seq_lens, beam_scores = engine.tf_session.run(
+    (rec_layer.output.get_placeholder_as_batch_major(), rec_layer.output.get_sequence_lengths(),
+     rec_layer.get_search_choices().beam_scores),
+    feed_dict={
+      extern_data.data["data"].placeholder: _pad(inputs),
+      extern_data.data["data"].size_placeholder[0]: [len(x) for x in inputs],
+      extern_data.data["classes"].placeholder: numpy.zeros((len(inputs), 0), dtype="int32"),
+      extern_data.data["classes"].size_placeholder[0]: numpy.zeros((len(inputs),), dtype="int32")})
+  assert_equal(beam_scores.shape, (len(inputs), 1))
+  search_results = [
+    (float(beam_scores[i][0]), _strip_end(output[i][:seq_lens[i]].tolist())) for i in range(len(inputs))]
+  print("In-graph search results:", search_results)
+  engine.finalize()
+
+  graph_filename = "%s/graph.meta" % tmp_dir
+  info_json = "%s/rec_step_by_step.json" % tmp_dir
+  subprocess.check_call([
+    sys.executable, "%s/tools/compile_tf_graph.py" % returnn_dir, config_filename,
+    "--rec_step_by_step", "output", "--rec_step_by_step_output_file", info_json,
+    "--output_file", graph_filename])
+  _compiled.update({
+    "graph": graph_filename, "chkpt": chkpt, "info_json": info_json, "config": config_filename,
+    "inputs": inputs, "search_results": search_results})
+  return _compiled
+
+
+def _pad(inputs):
+  """
+  :param list[numpy.ndarray] inputs:
+  :rtype: numpy.ndarray
+  """
+  data = numpy.zeros((len(inputs), max([len(x) for x in inputs]), n_data_dim), dtype="float32")
+  for i, x in enumerate(inputs):
+    data[i, :len(x)] = x
+  return data
+
+
+def _strip_end(seq, end_label=0):
+  """
+  :param list[int] seq:
+  :param int end_label:
+  :return: seq without the end label. the in-graph search and the decoder differ in whether it is included
+  :rtype: list[int]
+  """
+  seq = list(seq)
+  while seq and seq[-1] == end_label:
+    seq.pop()
+  return seq
+
+
+def _make_decoder(**kwargs):
+  """
+  :rtype: CompiledGraphDecoder
+  """
+  compiled = _get_compiled()
+  kwargs.setdefault("max_seq_len", max_seq_len)
+  kwargs.setdefault("length_normalization", False)
+  return CompiledGraphDecoder(
+    graph_filename=compiled["graph"], checkpoint_filename=compiled["chkpt"],
+    rec_step_by_step_json=compiled["info_json"], **kwargs)
+
+
+def test_CompiledGraphDecoder_continuous_batching_safe():
+  decoder = _make_decoder(beam_size=1)
+  try:
+    # The attention is over the base (encoder), which is zero-padded. The states have static dims.
+    assert_equal(decoder._is_continuous_batching_safe(), (True, None))
+    assert_true(decoder.continuous_batching)
+  finally:
+    decoder.close()
+
+
+def test_CompiledGraphDecoder_greedy_matches_search():
+  compiled = _get_compiled()
+  for continuous_batching in [False, True]:
+    # Fewer seqs in flight than inputs, such that new seqs join (while others are in flight, if continuous).
+    decoder = _make_decoder(beam_size=1, max_batch_size=2, continuous_batching=continuous_batching)
+    try:
+      results = decoder.decode(compiled["inputs"])
+      stats = decoder.get_stats()
+      print("continuous batching %r, stats %r" % (continuous_batching, stats))
+      assert_equal(stats["num_utterances"], len(compiled["inputs"]))
+      assert stats["num_joins"] >= 3
+      for res, (ref_score, ref_seq) in zip(results, compiled["search_results"]):
+        assert_equal(len(res), 1)
+        score, seq = res[0]
+        assert_equal(_strip_end(seq), ref_seq)
+        numpy.testing.assert_allclose(score, ref_score, rtol=1e-4, atol=1e-5)
+      # All rows are finished.
+      assert_equal(len(decoder._utterances), 0)
+      assert_equal(len(decoder._row_utts), 0)
+    finally:
+      decoder.close()
+
+
+def test_CompiledGraphDecoder_beam_continuous_batching():
+  compiled = _get_compiled()
+  all_results = {}
+  for continuous_batching in [False, True]:
+    decoder = _make_decoder(beam_size=3, max_batch_size=2, continuous_batching=continuous_batching)
+    try:
+      all_results[continuous_batching] = decoder.decode(compiled["inputs"])
+    finally:
+      decoder.close()
+  for res_static, res_cont in zip(all_results[False], all_results[True]):
+    print("n-best:", res_static)
+    assert 1 <= len(res_static) <= 3
+    assert_equal([seq for (_, seq) in res_static], [seq for (_, seq) in res_cont])
+    numpy.testing.assert_allclose(
+      [score for (score, _) in res_static], [score for (score, _) in res_cont], rtol=1e-4, atol=1e-5)
+    assert_equal([score for (score, _) in res_static], sorted([score for (score, _) in res_static], reverse=True))
+  for res, (ref_score, _) in zip(all_results[True], compiled["search_results"]):
+    # Without length normalization, this search continues until no active hyp can beat the best final one.
+    assert res[0][0] >= ref_score - 1e-4
+
+
+def test_decode_compiled_graph_tool():
+  compiled = _get_compiled()
+  out_filename = "%s/out.txt" % _get_tmp_dir()
+  subprocess.check_call([
+    sys.executable, "%s/tools/decode-compiled-graph.py" % returnn_dir,
+    "--graph", compiled["graph"], "--chkpt", compiled["chkpt"], "--rec_step_by_step_json", compiled["info_json"],
+    "--dataset", repr({"class": "DummyDataset", "input_dim": n_data_dim, "output_dim": n_classes_dim, "num_seqs": 3}),
+    "--beam_size", "2", "--max_batch_size", "2", "--max_seq_len", str(max_seq_len), "--output", out_filename])
+  lines = open(out_filename).read().splitlines()
+  assert_equal(len(lines), 3)
+  for line in lines:
+    seq_tag, score, labels = line.split("\t")
+    float(score)
+
+
+def test_concat_batch_padded():
+  with tf.Graph().as_default(), tf.Session() as session:
+    old = tf.constant(numpy.ones((2, 3, 1), dtype="float32"))
+    new = tf.constant(numpy.full((1, 5, 1), 2., dtype="float32"))
+    res = session.run(_concat_batch_padded(old, new, ndim=3))
+    assert_equal(res.shape, (3, 5, 1))
+    assert_equal(res[:, :, 0].tolist(), [[1, 1, 1, 0, 0], [1, 1, 1, 0, 0], [2, 2, 2, 2, 2]])
+    res = session.run(_concat_batch_padded(tf.constant([1, 2]), tf.constant([3]), ndim=1))
+    assert_equal(res.tolist(), [1, 2, 3])
+
+
+def test_CompiledGraphDecoder_is_continuous_batching_safe_dynamic_state():
+  decoder = object.__new__(CompiledGraphDecoder)
+  decoder.info = {"state_vars": {
+    "base_encoder": {"shape": [None, None, 5]},  # fine, zero-padded on join
+    "state_s": {"shape": [None, 7]},
+    "state_att_kv": {"shape": [None, None, 5]}}}  # e.g. accumulated keys/values of self-attention
+  decoder._var_ops = {}
+  safe, reason = decoder._is_continuous_batching_safe()
+  print("reason:", reason)
+  assert_false(safe)
+  assert "state_att_kv" in reason
+
+
+class _FakeSessionDecoder(CompiledGraphDecoder):
+  """
+  Only the host-side beam bookkeeping (:func:`_select`, :func:`_step`), with given scores instead of a graph.
+  """
+
+  def __init__(self, get_scores, beam_size, end_label=0):
+    """
+    :param (int,tuple|None)->numpy.ndarray get_scores: utterance idx, label hist -> (dim,) log probs
+    :param int beam_size:
+    :param int end_label:
+    """
+    self.beam_size = beam_size
+    self.end_label = end_label
+    self.length_normalization = False
+    self.stochastic_var_order = ["output"]
+    self._scores = {"output": "scores"}
+    self._select_ops = {"output": "select"}
+    self._choices = {"output": "choice"}
+    self._src_rows = "src_rows"
+    self._end_flag = None
+    self._next_step_op = "next_step"
+    self._row_utts = numpy.zeros((0,), dtype="int32")
+    self._row_scores = numpy.zeros((0,), dtype="float32")
+    self._row_hists = []
+    self._utterances = {}
+    self.get_scores = get_scores
+    self.selects = []  # type: typing.List[typing.Tuple[typing.List[int],typing.List[int]]]
+    self.num_steps = self.num_rows = self.num_session_runs = 0
+
+  def _run(self, fetches, feed_dict=None):
+    if fetches == "scores":
+      return numpy.array([
+        self.get_scores(utt_idx, hist) if utt_idx >= 0 else numpy.zeros((3,))
+        for (utt_idx, hist) in zip(self._row_utts, self._row_hists)], dtype="float32")
+    if fetches == "select":
+      self.selects.append((feed_dict["src_rows"].tolist(), feed_dict["choice"].tolist()))
+    return None
+
+  def add(self, idx, max_seq_len=10):
+    """
+    :param int idx:
+    :param int max_seq_len:
+    """
+    self._utterances[idx] = _Utterance(idx=idx, inputs=numpy.zeros((1,)), max_seq_len=max_seq_len)
+    self._row_utts = numpy.concatenate([self._row_utts, [idx]]).astype("int32")
+    self._row_scores = numpy.concatenate([self._row_scores, [0.]]).astype("float32")
+    self._row_hists = self._row_hists + [None]
+
+
+def test_CompiledGraphDecoder_select_step_bookkeeping():
+  log_probs = {
+    (0, False): numpy.log([0.05, 0.75, 0.2]), (0, True): numpy.log([0.5, 0.3, 0.2]),
+    (1, False): numpy.log([0.7, 0.2, 0.1])}
+
+  def get_scores(utt_idx, hist):
+    """
+    :param int utt_idx:
+    :param tuple|None hist:
+    :rtype: numpy.ndarray
+    """
+    return log_probs[(utt_idx, hist is not None)]
+
+  decoder = _FakeSessionDecoder(get_scores=get_scores, beam_size=2)
+  decoder.add(0)
+  decoder.add(1)
+  finished = decoder._step()
+  # Per utterance, the 2 best labels. One hyp of utterance 1 ended (label 0),
+  # and its other hyp cannot get better than that, so utterance 1 is finished already.
+  assert_equal(decoder.selects[-1], ([0, 0, 1, 1], [1, 2, 0, 1]))
+  assert_equal([utt.idx for utt in finished], [1])
+  assert_equal(decoder._row_utts.tolist(), [0, 0, -1, -1])
+  assert_equal(decoder._row_hists, [(1, None), (2, None), (0, None), (1, None)])
+  res = decoder._make_result(finished[0])
+  assert_equal([seq for (_, seq) in res], [[0]])
+  numpy.testing.assert_allclose([score for (score, _) in res], [log_probs[(1, False)][0]], rtol=1e-5)
+  del decoder._utterances[1]
+  # Next step: the dead rows (-1) are dropped by the select.
+  finished = decoder._step()
+  assert_equal(decoder.selects[-1], ([0, 0], [0, 1]))
+  assert_equal(decoder._row_hists, [(0, (1, None)), (1, (1, None))])
+  assert_equal([utt.idx for utt in finished], [0])
+  res = decoder._make_result(finished[0])
+  assert_equal([seq for (_, seq) in res], [[1, 0]])
+  numpy.testing.assert_allclose(
+    [score for (score, _) in res], [log_probs[(0, False)][1] + log_probs[(0, True)][0]], rtol=1e-5)
+  assert_equal(decoder._row_utts.tolist(), [-1, -1])
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  if len(sys.argv) <= 1:
+    for k, v in sorted(globals().items()):
+      if k.startswith("test_"):
+        print("-" * 40)
+        print("Executing: %s" % k)
+        try:
+          v()
+        except unittest.SkipTest as exc:
+          print("SkipTest:", exc)
+        print("-" * 40)
+    print("Finished all tests.")
+  else:
+    assert len(sys.argv) >= 2
+    for arg in sys.argv[1:]:
+      print("Executing: %s" % arg)
+      if arg in globals():
+        globals()[arg]()  # assume function and execute
+      else:
+        eval(arg)  # assume Python code and execute
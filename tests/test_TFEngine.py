@@ -186,6 +186,202 @@ def test_engine_train():
   engine.finalize()
 
 
+def test_engine_train_save_model_async():
+  from GeneratingDataset import DummyDataset
+  from glob import glob
+  seq_len = 5
+  n_data_dim = 2
+  n_classes_dim = 3
+  train_data = DummyDataset(input_dim=n_data_dim, output_dim=n_classes_dim, num_seqs=4, seq_len=seq_len)
+  train_data.init_seq_order(epoch=1)
+
+  tmp_dir = _get_tmp_dir()
+  config = Config()
+  config.update({
+    "model": "%s/model" % tmp_dir,
+    "num_outputs": n_classes_dim,
+    "num_inputs": n_data_dim,
+    "network": {"output": {"class": "softmax", "loss": "ce"}},
+    "save_model_async": True,
+    "cleanup_old_models": {"keep_last_n": 1, "keep_best_n": 0, "keep": []},
+    "start_epoch": 1,
+    "num_epochs": 3
+  })
+  _cleanup_old_models(config)
+  engine = Engine(config=config)
+  engine.init_train_from_config(config=config, train_data=train_data, dev_data=None, eval_data=None)
+  engine.train()
+  params = engine.network.get_param_values_dict(session=engine.tf_session)
+  engine.finalize()
+
+  assert_equal(sorted(Engine.get_existing_models(config).keys()), [3])
+  assert not glob("%s/.tmp.*" % tmp_dir)
+  reader = tf.train.NewCheckpointReader("%s/model.003" % tmp_dir)
+  numpy.testing.assert_almost_equal(reader.get_tensor("output/W"), params["output"]["W"])
+
+
+def test_engine_train_step_timing():
+  from GeneratingDataset import DummyDataset
+  import json
+  seq_len = 5
+  n_data_dim = 2
+  n_classes_dim = 3
+  train_data = DummyDataset(input_dim=n_data_dim, output_dim=n_classes_dim, num_seqs=4, seq_len=seq_len)
+  train_data.init_seq_order(epoch=1)
+
+  tmp_dir = _get_tmp_dir()
+  config = Config()
+  config.update({
+    "model": "%s/model" % tmp_dir,
+    "num_outputs": n_classes_dim,
+    "num_inputs": n_data_dim,
+    "network": {"output": {"class": "softmax", "loss": "ce"}},
+    "step_timing": True,
+    "step_timing_file": "%s/step_timings.jsonl" % tmp_dir,
+    "start_epoch": 1,
+    "num_epochs": 1
+  })
+  _cleanup_old_models(config)
+  engine = Engine(config=config)
+  engine.init_train_from_config(config=config, train_data=train_data, dev_data=None, eval_data=None)
+  engine.train()
+  engine.finalize()
+
+  lines = [json.loads(line) for line in open("%s/step_timings.jsonl" % tmp_dir).read().splitlines()]
+  steps, summary = lines[:-1], lines[-1]["summary"]
+  assert steps
+  assert_equal([info["step"] for info in steps], list(range(len(steps))))
+  for info in steps:
+    for key in ["data_wait", "feed", "session_run", "post_process", "horovod", "padding_ratio"]:
+      assert key in info
+    assert_equal(info["padding_ratio"], 0.)
+    assert_equal(info["epoch"], 1)
+    assert_equal(info["dataset"], train_data.name)
+    assert info["report_prefix"].startswith("train")
+  assert_equal(lines[-1]["epoch"], 1)
+  assert_equal(summary["num_steps"], len(steps))
+  assert_equal(summary["num_frames"], 4 * seq_len)
+
+
+def test_engine_train_local_data_parallel():
+  import subprocess
+  returnn_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  for reduce_type in ["grad", "param"]:
+    print("horovod_reduce_type %r" % reduce_type)
+    tmp_dir = _get_tmp_dir()
+    config_filename = "%s/returnn.config" % tmp_dir
+    with open(config_filename, "w") as f:
+      f.write("""#!rnn.py
+import os
+import TFEngine
+use_tensorflow = True
+task = "train"
+train = {"class": "Task12AXDataset", "num_seqs": 20}
+num_inputs = 9
+num_outputs = 2
+batch_size = 100
+max_seqs = 2
+network = {
+  "hidden": {"class": "linear", "activation": "tanh", "n_out": 5},
+  "output": {"class": "softmax", "loss": "ce", "from": ["hidden"]}}
+learning_rate = 0.01
+num_epochs = 2
+local_data_parallel = 2
+horovod_reduce_type = %r
+horovod_param_sync_step = 2
+# One allreduce per param, and only a single thread. The reductions must not deadlock.
+horovod_bucket_size = 0
+tf_session_opts = {"inter_op_parallelism_threads": 1}
+model = "%s/model.rank%%s" %% os.environ.get("RETURNN_LOCAL_DATA_PARALLEL_RANK", "main")
+# Usually only rank 0 saves the model. Here we want to compare the params of all ranks.
+TFEngine.Engine._do_save = lambda self: True
+log_verbosity = 4
+""" % (reduce_type, tmp_dir))
+    subprocess.check_call([sys.executable, "%s/rnn.py" % returnn_dir, config_filename], cwd=tmp_dir)
+    readers = [tf.train.NewCheckpointReader("%s/model.rank%i.002" % (tmp_dir, rank)) for rank in range(2)]
+    init_reader = tf.train.NewCheckpointReader("%s/model.rank0.001" % tmp_dir)
+    for name in ["hidden/W", "hidden/b", "output/W", "output/b"]:
+      numpy.testing.assert_array_equal(readers[0].get_tensor(name), readers[1].get_tensor(name))
+    # It was trained.
+    assert not numpy.array_equal(readers[0].get_tensor("output/W"), init_reader.get_tensor("output/W"))
+
+
+def test_engine_train_local_data_parallel_fetch_losses():
+  # In "grad" mode, the reductions of the fetched losses run together with the gradient reductions,
+  # and in eval also the reductions of the losses which are only used in eval.
+  import subprocess
+  returnn_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  tmp_dir = _get_tmp_dir()
+  config_filename = "%s/returnn.config" % tmp_dir
+  with open(config_filename, "w") as f:
+    f.write("""#!rnn.py
+import os
+use_tensorflow = True
+task = "train"
+train = {"class": "Task12AXDataset", "num_seqs": 20}
+dev = {"class": "Task12AXDataset", "num_seqs": 10, "fixed_random_seed": 1}
+num_inputs = 9
+num_outputs = 2
+batch_size = 100
+max_seqs = 2
+network = {
+  "hidden": {"class": "linear", "activation": "tanh", "n_out": 5},
+  "output": {"class": "softmax", "loss": "ce", "from": ["hidden"]},
+  "output_eval": {"class": "softmax", "loss": "ce", "from": ["hidden"], "target": "classes", "only_on_eval": True}}
+learning_rate = 0.01
+num_epochs = 2
+local_data_parallel = 2
+horovod_reduce_type = "grad"
+# One allreduce per param, and only a single thread. The reductions must not deadlock.
+horovod_bucket_size = 0
+tf_session_opts = {"inter_op_parallelism_threads": 1}
+model = "%s/model.rank%%s" %% os.environ.get("RETURNN_LOCAL_DATA_PARALLEL_RANK", "main")
+log_verbosity = 5
+""" % tmp_dir)
+  out = subprocess.check_output(
+    [sys.executable, "%s/rnn.py" % returnn_dir, config_filename], cwd=tmp_dir, stderr=subprocess.STDOUT, timeout=600)
+  out = out.decode("utf8")
+  print(out)
+  assert "error:output" in out and "error:output_eval" in out  # printed per step with log_verbosity 5
+  assert "dev: score" in out
+
+
+def test_engine_train_store_metadata_steps():
+  from GeneratingDataset import DummyDataset
+  from glob import glob
+  import json
+  seq_len = 5
+  n_data_dim = 2
+  n_classes_dim = 3
+  train_data = DummyDataset(input_dim=n_data_dim, output_dim=n_classes_dim, num_seqs=4, seq_len=seq_len)
+  train_data.init_seq_order(epoch=1)
+
+  tmp_dir = _get_tmp_dir()
+  config = Config()
+  config.update({
+    "model": "%s/model" % tmp_dir,
+    "tf_log_dir": "%s/tf-log" % tmp_dir,
+    "num_outputs": n_classes_dim,
+    "num_inputs": n_data_dim,
+    "network": {"output": {"class": "softmax", "loss": "ce"}},
+    "max_seqs": 1,
+    "store_metadata_steps": [1, 2],
+    "start_epoch": 1,
+    "num_epochs": 1
+  })
+  _cleanup_old_models(config)
+  engine = Engine(config=config)
+  engine.init_train_from_config(config=config, train_data=train_data, dev_data=None, eval_data=None)
+  engine.train()
+  engine.finalize()
+
+  traces = sorted(glob("%s/tf-log/*/timeline.step*.trace" % tmp_dir))
+  assert_equal([os.path.basename(fn) for fn in traces], ["timeline.step0001.trace", "timeline.step0002.trace"])
+  trace = json.load(open(traces[0]))
+  assert any([event.get("cat") == "Runner" and event["name"] == "session_run" for event in trace["traceEvents"]])
+  assert glob("%s/tf-log/*/top_ops.txt" % tmp_dir)
+
+
 def test_engine_train_uneven_batches():
   rnd = numpy.random.RandomState(42)
   from GeneratingDataset import StaticDataset
@@ -0,0 +1,225 @@
+from __future__ import print_function
+
+import os
+import sys
+my_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, "%s/.." % my_dir)
+
+import unittest
+import time
+import threading
+import numpy
+import numpy.testing
+from nose.tools import assert_equal, assert_in
+from TFInferenceServer import *
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+from Log import log
+log.initialize(verbosity=[5])
+
+
+def test_DynamicBatcher():
+  batches = []
+  block = threading.Event()
+
+  def process_batch(inputs):
+    block.wait()
+    batches.append(list(inputs))
+    return [x * 10 for x in inputs]
+
+  batcher = DynamicBatcher(process_batch, max_batch_seqs=3, max_batch_frames=20, max_latency=0.01)
+  try:
+    # The first request gets its own batch. While it is processed, the others are queued.
+    futures = {1: batcher.submit(1, length=1)}
+    time.sleep(0.1)
+    for x, length in [(2, 2), (3, 15), (4, 3), (5, 1), (6, 14)]:
+      futures[x] = batcher.submit(x, length=length)
+    block.set()
+    for x, future in futures.items():
+      assert_equal(future.result(timeout=10), x * 10)
+    print("batches:", batches)
+    assert_equal(batches[0], [1])
+    # Grouped by length, oldest first, and at most 3 seqs and 20 padded frames.
+    assert_equal(batches[1:], [[2, 4, 5], [3], [6]])
+    stats = batcher.get_stats()
+    print("stats:", stats)
+    assert_equal(stats["num_requests"], 6)
+    assert_equal(stats["num_batches"], 4)
+    assert_equal(stats["num_pending_requests"], 0)
+    assert 0 < stats["padding_frac"] < 1
+    assert stats["latency_max"] >= stats["latency_p50"] > 0
+  finally:
+    block.set()
+    batcher.stop()
+
+
+def test_DynamicBatcher_exception():
+  def process_batch(inputs):
+    raise ValueError("invalid inputs %r" % (inputs,))
+
+  batcher = DynamicBatcher(process_batch, max_latency=0.)
+  try:
+    future = batcher.submit("x", length=1)
+    try:
+      future.result(timeout=10)
+    except ValueError as exc:
+      print("Expected exception:", exc)
+    else:
+      assert False, "expected exception"
+    assert_equal(batcher.get_stats()["num_failed_requests"], 1)
+  finally:
+    batcher.stop()
+
+
+def test_InferenceServer_format_result():
+  assert_equal(InferenceServer._format_result("a b"), b"'a b'\n")
+  assert_in(b"(-1.5, 'a b')\n", InferenceServer._format_result([(-1.5, "a b"), (-2.0, "a c")]))
+
+
+def _get_multipart_body(boundary, fields):
+  """
+  :param str boundary:
+  :param dict[str,bytes] fields:
+  :rtype: bytes
+  """
+  body = b""
+  for name, content in sorted(fields.items()):
+    body += ("--%s\r\nContent-Disposition: form-data; name=\"%s\"; filename=\"%s.txt\"\r\n" % (
+      boundary, name, name)).encode("utf8")
+    body += b"Content-Type: text/plain\r\n\r\n" + content + b"\r\n"
+  return body + ("--%s--\r\n" % boundary).encode("utf8")
+
+
+def test_InferenceServer_get_input_bytes():
+  assert_equal(InferenceServer._get_input_bytes({}, b"a b"), b"a b")
+  body = _get_multipart_body("xyz123", {"file": b"a b\r\nc", "other": b"d"})
+  assert_equal(
+    InferenceServer._get_input_bytes({"content-type": "multipart/form-data; boundary=xyz123"}, body), b"a b\r\nc")
+  assert_equal(
+    InferenceServer._get_input_bytes({"content-type": 'multipart/form-data; boundary="xyz123"'}, body), b"a b\r\nc")
+
+
+def _make_search_engine(labels, beam_size):
+  """
+  :param list[str] labels: input and output vocab
+  :param int beam_size:
+  :rtype: TFEngine.Engine
+  """
+  import tempfile
+  import atexit
+  import shutil
+  from Config import Config
+  from TFEngine import Engine
+  from GeneratingDataset import Vocabulary
+  tmp_dir = tempfile.mkdtemp()
+  atexit.register(lambda: shutil.rmtree(tmp_dir))
+  vocab_file = "%s/vocab.txt" % tmp_dir
+  with open(vocab_file, "w") as f:
+    f.write(repr(Vocabulary.create_vocab_dict_from_labels(labels)))
+  n_classes = len(labels)
+  config = Config()
+  config.update({
+    "model": "%s/model" % tmp_dir,
+    "allow_random_model_init": True,
+    "extern_data": {
+      "data": {"dim": n_classes, "sparse": True, "vocab": {"vocab_file": vocab_file}},
+      "classes": {"dim": n_classes, "sparse": True, "vocab": {"vocab_file": vocab_file}}},
+    "network": {
+      "encoder": {"class": "linear", "activation": "tanh", "n_out": 5, "from": ["data"]},
+      "output": {
+        "class": "rec", "from": [], "target": "classes", "max_seq_len": 10,
+        "unit": {
+          "output": {"class": "choice", "target": "classes", "beam_size": beam_size, "from": ["output_prob"]},
+          "end": {"class": "compare", "from": ["output"], "value": 0},
+          "orth_embed": {"class": "linear", "activation": None, "from": ["output"], "n_out": 7},
+          "s": {"class": "rnn_cell", "unit": "LSTMBlock", "from": ["prev:c", "prev:orth_embed"], "n_out": 7},
+          "c_in": {"class": "linear", "activation": "tanh", "from": ["s", "prev:orth_embed"], "n_out": 5},
+          "c": {"class": "dot_attention", "from": ["c_in"], "base": "base:encoder", "base_ctx": "base:encoder"},
+          "output_prob": {"class": "softmax", "from": ["prev:s", "c"], "target": "classes", "loss": "ce"}}},
+      "decision": {"class": "decide", "from": ["output"], "loss": "edit_distance"}}
+  })
+  engine = Engine(config=config)
+  engine.start_epoch = 1
+  return engine
+
+
+def test_InferenceServer_process_batch():
+  labels = ["<s>", "UNK", "a", "b", "c", "d"]
+  beam_size = 3
+  engine = _make_search_engine(labels=labels, beam_size=beam_size)
+  server = InferenceServer(engine=engine, port=0, max_latency=0.01)
+  try:
+    sentences = ["a b c d", "d", "b x c"]
+    features_list = [server._get_features(s.encode("utf8")) for s in sentences]
+    assert_equal(features_list[2].tolist(), [3, 1, 4])  # "x" is unknown
+
+    input_data = server.setup["input_data"]
+    feed_dict = server._get_feed_dict(features_list)
+    data = feed_dict[input_data.placeholder]
+    assert_equal(data.shape, (3, 4))
+    assert_equal(feed_dict[input_data.size_placeholder[0]].tolist(), [4, 1, 3])
+    assert_equal(data[1].tolist(), [5, 0, 0, 0])  # zero padded
+    assert_equal(data[2].tolist(), [3, 1, 4, 0])
+
+    # The batched search must give the same hypotheses as searching each seq on its own.
+    batch_res = server._process_batch(features_list)
+    assert_equal(len(batch_res), len(sentences))
+    for features, seq_batch_res in zip(features_list, batch_res):
+      single_res, = server._process_batch([features])
+      print("hyps:", seq_batch_res)
+      assert_equal(len(seq_batch_res), beam_size)
+      assert_equal([txt for (score, txt) in seq_batch_res], [txt for (score, txt) in single_res])
+      numpy.testing.assert_allclose(
+        [score for (score, txt) in seq_batch_res], [score for (score, txt) in single_res], rtol=1e-4)
+
+    # Now the same through the HTTP server and the dynamic batcher.
+    try:
+      # noinspection PyCompatibility
+      from urllib.request import urlopen, Request
+    except ImportError:  # Python 2
+      # noinspection PyUnresolvedReferences,PyCompatibility
+      from urllib2 import urlopen, Request
+    httpd = server._make_http_server()
+    thread = threading.Thread(target=httpd.serve_forever, name="inference server test")
+    thread.daemon = True
+    thread.start()
+    try:
+      url = "http://localhost:%i/" % httpd.server_address[1]
+      assert_equal(urlopen(url, data=b"d").read(), InferenceServer._format_result(batch_res[1]))
+      assert_equal(
+        urlopen(Request(
+          url, data=_get_multipart_body("xyz123", {"file": b"b x c"}),
+          headers={"Content-Type": "multipart/form-data; boundary=xyz123"})).read(),
+        InferenceServer._format_result(batch_res[2]))
+      import json
+      stats = json.loads(urlopen(url + "stats").read().decode("utf8"))
+      assert_equal(stats["num_requests"], 2)
+    finally:
+      httpd.shutdown()
+      httpd.server_close()
+  finally:
+    server.batcher.stop()
+    engine.finalize()
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  if len(sys.argv) <= 1:
+    for k, v in sorted(globals().items()):
+      if k.startswith("test_"):
+        print("-" * 40)
+        print("Executing: %s" % k)
+        try:
+          v()
+        except unittest.SkipTest as exc:
+          print("SkipTest:", exc)
+        print("-" * 40)
+    print("Finished all tests.")
+  else:
+    assert len(sys.argv) >= 2
+    for arg in sys.argv[1:]:
+      print("Executing: %s" % arg)
+      if arg in globals():
+        globals()[arg]()  # assume function and execute
+      else:
+        eval(arg)  # assume Python code and execute
@@ -0,0 +1,83 @@
+from __future__ import print_function
+
+import os
+import sys
+my_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, "%s/.." % my_dir)
+
+import unittest
+import numpy
+from threading import Thread
+from nose.tools import assert_equal
+from TFLocalDataParallel import *
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+
+
+def test_Hub_allreduce_broadcast():
+  num_workers = 3
+  hub = Hub(num_workers=num_workers, authkey=b"test")
+  clients = [HubClient(address=hub.address, authkey=b"test", rank=rank) for rank in range(num_workers)]
+  results = {}
+
+  def worker(rank):
+    """
+    :param int rank:
+    """
+    client = clients[rank]
+    res = []
+    for step in range(5):
+      res.append(client.allreduce("sum", numpy.array([rank, step], dtype="float32"), average=False).tolist())
+    res.append(client.allreduce("avg", numpy.array([rank * 3], dtype="int32"), average=True).tolist())
+    res.append(client.broadcast("bcast", numpy.array(rank + 10), root_rank=1).tolist())
+    results[rank] = res
+
+  # Start in reverse order, such that the requests do not arrive in rank order.
+  threads = [Thread(target=worker, args=(rank,)) for rank in reversed(range(num_workers))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  for client in clients:
+    client.close()
+  hub.close()
+  expected = [[3., step * 3.] for step in range(5)] + [[3], 11]
+  for rank in range(num_workers):
+    assert_equal(results[rank], expected)
+
+
+def test_run_workers():
+  code = "\n".join([
+    "import sys, numpy",
+    "sys.path.insert(0, %r)" % os.path.dirname(my_dir),
+    "import TFLocalDataParallel as dp",
+    "dp.init()",
+    "assert dp.is_worker_process() and dp.size() == 2",
+    "res = dp._client.allreduce('x', numpy.array([dp.rank() + 1.]), average=False)",
+    "assert res.tolist() == [3.], res",
+    "sys.exit(0)"])
+  assert_equal(run_workers(num_workers=2, args=[sys.executable, "-c", code]), 0)
+  assert run_workers(num_workers=2, args=[sys.executable, "-c", "import sys; sys.exit(3)"]) != 0
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  if len(sys.argv) <= 1:
+    for k, v in sorted(globals().items()):
+      if k.startswith("test_"):
+        print("-" * 40)
+        print("Executing: %s" % k)
+        try:
+          v()
+        except unittest.SkipTest as exc:
+          print("SkipTest:", exc)
+        print("-" * 40)
+    print("Finished all tests.")
+  else:
+    assert len(sys.argv) >= 2
+    for arg in sys.argv[1:]:
+      print("Executing: %s" % arg)
+      if arg in globals():
+        globals()[arg]()  # assume function and execute
+      else:
+        eval(arg)  # assume Python code and execute
@@ -1338,6 +1338,150 @@ def test_search_no_rec_explicit_dyn_len():
   print("Seems fine.")
 
 
+def test_search_no_rec_explicit_early_exit():
+  from TFNetworkRecLayer import _SubnetworkRecCell
+  beam_size = 3
+  logits = numpy.array([
+    [-0.1, -3., -4., -9.],
+    [-1., -2., -3., -4.],
+    [-1., -2., -3., -4.]], dtype="float32")
+  # Let the 0 label be the EOS symbol. No length normalization.
+  # The hyp [0] has score -0.1 after frame 0, and no other hyp can get better than that.
+  # Thus with early exit, the loop should stop after frame 1, where all other hyps are ended.
+  n_time = 3
+  n_classes = 4
+  n_batch = 1
+  logits = numpy.expand_dims(logits, axis=0)
+
+  def run(early_exit):
+    """
+    :param bool early_exit:
+    :return: out (time,batch*beam), out_sizes (batch*beam,), num steps
+    :rtype: (numpy.ndarray, numpy.ndarray, int)
+    """
+    ChoiceLayer._debug_out = []
+    net_dict = {
+      "output": {"class": "rec", "from": ["data"], "max_seq_len": n_time, "unit": {
+        "output": {
+          "class": "choice", "from": ["data:source"], "input_type": "log_prob",
+          "explicit_search_source": "prev:output", 'initial_output': 0,
+          "beam_size": beam_size, "length_normalization": False,
+          "early_exit_end_label": 0 if early_exit else None,
+          "target": "classes"},
+        "end": {"class": "compare", "from": ["output"], "value": 0}
+      }}
+    }
+    extern_data = ExternData({
+      "data": {"dim": n_classes},
+      "classes": {"dim": n_classes, "sparse": True, "available_for_inference": False}})
+    with make_scope() as session:
+      net = TFNetwork(
+        extern_data=extern_data, search_flag=True, train_flag=False, eval_flag=False)
+      net.construct_from_dict(net_dict)
+      rec_layer = net.layers["output"]
+      assert isinstance(rec_layer.cell, _SubnetworkRecCell)
+      feed_dict = {
+        net.extern_data.data["data"].placeholder: logits,
+        net.extern_data.data["data"].size_placeholder[0]: [n_time]}
+      out, out_sizes = session.run(
+        (rec_layer.output.placeholder, rec_layer.output.get_sequence_lengths()),
+        feed_dict=feed_dict)
+    num_steps = len(ChoiceLayer._debug_out)
+    ChoiceLayer._debug_out = None
+    print("early exit %r, output %r, seq lens %r, num steps %i" % (early_exit, out.tolist(), out_sizes, num_steps))
+    return out, out_sizes, num_steps
+
+  out_ref, out_sizes_ref, num_steps_ref = run(early_exit=False)
+  out, out_sizes, num_steps = run(early_exit=True)
+  assert_equal(num_steps_ref, n_time)
+  assert_equal(num_steps, 2)
+  # The best hyp is the same.
+  assert_equal(out_sizes[0], out_sizes_ref[0])
+  assert_equal(out[:out_sizes[0] + 1, 0].tolist(), out_ref[:out_sizes[0] + 1, 0].tolist())
+
+
+def test_search_compact_finished_batch_entries():
+  from TFNetworkRecLayer import _SubnetworkRecCell
+  beam_size = 3
+  n_time = 4
+  n_classes = 4
+  n_batch = 2
+  logits = numpy.zeros((n_batch, n_time, n_classes), dtype="float32")
+  # Let the 0 label be the EOS symbol. No length normalization.
+  # Batch entry 0 is like in test_search_no_rec_explicit_early_exit, i.e. it is finished after frame 1.
+  logits[0] = [[-0.1, -3., -4., -9.]] + [[-1., -2., -3., -4.]] * (n_time - 1)
+  # Batch entry 1 never ends.
+  logits[1] = [[-9., -1., -2., -3.]] * n_time
+
+  def run(compact, optimize_move_layers_out=True):
+    """
+    :param bool compact:
+    :param bool optimize_move_layers_out:
+    :return: out (time,batch*beam), out_sizes (batch*beam,), beam scores (batch,beam), num batch entries per step
+    :rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray, list[int])
+    """
+    ChoiceLayer._debug_out = []
+    net_dict = {
+      "data_max": {"class": "reduce", "mode": "max", "axes": "T", "from": ["data"]},
+      "output": {
+        "class": "rec", "from": ["data"], "max_seq_len": n_time,
+        "compact_finished_batch_entries": compact, "optimize_move_layers_out": optimize_move_layers_out,
+        "unit": {
+          # Layers from outside of the loop. Without effect on the scores.
+          "zero_from_time": {
+            "class": "reduce", "mode": "max", "axes": "T", "from": ["base:data"]},  # uses the seq lens
+          "zero": {
+            "class": "eval", "from": ["zero_from_time", "base:data_max"], "eval": "(source(0) + source(1)) * 0."},
+          "scores": {"class": "combine", "kind": "add", "from": ["data:source", "zero"]},
+          "output": {
+            "class": "choice", "from": ["scores"], "input_type": "log_prob",
+            "explicit_search_source": "prev:output", 'initial_output': 0,
+            "beam_size": beam_size, "length_normalization": False, "early_exit_end_label": 0,
+            "target": "classes"},
+          "end": {"class": "compare", "from": ["output"], "value": 0}
+        }}
+    }
+    extern_data = ExternData({
+      "data": {"dim": n_classes},
+      "classes": {"dim": n_classes, "sparse": True, "available_for_inference": False}})
+    with make_scope() as session:
+      net = TFNetwork(
+        extern_data=extern_data, search_flag=True, train_flag=False, eval_flag=False)
+      net.construct_from_dict(net_dict)
+      rec_layer = net.layers["output"]
+      assert isinstance(rec_layer.cell, _SubnetworkRecCell)
+      feed_dict = {
+        net.extern_data.data["data"].placeholder: logits,
+        net.extern_data.data["data"].size_placeholder[0]: [n_time] * n_batch}
+      out, out_sizes, beam_scores = session.run(
+        (rec_layer.output.placeholder, rec_layer.output.get_sequence_lengths(),
+         rec_layer.get_search_choices().beam_scores),
+        feed_dict=feed_dict)
+    num_batch_entries = [step["labels"].shape[0] for step in ChoiceLayer._debug_out]
+    ChoiceLayer._debug_out = None
+    print("compact %r, optimize_move_layers_out %r, output %r, seq lens %r, scores %r, batch entries %r" % (
+      compact, optimize_move_layers_out, out.tolist(), out_sizes.tolist(), beam_scores.tolist(), num_batch_entries))
+    return out, out_sizes, beam_scores, num_batch_entries
+
+  out_ref, out_sizes_ref, beam_scores_ref, num_batch_entries_ref = run(compact=False)
+  assert_equal(num_batch_entries_ref, [n_batch] * n_time)
+  for optimize_move_layers_out in [True, False]:
+    out, out_sizes, beam_scores, num_batch_entries = run(
+      compact=True, optimize_move_layers_out=optimize_move_layers_out)
+    # Batch entry 0 is not computed anymore after frame 1.
+    assert_equal(num_batch_entries, [2, 2, 1, 1])
+    # All the hyps which are not pruned are the same.
+    for b in range(n_batch):
+      for i in range(beam_size):
+        if beam_scores_ref[b, i] == float("-inf"):
+          assert_equal(beam_scores[b, i], float("-inf"))
+          continue
+        j = b * beam_size + i
+        numpy.testing.assert_allclose(beam_scores[b, i], beam_scores_ref[b, i], rtol=1e-5)
+        assert_equal(out_sizes[j], out_sizes_ref[j])
+        assert_equal(out[:out_sizes[j], j].tolist(), out_ref[:out_sizes[j], j].tolist())
+
+
 def test_search_multi_choice():
   """
   This is a complex test, which defines a rec layer with multiple search choices (:class:`ChoiceLayer`),
@@ -3051,6 +3195,70 @@ def test_reclayer_optimize_out_selfatt_left():
     "class": "self_attention", "attention_left_only": True, "num_heads": 2, "total_key_dim": 6, "n_out": 18})
 
 
+def test_reclayer_optimize_out_selfatt_left_preallocated_kv_cache():
+  # Small initial buffer, such that it needs to grow inside the loop.
+  check_reclayer_optimize_out({
+    "class": "self_attention", "attention_left_only": True, "num_heads": 2, "total_key_dim": 6, "n_out": 18,
+    "preallocated_kv_cache": 1})
+
+
+def test_reclayer_selfatt_preallocated_kv_cache_search():
+  # With beam search, only the kv_ptr of the hyps are reordered, while k_buf/v_buf are not.
+  n_src_dim, n_tgt_dim = 5, 7
+  n_batch, n_time, beam_size = 3, 4, 3
+
+  def get_rec_layer_dict(preallocated_kv_cache):
+    """
+    :param int|None preallocated_kv_cache:
+    :rtype: dict[str]
+    """
+    return {"class": "rec", "from": [], "target": "classes", "max_seq_len": 10, "unit": {
+      "embed": {"class": "linear", "activation": None, "from": ["prev:output"], "n_out": 6},
+      "in": {"class": "combine", "kind": "add", "from": ["embed", "base:enc_mean"]},
+      "att": {
+        "class": "self_attention", "from": ["in"], "num_heads": 2, "total_key_dim": 6, "n_out": 6,
+        "attention_left_only": True, "preallocated_kv_cache": preallocated_kv_cache},
+      "output_prob": {"class": "softmax", "from": ["att"], "target": "classes", "loss": "ce"},
+      "output": {
+        "class": "choice", "target": "classes", "beam_size": beam_size, "from": ["output_prob"],
+        "initial_output": 0},
+      "end": {"class": "compare", "from": ["output"], "value": 0}}}
+
+  with make_scope() as session:
+    config = Config({"debug_print_layer_output_template": True})
+    extern_data = ExternData({
+      "data": {"dim": n_src_dim},
+      "classes": {"dim": n_tgt_dim, "sparse": True, "available_for_inference": False}})
+    net = TFNetwork(extern_data=extern_data, search_flag=True, train_flag=False, eval_flag=False, config=config)
+    net.construct_from_dict({
+      "enc": {"class": "linear", "activation": "tanh", "from": ["data"], "n_out": 6},
+      "enc_mean": {"class": "reduce", "mode": "mean", "axes": "T", "from": ["enc"]},
+      # Small initial buffer, such that it needs to grow inside the loop.
+      "dec_kv_cache": get_rec_layer_dict(preallocated_kv_cache=2),
+      "dec_kv_left": get_rec_layer_dict(preallocated_kv_cache=None)})
+    net.initialize_params(session=session)
+    net.layers["dec_kv_left"].set_param_values_by_dict(
+      values_dict=net.layers["dec_kv_cache"].get_param_values_dict(session=session), session=session)
+    fetches = {}
+    for name in ["dec_kv_cache", "dec_kv_left"]:
+      layer = net.layers[name]
+      assert_equal(layer.output.beam.beam_size, beam_size)
+      fetches[name] = (
+        layer.output.get_placeholder_as_batch_major(), layer.output.get_sequence_lengths(),
+        layer.get_search_choices().beam_scores)
+    out = session.run(fetches, feed_dict={
+      extern_data.data["data"].placeholder: numpy.random.RandomState(42).normal(size=(n_batch, n_time, n_src_dim)),
+      extern_data.data["data"].size_placeholder[0]: [n_time, n_time - 1, 2]})
+    (out1, seq_lens1, scores1), (out2, seq_lens2, scores2) = out["dec_kv_cache"], out["dec_kv_left"]
+    print("hyps:", out1, "seq lens:", seq_lens1, "scores:", scores1)
+    assert_equal(scores1.shape, (n_batch, beam_size))
+    assert_equal(seq_lens1.tolist(), seq_lens2.tolist())
+    assert_equal(out1.shape, out2.shape)
+    for b in range(n_batch * beam_size):
+      assert_equal(out1[b, :seq_lens1[b]].tolist(), out2[b, :seq_lens2[b]].tolist())
+    assert_allclose(scores1, scores2, rtol=1e-5)
+
+
 def test_reclayer_optimize_out_dot():
   # Used for multi-head dot-attention.
   AttNumHeads = 4
@@ -1595,6 +1595,31 @@ def test_CustomGradient_generic_loss_and_error_signal_post_func():
       assert_equal(session.run([z, x, grad_z]), [4., 5., 6.])
 
 
+def test_allreduce_bucketed():
+  calls = []
+
+  def allreduce_func(x):
+    calls.append(x)
+    return x + x
+
+  with tf.name_scope("test_allreduce_bucketed"):
+    xs = [
+      tf.constant(numpy.arange(6, dtype="float32").reshape((2, 3))), None,
+      tf.constant([1., 2.]), tf.constant(3.), tf.constant([4, 5])]
+    ys = allreduce_bucketed(xs, allreduce_func=allreduce_func, max_bucket_bytes=1024)
+    assert ys[1] is None
+    assert_equal(len(calls), 2)  # float32 and int32 bucket
+    for x, y in zip(xs, ys):
+      if x is not None:
+        assert_equal(y.get_shape().as_list(), x.get_shape().as_list())
+    xs_v, ys_v = session.run(([x for x in xs if x is not None], [y for y in ys if y is not None]))
+    for x_v, y_v in zip(xs_v, ys_v):
+      numpy.testing.assert_equal(y_v, x_v * 2)
+    del calls[:]
+    allreduce_bucketed(xs, allreduce_func=allreduce_func, max_bucket_bytes=16)
+    assert_equal(len(calls), 3)  # (2,3) alone, (2,) and () together, int32 alone
+
+
 def test_global_tensor():
   class C:
     i = 0
@@ -1856,6 +1881,22 @@ def test_tile_transposed():
     assert_equal(list(r[:, beam]), [1, 2, 3])
 
 
+def test_gather_scatter_batch_entries():
+  batch_size = 3
+  beam_size = 2
+  x = numpy.arange(batch_size * beam_size * 4).reshape((4, batch_size * beam_size))  # (time,batch*beam)
+  batch_idx = tf.constant([0, 2])
+  y = gather_batch_entries(tf.constant(x), batch_idx=batch_idx, batch_dim=batch_size, axis=1)
+  assert_equal(y.get_shape().as_list(), [4, None])
+  y_ = session.run(y)
+  assert_equal(y_.tolist(), x[:, [0, 1, 4, 5]].tolist())
+  z = scatter_batch_entries(y_ + 100, batch_idx=batch_idx, batch_dim=batch_size, default=tf.constant(x), axis=1)
+  z_ = session.run(z)
+  assert_equal(z_.tolist(), numpy.concatenate([x[:, :2] + 100, x[:, 2:4], x[:, 4:] + 100], axis=1).tolist())
+  z = scatter_batch_entries(tf.constant(y_ > 0), batch_idx=batch_idx, batch_dim=batch_size, axis=1)
+  assert_equal(session.run(z).tolist(), numpy.concatenate([x[:, :2] > 0, x[:, 2:4] < 0, x[:, 4:] > 0], axis=1).tolist())
+
+
 def test_expand_dims_unbroadcast_instead_of_tf_tile():
   batch_size = 3
   beam_size = 5
@@ -181,6 +181,35 @@ def test_NativeCodeCompiler():
   assert_equal(lib.get_magic(), 42)
 
 
+def test_NativeCodeCompiler_shared_cache():
+  import tempfile
+  import shutil
+  code = "extern \"C\" int get_magic() { return 17; }\n"
+  native = NativeCodeCompiler(base_name="test_NativeCodeCompiler_shared_cache", code_version=1, code=code)
+  own_mod_path = native._mod_path
+  native.get_lib_filename()
+  shared_cache_dir = tempfile.mkdtemp()
+  try:
+    # Like tools/compile_native_op.py --shared_cache_dir.
+    rel_mod_path = os.path.relpath(own_mod_path, native.cache_dir)
+    shutil.copytree(own_mod_path, "%s/%s/%s" % (shared_cache_dir, native.CacheDirName, rel_mod_path))
+    shutil.rmtree(own_mod_path)
+    NativeCodeCompiler.SharedCacheDir = shared_cache_dir
+    native = NativeCodeCompiler(base_name="test_NativeCodeCompiler_shared_cache", code_version=1, code=code)
+    import ctypes
+    lib = native.load_lib_ctypes()
+    lib.get_magic.restype = ctypes.c_int
+    assert_equal(lib.get_magic(), 17)
+    assert native.get_lib_filename().startswith(shared_cache_dir + "/")
+    assert not os.path.exists(own_mod_path)  # not compiled again
+    # Different code, not in the shared cache, thus compiled as usual.
+    native = NativeCodeCompiler(base_name="test_NativeCodeCompiler_shared_cache", code_version=2, code=code)
+    assert not native.get_lib_filename().startswith(shared_cache_dir + "/")
+  finally:
+    NativeCodeCompiler.SharedCacheDir = None
+    shutil.rmtree(shared_cache_dir)
+
+
 def test_Stats():
   rnd = numpy.random.RandomState(42)
   m = rnd.uniform(-2., 10., (1000, 3))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""
+Prebuilds the feature cache (see :class:`GeneratingDataset.FeatureCacheFile`) of a dataset,
+e.g. of :class:`GeneratingDataset.OggZipDataset` with the ``feature_cache`` option,
+by going once through all the seqs.
+Then the training does not need to extract the features at all.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+returnn_dir = os.path.dirname(my_dir)
+sys.path.append(returnn_dir)
+
+import rnn
+from Log import log
+import argparse
+from Dataset import init_dataset
+import Util
+
+
+def build_feature_cache(dataset, options):
+  """
+  :param Dataset.Dataset dataset:
+  :param options: argparse.Namespace
+  """
+  dataset.init_seq_order(epoch=options.epoch)
+  start_time = time.time()
+  seq_idx = 0
+  while dataset.is_less_than_num_seqs(seq_idx):
+    dataset.load_seqs(seq_idx, seq_idx + 1)
+    complete_frac = dataset.get_complete_frac(seq_idx)
+    Util.progress_bar_with_time(complete_frac, prefix="%i seqs" % (seq_idx + 1))
+    seq_idx += 1
+  print("Done. %i seqs, total time %s." % (seq_idx, Util.hms(time.time() - start_time)), file=log.v2)
+
+
+def get_dataset_dict(config_str, config_dataset):
+  """
+  :param str config_str: either filename to config-file, or dict for dataset
+  :param str|None config_dataset:
+  :rtype: dict[str]
+  """
+  if config_str.strip().startswith("{"):
+    assert not config_dataset
+    return eval(config_str.strip())
+  rnn.init_config(config_filename=config_str, default_config={"cache_size": "0"})
+  dataset_dict = rnn.config.typed_value(config_dataset or "train")
+  assert isinstance(dataset_dict, dict), "dataset %r in config must be a dict" % (config_dataset or "train")
+  return dataset_dict
+
+
+def main():
+  argparser = argparse.ArgumentParser(description='Prebuild the feature cache of a dataset.')
+  argparser.add_argument('crnn_config', help="either filename to config-file, or dict for dataset")
+  argparser.add_argument("--dataset", help="if given the config, specifies the dataset. e.g. 'dev'")
+  argparser.add_argument("--feature_cache", help="cache filename. overwrites the dataset option")
+  argparser.add_argument("--max_size", type=int, help="max cache size in bytes")
+  argparser.add_argument('--epoch', type=int, default=1)
+  argparser.add_argument("--num_workers", type=int, default=1, help="uses MultiProcDataset if >1")
+  argparser.add_argument("--verbosity", type=int, default=4, help="overwrites log_verbosity (default: 4)")
+  args = argparser.parse_args()
+  rnn.init_better_exchook()
+  log.initialize(verbosity=[args.verbosity])
+  dataset_dict = get_dataset_dict(config_str=args.crnn_config, config_dataset=args.dataset)
+  dataset_dict = dataset_dict.copy()
+  if args.feature_cache:
+    dataset_dict["feature_cache"] = {"filename": args.feature_cache, "max_size": args.max_size}
+  assert dataset_dict.get("feature_cache"), "specify the feature_cache, either in the dataset or via --feature_cache"
+  # We want to go through all seqs, in a deterministic order.
+  dataset_dict["seq_ordering"] = "default"
+  dataset_dict.pop("partition_epoch", None)
+  dataset_dict.pop("epoch_wise_filter", None)
+  if args.num_workers > 1:
+    dataset_dict = {"class": "MultiProcDataset", "dataset": dataset_dict, "num_workers": args.num_workers}
+  print("Using dataset %r." % dataset_dict, file=log.v3)
+  dataset = init_dataset(dataset_dict)
+  try:
+    build_feature_cache(dataset, args)
+  except KeyboardInterrupt:
+    print("KeyboardInterrupt")
+    sys.exit(1)
+  feature_cache = getattr(dataset, "feature_cache", None)
+  if feature_cache:
+    print("%s: %s" % (feature_cache, feature_cache.get_stats_str()), file=log.v2)
+
+
+if __name__ == '__main__':
+  main()
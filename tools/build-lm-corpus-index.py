@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+"""
+Builds the binary index for txt corpus files,
+such that :class:`LmDataset` with ``corpus_index=True`` can access them without reading the whole corpus.
+See :func:`LmDataset.build_txt_corpus_index`.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+returnn_dir = os.path.dirname(my_dir)
+sys.path.append(returnn_dir)
+
+import better_exchook
+from LmDataset import build_txt_corpus_index
+from Util import hms
+
+
+def main():
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument("corpus_files", nargs="+", help="txt corpus files (not compressed)")
+  argparser.add_argument("--output", help="index filename. only for a single corpus file. default: <corpus>.index.npy")
+  args = argparser.parse_args()
+  if args.output:
+    assert len(args.corpus_files) == 1, "--output only for a single corpus file"
+  for corpus_file in args.corpus_files:
+    start_time = time.time()
+    print("Building index for %r ..." % corpus_file)
+    index_filename = build_txt_corpus_index(corpus_file, index_filename=args.output)
+    print("Wrote %r, took %s." % (index_filename, hms(time.time() - start_time)))
+
+
+if __name__ == '__main__':
+  better_exchook.install()
+  try:
+    main()
+  except KeyboardInterrupt:
+    print("KeyboardInterrupt")
+    sys.exit(1)
@@ -6,6 +6,7 @@ from __future__ import print_function
 import os
 import sys
 import time
+import multiprocessing
 import tensorflow as tf
 import numpy
 
@@ -45,6 +46,12 @@ def init(config_filename, log_verbosity):
   assert Util.BackendEngine.is_tensorflow_selected(), "this is only for TensorFlow"
   rnn.init_faulthandler()
   rnn.init_config_json_network()
+
+
+def construct_network():
+  """
+  Constructs the network from the config, which will compile (or load) all the native ops it needs.
+  """
   if 'network' in config.typed_dict:
     print("Loading network")
     from TFNetwork import TFNetwork
@@ -58,6 +65,140 @@ def init(config_filename, log_verbosity):
     network.construct_from_dict(config.typed_dict["network"])
 
 
+def get_native_op_names(names=None, all_ops=False, network=None):
+  """
+  :param list[str]|None names: explicit op names, e.g. ["NativeLstm2"]
+  :param bool all_ops: all ops from NativeOp
+  :param dict[str]|None network: net dict from the config. we take all ops which are referred to by name
+    (case-insensitive, e.g. ``"unit": "nativelstm2"``).
+    Ops which are used in some other way will only be compiled afterwards, in the network construction.
+  :rtype: list[str]
+  """
+  import NativeOp
+  available = sorted([
+    name for (name, cls) in vars(NativeOp).items()
+    if isinstance(cls, type) and issubclass(cls, NativeOp.NativeOpGenBase) and cls is not NativeOp.NativeOpGenBase])
+  res = list(names or [])
+  if all_ops:
+    res += available
+  if network:
+    strs = set()
+
+    def _collect(d):
+      if isinstance(d, dict):
+        for v in d.values():
+          _collect(v)
+      elif isinstance(d, (list, tuple)):
+        for v in d:
+          _collect(v)
+      elif isinstance(d, str):
+        strs.add(d.lower())
+
+    _collect(network)
+    res += [name for name in available if name.lower() in strs]
+  for name in res:
+    assert name in available, "unknown native op %r, available: %r" % (name, available)
+  return sorted(set(res))
+
+
+def compile_native_op_worker(op_name, grad, shared_cache_dir, blas_lib, search_for_numpy_blas):
+  """
+  Runs in a subprocess, see :func:`compile_native_ops_parallel`.
+
+  :param str op_name: e.g. "NativeLstm2"
+  :param bool grad: the gradient op (nothing to do if the op does not define it)
+  :param str|None shared_cache_dir: reuse prebuilt libs from there
+  :param str|None blas_lib:
+  :param bool search_for_numpy_blas:
+  :return: (op name, grad, error or None)
+  :rtype: (str,bool,str|None)
+  """
+  import NativeOp
+  from TFUtil import NativeCodeCompiler
+  from TFNativeOp import OpMaker, OpDescription
+  NativeCodeCompiler.SharedCacheDir = shared_cache_dir
+  error = None
+  # noinspection PyBroadException
+  try:
+    description = OpDescription.from_gen_base(getattr(NativeOp, op_name))
+    if grad:
+      description = description.grad()  # None if not defined
+    if description:
+      maker = OpMaker(
+        description=description, search_for_numpy_blas=search_for_numpy_blas, blas_lib=blas_lib)
+      # noinspection PyProtectedMember
+      maker._make_mod()
+  except Exception:
+    import traceback
+    error = traceback.format_exc()
+  return op_name, grad, error
+
+
+def compile_native_ops_parallel(op_names, num_jobs, shared_cache_dir, blas_lib, search_for_numpy_blas):
+  """
+  Compiles the ops (forward and gradient each) in parallel, each in its own subprocess.
+  The libs end up in the usual cache dir (or are reused from the shared cache dir),
+  i.e. the following :func:`TFNativeOp.make_op` calls in this process will not need to compile anymore.
+
+  :param list[str] op_names:
+  :param int num_jobs:
+  :param str|None shared_cache_dir:
+  :param str|None blas_lib:
+  :param bool search_for_numpy_blas:
+  :return: op names which failed
+  :rtype: list[str]
+  """
+  tasks = [(op_name, grad) for op_name in op_names for grad in (False, True)]
+  print("Compile %i native ops (forward and gradient) with %i jobs." % (len(op_names), num_jobs))
+  start_time = time.time()
+  if hasattr(multiprocessing, "get_context"):
+    # Use spawn, not fork, as we might have initialized TF already.
+    pool = multiprocessing.get_context("spawn").Pool(processes=num_jobs)
+  else:  # Python 2, no get_context, only fork
+    pool = multiprocessing.Pool(processes=num_jobs)
+  results = [
+    pool.apply_async(
+      compile_native_op_worker, (op_name, grad, shared_cache_dir, blas_lib, search_for_numpy_blas))
+    for (op_name, grad) in tasks]
+  errors = []
+  for res in results:
+    op_name, grad, error = res.get()
+    if error:
+      print("Error for %s%s:" % (op_name, " (grad)" if grad else ""))
+      print(error)
+      errors.append(op_name)
+  pool.close()
+  pool.join()
+  print("Compiled in %s." % hms(time.time() - start_time))
+  return sorted(set(errors))
+
+
+def copy_to_shared_cache(compiler, shared_cache_dir):
+  """
+  Copies the lib dir, with the same layout as in the own cache dir,
+  such that :func:`NativeCodeCompiler._maybe_use_shared_cache` finds it.
+
+  :param NativeCodeCompiler compiler:
+  :param str shared_cache_dir:
+  """
+  import shutil
+  # noinspection PyProtectedMember
+  mod_path = compiler._mod_path
+  target = "%s/%s/%s" % (shared_cache_dir, compiler.CacheDirName, os.path.relpath(mod_path, compiler.cache_dir))
+  if os.path.abspath(mod_path) == os.path.abspath(target):
+    return  # this was already used from the shared cache
+  if os.path.exists(target):
+    print("Exists already in shared cache:", target)
+    return
+  if not os.path.exists(os.path.dirname(target)):
+    os.makedirs(os.path.dirname(target))
+  # Copy to a tmp dir first, such that other jobs never see an incomplete dir.
+  tmp_target = "%s.tmp.%i" % (target, os.getpid())
+  shutil.copytree(mod_path, tmp_target, ignore=shutil.ignore_patterns("lock_file"))
+  os.rename(tmp_target, target)
+  print("Copied to shared cache:", target)
+
+
 def main(argv):
   from TFUtil import CudaEnv, NativeCodeCompiler
   CudaEnv.verbose_find_cuda = True
@@ -65,7 +206,14 @@ def main(argv):
 
   argparser = argparse.ArgumentParser(description='Compile some op')
   argparser.add_argument('--config', help="filename to config-file")
-  argparser.add_argument('--native_op', help="op name. e.g. 'LstmGenericBase'")
+  argparser.add_argument('--native_op', help="op name(s), comma-separated. e.g. 'LstmGenericBase'")
+  argparser.add_argument('--all_native_ops', action='store_true', help="compile all ops from NativeOp")
+  argparser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                         help="number of parallel compile processes (default: num CPUs)")
+  argparser.add_argument('--shared_cache_dir',
+                         help="copy the libs into this (shared) cache dir. "
+                              "use it via the config option native_shared_cache_dir "
+                              "or the env var RETURNN_NATIVE_SHARED_CACHE_DIR")
   argparser.add_argument('--blas_lib', default=None,
                          help="specify which blas lib to use (path to .so or file name to search for)")
   argparser.add_argument('--search_for_numpy_blas', dest='search_for_numpy_blas', action='store_true',
@@ -76,13 +224,29 @@ def main(argv):
   argparser.add_argument("--output_file", help='if given, will write the list of libs to this file')
   args = argparser.parse_args(argv[1:])
   init(config_filename=args.config, log_verbosity=args.verbosity)
+  if args.shared_cache_dir:
+    # Reuse what is already there.
+    NativeCodeCompiler.SharedCacheDir = args.shared_cache_dir
 
   import NativeOp
   from TFNativeOp import make_op, OpMaker
-  if args.native_op:
-    print("Loading native op %r" % args.native_op)
-    make_op(getattr(NativeOp, args.native_op), compiler_opts={"verbose": True},
+  op_names = get_native_op_names(
+    names=args.native_op.split(",") if args.native_op else None, all_ops=args.all_native_ops,
+    network=config.typed_dict.get("network", None))
+  failed_op_names = []
+  if op_names:
+    failed_op_names = compile_native_ops_parallel(
+      op_names=op_names, num_jobs=args.jobs, shared_cache_dir=NativeCodeCompiler.SharedCacheDir,
+      blas_lib=args.blas_lib, search_for_numpy_blas=args.search_for_numpy_blas)
+  # Now all should be in the cache. This also collects the compilers.
+  for op_name in op_names:
+    if op_name in failed_op_names:
+      continue
+    print("Loading native op %r" % op_name)
+    make_op(getattr(NativeOp, op_name), compiler_opts={"verbose": True},
             search_for_numpy_blas=args.search_for_numpy_blas, blas_lib=args.blas_lib)
+  # This will compile the remaining ops, which are used by the network but were not found by name.
+  construct_network()
 
   libs = []
   if OpMaker.with_cuda and OpMaker.tf_blas_gemm_workaround:
@@ -103,12 +267,20 @@ def main(argv):
   else:
     print("no libs compiled. use --native_op or --config")
 
+  if args.shared_cache_dir:
+    for compiler in NativeCodeCompiler.CollectedCompilers:
+      copy_to_shared_cache(compiler, shared_cache_dir=args.shared_cache_dir)
+
   if args.output_file:
     with open(args.output_file, "w") as f:
       for fn in libs:
         f.write(fn + '\n')
     print("Wrote lib list to file:", args.output_file)
 
+  if failed_op_names:
+    print("Failed native ops:", ", ".join(failed_op_names))
+    sys.exit(1)
+
 
 if __name__ == '__main__':
   main(sys.argv)
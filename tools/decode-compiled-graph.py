@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Decodes a dataset with the step-by-step graph compiled via ``compile_tf_graph.py --rec_step_by_step ...``,
+using :class:`TFCompiledGraphDecoder.CompiledGraphDecoder`, and reports the throughput and latency.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+returnn_dir = os.path.dirname(my_dir)
+sys.path.append(returnn_dir)
+
+import better_exchook
+from Log import log
+from Dataset import init_dataset
+from Util import hms
+
+
+def iterate_dataset(dataset, key, num_seqs=None):
+  """
+  :param Dataset.Dataset dataset:
+  :param str key:
+  :param int|None num_seqs:
+  :return: yields (seq tag, data)
+  """
+  dataset.init_seq_order(epoch=1)
+  seq_idx = 0
+  while dataset.is_less_than_num_seqs(seq_idx) and (num_seqs is None or seq_idx < num_seqs):
+    dataset.load_seqs(seq_idx, seq_idx + 1)
+    yield dataset.get_tag(seq_idx), dataset.get_data(seq_idx, key)
+    seq_idx += 1
+
+
+def main():
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument("--graph", required=True, help="compiled TF graph (pb, pbtxt, meta, metatxt)")
+  argparser.add_argument("--chkpt", required=True, help="TF checkpoint (model params)")
+  argparser.add_argument("--rec_step_by_step_json", required=True)
+  argparser.add_argument("--dataset", required=True, help="dataset dict, e.g. \"{'class': 'HDFDataset', ...}\"")
+  argparser.add_argument("--key", default="data", help="data-key of the encoder input (default: 'data')")
+  argparser.add_argument("--num_seqs", type=int, help="only decode the first n seqs")
+  argparser.add_argument("--beam_size", type=int, default=12)
+  argparser.add_argument("--max_batch_size", type=int, default=32, help="max num of seqs in flight")
+  argparser.add_argument("--max_seq_len", type=int, default=100)
+  argparser.add_argument("--max_seq_len_factor", type=float)
+  argparser.add_argument("--no_length_normalization", action="store_true")
+  argparser.add_argument("--continuous_batching", type=int, help="0 or 1. default: if safe for the graph")
+  argparser.add_argument("--output", help="write the best hyp per seq to this file (seq tag, score, labels)")
+  argparser.add_argument("--verbosity", type=int, default=4)
+  args = argparser.parse_args()
+  log.initialize(verbosity=[args.verbosity])
+  from TFCompiledGraphDecoder import CompiledGraphDecoder
+  decoder = CompiledGraphDecoder(
+    graph_filename=args.graph, checkpoint_filename=args.chkpt, rec_step_by_step_json=args.rec_step_by_step_json,
+    beam_size=args.beam_size, max_batch_size=args.max_batch_size, data_key=args.key,
+    max_seq_len=args.max_seq_len, max_seq_len_factor=args.max_seq_len_factor,
+    length_normalization=not args.no_length_normalization,
+    continuous_batching=bool(args.continuous_batching) if args.continuous_batching is not None else None)
+  dataset = init_dataset(args.dataset)
+  seq_tags = []
+
+  def get_inputs():
+    """
+    :return: yields the encoder inputs, and collects the seq tags
+    """
+    for seq_tag, data in iterate_dataset(dataset, key=args.key, num_seqs=args.num_seqs):
+      seq_tags.append(seq_tag)
+      yield data
+
+  out_file = open(args.output, "w") if args.output else None
+  start_time = time.time()
+  for idx, hyps in decoder.decode_iter(get_inputs()):
+    score, seq = hyps[0]
+    print("seq %i %r: score %.3f, %r" % (idx, seq_tags[idx], score, seq), file=log.v4)
+    if out_file:
+      out_file.write("%s\t%f\t%s\n" % (seq_tags[idx], score, " ".join(map(str, seq))))
+  if out_file:
+    out_file.close()
+  print("Decoded %i seqs, took %s." % (len(seq_tags), hms(time.time() - start_time)))
+  for key, value in sorted(decoder.get_stats().items()):
+    print("  %s: %r" % (key, value))
+  decoder.close()
+
+
+if __name__ == '__main__':
+  better_exchook.install()
+  try:
+    main()
+  except KeyboardInterrupt:
+    print("KeyboardInterrupt")
+    sys.exit(1)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+"""
+Converts the text files of a :class:`LmDataset.TranslationDataset` into the packed binary format,
+which can then be used via ``use_packed=True``.
+See :func:`LmDataset.TranslationDataset.write_packed_data`.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+returnn_dir = os.path.dirname(my_dir)
+sys.path.append(returnn_dir)
+
+import better_exchook
+from Log import log
+from LmDataset import TranslationDataset
+from Util import hms
+
+
+def main():
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument("path", help="directory of the TranslationDataset")
+  argparser.add_argument("file_postfixes", nargs="+", help="e.g. train dev")
+  argparser.add_argument("--source_postfix", default="", help="same as for the TranslationDataset")
+  argparser.add_argument("--target_postfix", default="", help="same as for the TranslationDataset")
+  argparser.add_argument("--source_only", action="store_true")
+  argparser.add_argument("--unknown_label", help="same as for the TranslationDataset")
+  argparser.add_argument("--verbosity", type=int, default=4)
+  args = argparser.parse_args()
+  log.initialize(verbosity=[args.verbosity])
+  for file_postfix in args.file_postfixes:
+    start_time = time.time()
+    dataset = TranslationDataset(
+      path=args.path, file_postfix=file_postfix,
+      source_postfix=args.source_postfix, target_postfix=args.target_postfix,
+      source_only=args.source_only, unknown_label=args.unknown_label)
+    dataset.write_packed_data()
+    print("Packed %r, took %s." % (file_postfix, hms(time.time() - start_time)))
+
+
+if __name__ == '__main__':
+  better_exchook.install()
+  try:
+    main()
+  except KeyboardInterrupt:
+    print("KeyboardInterrupt")
+    sys.exit(1)